@@ -0,0 +1,225 @@
+﻿import heapq
+import itertools
+import logging
+import mmap
+import multiprocessing
+import os
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("NOTIFICACOES")
+
+PRIORIDADE_ALERTA = 0
+PRIORIDADE_ENTRADA = 1
+PRIORIDADE_RESUMO = 2
+NOMES_PRIORIDADE = {PRIORIDADE_ALERTA: "alerta", PRIORIDADE_ENTRADA: "entrada", PRIORIDADE_RESUMO: "resumo"}
+# Balde: (fichas, atualizado em monotonic, iniciado).
+_FORMATO_BALDE = "<ddQ"
+_TAMANHO_BALDE = struct.calcsize(_FORMATO_BALDE)
+_TOTAL_BALDES = 256
+
+
+def _ler_env_inteiro(chave, padrao, minimo=0):
+    try:
+        return max(minimo, int(os.getenv(chave, str(padrao)).strip()))
+    except ValueError:
+        return padrao
+
+
+def separar_destinatarios(destinatarios):
+    if not destinatarios:
+        return []
+    vistos = []
+    for destino in destinatarios.split(","):
+        destino = destino.strip()
+        if destino and destino not in vistos:
+            vistos.append(destino)
+    return vistos
+
+
+class BaldesCompartilhados:
+    # Fichas por destinatário num mmap anônimo criado antes do fork: os
+    # workers (WEBHOOK_WORKERS) dividem o mesmo limite em vez de cada um ter
+    # o seu. O destinatário vai para um balde pelo hash do nome; dois
+    # destinatários no mesmo balde só deixam o limite mais estrito.
+    def __init__(self, total=_TOTAL_BALDES):
+        self._mapa = mmap.mmap(-1, total * _TAMANHO_BALDE)
+        self._lock = multiprocessing.Lock()
+        self.total = total
+
+    def _posicao(self, nome):
+        return zlib.crc32(nome.encode("utf-8")) % self.total * _TAMANHO_BALDE
+
+    def _ler(self, posicao, capacidade, taxa, agora):
+        fichas, atualizado, iniciado = struct.unpack_from(_FORMATO_BALDE, self._mapa, posicao)
+        if not iniciado:
+            return float(capacidade)
+        # CLOCK_MONOTONIC é o mesmo para todos os processos do host.
+        return min(capacidade, fichas + max(0.0, agora - atualizado) * taxa)
+
+    def consumir(self, nome, necessarias, capacidade, taxa):
+        # Tira uma ficha se houver `necessarias`; senão devolve a espera.
+        posicao = self._posicao(nome)
+        agora = time.monotonic()
+        with self._lock:
+            fichas = self._ler(posicao, capacidade, taxa, agora)
+            if fichas >= necessarias:
+                fichas -= 1
+                espera = None
+            else:
+                espera = (necessarias - fichas) / taxa
+            struct.pack_into(_FORMATO_BALDE, self._mapa, posicao, fichas, agora, 1)
+        return espera
+
+    def fichas(self, nome, capacidade, taxa):
+        with self._lock:
+            return self._ler(self._posicao(nome), capacidade, taxa, time.monotonic())
+
+
+class _Destinatario:
+    __slots__ = ("nome", "fila", "ocupado", "enviadas", "descartadas")
+
+    def __init__(self, nome):
+        self.nome = nome
+        # heap de (prioridade, sequência, mensagem, imagem, enfileirada_em)
+        self.fila = []
+        self.ocupado = False
+        self.enviadas = 0
+        self.descartadas = 0
+
+
+class AgendadorNotificacoes:
+    # Cada destinatário tem sua fila por prioridade e um balde de fichas
+    # (WHATSAPP_ENVIOS_POR_MINUTO, rajada de WHATSAPP_RAJADA). Destinatários
+    # diferentes são atendidos em paralelo; o mesmo destinatário recebe uma
+    # mensagem por vez, na ordem da fila. Entradas e resumos só consomem
+    # fichas acima de WHATSAPP_RESERVA_ALERTAS, que fica para os alertas.
+    # Com `baldes` compartilhados, o limite vale para todos os workers.
+    def __init__(self, enviar, baldes=None):
+        self.enviar = enviar
+        self.baldes = baldes if baldes is not None else BaldesCompartilhados()
+        self.por_minuto = _ler_env_inteiro("WHATSAPP_ENVIOS_POR_MINUTO", 12, minimo=1)
+        self.rajada = _ler_env_inteiro("WHATSAPP_RAJADA", 3, minimo=1)
+        self.reserva = min(_ler_env_inteiro("WHATSAPP_RESERVA_ALERTAS", 1), self.rajada - 1)
+        self.paralelos = _ler_env_inteiro(
+            "WHATSAPP_ENVIOS_PARALELOS", _ler_env_inteiro("WHATSAPP_CONEXOES_MAXIMAS", 4, minimo=1), minimo=1
+        )
+        self.fila_maxima = _ler_env_inteiro("WHATSAPP_FILA_MAXIMA", 200, minimo=1)
+        self.taxa = self.por_minuto / 60.0
+
+        self._destinatarios = {}
+        self._sequencia = itertools.count()
+        self._condicao = threading.Condition()
+        self._executor = None
+        self._thread = None
+        self.falhas = 0
+
+    def _destinatario(self, nome):
+        destinatario = self._destinatarios.get(nome)
+        if destinatario is None:
+            destinatario = self._destinatarios[nome] = _Destinatario(nome)
+        return destinatario
+
+    def enfileirar(self, mensagem, destinatarios, caminho_imagem=None, prioridade=PRIORIDADE_ENTRADA):
+        lista = separar_destinatarios(destinatarios)
+        if not lista:
+            return 0
+        self._iniciar()
+        agora = time.monotonic()
+        with self._condicao:
+            for nome in lista:
+                destinatario = self._destinatario(nome)
+                item = (prioridade, next(self._sequencia), mensagem, caminho_imagem, agora)
+                if len(destinatario.fila) >= self.fila_maxima:
+                    # Fila cheia: sai a mensagem menos prioritária e mais nova.
+                    pior = max(destinatario.fila)
+                    destinatario.descartadas += 1
+                    if pior[:2] < item[:2]:
+                        logger.warning(f"Fila de {nome} cheia: mensagem de {NOMES_PRIORIDADE[prioridade]} descartada")
+                        continue
+                    destinatario.fila.remove(pior)
+                    heapq.heapify(destinatario.fila)
+                    logger.warning(f"Fila de {nome} cheia: mensagem de {NOMES_PRIORIDADE[pior[0]]} descartada")
+                heapq.heappush(destinatario.fila, item)
+            self._condicao.notify()
+        return len(lista)
+
+    def _selecionar(self):
+        # Devolve os envios liberados agora e quanto esperar pelo próximo.
+        liberados = []
+        espera = None
+        for destinatario in self._destinatarios.values():
+            if destinatario.ocupado or not destinatario.fila:
+                continue
+            prioridade = destinatario.fila[0][0]
+            necessarias = 1 if prioridade == PRIORIDADE_ALERTA else 1 + self.reserva
+            faltam = self.baldes.consumir(destinatario.nome, necessarias, self.rajada, self.taxa)
+            if faltam is None:
+                destinatario.ocupado = True
+                liberados.append((destinatario, heapq.heappop(destinatario.fila)))
+            else:
+                espera = faltam if espera is None else min(espera, faltam)
+        return liberados, espera
+
+    def _executar(self):
+        while True:
+            with self._condicao:
+                liberados, espera = self._selecionar()
+                if not liberados:
+                    self._condicao.wait(espera)
+                    continue
+            for destinatario, item in liberados:
+                self._executor.submit(self._enviar, destinatario, item)
+
+    def _enviar(self, destinatario, item):
+        prioridade, _, mensagem, caminho_imagem, enfileirada_em = item
+        try:
+            atraso = time.monotonic() - enfileirada_em
+            if atraso > 60:
+                logger.info(f"{NOMES_PRIORIDADE[prioridade]} para {destinatario.nome} aguardou {atraso:.0f}s na fila")
+            self.enviar(mensagem, destinatario.nome, caminho_imagem)
+            destinatario.enviadas += 1
+        except Exception as exc:
+            self.falhas += 1
+            logger.error(f"Erro ao enviar notificação para {destinatario.nome}: {exc}")
+        finally:
+            with self._condicao:
+                destinatario.ocupado = False
+                self._condicao.notify()
+
+    def _iniciar(self):
+        if self._thread is not None:
+            return
+        with self._condicao:
+            if self._thread is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self.paralelos, thread_name_prefix="notificacao")
+            self._thread = threading.Thread(target=self._executar, daemon=True, name="agendador-notificacoes")
+            self._thread.start()
+
+    def pendentes(self):
+        with self._condicao:
+            return sum(len(destinatario.fila) + destinatario.ocupado for destinatario in self._destinatarios.values())
+
+    def estado(self):
+        with self._condicao:
+            destinatarios = {
+                destinatario.nome: {
+                    "pendentes": len(destinatario.fila),
+                    "fichas": round(self.baldes.fichas(destinatario.nome, self.rajada, self.taxa), 2),
+                    "enviadas": destinatario.enviadas,
+                    "descartadas": destinatario.descartadas,
+                }
+                for destinatario in self._destinatarios.values()
+            }
+        return {
+            "envios_por_minuto": self.por_minuto,
+            "rajada": self.rajada,
+            "reserva_alertas": self.reserva,
+            "paralelos": self.paralelos,
+            "falhas": self.falhas,
+            "destinatarios": destinatarios,
+        }
@@ -0,0 +1,368 @@
+﻿import argparse
+import logging
+import mimetypes
+import os
+import posixpath
+import shutil
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+logger = logging.getLogger("ARMAZENAMENTO")
+
+mimetypes.add_type("image/webp", ".webp")
+mimetypes.add_type("image/avif", ".avif")
+
+CACHE_CONTROL_CAPTURAS = "public, max-age=31536000, immutable"
+
+
+def _ler_env_inteiro(chave, padrao, minimo=0):
+    try:
+        return max(minimo, int(os.getenv(chave, str(padrao)).strip()))
+    except ValueError:
+        return padrao
+
+
+def tipo_conteudo(relativo):
+    return mimetypes.guess_type(relativo)[0] or "application/octet-stream"
+
+
+def etag_captura(relativo):
+    return posixpath.splitext(posixpath.basename(relativo))[0]
+
+
+def chave_valida(relativo):
+    partes = relativo.replace("\\", "/").split("/")
+    return bool(relativo) and not relativo.startswith(("/", "\\")) and ".." not in partes
+
+
+class ArmazenamentoLocal:
+    nome = "local"
+
+    def __init__(self, diretorio_static):
+        self.diretorio_static = os.path.realpath(diretorio_static)
+        self.diretorio_temporario = os.path.join(self.diretorio_static, "captures")
+        os.makedirs(self.diretorio_temporario, exist_ok=True)
+
+    def caminho_local(self, relativo):
+        caminho = os.path.realpath(os.path.join(self.diretorio_static, relativo))
+        if not caminho.startswith(self.diretorio_static + os.sep):
+            return None
+        return caminho
+
+    def existe(self, relativo):
+        caminho = self.caminho_local(relativo)
+        return caminho is not None and os.path.isfile(caminho)
+
+    def gravar(self, relativo, caminho_origem):
+        destino = self.caminho_local(relativo)
+        if destino is None:
+            raise ValueError(f"Caminho inválido: {relativo}")
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        os.replace(caminho_origem, destino)
+
+    def abrir(self, relativo):
+        caminho = self.caminho_local(relativo)
+        if caminho is None or not os.path.isfile(caminho):
+            return None
+        return open(caminho, "rb")
+
+    def ler(self, relativo):
+        arquivo = self.abrir(relativo)
+        if arquivo is None:
+            return None
+        with arquivo:
+            return arquivo.read()
+
+    def remover(self, relativo):
+        caminho = self.caminho_local(relativo)
+        if caminho is None:
+            return
+        try:
+            os.remove(caminho)
+        except FileNotFoundError:
+            pass
+
+    def obter_arquivo_local(self, relativo):
+        # Devolve (caminho, temporario); no disco local não há cópia.
+        caminho = self.caminho_local(relativo)
+        if caminho is None or not os.path.isfile(caminho):
+            return None, False
+        return caminho, False
+
+    def url_redirecionamento(self, relativo, expira_segundos=3600):
+        return None
+
+    def estado(self):
+        return {"tipo": self.nome}
+
+
+class ArmazenamentoS3:
+    nome = "s3"
+
+    def __init__(
+        self,
+        bucket,
+        prefixo="",
+        endpoint_url=None,
+        regiao=None,
+        access_key=None,
+        secret_key=None,
+        diretorio_temporario=None,
+        max_conexoes=20,
+        limiar_multipart_mb=8,
+        concorrencia=8,
+        redirecionar=False,
+    ):
+        if boto3 is None:
+            raise RuntimeError("ARMAZENAMENTO=s3 requer o pacote boto3 (pip install boto3)")
+        if not bucket:
+            raise ValueError("S3_BUCKET não definido")
+
+        self.bucket = bucket
+        self.prefixo = prefixo.strip("/") + "/" if prefixo and prefixo.strip("/") else ""
+        self.redirecionar = redirecionar
+        self.diretorio_temporario = diretorio_temporario
+        os.makedirs(diretorio_temporario, exist_ok=True)
+
+        configuracao = Config(
+            max_pool_connections=max_conexoes,
+            retries={"max_attempts": 4, "mode": "standard"},
+            s3={"addressing_style": "path"} if endpoint_url else None,
+        )
+        self.cliente = boto3.session.Session().client(
+            "s3",
+            endpoint_url=endpoint_url or None,
+            region_name=regiao or None,
+            aws_access_key_id=access_key or None,
+            aws_secret_access_key=secret_key or None,
+            config=configuracao,
+        )
+        limiar = limiar_multipart_mb * 1024 * 1024
+        self.transferencia = TransferConfig(
+            multipart_threshold=limiar,
+            multipart_chunksize=limiar,
+            max_concurrency=concorrencia,
+            use_threads=True,
+        )
+
+    def chave(self, relativo):
+        return self.prefixo + relativo.replace("\\", "/")
+
+    def caminho_local(self, relativo):
+        return None
+
+    def existe(self, relativo):
+        try:
+            self.cliente.head_object(Bucket=self.bucket, Key=self.chave(relativo))
+            return True
+        except ClientError as exc:
+            if exc.response.get("Error", {}).get("Code") in {"404", "NoSuchKey", "NotFound"}:
+                return False
+            raise
+
+    def gravar(self, relativo, caminho_origem):
+        # upload_file usa o TransferManager: multipart em partes paralelas
+        # acima do limiar e o pool de conexões compartilhado do cliente.
+        try:
+            self.cliente.upload_file(
+                caminho_origem,
+                self.bucket,
+                self.chave(relativo),
+                ExtraArgs={"ContentType": tipo_conteudo(relativo), "CacheControl": CACHE_CONTROL_CAPTURAS},
+                Config=self.transferencia,
+            )
+        finally:
+            try:
+                os.remove(caminho_origem)
+            except FileNotFoundError:
+                pass
+
+    def abrir(self, relativo):
+        try:
+            resposta = self.cliente.get_object(Bucket=self.bucket, Key=self.chave(relativo))
+        except ClientError as exc:
+            if exc.response.get("Error", {}).get("Code") in {"404", "NoSuchKey", "NotFound"}:
+                return None
+            raise
+        corpo = resposta["Body"]
+        corpo.tamanho = resposta.get("ContentLength")
+        return corpo
+
+    def ler(self, relativo):
+        corpo = self.abrir(relativo)
+        if corpo is None:
+            return None
+        try:
+            return corpo.read()
+        finally:
+            corpo.close()
+
+    def remover(self, relativo):
+        self.cliente.delete_object(Bucket=self.bucket, Key=self.chave(relativo))
+
+    def obter_arquivo_local(self, relativo):
+        destino = os.path.join(self.diretorio_temporario, f".{uuid.uuid4().hex}{os.path.splitext(relativo)[1]}")
+        try:
+            self.cliente.download_file(self.bucket, self.chave(relativo), destino, Config=self.transferencia)
+        except ClientError as exc:
+            if os.path.exists(destino):
+                os.remove(destino)
+            if exc.response.get("Error", {}).get("Code") in {"404", "NoSuchKey", "NotFound"}:
+                return None, False
+            raise
+        return destino, True
+
+    def url_redirecionamento(self, relativo, expira_segundos=3600):
+        if not self.redirecionar:
+            return None
+        return self.cliente.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": self.chave(relativo)},
+            ExpiresIn=expira_segundos,
+        )
+
+    def estado(self):
+        return {"tipo": self.nome, "bucket": self.bucket, "prefixo": self.prefixo, "redirecionar": self.redirecionar}
+
+
+def criar_armazenamento(diretorio_static, diretorio_temporario=None):
+    tipo = os.getenv("ARMAZENAMENTO", "local").strip().lower() or "local"
+    if tipo == "local":
+        return ArmazenamentoLocal(diretorio_static)
+    if tipo == "segmentos":
+        from segmentos import ArmazenamentoSegmentos
+
+        return ArmazenamentoSegmentos(
+            os.getenv("SEGMENTOS_DIRETORIO", "").strip()
+            or os.path.join(os.path.dirname(os.path.abspath(__file__)), "storage", "segmentos"),
+            tamanho_maximo_mb=_ler_env_inteiro("SEGMENTOS_TAMANHO_MB", 256, minimo=1),
+            fsync=os.getenv("SEGMENTOS_FSYNC", "0").strip() == "1",
+        )
+    if tipo != "s3":
+        raise ValueError(f"ARMAZENAMENTO inválido: {tipo} (use local, segmentos ou s3)")
+
+    return ArmazenamentoS3(
+        bucket=os.getenv("S3_BUCKET", "").strip(),
+        prefixo=os.getenv("S3_PREFIXO", "").strip(),
+        endpoint_url=os.getenv("S3_ENDPOINT_URL", "").strip(),
+        regiao=os.getenv("S3_REGIAO", "").strip(),
+        access_key=os.getenv("S3_ACCESS_KEY_ID", "").strip(),
+        secret_key=os.getenv("S3_SECRET_ACCESS_KEY", "").strip(),
+        diretorio_temporario=diretorio_temporario
+        or os.path.join(os.path.dirname(os.path.abspath(__file__)), "storage", "tmp"),
+        max_conexoes=_ler_env_inteiro("S3_MAX_CONEXOES", 20, minimo=1),
+        limiar_multipart_mb=_ler_env_inteiro("S3_MULTIPART_MB", 8, minimo=5),
+        concorrencia=_ler_env_inteiro("S3_CONCORRENCIA", 8, minimo=1),
+        redirecionar=os.getenv("S3_REDIRECIONAR", "0").strip() == "1",
+    )
+
+
+class EnviadorLote:
+    # Envio em massa com pool de threads sobre o mesmo cliente (e pool de
+    # conexões) do backend de destino.
+    def __init__(self, destino, concorrencia=16):
+        self.destino = destino
+        self.concorrencia = concorrencia
+        self.enviados = 0
+        self.ignorados = 0
+        self.falhas = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def _enviar(self, relativo, caminho_origem, manter_origem):
+        if self.destino.existe(relativo):
+            with self._lock:
+                self.ignorados += 1
+            return
+
+        tamanho = os.path.getsize(caminho_origem)
+        origem = caminho_origem
+        if manter_origem:
+            origem = os.path.join(
+                self.destino.diretorio_temporario or os.path.dirname(caminho_origem),
+                f".{uuid.uuid4().hex}.tmp",
+            )
+            shutil.copyfile(caminho_origem, origem)
+        self.destino.gravar(relativo, origem)
+        with self._lock:
+            self.enviados += 1
+            self.bytes += tamanho
+
+    def enviar(self, itens, manter_origem=True, ao_progredir=None):
+        with ThreadPoolExecutor(max_workers=self.concorrencia, thread_name_prefix="enviador") as executor:
+            futuros = {
+                executor.submit(self._enviar, relativo, caminho, manter_origem): relativo for relativo, caminho in itens
+            }
+            for indice, futuro in enumerate(as_completed(futuros), start=1):
+                try:
+                    futuro.result()
+                except Exception as exc:
+                    with self._lock:
+                        self.falhas += 1
+                    logger.warning(f"Falha ao enviar {futuros[futuro]}: {exc}")
+                if ao_progredir is not None:
+                    ao_progredir(indice, len(futuros))
+
+
+def _listar_capturas_locais(diretorio_static):
+    base = os.path.join(diretorio_static, "captures")
+    for raiz, _, arquivos in os.walk(base):
+        for nome in arquivos:
+            if nome.startswith(".") or nome.endswith(".tmp"):
+                continue
+            caminho = os.path.join(raiz, nome)
+            yield os.path.relpath(caminho, diretorio_static).replace(os.sep, "/"), caminho
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Armazenamento de capturas LPR")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+
+    envio = subparsers.add_parser(
+        "enviar-locais",
+        help="envia static/captures para o backend configurado (ARMAZENAMENTO=s3 ou segmentos)",
+    )
+    envio.add_argument("--concorrencia", type=int, default=16)
+    envio.add_argument("--remover-local", action="store_true", help="apaga o arquivo local após o envio")
+
+    argumentos = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(name)s | %(message)s")
+
+    diretorio_static = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+    try:
+        from dotenv import load_dotenv
+
+        load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
+    except ImportError:
+        pass
+
+    destino = criar_armazenamento(diretorio_static)
+    if destino.nome == "local":
+        print("ARMAZENAMENTO=local: nada a enviar (defina ARMAZENAMENTO=s3 ou segmentos)")
+        sys.exit(1)
+
+    itens = list(_listar_capturas_locais(diretorio_static))
+    enviador = EnviadorLote(destino, concorrencia=max(1, argumentos.concorrencia))
+    inicio = time.monotonic()
+
+    def progresso(feitos, total):
+        if feitos % 500 == 0 or feitos == total:
+            print(f"{feitos}/{total} processado(s)")
+
+    enviador.enviar(itens, manter_origem=not argumentos.remover_local, ao_progredir=progresso)
+    decorrido = max(0.001, time.monotonic() - inicio)
+    print(
+        f"Enviados: {enviador.enviados} | já existentes: {enviador.ignorados} | falhas: {enviador.falhas} | "
+        f"{enviador.bytes / (1024 * 1024):.1f} MB em {decorrido:.1f}s"
+    )
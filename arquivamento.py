@@ -0,0 +1,252 @@
+﻿import argparse
+import gzip
+import json
+import logging
+import os
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+import capturas
+import database
+from models import EntradaLPR
+from travas import LockExclusivo
+
+logger = logging.getLogger("ARQUIVAMENTO")
+
+CAMPOS = ("id", "placa", "cor_placa", "cor_veiculo", "confianca", "timestamp", "dispositivo_id", "direcao")
+ARQUIVO_INDICE = "indice.json"
+TAMANHO_LOTE_REMOCAO = 500
+
+
+def _ler_env_inteiro(chave, padrao, minimo=0):
+    try:
+        return max(minimo, int(os.getenv(chave, str(padrao)).strip()))
+    except ValueError:
+        return padrao
+
+
+def _chave(linha):
+    # Mesma chave única de lpr_webhook: os ids mudam na migração do SQLite.
+    return linha["placa"], linha["timestamp"]
+
+
+def _para_linha(registro):
+    linha = {campo: getattr(registro, campo) for campo in CAMPOS}
+    linha["timestamp"] = registro.timestamp.isoformat()
+    return linha
+
+
+def _para_registro(linha):
+    campos = dict(linha)
+    campos["timestamp"] = datetime.fromisoformat(campos["timestamp"])
+    return EntradaLPR(**campos)
+
+
+class ArquivoFrio:
+    # Leituras mais antigas que ARQUIVO_APOS_DIAS saem de lpr_webhook para um
+    # arquivo gzip por dia (JSON por linha, ordenado por horário). O índice
+    # guarda primeiro/último horário e câmeras de cada arquivo, e as
+    # consultas por período só abrem os arquivos que podem ter resultado.
+    def __init__(self, diretorio=None, dias=None):
+        self.diretorio = diretorio or os.getenv("ARQUIVO_DIRETORIO", "").strip() or os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "storage", "arquivo"
+        )
+        self.dias = _ler_env_inteiro("ARQUIVO_APOS_DIAS", 0) if dias is None else dias
+        # Arquivar libera a imagem da leitura; antes da retenção, as imagens
+        # sairiam mais cedo do que RETENCAO_IMAGENS_DIAS promete.
+        retencao = _ler_env_inteiro("RETENCAO_IMAGENS_DIAS", 15)
+        if 0 < self.dias < retencao:
+            logger.warning(
+                f"ARQUIVO_APOS_DIAS={self.dias} menor que RETENCAO_IMAGENS_DIAS={retencao}; usando {retencao}"
+            )
+            self.dias = retencao
+        self._indice = {}
+        self._versao_indice = None
+        self.ultima_execucao = None
+
+    def ativo(self):
+        return self.dias > 0
+
+    def _caminho(self, nome):
+        return os.path.join(self.diretorio, nome)
+
+    def travar(self):
+        # Exclui outra execução do arquivamento (líder, CLI) enquanto dura.
+        os.makedirs(self.diretorio, exist_ok=True)
+        return LockExclusivo(self._caminho(".lock"))
+
+    def _carregar_indice(self):
+        # Outro processo (líder, CLI) pode ter regravado o índice.
+        caminho = self._caminho(ARQUIVO_INDICE)
+        try:
+            versao = os.stat(caminho).st_mtime_ns
+        except FileNotFoundError:
+            self._indice, self._versao_indice = {}, None
+            return self._indice
+        if versao != self._versao_indice:
+            with open(caminho, encoding="utf-8") as arquivo:
+                self._indice = json.load(arquivo)
+            self._versao_indice = versao
+        return self._indice
+
+    def _salvar_indice(self, indice):
+        caminho = self._caminho(ARQUIVO_INDICE)
+        temporario = f"{caminho}.tmp"
+        with open(temporario, "w", encoding="utf-8") as arquivo:
+            json.dump(indice, arquivo, ensure_ascii=False, indent=1, sort_keys=True)
+            arquivo.flush()
+            os.fsync(arquivo.fileno())
+        os.replace(temporario, caminho)
+
+    def _ler_dia(self, entrada):
+        with gzip.open(self._caminho(entrada["arquivo"]), "rt", encoding="utf-8") as arquivo:
+            for texto in arquivo:
+                yield json.loads(texto)
+
+    def _gravar_dia(self, indice, dia, linhas):
+        nome = f"lpr-{dia.isoformat()}.jsonl.gz"
+        # Dia já arquivado (leitura atrasada ou execução interrompida antes
+        # da remoção no banco): junta com o que já está no arquivo.
+        if dia.isoformat() in indice:
+            existentes = {_chave(linha): linha for linha in self._ler_dia(indice[dia.isoformat()])}
+            existentes.update((_chave(linha), linha) for linha in linhas)
+            linhas = list(existentes.values())
+        linhas.sort(key=lambda linha: (linha["timestamp"], linha["placa"]))
+
+        caminho = self._caminho(nome)
+        temporario = f"{caminho}.tmp"
+        with open(temporario, "wb") as destino:
+            with gzip.GzipFile(fileobj=destino, mode="wb", compresslevel=9, mtime=0) as arquivo:
+                for linha in linhas:
+                    arquivo.write(json.dumps(linha, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+                    arquivo.write(b"\n")
+            destino.flush()
+            os.fsync(destino.fileno())
+        os.replace(temporario, caminho)
+
+        indice[dia.isoformat()] = {
+            "arquivo": nome,
+            "linhas": len(linhas),
+            "bytes": os.path.getsize(caminho),
+            "primeiro": linhas[0]["timestamp"],
+            "ultimo": linhas[-1]["timestamp"],
+            "dispositivos": sorted({linha["dispositivo_id"] or "" for linha in linhas}),
+        }
+        self._salvar_indice(indice)
+
+    def arquivar(self, obter_sessao, limite=None):
+        # Um dia por vez: grava o arquivo, atualiza o índice e só então
+        # remove as leituras do banco. As imagens não vão para o arquivo; a
+        # referência é liberada como na retenção.
+        if limite is None:
+            limite = datetime.combine(datetime.now().date() - timedelta(days=self.dias), datetime.min.time())
+        dias = linhas_arquivadas = 0
+
+        with self.travar():
+            indice = dict(self._carregar_indice())
+            sessao = obter_sessao()
+            try:
+                while True:
+                    primeiro = sessao.query(func.min(EntradaLPR.timestamp)).filter(EntradaLPR.timestamp < limite).scalar()
+                    if primeiro is None:
+                        break
+                    inicio = datetime.combine(primeiro.date(), datetime.min.time())
+                    fim = min(inicio + timedelta(days=1), limite)
+                    registros = (
+                        sessao.query(EntradaLPR)
+                        .filter(EntradaLPR.timestamp >= inicio, EntradaLPR.timestamp < fim)
+                        .order_by(EntradaLPR.timestamp, EntradaLPR.id)
+                        .all()
+                    )
+                    self._gravar_dia(indice, primeiro.date(), [_para_linha(registro) for registro in registros])
+
+                    por_hash = Counter(registro.hash_imagem for registro in registros if registro.hash_imagem)
+                    ids = [registro.id for registro in registros]
+                    for posicao in range(0, len(ids), TAMANHO_LOTE_REMOCAO):
+                        lote = ids[posicao : posicao + TAMANHO_LOTE_REMOCAO]
+                        sessao.query(EntradaLPR).filter(EntradaLPR.id.in_(lote)).delete(synchronize_session=False)
+                    for hash_imagem, quantidade in por_hash.items():
+                        capturas.liberar(sessao, hash_imagem, quantidade)
+                    sessao.commit()
+                    sessao.expunge_all()
+
+                    dias += 1
+                    linhas_arquivadas += len(registros)
+                    logger.info(f"Arquivado {inicio.date().isoformat()}: {len(registros)} leitura(s)")
+            except Exception:
+                sessao.rollback()
+                raise
+            finally:
+                sessao.close()
+
+        self.ultima_execucao = datetime.now()
+        return dias, linhas_arquivadas
+
+    def dias_arquivados(self):
+        return set(self._carregar_indice())
+
+    def percorrer(self, inicio=None, fim=None, dispositivo=None, reverso=False):
+        # Linhas arquivadas no período (`fim` exclusivo), um dia por vez.
+        indice = self._carregar_indice()
+        inicio_texto = inicio.isoformat() if inicio is not None else None
+        fim_texto = fim.isoformat() if fim is not None else None
+        for dia in sorted(indice, reverse=reverso):
+            entrada = indice[dia]
+            if fim_texto is not None and entrada["primeiro"] >= fim_texto:
+                continue
+            if inicio_texto is not None and entrada["ultimo"] < inicio_texto:
+                continue
+            if dispositivo and dispositivo not in entrada["dispositivos"]:
+                continue
+            for linha in self._ler_dia(entrada):
+                if fim_texto is not None and linha["timestamp"] >= fim_texto:
+                    break
+                if inicio_texto is not None and linha["timestamp"] < inicio_texto:
+                    continue
+                if dispositivo and linha["dispositivo_id"] != dispositivo:
+                    continue
+                yield _para_registro(linha)
+
+    def consultar(self, placa=None, inicio=None, fim=None, dispositivo=None):
+        # `placa` já normalizada; `fim` exclusivo. Mesmo filtro de
+        # obter_registros_filtrados, aplicado às linhas dos arquivos.
+        return [
+            registro
+            for registro in self.percorrer(inicio, fim, dispositivo, reverso=True)
+            if not placa or placa in registro.placa.upper().replace("-", "")
+        ]
+
+    def estado(self):
+        indice = self._carregar_indice()
+        return {
+            "ativo": self.ativo(),
+            "apos_dias": self.dias,
+            "diretorio": self.diretorio,
+            "arquivos": len(indice),
+            "linhas": sum(entrada["linhas"] for entrada in indice.values()),
+            "bytes": sum(entrada["bytes"] for entrada in indice.values()),
+            "primeiro_dia": min(indice) if indice else None,
+            "ultimo_dia": max(indice) if indice else None,
+            "ultima_execucao": self.ultima_execucao.isoformat() if self.ultima_execucao else None,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Arquivamento de leituras antigas (lpr_webhook)")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+
+    execucao = subparsers.add_parser("executar", help="move para o arquivo as leituras mais antigas que o limite")
+    execucao.add_argument("--dias", type=int, help="mantém no banco os últimos N dias (padrão: ARQUIVO_APOS_DIAS)")
+
+    argumentos = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(name)s | %(message)s")
+
+    arquivo_frio = ArquivoFrio(dias=argumentos.dias)
+    if not arquivo_frio.ativo():
+        parser.error("defina ARQUIVO_APOS_DIAS ou --dias (maior que 0)")
+
+    database.inicializar_banco()
+    dias, linhas = arquivo_frio.arquivar(database.nova_sessao)
+    print(f"Banco: {database.modo_banco_ativo()} | dias arquivados: {dias} | leituras: {linhas} | {arquivo_frio.diretorio}")
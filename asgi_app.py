@@ -0,0 +1,336 @@
+﻿import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from armazenamento import CACHE_CONTROL_CAPTURAS, chave_valida, etag_captura, tipo_conteudo
+
+logger = logging.getLogger("ASGI")
+
+TAMANHO_MAXIMO_CORPO = 32 * 1024 * 1024
+TAMANHO_BLOCO_ARQUIVO = 64 * 1024
+
+_CABECALHOS_CORS = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-headers", b"Content-Type,Authorization"),
+    (b"access-control-allow-methods", b"GET,PUT,POST,DELETE,OPTIONS"),
+]
+
+
+class _RequisicaoASGI:
+    def __init__(self, scope):
+        self.headers = {}
+        for chave, valor in scope.get("headers", []):
+            self.headers[chave.decode("latin-1").title()] = valor.decode("latin-1")
+        cliente = scope.get("client")
+        self.remote_addr = cliente[0] if cliente else ""
+        self.args = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True))
+        tamanho = self.headers.get("Content-Length", "")
+        self.content_length = int(tamanho) if tamanho.isdigit() else None
+
+
+def _ler_env_inteiro(chave, padrao):
+    try:
+        return max(1, int(os.getenv(chave, str(padrao)).strip()))
+    except ValueError:
+        return padrao
+
+
+class CorpoMuitoGrande(Exception):
+    pass
+
+
+async def _ler_corpo(receive):
+    # None: o cliente desconectou e não há a quem responder.
+    partes = []
+    total = 0
+    while True:
+        mensagem = await receive()
+        if mensagem["type"] == "http.disconnect":
+            return None
+        corpo = mensagem.get("body", b"")
+        total += len(corpo)
+        if total > TAMANHO_MAXIMO_CORPO:
+            raise CorpoMuitoGrande(total)
+        partes.append(corpo)
+        if not mensagem.get("more_body", False):
+            return b"".join(partes)
+
+
+async def _responder(send, status, corpo, tipo=b"application/json", cabecalhos=None):
+    lista = [(b"content-type", tipo), (b"content-length", str(len(corpo)).encode("ascii"))]
+    lista.extend(_CABECALHOS_CORS)
+    lista.extend(cabecalhos or [])
+    await send({"type": "http.response.start", "status": status, "headers": lista})
+    await send({"type": "http.response.body", "body": corpo})
+
+
+async def _responder_json(send, payload, status=200):
+    await _responder(send, status, json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+
+
+def _decodificar_json(corpo):
+    if not corpo:
+        return None
+    try:
+        return json.loads(corpo)
+    except ValueError:
+        return None
+
+
+def criar_app(nucleo, wsgi_app=None):
+    # nucleo é o módulo main já inicializado: as mesmas funções de negócio
+    # do Flask são usadas aqui, apenas executadas fora do event loop.
+    try:
+        from asgiref.wsgi import WsgiToAsgi
+    except ImportError as exc:
+        raise RuntimeError("Modo ASGI requer o pacote asgiref (pip install asgiref)") from exc
+
+    executor = ThreadPoolExecutor(
+        max_workers=_ler_env_inteiro("ASGI_DB_WORKERS", 30),
+        thread_name_prefix="asgi-db",
+    )
+    fallback_wsgi = WsgiToAsgi(wsgi_app or nucleo.app)
+    armazenamento = nucleo.armazenamento
+
+    async def em_thread(funcao, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, lambda: funcao(*args, **kwargs))
+
+    def configurar_notificacoes(loop):
+        def despachar(notificador, mensagem, caminho_imagem, destinatarios=None, aguardar=False):
+            futuro = asyncio.run_coroutine_threadsafe(
+                notificador.enviar_mensagem_async(
+                    mensagem,
+                    destinatarios=destinatarios,
+                    caminho_imagem=caminho_imagem,
+                ),
+                loop,
+            )
+            # O agendador (thread própria) espera o envio terminar para
+            # liberar o destinatário; as falhas ficam com ele.
+            if aguardar:
+                return futuro.result()
+            futuro.add_done_callback(_registrar_falha_notificacao)
+            return None
+
+        nucleo.despachar_notificacao = despachar
+
+    async def webhook(scope, receive, send, tratador, com_tamanho):
+        try:
+            corpo = await _ler_corpo(receive)
+        except CorpoMuitoGrande:
+            await _responder_json(send, {"erro": "Payload muito grande"}, 413)
+            return
+        if corpo is None:
+            return
+        requisicao = _RequisicaoASGI(scope)
+        ip_origem = nucleo.obter_ip_cliente(requisicao)
+        dados = _decodificar_json(corpo)
+        if com_tamanho:
+            resposta, status = await em_thread(tratador, dados, tamanho_payload=len(corpo), ip_origem=ip_origem)
+        else:
+            resposta, status = await em_thread(tratador, dados, ip_origem=ip_origem)
+        # Os tratadores devolvem a resposta fixa já codificada.
+        await _responder(send, status, resposta)
+
+    async def registros(scope, receive, send):
+        corpo, status = await em_thread(nucleo.consultar_registros, _RequisicaoASGI(scope).args)
+        await _responder(send, status, corpo)
+
+    async def stats(scope, receive, send):
+        payload, status = await em_thread(nucleo.consultar_estatisticas, _RequisicaoASGI(scope).args)
+        await _responder_json(send, payload, status)
+
+    async def sugestoes(scope, receive, send):
+        # Índice em memória: responde direto no event loop.
+        payload, status = nucleo.consultar_sugestoes(_RequisicaoASGI(scope).args)
+        await _responder_json(send, payload, status)
+
+    async def cameras(scope, receive, send):
+        payload, status = nucleo.consultar_cameras()
+        await _responder_json(send, payload, status)
+
+    async def captura(scope, receive, send):
+        relativo = scope["path"][len("/static/"):]
+        if not chave_valida(relativo):
+            await _responder(send, 404, b"Arquivo n\xc3\xa3o encontrado", b"text/plain; charset=utf-8")
+            return
+
+        requisicao = _RequisicaoASGI(scope)
+        etag = f'"{etag_captura(relativo)}"'.encode("ascii")
+        cabecalhos = [(b"etag", etag), (b"cache-control", CACHE_CONTROL_CAPTURAS.encode("ascii"))] + _CABECALHOS_CORS
+        se_diferente = requisicao.headers.get("If-None-Match", "")
+        if se_diferente and (se_diferente.strip() == "*" or etag.decode("ascii") in _etags(se_diferente)):
+            await send({"type": "http.response.start", "status": 304, "headers": cabecalhos})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        caminho = armazenamento.caminho_local(relativo)
+        if caminho is None:
+            url = armazenamento.url_redirecionamento(relativo)
+            if url:
+                await send(
+                    {
+                        "type": "http.response.start",
+                        "status": 302,
+                        "headers": [(b"location", url.encode("utf-8"))] + _CABECALHOS_CORS,
+                    }
+                )
+                await send({"type": "http.response.body", "body": b""})
+                return
+            arquivo = await em_thread(armazenamento.abrir, relativo)
+        elif os.path.isfile(caminho):
+            arquivo = await em_thread(open, caminho, "rb")
+        else:
+            arquivo = None
+        if arquivo is None:
+            await _responder(send, 404, b"Arquivo n\xc3\xa3o encontrado", b"text/plain; charset=utf-8")
+            return
+
+        try:
+            tamanho = os.fstat(arquivo.fileno()).st_size if caminho is not None else getattr(arquivo, "tamanho", None)
+            cabecalhos.append((b"content-type", tipo_conteudo(relativo).encode("ascii")))
+            status, inicio, restante = 200, 0, tamanho
+            if tamanho is not None:
+                cabecalhos.append((b"accept-ranges", b"bytes"))
+                intervalo = _intervalo(requisicao.headers.get("Range", ""), tamanho)
+                if intervalo is False:
+                    cabecalhos.append((b"content-range", f"bytes */{tamanho}".encode("ascii")))
+                    await send({"type": "http.response.start", "status": 416, "headers": cabecalhos})
+                    await send({"type": "http.response.body", "body": b""})
+                    return
+                if intervalo is not None:
+                    inicio, fim = intervalo
+                    status, restante = 206, fim - inicio + 1
+                    cabecalhos.append((b"content-range", f"bytes {inicio}-{fim}/{tamanho}".encode("ascii")))
+                cabecalhos.append((b"content-length", str(restante).encode("ascii")))
+
+            await send({"type": "http.response.start", "status": status, "headers": cabecalhos})
+            if scope["method"] == "HEAD":
+                await send({"type": "http.response.body", "body": b""})
+                return
+
+            if caminho is not None and "http.response.zerocopysend" in scope.get("extensions", {}):
+                # Servidor com suporte a sendfile (extensão zerocopysend do ASGI).
+                await send(
+                    {"type": "http.response.zerocopysend", "file": arquivo, "offset": inicio, "count": restante}
+                )
+                return
+
+            await _pular(arquivo, inicio, em_thread)
+            while restante is None or restante > 0:
+                tamanho_bloco = TAMANHO_BLOCO_ARQUIVO if restante is None else min(TAMANHO_BLOCO_ARQUIVO, restante)
+                bloco = await em_thread(arquivo.read, tamanho_bloco)
+                if restante is not None:
+                    restante -= len(bloco)
+                fim_corpo = not bloco or restante == 0
+                await send({"type": "http.response.body", "body": bloco, "more_body": not fim_corpo})
+                if fim_corpo:
+                    break
+        finally:
+            arquivo.close()
+
+    rotas = {
+        ("POST", "/NotificationInfo/TollgateInfo"): lambda s, r, e: webhook(s, r, e, nucleo.tratar_tollgate_info, True),
+        ("POST", "/NotificationInfo/KeepAlive"): lambda s, r, e: webhook(s, r, e, nucleo.tratar_keep_alive, False),
+        ("POST", "/NotificationInfo/DeviceInfo"): lambda s, r, e: webhook(s, r, e, nucleo.tratar_device_info, False),
+        ("GET", "/api/records"): registros,
+        ("GET", "/api/stats"): stats,
+        ("GET", "/api/cameras"): cameras,
+        ("GET", "/api/plates/suggest"): sugestoes,
+    }
+
+    async def lifespan(receive, send):
+        while True:
+            mensagem = await receive()
+            if mensagem["type"] == "lifespan.startup":
+                configurar_notificacoes(asyncio.get_running_loop())
+                await send({"type": "lifespan.startup.complete"})
+            elif mensagem["type"] == "lifespan.shutdown":
+                nucleo.despachar_notificacao = None
+                executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            await lifespan(receive, send)
+            return
+
+        if scope["type"] == "http":
+            ip_cliente = nucleo.obter_ip_cliente(_RequisicaoASGI(scope))
+            permitido, grupo = nucleo.verificar_acesso(scope["path"], ip_cliente)
+            if not permitido:
+                corpo, status = nucleo.resposta_acesso_negado(grupo)
+                if isinstance(corpo, dict):
+                    await _responder_json(send, corpo, status)
+                else:
+                    await _responder(send, status, corpo.encode("utf-8"), b"text/plain; charset=utf-8")
+                return
+            indisponivel = nucleo.resposta_banco_em_preparo(scope["path"])
+            if indisponivel is not None:
+                await _responder_json(send, *indisponivel)
+                return
+
+            rota = rotas.get((scope["method"], scope["path"]))
+            if rota is not None:
+                await rota(scope, receive, send)
+                return
+            if scope["method"] in {"GET", "HEAD"} and scope["path"].startswith("/static/captures/"):
+                await captura(scope, receive, send)
+                return
+
+        await fallback_wsgi(scope, receive, send)
+
+    return app
+
+
+def _etags(cabecalho):
+    return {parte.strip().removeprefix("W/") for parte in cabecalho.split(",")}
+
+
+def _intervalo(cabecalho, tamanho):
+    # Um único intervalo "bytes=a-b", "bytes=a-" ou "bytes=-n". None sem
+    # Range (ou com formato não suportado), False se não satisfatível.
+    if not cabecalho.startswith("bytes=") or "," in cabecalho or tamanho <= 0:
+        return None
+    inicio, separador, fim = cabecalho[6:].strip().partition("-")
+    if not separador:
+        return None
+    try:
+        if not inicio:
+            sufixo = int(fim)
+            if sufixo <= 0:
+                return False
+            return max(0, tamanho - sufixo), tamanho - 1
+        inicio = int(inicio)
+        fim = min(int(fim), tamanho - 1) if fim else tamanho - 1
+    except ValueError:
+        return None
+    if inicio >= tamanho or fim < inicio:
+        return False
+    return inicio, fim
+
+
+async def _pular(arquivo, quantidade, em_thread):
+    if not quantidade:
+        return
+    if hasattr(arquivo, "seek") and getattr(arquivo, "seekable", lambda: False)():
+        await em_thread(arquivo.seek, quantidade)
+        return
+    while quantidade > 0:
+        bloco = await em_thread(arquivo.read, min(TAMANHO_BLOCO_ARQUIVO, quantidade))
+        if not bloco:
+            return
+        quantidade -= len(bloco)
+
+
+def _registrar_falha_notificacao(futuro):
+    if futuro.cancelled():
+        return
+    erro = futuro.exception()
+    if erro is not None:
+        logger.error(f"Erro ao enviar mensagem WhatsApp (async): {erro}")
@@ -0,0 +1,395 @@
+﻿import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import string
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+try:
+    from dotenv import load_dotenv
+
+    load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
+except ImportError:
+    pass
+
+
+def _percentil(valores, percentual):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, int(round(percentual / 100 * (len(ordenados) - 1))))
+    return ordenados[indice]
+
+
+def _placa_aleatoria():
+    return "".join(random.choices(string.ascii_uppercase, k=3)) + "".join(random.choices(string.digits, k=4))
+
+
+def _payload_tollgate(tamanho_imagem):
+    payload = {
+        "Picture": {
+            "Plate": {"PlateNumber": _placa_aleatoria(), "PlateColor": "White", "Confidence": 90},
+            "Vehicle": {"VehicleColor": "Black"},
+            "SnapInfo": {
+                "AccurateTime": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "DeviceID": f"bench-{random.randint(1, 40):02d}",
+            },
+        }
+    }
+    if tamanho_imagem > 0:
+        payload["Picture"]["NormalPic"] = {"Content": base64.b64encode(os.urandom(tamanho_imagem)).decode("ascii")}
+    return json.dumps(payload).encode("utf-8")
+
+
+async def _ler_resposta(reader):
+    linha_status = await reader.readline()
+    if not linha_status:
+        raise ConnectionError("conexão encerrada pelo servidor")
+    status = int(linha_status.split(b" ", 2)[1])
+
+    cabecalhos = {}
+    while True:
+        linha = await reader.readline()
+        if linha in {b"\r\n", b"\n", b""}:
+            break
+        chave, _, valor = linha.decode("latin-1").partition(":")
+        cabecalhos[chave.strip().lower()] = valor.strip()
+
+    if "content-length" in cabecalhos:
+        await reader.readexactly(int(cabecalhos["content-length"]))
+    elif "chunked" in cabecalhos.get("transfer-encoding", "").lower():
+        while True:
+            tamanho = int((await reader.readline()).split(b";", 1)[0].strip() or b"0", 16)
+            await reader.readexactly(tamanho + 2)
+            if tamanho == 0:
+                break
+    else:
+        await reader.read()
+
+    return status, cabecalhos.get("connection", "").lower() == "close"
+
+
+async def _cliente_carga(args, host, porta, fim, resultado):
+    reader = writer = None
+    while time.monotonic() < fim:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, porta)
+
+            if args.rota == "records":
+                requisicao = (
+                    f"GET /api/records?data_inicio={datetime.now():%Y-%m-%d} HTTP/1.1\r\n"
+                    f"Host: {host}:{porta}\r\nConnection: keep-alive\r\n\r\n"
+                ).encode("latin-1")
+            else:
+                corpo = _payload_tollgate(args.imagem_bytes)
+                requisicao = (
+                    f"POST /NotificationInfo/TollgateInfo HTTP/1.1\r\nHost: {host}:{porta}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(corpo)}\r\n"
+                    "Connection: keep-alive\r\n\r\n"
+                ).encode("latin-1") + corpo
+
+            inicio = time.perf_counter()
+            writer.write(requisicao)
+            await writer.drain()
+            status, fechar = await _ler_resposta(reader)
+            resultado["latencias"].append((time.perf_counter() - inicio) * 1000)
+
+            if status == 200:
+                resultado["ok"] += 1
+            else:
+                resultado["erros"] += 1
+            if fechar:
+                writer.close()
+                writer = None
+        except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+            resultado["erros"] += 1
+            if writer is not None:
+                writer.close()
+            writer = None
+            await asyncio.sleep(0.05)
+
+    if writer is not None:
+        writer.close()
+
+
+async def _conexao_ociosa(host, porta, fim, resultado):
+    try:
+        reader, writer = await asyncio.open_connection(host, porta)
+    except OSError:
+        resultado["ociosas_recusadas"] += 1
+        return
+
+    resultado["ociosas_abertas"] += 1
+    try:
+        restante = fim - time.monotonic()
+        if restante > 0:
+            dados = await asyncio.wait_for(reader.read(1), timeout=restante)
+            if not dados:
+                resultado["ociosas_derrubadas"] += 1
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        writer.close()
+
+
+async def _benchmark_servidor(args):
+    partes = urlsplit(args.url)
+    host, porta = partes.hostname, partes.port or 80
+    resultado = {
+        "ok": 0,
+        "erros": 0,
+        "latencias": [],
+        "ociosas_abertas": 0,
+        "ociosas_recusadas": 0,
+        "ociosas_derrubadas": 0,
+    }
+
+    fim = time.monotonic() + args.duracao
+    tarefas = [
+        asyncio.create_task(_conexao_ociosa(host, porta, fim, resultado)) for _ in range(args.conexoes_ociosas)
+    ]
+    if tarefas:
+        await asyncio.sleep(1)
+
+    inicio = time.monotonic()
+    tarefas.extend(
+        asyncio.create_task(_cliente_carga(args, host, porta, fim, resultado)) for _ in range(args.concorrencia)
+    )
+    await asyncio.gather(*tarefas)
+    decorrido = max(0.001, time.monotonic() - inicio)
+
+    latencias = resultado["latencias"]
+    print(f"Rota: {args.rota} | concorrência: {args.concorrencia} | duração: {decorrido:.1f}s")
+    print(f"Requisições OK: {resultado['ok']} | erros: {resultado['erros']}")
+    print(f"Vazão: {resultado['ok'] / decorrido:.1f} req/s")
+    print(
+        f"Latência ms: p50={_percentil(latencias, 50):.1f} p95={_percentil(latencias, 95):.1f} "
+        f"p99={_percentil(latencias, 99):.1f} max={max(latencias) if latencias else 0:.1f}"
+    )
+    if args.conexoes_ociosas:
+        print(
+            f"Conexões ociosas: abertas={resultado['ociosas_abertas']} "
+            f"recusadas={resultado['ociosas_recusadas']} derrubadas={resultado['ociosas_derrubadas']}"
+        )
+
+
+def _placa_mercosul():
+    letras = "".join(random.choices(string.ascii_uppercase, k=4))
+    numeros = "".join(random.choices(string.digits, k=3))
+    return f"{letras[:3]}{numeros[0]}{letras[3]}{numeros[1:]}"
+
+
+def _ruido_ocr(placa, confusoes):
+    indice = random.randrange(len(placa))
+    caractere = placa[indice]
+    for grupo in confusoes:
+        if caractere in grupo and len(grupo) > 1:
+            troca = random.choice([item for item in grupo if item != caractere])
+            return placa[:indice] + troca + placa[indice + 1 :]
+    return None
+
+
+def _benchmark_watchlist(args):
+    from placas import GRUPOS_CONFUSAO, canonizar_placa, distancia_ate_um
+    from watchlist import EntradaWatchlist, IndiceWatchlist
+
+    random.seed(args.semente)
+    placas = set()
+    while len(placas) < args.entradas:
+        placas.add(_placa_mercosul() if random.random() < 0.5 else _placa_aleatoria())
+    placas = list(placas)
+
+    inicio = time.perf_counter()
+    indice = IndiceWatchlist(EntradaWatchlist(placa, "teste") for placa in placas)
+    construcao = time.perf_counter() - inicio
+
+    consultas = []
+    for _ in range(args.consultas):
+        sorteio = random.random()
+        if sorteio < 0.05:
+            consultas.append(random.choice(placas))
+        elif sorteio < 0.10:
+            consultas.append(_ruido_ocr(random.choice(placas), GRUPOS_CONFUSAO) or random.choice(placas))
+        elif sorteio < 0.15:
+            placa = random.choice(placas)
+            posicao = random.randrange(len(placa))
+            consultas.append(placa[:posicao] + random.choice(string.ascii_uppercase) + placa[posicao + 1 :])
+        else:
+            consultas.append(_placa_mercosul())
+
+    tipos = {}
+    latencias = []
+    inicio_total = time.perf_counter()
+    for placa in consultas:
+        inicio = time.perf_counter()
+        resultado = indice.verificar(placa)
+        latencias.append((time.perf_counter() - inicio) * 1_000_000)
+        tipo = resultado.tipo if resultado else "nenhuma"
+        tipos[tipo] = tipos.get(tipo, 0) + 1
+    total = time.perf_counter() - inicio_total
+
+    print(f"Watchlist: {len(indice)} placa(s) | construção do índice: {construcao * 1000:.0f} ms")
+    print(f"Consultas: {len(consultas)} em {total:.2f}s ({len(consultas) / total:,.0f}/s)")
+    print(
+        f"Latência µs: p50={_percentil(latencias, 50):.1f} p95={_percentil(latencias, 95):.1f} "
+        f"p99={_percentil(latencias, 99):.1f} max={max(latencias):.1f}"
+    )
+    print("Correspondências: " + ", ".join(f"{tipo}={total}" for tipo, total in sorted(tipos.items())))
+
+    if args.comparar_linear:
+        amostra = consultas[: min(200, len(consultas))]
+        chaves = [canonizar_placa(placa) for placa in placas]
+        inicio = time.perf_counter()
+        for placa in amostra:
+            chave = canonizar_placa(placa)
+            any(distancia_ate_um(chave, candidata) for candidata in chaves)
+        linear = (time.perf_counter() - inicio) / len(amostra) * 1_000_000
+        print(f"Varredura linear (referência): {linear:,.0f} µs/consulta")
+
+
+def _benchmark_serializacao(args):
+    import tempfile
+
+    from sqlalchemy import create_engine, insert
+    from sqlalchemy.orm import sessionmaker
+
+    from database import obter_linhas_registros, obter_registros_filtrados
+    from models import Base, EntradaLPR
+    from serializacao import codificador, para_json
+
+    random.seed(args.semente)
+    with tempfile.TemporaryDirectory() as diretorio:
+        engine = create_engine(f"sqlite:///{os.path.join(diretorio, 'bench.db')}")
+        Base.metadata.create_all(engine)
+        agora = datetime.now()
+        linhas = [
+            {
+                "placa": _placa_aleatoria(),
+                "cor_placa": "White",
+                "cor_veiculo": "Black",
+                "confianca": str(random.randint(60, 99)),
+                "caminho_imagem": f"captures/{indice % 256:02x}/{indice:064x}.jpg" if indice % 4 else None,
+                "timestamp": agora.replace(microsecond=0) - timedelta(seconds=indice),
+                "dispositivo_id": f"bench-{indice % 40:02d}",
+            }
+            for indice in range(args.linhas)
+        ]
+        with engine.begin() as conexao:
+            conexao.execute(insert(EntradaLPR), linhas)
+        fabrica = sessionmaker(bind=engine)
+
+        def orm():
+            sessao = fabrica()
+            try:
+                payload = [
+                    {
+                        "id": registro.id,
+                        "placa": registro.placa,
+                        "cor_placa": registro.cor_placa,
+                        "cor_veiculo": registro.cor_veiculo,
+                        "confianca": registro.confianca,
+                        "imagem_url": f"/static/{registro.caminho_imagem}" if registro.caminho_imagem else None,
+                        "timestamp": registro.timestamp.isoformat(),
+                        "dispositivo_id": registro.dispositivo_id,
+                    }
+                    for registro in obter_registros_filtrados(sessao)
+                ]
+                return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            finally:
+                sessao.close()
+
+        def enxuto():
+            sessao = fabrica()
+            try:
+                return para_json(
+                    [
+                        {
+                            "id": registro_id,
+                            "placa": placa,
+                            "cor_placa": cor_placa,
+                            "cor_veiculo": cor_veiculo,
+                            "confianca": confianca,
+                            "imagem_url": f"/static/{caminho}" if caminho else None,
+                            "timestamp": timestamp,
+                            "dispositivo_id": dispositivo,
+                        }
+                        for registro_id, placa, cor_placa, cor_veiculo, confianca, caminho, timestamp, dispositivo in (
+                            obter_linhas_registros(sessao)
+                        )
+                    ]
+                )
+            finally:
+                sessao.close()
+
+        if json.loads(orm()) != json.loads(enxuto()):
+            raise SystemExit("Os dois caminhos devolveram resultados diferentes")
+
+        print(f"Linhas: {args.linhas} | repetições: {args.repeticoes} | codificador: {codificador()}")
+        tempos = {}
+        for nome, funcao in (("ORM + json", orm), ("Core + " + codificador(), enxuto)):
+            medidas = []
+            for _ in range(args.repeticoes):
+                inicio = time.perf_counter()
+                corpo = funcao()
+                medidas.append((time.perf_counter() - inicio) * 1000)
+            tempos[nome] = _percentil(medidas, 50)
+            print(
+                f"{nome:>14}: p50={tempos[nome]:.1f} ms p95={_percentil(medidas, 95):.1f} ms "
+                f"| {len(corpo) / 1024:,.0f} KiB"
+            )
+        orm_ms, enxuto_ms = tempos.values()
+        print(f"Ganho: {orm_ms / enxuto_ms:.1f}x")
+        engine.dispose()
+
+
+def _url_padrao():
+    host = os.getenv("WEBHOOK_HOST", "127.0.0.1").strip() or "127.0.0.1"
+    porta = os.getenv("WEBHOOK_PORT", "8000").strip() or "8000"
+    return f"http://{host}:{porta}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks do HR Intelbras LPR Webhook")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+
+    servidor = subparsers.add_parser(
+        "servidor",
+        help="carga HTTP contra um servidor em execução (compare SERVIDOR_MODO=waitress e asgi)",
+    )
+    servidor.add_argument("--url", default=_url_padrao())
+    servidor.add_argument("--rota", choices=["tollgate", "records"], default="tollgate")
+    servidor.add_argument("--concorrencia", type=int, default=50)
+    servidor.add_argument("--duracao", type=float, default=15.0)
+    servidor.add_argument("--imagem-bytes", type=int, default=0)
+    servidor.add_argument(
+        "--conexoes-ociosas",
+        type=int,
+        default=0,
+        help="conexões abertas sem enviar requisição (simula câmeras lentas)",
+    )
+
+    watchlist = subparsers.add_parser("watchlist", help="consulta ao índice da watchlist (sem servidor/banco)")
+    watchlist.add_argument("--entradas", type=int, default=100000)
+    watchlist.add_argument("--consultas", type=int, default=200000)
+    watchlist.add_argument("--semente", type=int, default=42)
+    watchlist.add_argument("--comparar-linear", action="store_true", help="mede também uma varredura linear")
+
+    serializacao = subparsers.add_parser(
+        "serializacao", help="/api/records: ORM + json contra Core + orjson (SQLite temporário, sem servidor)"
+    )
+    serializacao.add_argument("--linhas", type=int, default=20000)
+    serializacao.add_argument("--repeticoes", type=int, default=20)
+    serializacao.add_argument("--semente", type=int, default=42)
+
+    argumentos = parser.parse_args()
+    if argumentos.comando == "servidor":
+        asyncio.run(_benchmark_servidor(argumentos))
+    elif argumentos.comando == "watchlist":
+        _benchmark_watchlist(argumentos)
+    elif argumentos.comando == "serializacao":
+        _benchmark_serializacao(argumentos)
@@ -0,0 +1,187 @@
+﻿import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+# Contadores: 0 = qualquer gravação, 1 = invalidação total, 2.. = por dia.
+_CONTADOR_ESCRITAS = 0
+_CONTADOR_LIMPEZAS = 1
+_BALDES_DIA = 512
+# Consultas com período maior que isso dependem do contador geral.
+_DIAS_MAXIMOS_PERIODO = 62
+_FORMATO = "<Q"
+_TAMANHO = struct.calcsize(_FORMATO)
+
+
+def _ler_env_inteiro(chave, padrao, minimo=0):
+    try:
+        return max(minimo, int(os.getenv(chave, str(padrao)).strip()))
+    except ValueError:
+        return padrao
+
+
+def _ler_data(valor):
+    if not valor or not valor.strip():
+        return None
+    try:
+        return datetime.strptime(valor.strip(), "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+
+class _ContadoresCompartilhados:
+    # mmap anônimo criado antes do fork: todos os workers enxergam os mesmos
+    # contadores. O incremento não é atômico entre processos, mas qualquer
+    # mudança de valor já invalida quem guardou o valor anterior.
+    def __init__(self, baldes=_BALDES_DIA):
+        self._mapa = mmap.mmap(-1, (2 + baldes) * _TAMANHO)
+        self.baldes = baldes
+
+    def ler(self, indice):
+        return struct.unpack_from(_FORMATO, self._mapa, indice * _TAMANHO)[0]
+
+    def incrementar(self, indice):
+        struct.pack_into(_FORMATO, self._mapa, indice * _TAMANHO, self.ler(indice) + 1)
+
+    def indice_dia(self, dia):
+        return 2 + dia.toordinal() % self.baldes
+
+
+class _Pendente:
+    __slots__ = ("evento", "resultado", "erro")
+
+    def __init__(self):
+        self.evento = threading.Event()
+        self.resultado = None
+        self.erro = None
+
+
+class CacheRegistros:
+    # Respostas de /api/records já serializadas, por filtro normalizado.
+    # Uma entrada guarda os contadores dos dias que cobre no momento da
+    # consulta e deixa de valer quando uma gravação nesses dias os altera.
+    def __init__(self):
+        self.maximo_entradas = _ler_env_inteiro("CACHE_REGISTROS_ENTRADAS", 128)
+        self.maximo_bytes = _ler_env_inteiro("CACHE_REGISTROS_MAX_MB", 64) * 1024 * 1024
+        # Limite de idade para o que os contadores não enxergam (outras
+        # instâncias, réplicas atrasadas).
+        self.ttl = _ler_env_inteiro("CACHE_REGISTROS_TTL_SEGUNDOS", 30, minimo=1)
+        self._contadores = _ContadoresCompartilhados()
+        self._entradas = OrderedDict()
+        self._em_andamento = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.acertos = 0
+        self.falhas = 0
+        self.coalescidas = 0
+        self.invalidadas = 0
+
+    def ativo(self):
+        return self.maximo_entradas > 0
+
+    @staticmethod
+    def chave(placa=None, data_inicio=None, data_fim=None, dispositivo=None):
+        placa = (placa or "").replace("-", "").replace(" ", "").upper().strip() or None
+        dispositivo = (dispositivo or "").strip() or None
+        return placa, _ler_data(data_inicio), _ler_data(data_fim), dispositivo
+
+    def _versao(self, chave):
+        _, inicio, fim, _ = chave
+        limpezas = self._contadores.ler(_CONTADOR_LIMPEZAS)
+        if inicio is None or fim is None or (fim - inicio).days > _DIAS_MAXIMOS_PERIODO:
+            return limpezas, self._contadores.ler(_CONTADOR_ESCRITAS)
+        dias = ((inicio + timedelta(days=deslocamento)) for deslocamento in range(max(0, (fim - inicio).days) + 1))
+        return (limpezas, *(self._contadores.ler(self._contadores.indice_dia(dia)) for dia in dias))
+
+    def _valida(self, chave, entrada):
+        corpo, versao, criada_em = entrada
+        return time.monotonic() - criada_em < self.ttl and versao == self._versao(chave)
+
+    def _remover(self, chave):
+        entrada = self._entradas.pop(chave, None)
+        if entrada is not None:
+            self._bytes -= len(entrada[0])
+
+    def _guardar(self, chave, corpo, versao):
+        if len(corpo) > self.maximo_bytes:
+            return
+        self._remover(chave)
+        self._entradas[chave] = (corpo, versao, time.monotonic())
+        self._bytes += len(corpo)
+        while self._entradas and (len(self._entradas) > self.maximo_entradas or self._bytes > self.maximo_bytes):
+            _, (antigo, _, _) = self._entradas.popitem(last=False)
+            self._bytes -= len(antigo)
+
+    def obter(self, chave, calcular):
+        if not self.ativo():
+            return calcular()
+
+        with self._lock:
+            entrada = self._entradas.get(chave)
+            if entrada is not None:
+                if self._valida(chave, entrada):
+                    self._entradas.move_to_end(chave)
+                    self.acertos += 1
+                    return entrada[0]
+                self._remover(chave)
+                self.invalidadas += 1
+            pendente = self._em_andamento.get(chave)
+            responsavel = pendente is None
+            if responsavel:
+                pendente = self._em_andamento[chave] = _Pendente()
+                self.falhas += 1
+            else:
+                self.coalescidas += 1
+
+        # Requisições iguais ao mesmo tempo esperam a mesma consulta.
+        if not responsavel:
+            pendente.evento.wait()
+            if pendente.erro is not None:
+                raise pendente.erro
+            return pendente.resultado
+
+        # A versão é lida antes da consulta: uma gravação durante a consulta
+        # já deixa a entrada inválida.
+        versao = self._versao(chave)
+        try:
+            corpo = calcular()
+            pendente.resultado = corpo
+            with self._lock:
+                self._guardar(chave, corpo, versao)
+            return corpo
+        except Exception as exc:
+            pendente.erro = exc
+            raise
+        finally:
+            with self._lock:
+                self._em_andamento.pop(chave, None)
+            pendente.evento.set()
+
+    def invalidar(self, timestamp):
+        # Chamado depois do commit de uma leitura com esse timestamp.
+        self._contadores.incrementar(self._contadores.indice_dia(timestamp.date()))
+        self._contadores.incrementar(_CONTADOR_ESCRITAS)
+
+    def invalidar_tudo(self):
+        self._contadores.incrementar(_CONTADOR_LIMPEZAS)
+        self._contadores.incrementar(_CONTADOR_ESCRITAS)
+
+    def estado(self):
+        with self._lock:
+            entradas = len(self._entradas)
+            tamanho = self._bytes
+        consultas = self.acertos + self.falhas + self.coalescidas
+        return {
+            "ativo": self.ativo(),
+            "entradas": entradas,
+            "bytes": tamanho,
+            "acertos": self.acertos,
+            "falhas": self.falhas,
+            "coalescidas": self.coalescidas,
+            "invalidadas": self.invalidadas,
+            "taxa_acerto": round((self.acertos + self.coalescidas) / consultas, 4) if consultas else None,
+        }
@@ -0,0 +1,294 @@
+﻿import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+from models import CameraLPR
+
+logger = logging.getLogger("CAMERAS")
+
+JANELA_TAXA_MINUTOS = 5
+
+
+def _ler_inteiro_env(chave, padrao, minimo=0):
+    valor = os.getenv(chave, "").strip()
+    if not valor:
+        return padrao
+    try:
+        return max(minimo, int(valor))
+    except ValueError:
+        logger.warning(f"Valor inválido em {chave}='{valor}', usando {padrao}")
+        return padrao
+
+
+class _EstadoCamera:
+    __slots__ = (
+        "dispositivo_id",
+        "nome",
+        "modelo",
+        "ultimo_ip",
+        "ultimo_contato",
+        "ultimo_evento",
+        "total_eventos",
+        "total_duplicados",
+        "bytes_recebidos",
+        "bytes_ultimo",
+        "bytes_maximo",
+        "tempo_total_ms",
+        "eventos_medidos",
+        "eventos_por_minuto",
+        "pendente_eventos",
+        "pendente_duplicados",
+        "pendente_bytes",
+        "alterado",
+    )
+
+    def __init__(self, dispositivo_id):
+        self.dispositivo_id = dispositivo_id
+        self.nome = None
+        self.modelo = None
+        self.ultimo_ip = None
+        self.ultimo_contato = None
+        self.ultimo_evento = None
+        self.total_eventos = 0
+        self.total_duplicados = 0
+        self.bytes_recebidos = 0
+        self.bytes_ultimo = 0
+        self.bytes_maximo = 0
+        self.tempo_total_ms = 0.0
+        self.eventos_medidos = 0
+        self.eventos_por_minuto = deque()
+        self.pendente_eventos = 0
+        self.pendente_duplicados = 0
+        self.pendente_bytes = 0
+        self.alterado = False
+
+    def contar_minuto(self, agora):
+        minuto = int(agora // 60)
+        if self.eventos_por_minuto and self.eventos_por_minuto[-1][0] == minuto:
+            self.eventos_por_minuto[-1][1] += 1
+        else:
+            self.eventos_por_minuto.append([minuto, 1])
+        self._descartar_minutos_antigos(minuto)
+
+    def _descartar_minutos_antigos(self, minuto_atual):
+        limite = minuto_atual - JANELA_TAXA_MINUTOS
+        while self.eventos_por_minuto and self.eventos_por_minuto[0][0] <= limite:
+            self.eventos_por_minuto.popleft()
+
+    def taxa_por_minuto(self, agora):
+        self._descartar_minutos_antigos(int(agora // 60))
+        total = sum(contagem for _, contagem in self.eventos_por_minuto)
+        return total / JANELA_TAXA_MINUTOS
+
+
+class RegistroCameras:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cameras = {}
+        self.carregar_configuracoes()
+
+    def carregar_configuracoes(self):
+        self.limite_silencio_segundos = _ler_inteiro_env("CAMERA_SILENCIO_SEGUNDOS", 300, minimo=10)
+        self.limite_eventos_minuto = _ler_inteiro_env("CAMERA_LIMITE_EVENTOS_MINUTO", 120, minimo=1)
+        self.limite_processamento_ms = _ler_inteiro_env("CAMERA_LIMITE_PROCESSAMENTO_MS", 1000, minimo=1)
+
+    def _obter(self, dispositivo_id):
+        estado = self._cameras.get(dispositivo_id)
+        if estado is None:
+            estado = _EstadoCamera(dispositivo_id)
+            self._cameras[dispositivo_id] = estado
+        return estado
+
+    def registrar_contato(self, dispositivo_id, ip=None, nome=None, modelo=None):
+        if not dispositivo_id:
+            return
+        with self._lock:
+            estado = self._obter(dispositivo_id)
+            estado.ultimo_contato = datetime.now()
+            if ip:
+                estado.ultimo_ip = ip
+            if nome:
+                estado.nome = nome
+            if modelo:
+                estado.modelo = modelo
+            estado.alterado = True
+
+    def registrar_evento(self, dispositivo_id, tamanho_payload=0, duracao_ms=0.0, duplicado=False, ip=None):
+        if not dispositivo_id:
+            return
+        agora = time.time()
+        tamanho_payload = max(0, int(tamanho_payload or 0))
+        with self._lock:
+            estado = self._obter(dispositivo_id)
+            estado.ultimo_contato = datetime.fromtimestamp(agora)
+            estado.ultimo_evento = estado.ultimo_contato
+            if ip:
+                estado.ultimo_ip = ip
+            estado.total_eventos += 1
+            estado.pendente_eventos += 1
+            if duplicado:
+                estado.total_duplicados += 1
+                estado.pendente_duplicados += 1
+            estado.bytes_recebidos += tamanho_payload
+            estado.pendente_bytes += tamanho_payload
+            estado.bytes_ultimo = tamanho_payload
+            estado.bytes_maximo = max(estado.bytes_maximo, tamanho_payload)
+            estado.tempo_total_ms += duracao_ms
+            estado.eventos_medidos += 1
+            estado.contar_minuto(agora)
+            estado.alterado = True
+
+    def _classificar(self, estado, agora, taxa, tempo_medio_ms):
+        if estado.ultimo_contato is None:
+            return "desconhecida"
+        if (agora - estado.ultimo_contato).total_seconds() > self.limite_silencio_segundos:
+            return "silenciosa"
+        if taxa > self.limite_eventos_minuto:
+            return "inundando"
+        if tempo_medio_ms > self.limite_processamento_ms:
+            return "lenta"
+        return "online"
+
+    def listar(self):
+        agora = datetime.now()
+        agora_ts = time.time()
+        resultado = []
+        with self._lock:
+            for estado in self._cameras.values():
+                taxa = estado.taxa_por_minuto(agora_ts)
+                tempo_medio_ms = estado.tempo_total_ms / estado.eventos_medidos if estado.eventos_medidos else 0.0
+                resultado.append(
+                    {
+                        "dispositivo_id": estado.dispositivo_id,
+                        "nome": estado.nome,
+                        "modelo": estado.modelo,
+                        "ultimo_ip": estado.ultimo_ip,
+                        "ultimo_contato": estado.ultimo_contato.isoformat() if estado.ultimo_contato else None,
+                        "ultimo_evento": estado.ultimo_evento.isoformat() if estado.ultimo_evento else None,
+                        "segundos_sem_contato": (
+                            int((agora - estado.ultimo_contato).total_seconds()) if estado.ultimo_contato else None
+                        ),
+                        "eventos_por_minuto": round(taxa, 2),
+                        "total_eventos": estado.total_eventos,
+                        "total_duplicados": estado.total_duplicados,
+                        "taxa_duplicados": (
+                            round(estado.total_duplicados / estado.total_eventos, 4) if estado.total_eventos else 0.0
+                        ),
+                        "bytes_recebidos": estado.bytes_recebidos,
+                        "bytes_medio": estado.bytes_recebidos // estado.total_eventos if estado.total_eventos else 0,
+                        "bytes_ultimo": estado.bytes_ultimo,
+                        "bytes_maximo": estado.bytes_maximo,
+                        "processamento_medio_ms": round(tempo_medio_ms, 2),
+                        "status": self._classificar(estado, agora, taxa, tempo_medio_ms),
+                    }
+                )
+        resultado.sort(key=lambda item: item["dispositivo_id"])
+        return resultado
+
+    def carregar(self, sessao):
+        linhas = sessao.query(CameraLPR).all()
+        with self._lock:
+            for linha in linhas:
+                estado = self._obter(linha.dispositivo_id)
+                estado.nome = estado.nome or linha.nome
+                estado.modelo = estado.modelo or linha.modelo
+                estado.ultimo_ip = estado.ultimo_ip or linha.ultimo_ip
+                if linha.ultimo_contato and (
+                    estado.ultimo_contato is None or linha.ultimo_contato > estado.ultimo_contato
+                ):
+                    estado.ultimo_contato = linha.ultimo_contato
+                estado.total_eventos += linha.total_eventos or 0
+                estado.total_duplicados += linha.total_duplicados or 0
+                estado.bytes_recebidos += linha.bytes_recebidos or 0
+        return len(linhas)
+
+    def _retirar_pendencias(self):
+        pendencias = []
+        with self._lock:
+            for estado in self._cameras.values():
+                if not estado.alterado:
+                    continue
+                pendencias.append(
+                    {
+                        "dispositivo_id": estado.dispositivo_id,
+                        "nome": estado.nome,
+                        "modelo": estado.modelo,
+                        "ultimo_ip": estado.ultimo_ip,
+                        "ultimo_contato": estado.ultimo_contato,
+                        "eventos": estado.pendente_eventos,
+                        "duplicados": estado.pendente_duplicados,
+                        "bytes": estado.pendente_bytes,
+                    }
+                )
+                estado.pendente_eventos = 0
+                estado.pendente_duplicados = 0
+                estado.pendente_bytes = 0
+                estado.alterado = False
+        return pendencias
+
+    def _devolver_pendencias(self, pendencias):
+        with self._lock:
+            for item in pendencias:
+                estado = self._obter(item["dispositivo_id"])
+                estado.pendente_eventos += item["eventos"]
+                estado.pendente_duplicados += item["duplicados"]
+                estado.pendente_bytes += item["bytes"]
+                estado.alterado = True
+
+    def _aplicar_pendencia(self, sessao, item):
+        valores = {
+            CameraLPR.total_eventos: CameraLPR.total_eventos + item["eventos"],
+            CameraLPR.total_duplicados: CameraLPR.total_duplicados + item["duplicados"],
+            CameraLPR.bytes_recebidos: CameraLPR.bytes_recebidos + item["bytes"],
+            CameraLPR.ultimo_contato: item["ultimo_contato"],
+        }
+        for campo in ("nome", "modelo", "ultimo_ip"):
+            if item[campo]:
+                valores[getattr(CameraLPR, campo)] = item[campo]
+
+        atualizados = (
+            sessao.query(CameraLPR)
+            .filter(CameraLPR.dispositivo_id == item["dispositivo_id"])
+            .update(valores, synchronize_session=False)
+        )
+        if atualizados:
+            return
+
+        sessao.add(
+            CameraLPR(
+                dispositivo_id=item["dispositivo_id"],
+                nome=item["nome"],
+                modelo=item["modelo"],
+                ultimo_ip=item["ultimo_ip"],
+                ultimo_contato=item["ultimo_contato"],
+                total_eventos=item["eventos"],
+                total_duplicados=item["duplicados"],
+                bytes_recebidos=item["bytes"],
+            )
+        )
+        sessao.flush()
+
+    def persistir(self, sessao):
+        pendencias = self._retirar_pendencias()
+        if not pendencias:
+            return 0
+
+        try:
+            for item in pendencias:
+                try:
+                    with sessao.begin_nested():
+                        self._aplicar_pendencia(sessao, item)
+                except IntegrityError:
+                    self._aplicar_pendencia(sessao, item)
+            sessao.commit()
+        except Exception:
+            sessao.rollback()
+            self._devolver_pendencias(pendencias)
+            raise
+
+        return len(pendencias)
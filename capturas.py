@@ -0,0 +1,291 @@
+﻿import base64
+import binascii
+import hashlib
+import logging
+import os
+import uuid
+from datetime import datetime
+
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import CapturaLPR, EntradaLPR
+
+logger = logging.getLogger("CAPTURAS")
+
+TAMANHO_MINIMO_IMAGEM = 1000
+# Múltiplo de 4 para que cada bloco base64 seja decodificado isoladamente.
+TAMANHO_BLOCO_BASE64 = 64 * 1024
+TAMANHO_LOTE_RETENCAO = 2000
+# 8 colunas por linha no upsert: abaixo do limite de 999 parâmetros do SQLite.
+TAMANHO_LOTE_REFERENCIAS = 100
+
+
+class ImagemInvalida(ValueError):
+    pass
+
+
+class CapturaArmazenada:
+    __slots__ = ("hash", "caminho", "caminho_absoluto", "tamanho")
+
+    def __init__(self, hash_imagem, caminho, caminho_absoluto, tamanho):
+        self.hash = hash_imagem
+        self.caminho = caminho
+        self.caminho_absoluto = caminho_absoluto
+        self.tamanho = tamanho
+
+
+def caminho_relativo(hash_imagem):
+    # Chave do backend de armazenamento: sempre com "/", também no Windows.
+    return f"captures/{hash_imagem[:2]}/{hash_imagem}.jpg"
+
+
+def hash_do_caminho(caminho):
+    # captures/ab/<hash>.jpg ou, depois da recompressão, <hash>-n<nivel>.<ext>
+    nome = caminho.replace("\\", "/").rsplit("/", 1)[-1]
+    return nome.split(".", 1)[0].split("-n", 1)[0]
+
+
+def caminho_atual(sessao, caminho):
+    # Caminho vigente do blob de uma chave antiga: mensagens na fila do
+    # WhatsApp guardam o caminho do momento da leitura, e a recompressão pode
+    # ter trocado o arquivo desde então.
+    return sessao.query(CapturaLPR.caminho).filter(CapturaLPR.hash == hash_do_caminho(caminho)).scalar()
+
+
+def _extrair_base64(conteudo):
+    if conteudo.startswith("data:image/") and "," in conteudo:
+        conteudo = conteudo.split(",", 1)[1]
+    if any(caractere in conteudo for caractere in "\r\n \t"):
+        conteudo = "".join(conteudo.split())
+    return conteudo
+
+
+def decodificar_para_arquivo(conteudo, diretorio_temporario):
+    # Decodifica o base64 em blocos, alimentando o sha256 e o arquivo
+    # temporário ao mesmo tempo; a imagem nunca é montada inteira em memória.
+    dados = _extrair_base64(conteudo)
+    os.makedirs(diretorio_temporario, exist_ok=True)
+    caminho_temporario = os.path.join(diretorio_temporario, f".{uuid.uuid4().hex}.tmp")
+    resumo = hashlib.sha256()
+    tamanho = 0
+
+    try:
+        with open(caminho_temporario, "wb") as arquivo:
+            for inicio in range(0, len(dados), TAMANHO_BLOCO_BASE64):
+                bloco = base64.b64decode(dados[inicio : inicio + TAMANHO_BLOCO_BASE64])
+                resumo.update(bloco)
+                arquivo.write(bloco)
+                tamanho += len(bloco)
+    except (binascii.Error, ValueError) as exc:
+        os.remove(caminho_temporario)
+        raise ImagemInvalida(f"Base64 inválido: {exc}") from exc
+    except Exception:
+        os.remove(caminho_temporario)
+        raise
+
+    if tamanho < TAMANHO_MINIMO_IMAGEM:
+        os.remove(caminho_temporario)
+        raise ImagemInvalida(f"Imagem muito pequena ({tamanho} bytes)")
+
+    return resumo.hexdigest(), caminho_temporario, tamanho
+
+
+def _ajustar_referencias(sessao, hash_imagem, caminho, tamanho, delta):
+    _ajustar_referencias_lote(sessao, [(hash_imagem, caminho, tamanho, delta)])
+
+
+def _ajustar_referencias_lote(sessao, itens):
+    dialeto = sessao.get_bind().dialect.name
+    modulo = postgresql if dialeto == "postgresql" else sqlite
+    agora = datetime.utcnow()
+    comando = modulo.insert(CapturaLPR).values(
+        [
+            {
+                "hash": hash_imagem,
+                "caminho": caminho,
+                "tamanho": tamanho,
+                "tamanho_original": tamanho,
+                "nivel": 0,
+                "referencias": delta,
+                "criado_em": agora,
+                "ultimo_uso": agora,
+            }
+            for hash_imagem, caminho, tamanho, delta in itens
+        ]
+    )
+    comando = comando.on_conflict_do_update(
+        index_elements=[CapturaLPR.hash],
+        set_={"referencias": CapturaLPR.referencias + comando.excluded.referencias, "ultimo_uso": agora},
+    )
+    sessao.execute(comando)
+
+
+def referenciar(sessao, hash_imagem, caminho, tamanho=0):
+    _ajustar_referencias(sessao, hash_imagem, caminho, tamanho, 1)
+
+
+def liberar(sessao, hash_imagem, quantidade=1):
+    if not hash_imagem:
+        return
+    sessao.query(CapturaLPR).filter(CapturaLPR.hash == hash_imagem).update(
+        {CapturaLPR.referencias: CapturaLPR.referencias - quantidade},
+        synchronize_session=False,
+    )
+
+
+def armazenar(sessao, conteudo, armazenamento):
+    hash_imagem, caminho_temporario, tamanho = decodificar_para_arquivo(
+        conteudo,
+        armazenamento.diretorio_temporario,
+    )
+    relativo = caminho_relativo(hash_imagem)
+
+    try:
+        # A referência é gravada antes de conferir o arquivo: com a linha do
+        # blob bloqueada, a retenção e a recompressão não conseguem trocá-lo
+        # entre a conferência e o commit.
+        referenciar(sessao, hash_imagem, relativo, tamanho)
+        atual = sessao.query(CapturaLPR.caminho).filter(CapturaLPR.hash == hash_imagem).scalar() or relativo
+        if armazenamento.existe(atual):
+            os.remove(caminho_temporario)
+            return CapturaArmazenada(hash_imagem, atual, armazenamento.caminho_local(atual), tamanho)
+
+        armazenamento.gravar(relativo, caminho_temporario)
+        if atual != relativo:
+            _restaurar_original(sessao, hash_imagem, relativo, tamanho)
+    except Exception:
+        if os.path.exists(caminho_temporario):
+            os.remove(caminho_temporario)
+        raise
+
+    return CapturaArmazenada(hash_imagem, relativo, armazenamento.caminho_local(relativo), tamanho)
+
+
+def armazenar_lote(sessao, itens, armazenamento):
+    # Imagens já decodificadas (importação em lote), como
+    # (hash, caminho_temporario, tamanho, referencias): as referências e os
+    # caminhos atuais vão em poucos comandos; só a cópia é por imagem.
+    # Devolve hash -> caminho. Os arquivos temporários são consumidos.
+    caminhos = {}
+    try:
+        for inicio in range(0, len(itens), TAMANHO_LOTE_REFERENCIAS):
+            lote = itens[inicio : inicio + TAMANHO_LOTE_REFERENCIAS]
+            _ajustar_referencias_lote(
+                sessao,
+                [(hash_imagem, caminho_relativo(hash_imagem), tamanho, referencias) for hash_imagem, _, tamanho, referencias in lote],
+            )
+            atuais = dict(
+                sessao.query(CapturaLPR.hash, CapturaLPR.caminho)
+                .filter(CapturaLPR.hash.in_([hash_imagem for hash_imagem, _, _, _ in lote]))
+                .all()
+            )
+            for hash_imagem, caminho_temporario, tamanho, _ in lote:
+                relativo = caminho_relativo(hash_imagem)
+                atual = atuais.get(hash_imagem) or relativo
+                if armazenamento.existe(atual):
+                    os.remove(caminho_temporario)
+                    caminhos[hash_imagem] = atual
+                    continue
+                armazenamento.gravar(relativo, caminho_temporario)
+                if atual != relativo:
+                    _restaurar_original(sessao, hash_imagem, relativo, tamanho)
+                caminhos[hash_imagem] = relativo
+    finally:
+        for _, caminho_temporario, _, _ in itens:
+            if os.path.exists(caminho_temporario):
+                os.remove(caminho_temporario)
+    return caminhos
+
+
+def _restaurar_original(sessao, hash_imagem, relativo, tamanho):
+    # O arquivo recomprimido sumiu: volta a apontar para o original recém-gravado.
+    sessao.query(CapturaLPR).filter(CapturaLPR.hash == hash_imagem).update(
+        {
+            CapturaLPR.caminho: relativo,
+            CapturaLPR.tamanho: tamanho,
+            CapturaLPR.tamanho_original: tamanho,
+            CapturaLPR.nivel: 0,
+        },
+        synchronize_session=False,
+    )
+    atualizar_caminho_leituras(sessao, hash_imagem, relativo)
+
+
+def atualizar_caminho_leituras(sessao, hash_imagem, caminho):
+    sessao.query(EntradaLPR).filter(EntradaLPR.hash_imagem == hash_imagem).update(
+        {EntradaLPR.caminho_imagem: caminho},
+        synchronize_session=False,
+    )
+
+
+def liberar_expiradas(sessao, limite):
+    # Desvincula imagens de leituras anteriores ao limite; o blob só é apagado
+    # depois, quando nenhuma leitura o referencia.
+    liberadas = 0
+    while True:
+        linhas = (
+            sessao.query(EntradaLPR.id, EntradaLPR.hash_imagem)
+            .filter(EntradaLPR.timestamp < limite, EntradaLPR.hash_imagem.isnot(None))
+            .limit(TAMANHO_LOTE_RETENCAO)
+            .all()
+        )
+        if not linhas:
+            return liberadas
+
+        por_hash = {}
+        for _, hash_imagem in linhas:
+            por_hash[hash_imagem] = por_hash.get(hash_imagem, 0) + 1
+
+        sessao.query(EntradaLPR).filter(EntradaLPR.id.in_([linha_id for linha_id, _ in linhas])).update(
+            {EntradaLPR.hash_imagem: None, EntradaLPR.caminho_imagem: None},
+            synchronize_session=False,
+        )
+        for hash_imagem, quantidade in por_hash.items():
+            liberar(sessao, hash_imagem, quantidade)
+        sessao.commit()
+        liberadas += len(linhas)
+
+
+def remover_orfas(sessao, armazenamento):
+    removidas = 0
+    orfas = (
+        sessao.query(CapturaLPR.hash, CapturaLPR.caminho)
+        .filter(CapturaLPR.referencias <= 0)
+        .limit(TAMANHO_LOTE_RETENCAO)
+        .all()
+    )
+    for hash_imagem, caminho in orfas:
+        apagadas = (
+            sessao.query(CapturaLPR)
+            .filter(CapturaLPR.hash == hash_imagem, CapturaLPR.referencias <= 0)
+            .delete(synchronize_session=False)
+        )
+        if apagadas:
+            try:
+                armazenamento.remover(caminho)
+            except Exception as exc:
+                sessao.rollback()
+                logger.warning(f"Não foi possível remover captura {caminho}: {exc}")
+                continue
+            removidas += 1
+        sessao.commit()
+    return removidas
+
+
+def resumo(sessao):
+    total, referencias, tamanho, original = sessao.query(
+        func.count(CapturaLPR.hash),
+        func.coalesce(func.sum(CapturaLPR.referencias), 0),
+        func.coalesce(func.sum(CapturaLPR.tamanho), 0),
+        func.coalesce(func.sum(func.coalesce(CapturaLPR.tamanho_original, CapturaLPR.tamanho)), 0),
+    ).one()
+    por_nivel = dict(sessao.query(CapturaLPR.nivel, func.count(CapturaLPR.hash)).group_by(CapturaLPR.nivel).all())
+    return {
+        "blobs": total,
+        "referencias": int(referencias),
+        "bytes": int(tamanho),
+        "bytes_originais": int(original),
+        "bytes_economizados": int(original) - int(tamanho),
+        "por_nivel": {str(nivel): quantidade for nivel, quantidade in por_nivel.items()},
+    }
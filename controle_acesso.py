@@ -0,0 +1,239 @@
+﻿import ipaddress
+import logging
+import os
+import threading
+import time
+from bisect import bisect_right
+from functools import lru_cache
+
+logger = logging.getLogger("CONTROLE_ACESSO")
+
+# Grupo de rota -> (variável de IPs permitidos, variável de IPs negados).
+GRUPOS = {
+    "frontend": ("FRONTEND_ALLOWED_IPS", "FRONTEND_DENIED_IPS"),
+    "api": ("API_ALLOWED_IPS", "API_DENIED_IPS"),
+    "camera": ("CAMERA_ALLOWED_IPS", "CAMERA_DENIED_IPS"),
+}
+
+_PREFIXOS_GRUPO = (
+    ("/NotificationInfo/", "camera"),
+    ("/api/", "api"),
+    ("/assets/", "frontend"),
+    ("/static/", "frontend"),
+)
+_ROTAS_FRONTEND = {"/", "/favicon.ico"}
+
+# Proxies reversos cujos X-Forwarded-For / X-Real-IP são aceitos.
+VARIAVEL_PROXIES = "PROXIES_CONFIAVEIS"
+
+
+def grupo_da_rota(caminho):
+    if caminho in _ROTAS_FRONTEND:
+        return "frontend"
+    for prefixo, grupo in _PREFIXOS_GRUPO:
+        if caminho.startswith(prefixo):
+            return grupo
+    return None
+
+
+@lru_cache(maxsize=4096)
+def _converter_ip(ip):
+    try:
+        endereco = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    if endereco.version == 6 and endereco.ipv4_mapped is not None:
+        endereco = endereco.ipv4_mapped
+    return endereco.version, int(endereco)
+
+
+class ListaIPs:
+    # Redes compiladas em intervalos [inicio, fim] ordenados e fundidos;
+    # a consulta é uma busca binária por versão de IP.
+    __slots__ = ("entradas", "_inicios", "_fins")
+
+    def __init__(self, entradas, nome_variavel=""):
+        self.entradas = []
+        intervalos = {4: [], 6: []}
+        for item in entradas:
+            try:
+                rede = ipaddress.ip_network(item, strict=False)
+            except ValueError:
+                logger.warning(f"{nome_variavel or 'IP'} inválido ignorado: {item}")
+                continue
+            self.entradas.append(item)
+            intervalos[rede.version].append((int(rede.network_address), int(rede.broadcast_address)))
+
+        self._inicios = {}
+        self._fins = {}
+        for versao, lista in intervalos.items():
+            inicios, fins = [], []
+            for inicio, fim in sorted(lista):
+                if fins and inicio <= fins[-1] + 1:
+                    fins[-1] = max(fins[-1], fim)
+                else:
+                    inicios.append(inicio)
+                    fins.append(fim)
+            self._inicios[versao] = inicios
+            self._fins[versao] = fins
+
+    def __bool__(self):
+        return bool(self.entradas)
+
+    def __len__(self):
+        return len(self.entradas)
+
+    def contem(self, ip):
+        convertido = _converter_ip(ip) if ip else None
+        if convertido is None:
+            return False
+        versao, valor = convertido
+        indice = bisect_right(self._inicios[versao], valor) - 1
+        return indice >= 0 and self._fins[versao][indice] >= valor
+
+
+class _RegraGrupo:
+    __slots__ = ("permitidos", "negados")
+
+    def __init__(self, permitidos, negados):
+        self.permitidos = permitidos
+        self.negados = negados
+
+    def permitido(self, ip):
+        if self.negados and self.negados.contem(ip):
+            return False
+        if not self.permitidos:
+            return True
+        return self.permitidos.contem(ip)
+
+
+def _separar_lista(valor):
+    return [item.strip() for item in (valor or "").split(",") if item.strip()]
+
+
+class ControleAcesso:
+    def __init__(self, caminho_env=None, intervalo_recarga=None):
+        if intervalo_recarga is None:
+            try:
+                intervalo_recarga = float(os.getenv("ACESSO_RECARGA_SEGUNDOS", "5").strip() or 5)
+            except ValueError:
+                intervalo_recarga = 5.0
+        self.caminho_env = caminho_env
+        self.intervalo_recarga = max(0.0, intervalo_recarga)
+
+        self._regras = {}
+        self._proxies = ListaIPs([])
+        self._assinatura = None
+        self._mtime_env = None
+        self._proxima_verificacao = 0.0
+        self._lock = threading.Lock()
+
+    def _variaveis(self):
+        return [variavel for par in GRUPOS.values() for variavel in par] + [VARIAVEL_PROXIES]
+
+    def _sincronizar_env(self):
+        if not self.caminho_env:
+            return
+        try:
+            mtime = os.path.getmtime(self.caminho_env)
+        except OSError:
+            return
+        if mtime == self._mtime_env:
+            return
+
+        primeira_leitura = self._mtime_env is None
+        self._mtime_env = mtime
+        if primeira_leitura:
+            return
+
+        try:
+            from dotenv import dotenv_values
+        except ImportError:
+            return
+
+        valores = dotenv_values(self.caminho_env)
+        for variavel in self._variaveis():
+            if variavel in valores:
+                os.environ[variavel] = valores[variavel] or ""
+            else:
+                os.environ.pop(variavel, None)
+
+    def recarregar(self, forcar=False):
+        with self._lock:
+            self._sincronizar_env()
+            assinatura = tuple(os.getenv(variavel, "").strip() for variavel in self._variaveis())
+            if not forcar and assinatura == self._assinatura:
+                return False
+
+            regras = {}
+            for grupo, (var_permitidos, var_negados) in GRUPOS.items():
+                regras[grupo] = _RegraGrupo(
+                    ListaIPs(_separar_lista(os.getenv(var_permitidos)), var_permitidos),
+                    ListaIPs(_separar_lista(os.getenv(var_negados)), var_negados),
+                )
+
+            recarga = self._assinatura is not None
+            self._regras = regras
+            self._proxies = ListaIPs(_separar_lista(os.getenv(VARIAVEL_PROXIES)), VARIAVEL_PROXIES)
+            self._assinatura = assinatura
+            self._proxima_verificacao = time.monotonic() + self.intervalo_recarga
+
+        if recarga:
+            logger.warning(f"Controle de acesso recarregado: {self.resumo()}")
+        return True
+
+    def _verificar_recarga(self):
+        agora = time.monotonic()
+        if agora < self._proxima_verificacao:
+            return
+        self._proxima_verificacao = agora + self.intervalo_recarga
+        try:
+            self.recarregar()
+        except Exception as exc:
+            logger.error(f"Erro ao recarregar controle de acesso: {exc}")
+
+    def regra(self, grupo):
+        self._verificar_recarga()
+        return self._regras.get(grupo)
+
+    def permitido(self, grupo, ip):
+        regra = self.regra(grupo)
+        return regra is None or regra.permitido(ip)
+
+    def permitido_rota(self, caminho, ip):
+        grupo = grupo_da_rota(caminho)
+        if grupo is None:
+            return True, None
+        return self.permitido(grupo, ip), grupo
+
+    def ip_cliente(self, endereco_socket, encaminhado_para="", ip_real=""):
+        # Os cabeçalhos de proxy só valem quando a conexão vem de um proxy
+        # confiável; do X-Forwarded-For vale o último salto que não é proxy,
+        # já que o cliente pode escrever o que quiser nos primeiros.
+        self._verificar_recarga()
+        ip = endereco_socket or ""
+        if self._proxies.contem(ip):
+            saltos = _separar_lista(encaminhado_para)
+            if saltos:
+                ip = saltos[0]
+                for salto in reversed(saltos):
+                    if not self._proxies.contem(salto):
+                        ip = salto
+                        break
+            elif ip_real and ip_real.strip():
+                ip = ip_real.strip()
+        if ip.startswith("::ffff:"):
+            ip = ip[len("::ffff:") :]
+        return ip
+
+    def restrito(self, grupo):
+        regra = self._regras.get(grupo)
+        return regra is not None and bool(regra.permitidos)
+
+    def resumo(self):
+        partes = []
+        for grupo, regra in self._regras.items():
+            permitidos = f"{len(regra.permitidos)} permitido(s)" if regra.permitidos else "todos permitidos"
+            partes.append(f"{grupo}: {permitidos}, {len(regra.negados)} negado(s)")
+        partes.append(f"proxies confiáveis: {len(self._proxies)}")
+        return "; ".join(partes)
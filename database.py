@@ -1,16 +1,21 @@
 ﻿from __future__ import annotations
 
+import itertools
 import logging
 import os
 import threading
+import time
+from collections import Counter
 from datetime import datetime, timedelta
 from typing import Optional
 from urllib.parse import quote_plus
 
-from sqlalchemy import create_engine, func, text
+from sqlalchemy import create_engine, func, inspect, select, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import sessionmaker
 
-from models import Base, EntradaLPR
+from models import Base, CapturaLPR, EntradaLPR, ResumoPlaca, RollupLPR, VisitaLPR
 
 logger = logging.getLogger("DATABASE")
 
@@ -27,6 +32,7 @@ _STORAGE_DIR = os.path.join(_BASE_DIR, "storage")
 _SQLITE_FILE = os.path.join(_STORAGE_DIR, "lpr_local.db")
 
 _DB_LOCK = threading.RLock()
+_CHAVE_LOCK_SCHEMA = 0x48524C53
 
 URL_BANCO = None
 engine = None
@@ -37,6 +43,21 @@ engine_postgres = None
 _modo_banco = "desconhecido"
 _aviso_senha_exemplo_emitido = False
 
+# Réplicas de leitura (opcionais) para consultas do painel e estatísticas.
+_replicas = []
+_contador_replicas = itertools.count()
+_verificador_replicas_pid = None
+# Estrutura já conferida no PostgreSQL por este processo (ou pelo pai antes
+# do fork): a sincronização periódica não repete o DDL.
+_estrutura_sqlite_pronta = False
+_estrutura_postgres_pronta = False
+# Atraso de replicação em segundos; 0 numa réplica em dia ou no primário.
+_SQL_ATRASO_REPLICA = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0 "
+    "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
 
 def _obter_url_postgres():
     global _aviso_senha_exemplo_emitido
@@ -101,17 +122,147 @@ def _criar_engine_sqlite():
     )
 
 
-def _criar_engine_postgres(url):
+def _criar_engine_postgres(url, pool_size=10, max_overflow=20):
     return create_engine(
         url,
-        connect_args={"options": "-c client_encoding=UTF8"},
-        pool_size=10,
-        max_overflow=20,
+        # Sem timeout, um host inacessível prende a inicialização no connect.
+        connect_args={
+            "options": "-c client_encoding=UTF8",
+            "connect_timeout": int(os.getenv("POSTGRES_TIMEOUT_CONEXAO", "5").strip() or 5),
+        },
+        pool_size=pool_size,
+        max_overflow=max_overflow,
         pool_pre_ping=True,
         echo=False,
     )
 
 
+def _garantir_colunas(connection):
+    inspetor = inspect(connection)
+    tabelas_existentes = set(inspetor.get_table_names())
+
+    for tabela in Base.metadata.sorted_tables:
+        if tabela.name not in tabelas_existentes:
+            continue
+
+        colunas_existentes = {coluna["name"] for coluna in inspetor.get_columns(tabela.name)}
+        for coluna in tabela.columns:
+            if coluna.name in colunas_existentes:
+                continue
+
+            tipo = coluna.type.compile(dialect=connection.dialect)
+            connection.execute(text(f'ALTER TABLE {tabela.name} ADD COLUMN "{coluna.name}" {tipo}'))
+            logger.info(f"Coluna {tabela.name}.{coluna.name} adicionada ao schema")
+
+
+class LeiturasDuplicadas(RuntimeError):
+    pass
+
+
+def _contar_leituras_duplicadas(connection):
+    tabela = EntradaLPR.__table__
+    grupos = (
+        select(func.count().label("total"))
+        .select_from(tabela)
+        .group_by(tabela.c.placa, tabela.c.timestamp)
+        .having(func.count() > 1)
+        .subquery()
+    )
+    return connection.execute(select(func.coalesce(func.sum(grupos.c.total - 1), 0))).scalar()
+
+
+def _remover_leituras_duplicadas(connection):
+    # Bancos anteriores ao índice único podem repetir (placa, timestamp):
+    # fica a primeira leitura gravada e a imagem das demais é liberada.
+    # Só pela migração explícita (migracoes.py), nunca na inicialização.
+    tabela = EntradaLPR.__table__
+    primeiras = select(func.min(tabela.c.id)).group_by(tabela.c.placa, tabela.c.timestamp)
+    duplicadas = connection.execute(
+        select(tabela.c.id, tabela.c.hash_imagem).where(tabela.c.id.not_in(primeiras))
+    ).all()
+    if not duplicadas:
+        return 0
+
+    ids = [linha_id for linha_id, _ in duplicadas]
+    for posicao in range(0, len(ids), 500):
+        connection.execute(tabela.delete().where(tabela.c.id.in_(ids[posicao : posicao + 500])))
+    por_hash = Counter(hash_imagem for _, hash_imagem in duplicadas if hash_imagem)
+    capturas = CapturaLPR.__table__
+    for hash_imagem, quantidade in por_hash.items():
+        connection.execute(
+            capturas.update()
+            .where(capturas.c.hash == hash_imagem)
+            .values(referencias=capturas.c.referencias - quantidade)
+        )
+    logger.info(f"{len(ids)} leitura(s) duplicada(s) (mesma placa e horário) removida(s) de {tabela.name}")
+    return len(ids)
+
+
+def _garantir_indices(connection):
+    inspetor = inspect(connection)
+    for tabela in Base.metadata.sorted_tables:
+        existentes = {indice["name"] for indice in inspetor.get_indexes(tabela.name)}
+        for indice in tabela.indexes:
+            if indice.name in existentes:
+                continue
+            if indice.unique and tabela is EntradaLPR.__table__:
+                duplicadas = _contar_leituras_duplicadas(connection)
+                if duplicadas:
+                    raise LeiturasDuplicadas(
+                        f"{tabela.name} tem {duplicadas} leitura(s) repetida(s) (mesma placa e horário) e o "
+                        f"índice único {indice.name} não pode ser criado. Com o serviço parado, rode "
+                        "`python migracoes.py remover-duplicadas` (remove as cópias e recalcula rollups e "
+                        "visitas) e inicie de novo."
+                    )
+            try:
+                with connection.begin_nested():
+                    indice.create(bind=connection)
+                logger.info(f"Índice {indice.name} criado")
+            except Exception as exc:
+                if indice.unique:
+                    # A deduplicação entre processos e o importador dependem
+                    # do índice único: sem ele, a inicialização para.
+                    raise RuntimeError(
+                        f"Não foi possível criar o índice único {indice.name}: {_formatar_erro(exc)}"
+                    ) from exc
+                logger.warning(f"Não foi possível criar índice {indice.name}: {_formatar_erro(exc)}")
+
+
+def _criar_estrutura(alvo_engine, remover_duplicadas=False):
+    with alvo_engine.connect() as connection:
+        postgres = connection.dialect.name == "postgresql"
+        if postgres:
+            # Várias instâncias podem subir ao mesmo tempo: o DDL roda uma de cada vez.
+            connection.execute(text("SELECT pg_advisory_lock(:chave)"), {"chave": _CHAVE_LOCK_SCHEMA})
+        try:
+            Base.metadata.create_all(bind=connection)
+            _garantir_colunas(connection)
+            removidas = _remover_leituras_duplicadas(connection) if remover_duplicadas else 0
+            _garantir_indices(connection)
+            connection.commit()
+            return removidas
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            if postgres:
+                connection.execute(text("SELECT pg_advisory_unlock(:chave)"), {"chave": _CHAVE_LOCK_SCHEMA})
+                connection.commit()
+
+
+def bloquear_chave_transacao(sessao, chave):
+    bind = sessao.get_bind()
+    if bind.dialect.name != "postgresql":
+        return
+    sessao.execute(text("SELECT pg_advisory_xact_lock(hashtext(:chave))"), {"chave": chave})
+
+
+def reiniciar_pools_apos_fork():
+    for alvo in (engine_sqlite, engine_postgres, *(replica.engine for replica in _replicas)):
+        if alvo is not None:
+            alvo.dispose(close=False)
+
+
 def _testar_engine(alvo_engine):
     with alvo_engine.connect() as connection:
         connection.execute(text("SELECT 1")).fetchone()
@@ -205,12 +356,165 @@ def nova_sessao():
     return factory()
 
 
-def inicializar_banco():
-    global URL_BANCO, engine_sqlite, engine_postgres
+def _ler_env_inteiro(chave, padrao, minimo=0):
+    try:
+        return max(minimo, int(os.getenv(chave, str(padrao)).strip()))
+    except ValueError:
+        return padrao
+
+
+class _Replica:
+    __slots__ = ("nome", "engine", "fabrica", "saudavel", "atraso", "erro")
+
+    def __init__(self, url):
+        url = make_url(url)
+        self.nome = f"{url.host}:{url.port or 5432}"
+        self.engine = _criar_engine_postgres(
+            url,
+            pool_size=_ler_env_inteiro("REPLICA_POOL_SIZE", 5, minimo=1),
+            max_overflow=_ler_env_inteiro("REPLICA_POOL_OVERFLOW", 10),
+        )
+        self.fabrica = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        # Só recebe leituras depois da primeira verificação.
+        self.saudavel = False
+        self.atraso = None
+        self.erro = None
+
+
+def _obter_urls_replicas():
+    urls = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+    if urls:
+        validas = [url for url in urls if url.startswith("postgresql")]
+        if len(validas) != len(urls):
+            logger.error("DATABASE_REPLICA_URLS contém URL que não é PostgreSQL; ignorada")
+        return validas
+
+    # Mesmas credenciais do primário, só o host muda.
+    hosts = [host.strip() for host in os.getenv("POSTGRES_REPLICA_HOSTS", "").split(",") if host.strip()]
+    base = _obter_url_postgres()
+    if not hosts or not base:
+        return []
+    base = make_url(base)
+    urls = []
+    for host in hosts:
+        nome, _, porta = host.partition(":")
+        urls.append(base.set(host=nome, port=int(porta) if porta else base.port))
+    return urls
+
+
+def _verificar_replica(replica):
+    atraso_maximo = _ler_env_inteiro("REPLICA_ATRASO_MAXIMO_SEGUNDOS", 30)
+    try:
+        with replica.engine.connect() as connection:
+            replica.atraso = float(connection.execute(_SQL_ATRASO_REPLICA).scalar() or 0)
+        saudavel = atraso_maximo <= 0 or replica.atraso <= atraso_maximo
+        erro = None if saudavel else f"atraso de {replica.atraso:.1f}s acima de {atraso_maximo}s"
+    except Exception as exc:
+        saudavel = False
+        erro = _formatar_erro(exc)
+
+    if saudavel != replica.saudavel:
+        if saudavel:
+            logger.info(f"Réplica {replica.nome} disponível para leituras")
+        else:
+            logger.warning(f"Réplica {replica.nome} fora do rodízio: {erro}")
+    replica.saudavel = saudavel
+    replica.erro = erro
+
+
+def _garantir_verificador_replicas():
+    # A thread não sobrevive ao fork: cada worker inicia a sua.
+    global _verificador_replicas_pid
+    if not _replicas or _verificador_replicas_pid == os.getpid():
+        return
+    with _DB_LOCK:
+        if _verificador_replicas_pid == os.getpid():
+            return
+        _verificador_replicas_pid = os.getpid()
+    intervalo = _ler_env_inteiro("REPLICA_VERIFICACAO_SEGUNDOS", 10, minimo=1)
+
+    def worker():
+        while True:
+            for replica in _replicas:
+                _verificar_replica(replica)
+            time.sleep(intervalo)
+
+    threading.Thread(target=worker, daemon=True, name="verificador-replicas").start()
+
+
+def configurar_replicas():
+    global _replicas
+    replicas = []
+    for url in _obter_urls_replicas():
+        try:
+            replicas.append(_Replica(url))
+        except Exception as exc:
+            logger.warning(f"Réplica de leitura ignorada: {_formatar_erro(exc)}")
+    _replicas = replicas
+    if _replicas:
+        # O verificador sobe na primeira leitura de cada processo, nunca
+        # antes do fork dos workers.
+        logger.info(f"Réplicas de leitura: {', '.join(replica.nome for replica in _replicas)}")
+    return len(_replicas)
+
+
+def _escolher_replica():
+    # Com o SQLite ativo (primário fora), as réplicas não têm as leituras
+    # recentes: tudo fica no banco ativo.
+    if not _replicas or modo_banco_ativo() != "postgres":
+        return None
+    _garantir_verificador_replicas()
+    saudaveis = [replica for replica in _replicas if replica.saudavel]
+    if not saudaveis:
+        return None
+    return saudaveis[next(_contador_replicas) % len(saudaveis)]
+
+
+def executar_leitura(funcao):
+    # Consultas somente leitura: vão para uma réplica saudável em rodízio e,
+    # se ela falhar no meio, são refeitas no banco ativo.
+    replica = _escolher_replica()
+    if replica is not None:
+        sessao = replica.fabrica()
+        try:
+            return funcao(sessao)
+        except OperationalError as exc:
+            replica.saudavel = False
+            replica.erro = _formatar_erro(exc)
+            logger.warning(f"Réplica {replica.nome} falhou; consultando o primário: {replica.erro}")
+        finally:
+            sessao.close()
+
+    sessao = nova_sessao()
+    try:
+        return funcao(sessao)
+    finally:
+        sessao.close()
+
+
+def estado_replicas():
+    return [
+        {
+            "nome": replica.nome,
+            "saudavel": replica.saudavel,
+            "atraso_segundos": replica.atraso,
+            "erro": replica.erro,
+        }
+        for replica in _replicas
+    ]
+
+
+def inicializar_banco(criar_estrutura=True):
+    # Sem `criar_estrutura`, o DDL do SQLite local fica para criar_tabelas().
+    global URL_BANCO, engine_sqlite, engine_postgres, _estrutura_sqlite_pronta
 
     URL_BANCO = _obter_url_postgres()
     engine_sqlite = _criar_engine_sqlite()
-    Base.metadata.create_all(bind=engine_sqlite)
+    _estrutura_sqlite_pronta = False
+    if criar_estrutura:
+        _criar_estrutura(engine_sqlite)
+        _estrutura_sqlite_pronta = True
+    configurar_replicas()
 
     if URL_BANCO:
         try:
@@ -228,12 +532,43 @@ def inicializar_banco():
 
 
 def criar_tabelas():
+    global _estrutura_postgres_pronta, _estrutura_sqlite_pronta
     with _DB_LOCK:
         if engine is None:
             raise RuntimeError("Engine ativa não inicializada")
-        Base.metadata.create_all(bind=engine)
+        if not _estrutura_sqlite_pronta and engine is not engine_sqlite:
+            _criar_estrutura(engine_sqlite)
+            _estrutura_sqlite_pronta = True
+        _criar_estrutura(engine)
+        if engine is engine_sqlite:
+            _estrutura_sqlite_pronta = True
+        if engine is engine_postgres:
+            _estrutura_postgres_pronta = True
+
 
 
+
+def estrutura_pronta():
+    # DDL concluído no banco ativo (criar_tabelas ou promoção).
+    if engine is None:
+        return False
+    if engine is engine_postgres:
+        return _estrutura_postgres_pronta
+    return _estrutura_sqlite_pronta
+
+def remover_leituras_duplicadas():
+    # Migração explícita para o índice único (placa, timestamp): remove as
+    # cópias e cria os índices no SQLite local e no PostgreSQL ativo.
+    # Devolve [(modo, engine, removidas)].
+    global _estrutura_sqlite_pronta, _estrutura_postgres_pronta
+    with _DB_LOCK:
+        resultado = [("sqlite", engine_sqlite, _criar_estrutura(engine_sqlite, remover_duplicadas=True))]
+        _estrutura_sqlite_pronta = True
+        if engine is engine_postgres and engine_postgres is not None:
+            resultado.append(("postgres", engine_postgres, _criar_estrutura(engine_postgres, remover_duplicadas=True)))
+            _estrutura_postgres_pronta = True
+    return resultado
+
 def _ajustar_sequence_postgres(pg_session):
     pg_session.execute(
         text(
@@ -244,6 +579,10 @@ def _ajustar_sequence_postgres(pg_session):
 
 
 def _migrar_sqlite_para_postgres(sqlite_engine, postgres_engine):
+    import capturas
+    import estatisticas
+    import visitas
+
     sqlite_session_factory = sessionmaker(autocommit=False, autoflush=False, bind=sqlite_engine)
     pg_session_factory = sessionmaker(autocommit=False, autoflush=False, bind=postgres_engine)
 
@@ -256,7 +595,12 @@ def _migrar_sqlite_para_postgres(sqlite_engine, postgres_engine):
             return 0
 
         existing_ids = {row_id for (row_id,) in pg_session.query(EntradaLPR.id).all()}
+        # Os workers continuam gravando no PostgreSQL: os resumos das placas
+        # migradas ficam bloqueados até o commit (fora dos savepoints, que
+        # soltariam o lock no rollback).
+        visitas.bloquear_placas(pg_session, *(row.placa for row in sqlite_rows))
         migrated = 0
+        skipped = 0
 
         for row in sqlite_rows:
             target_id = row.id if row.id not in existing_ids else None
@@ -268,9 +612,21 @@ def _migrar_sqlite_para_postgres(sqlite_engine, postgres_engine):
                 caminho_imagem=row.caminho_imagem,
                 confianca=row.confianca,
                 timestamp=row.timestamp,
+                dispositivo_id=row.dispositivo_id,
+                hash_imagem=row.hash_imagem,
+                direcao=row.direcao,
             )
-            pg_session.add(new_record)
-            pg_session.flush()
+            try:
+                with pg_session.begin_nested():
+                    pg_session.add(new_record)
+                    pg_session.flush()
+                    estatisticas.incrementar(pg_session, new_record)
+                    visitas.registrar(pg_session, new_record)
+                    if row.hash_imagem:
+                        capturas.referenciar(pg_session, row.hash_imagem, row.caminho_imagem)
+            except IntegrityError:
+                skipped += 1
+                continue
             existing_ids.add(new_record.id)
             migrated += 1
 
@@ -278,9 +634,15 @@ def _migrar_sqlite_para_postgres(sqlite_engine, postgres_engine):
         pg_session.commit()
 
         sqlite_session.query(EntradaLPR).delete()
+        sqlite_session.query(RollupLPR).delete()
+        sqlite_session.query(CapturaLPR).delete()
+        sqlite_session.query(VisitaLPR).delete()
+        sqlite_session.query(ResumoPlaca).delete()
         sqlite_session.commit()
 
         logger.info(f"Migração SQLite -> PostgreSQL concluída: {migrated} registro(s)")
+        if skipped:
+            logger.info(f"Migração SQLite -> PostgreSQL: {skipped} registro(s) já existente(s) ignorado(s)")
         return migrated
 
     except Exception as exc:
@@ -294,8 +656,8 @@ def _migrar_sqlite_para_postgres(sqlite_engine, postgres_engine):
         pg_session.close()
 
 
-def tentar_promover_para_postgres_e_migrar():
-    global URL_BANCO, engine_postgres
+def tentar_promover_para_postgres_e_migrar(migrar=True):
+    global URL_BANCO, engine_postgres, _estrutura_postgres_pronta
 
     if URL_BANCO is None:
         URL_BANCO = _obter_url_postgres()
@@ -316,10 +678,12 @@ def tentar_promover_para_postgres_e_migrar():
         logger.warning(f"PostgreSQL ainda indisponível: {_formatar_erro(exc)}")
         return False, 0
 
-    Base.metadata.create_all(bind=engine_postgres)
+    if not _estrutura_postgres_pronta:
+        _criar_estrutura(engine_postgres)
+        _estrutura_postgres_pronta = True
 
     migrated = 0
-    if engine_sqlite is not None:
+    if migrar and engine_sqlite is not None:
         migrated = _migrar_sqlite_para_postgres(engine_sqlite, engine_postgres)
 
     promoted = False
@@ -331,13 +695,27 @@ def tentar_promover_para_postgres_e_migrar():
     return promoted, migrated
 
 
-def obter_registros_filtrados(
-    sessao,
-    placa: Optional[str] = None,
-    data_inicio: Optional[str] = None,
-    data_fim: Optional[str] = None,
-):
-    consulta = sessao.query(EntradaLPR)
+# Colunas servidas por /api/records, na ordem das tuplas de
+# obter_linhas_registros.
+COLUNAS_REGISTROS = (
+    EntradaLPR.id,
+    EntradaLPR.placa,
+    EntradaLPR.cor_placa,
+    EntradaLPR.cor_veiculo,
+    EntradaLPR.confianca,
+    EntradaLPR.caminho_imagem,
+    EntradaLPR.timestamp,
+    EntradaLPR.dispositivo_id,
+)
+
+
+def _aplicar_filtros_registros(consulta, placa, data_inicio, data_fim, dispositivo):
+    # Serve tanto para Query (ORM) quanto para select() (Core).
+    placa_normalizada = None
+    dt_inicio = dt_fim = None
+
+    if dispositivo and dispositivo.strip():
+        consulta = consulta.filter(EntradaLPR.dispositivo_id == dispositivo.strip())
 
     if placa and placa.strip():
         placa_normalizada = placa.replace("-", "").replace(" ", "").upper().strip()
@@ -363,4 +741,66 @@ def obter_registros_filtrados(
             except ValueError:
                 pass
 
-    return consulta.order_by(EntradaLPR.timestamp.desc()).all()
+    return consulta.order_by(EntradaLPR.timestamp.desc()), placa_normalizada, dt_inicio, dt_fim
+
+
+def _consultar_arquivo(arquivo, placa_normalizada, dt_inicio, dt_fim, dispositivo):
+    # Período informado: inclui as leituras já arquivadas nesse intervalo.
+    if arquivo is None or (dt_inicio is None and dt_fim is None):
+        return []
+    return arquivo.consultar(
+        placa_normalizada, dt_inicio, dt_fim, dispositivo.strip() if dispositivo and dispositivo.strip() else None
+    )
+
+
+def obter_registros_filtrados(
+    sessao,
+    placa: Optional[str] = None,
+    data_inicio: Optional[str] = None,
+    data_fim: Optional[str] = None,
+    dispositivo: Optional[str] = None,
+    arquivo=None,
+):
+    consulta, placa_normalizada, dt_inicio, dt_fim = _aplicar_filtros_registros(
+        sessao.query(EntradaLPR), placa, data_inicio, data_fim, dispositivo
+    )
+    registros = consulta.all()
+
+    arquivados = _consultar_arquivo(arquivo, placa_normalizada, dt_inicio, dt_fim, dispositivo)
+    if not arquivados:
+        return registros
+    # Um dia pode estar nos dois lados se o arquivamento parou antes de
+    # remover as leituras do banco.
+    vistos = {(registro.placa, registro.timestamp) for registro in registros}
+    registros.extend(registro for registro in arquivados if (registro.placa, registro.timestamp) not in vistos)
+    registros.sort(key=lambda registro: registro.timestamp, reverse=True)
+    return registros
+
+
+def obter_linhas_registros(
+    sessao,
+    placa: Optional[str] = None,
+    data_inicio: Optional[str] = None,
+    data_fim: Optional[str] = None,
+    dispositivo: Optional[str] = None,
+    arquivo=None,
+):
+    # Mesmo resultado de obter_registros_filtrados, mas em tuplas de
+    # COLUNAS_REGISTROS via Core: sem montar um EntradaLPR por linha.
+    consulta, placa_normalizada, dt_inicio, dt_fim = _aplicar_filtros_registros(
+        select(*COLUNAS_REGISTROS), placa, data_inicio, data_fim, dispositivo
+    )
+    linhas = sessao.execute(consulta).all()
+
+    arquivados = _consultar_arquivo(arquivo, placa_normalizada, dt_inicio, dt_fim, dispositivo)
+    if not arquivados:
+        return linhas
+    vistos = {(linha.placa, linha.timestamp) for linha in linhas}
+    linhas.extend(
+        tuple(getattr(registro, coluna.key) for coluna in COLUNAS_REGISTROS)
+        for registro in arquivados
+        if (registro.placa, registro.timestamp) not in vistos
+    )
+    # Posição 6: timestamp.
+    linhas.sort(key=lambda linha: linha[6], reverse=True)
+    return linhas
@@ -0,0 +1,165 @@
+﻿import os
+import threading
+import time
+from collections import OrderedDict
+
+from placas import canonizar_placa, delecoes, distancia_ate_um
+
+
+def _ler_env_inteiro(chave, padrao, minimo=0):
+    try:
+        return max(minimo, int(os.getenv(chave, str(padrao)).strip()))
+    except ValueError:
+        return padrao
+
+
+def ler_confianca(valor):
+    try:
+        return int(float(valor))
+    except (TypeError, ValueError):
+        return -1
+
+
+class Agrupamento:
+    __slots__ = ("registro_id", "placa", "confianca", "chaves", "leituras", "visto_em", "alertado", "lock")
+
+    def __init__(self, registro_id, placa, confianca):
+        self.registro_id = registro_id
+        self.placa = placa
+        self.confianca = confianca
+        self.chaves = set()
+        self.leituras = 0
+        self.visto_em = 0.0
+        self.alertado = False
+        # Gravação e correções do registro do agrupamento, fora do lock da
+        # câmera.
+        self.lock = threading.Lock()
+
+
+class _JanelaCamera:
+    # Agrupamentos ativos de uma câmera, em ordem do último evento visto.
+    # chaves: chave canônica -> agrupamento; delecoes: variante -> chaves.
+    __slots__ = ("agrupamentos", "chaves", "delecoes", "lock")
+
+    def __init__(self):
+        self.agrupamentos = OrderedDict()
+        self.chaves = {}
+        self.delecoes = {}
+        self.lock = threading.Lock()
+
+    def indexar(self, agrupamento, chave):
+        anterior = self.chaves.get(chave)
+        if anterior is agrupamento:
+            return
+        if anterior is not None:
+            anterior.chaves.discard(chave)
+        self.chaves[chave] = agrupamento
+        agrupamento.chaves.add(chave)
+        if anterior is None:
+            for variante in delecoes(chave):
+                self.delecoes.setdefault(variante, set()).add(chave)
+
+    def remover(self, agrupamento):
+        self.agrupamentos.pop(id(agrupamento), None)
+        for chave in agrupamento.chaves:
+            if self.chaves.get(chave) is not agrupamento:
+                continue
+            del self.chaves[chave]
+            for variante in delecoes(chave):
+                conjunto = self.delecoes.get(variante)
+                if conjunto is not None:
+                    conjunto.discard(chave)
+                    if not conjunto:
+                        del self.delecoes[variante]
+        agrupamento.chaves.clear()
+
+    def expirar(self, limite):
+        while self.agrupamentos:
+            agrupamento = next(iter(self.agrupamentos.values()))
+            if agrupamento.visto_em >= limite:
+                break
+            self.remover(agrupamento)
+
+    def buscar(self, chave, aproximada):
+        agrupamento = self.chaves.get(chave)
+        if agrupamento is not None or not aproximada:
+            return agrupamento
+
+        candidatas = set(self.delecoes.get(chave, ()))
+        for variante in delecoes(chave):
+            if variante in self.chaves:
+                candidatas.add(variante)
+            candidatas.update(self.delecoes.get(variante, ()))
+
+        melhor = None
+        for candidata in candidatas:
+            if not distancia_ate_um(chave, candidata):
+                continue
+            encontrado = self.chaves[candidata]
+            if melhor is None or encontrado.visto_em > melhor.visto_em:
+                melhor = encontrado
+        return melhor
+
+
+class DetectorDuplicatas:
+    def __init__(self, janela_segundos=None, aproximada=None):
+        self.janela_segundos = (
+            janela_segundos if janela_segundos is not None else _ler_env_inteiro("DEDUP_JANELA_SEGUNDOS", 30, minimo=1)
+        )
+        if aproximada is None:
+            aproximada = os.getenv("DEDUP_APROXIMADA", "1").strip() != "0"
+        self.aproximada = aproximada
+        self._cameras = {}
+        self._lock = threading.Lock()
+
+    def _janela(self, camera):
+        chave = camera or ""
+        janela = self._cameras.get(chave)
+        if janela is None:
+            with self._lock:
+                janela = self._cameras.setdefault(chave, _JanelaCamera())
+        return janela
+
+    def bloquear(self, camera):
+        # Serializa busca + registro do agrupamento de uma mesma câmera no
+        # processo, para que duas leituras próximas não criem dois
+        # agrupamentos em paralelo. A gravação no banco fica com o lock do
+        # agrupamento.
+        return self._janela(camera).lock
+
+    # `agora` permite usar o horário do evento (importação de histórico) no
+    # lugar do relógio do processo.
+    def buscar(self, camera, placa, agora=None):
+        chave = canonizar_placa(placa)
+        if not chave:
+            return None
+        janela = self._janela(camera)
+        janela.expirar((time.monotonic() if agora is None else agora) - self.janela_segundos)
+        return janela.buscar(chave, self.aproximada)
+
+    def registrar(self, camera, placa, confianca, registro_id=None, agrupamento=None, agora=None):
+        chave = canonizar_placa(placa)
+        if not chave:
+            return None
+        janela = self._janela(camera)
+        if agrupamento is None:
+            agrupamento = Agrupamento(registro_id, placa, confianca)
+        janela.indexar(agrupamento, chave)
+        agrupamento.leituras += 1
+        agrupamento.visto_em = time.monotonic() if agora is None else agora
+        janela.agrupamentos[id(agrupamento)] = agrupamento
+        janela.agrupamentos.move_to_end(id(agrupamento))
+        return agrupamento
+
+    def descartar(self, camera, agrupamento):
+        # Agrupamento reservado cuja gravação não aconteceu.
+        janela = self._janela(camera)
+        with janela.lock:
+            janela.remover(agrupamento)
+
+    def estado(self):
+        return {
+            "janela_segundos": self.janela_segundos,
+            "aproximada": self.aproximada,
+            "agrupamentos_ativos": sum(len(janela.agrupamentos) for janela in list(self._cameras.values())),
+        }
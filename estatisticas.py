@@ -0,0 +1,222 @@
+﻿import argparse
+import logging
+import os
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+import database
+from arquivamento import ArquivoFrio
+from models import EntradaLPR, RollupLPR
+
+# Dimensões agregadas por hora; "total" usa valor vazio.
+DIMENSOES = {
+    "cor_veiculo": "cor_veiculo",
+    "cor_placa": "cor_placa",
+    "dispositivo": "dispositivo_id",
+}
+GRANULARIDADES = {"hora", "dia"}
+MAXIMO_DIAS_CONSULTA = 366
+TAMANHO_LOTE_RECONSTRUCAO = 5000
+
+
+def truncar_hora(momento):
+    return momento.replace(minute=0, second=0, microsecond=0)
+
+
+def _valores_registro(registro):
+    hora = truncar_hora(registro.timestamp)
+    chaves = [(hora, "total", "")]
+    for dimensao, atributo in DIMENSOES.items():
+        chaves.append((hora, dimensao, getattr(registro, atributo) or ""))
+    return chaves
+
+
+def _upsert(sessao, contagens):
+    if not contagens:
+        return
+
+    linhas = [
+        {"hora": hora, "dimensao": dimensao, "valor": valor, "total": total}
+        for (hora, dimensao, valor), total in contagens.items()
+    ]
+    dialeto = sessao.get_bind().dialect.name
+    modulo = postgresql if dialeto == "postgresql" else sqlite
+    comando = modulo.insert(RollupLPR).values(linhas)
+    comando = comando.on_conflict_do_update(
+        index_elements=[RollupLPR.hora, RollupLPR.dimensao, RollupLPR.valor],
+        set_={"total": RollupLPR.total + comando.excluded.total},
+    )
+    sessao.execute(comando)
+
+
+def incrementar(sessao, registro):
+    # Executado na mesma transação do INSERT em lpr_webhook: se o registro
+    # for descartado (rollback), o rollup também é.
+    _upsert(sessao, Counter(_valores_registro(registro)))
+
+
+def incrementar_lote(sessao, registros):
+    contagens = Counter()
+    for registro in registros:
+        contagens.update(_valores_registro(registro))
+    _upsert(sessao, contagens)
+
+
+def reconstruir(sessao, inicio=None, fim=None, arquivo=None):
+    # Com `arquivo` (ArquivoFrio), as leituras já arquivadas do período também
+    # entram na contagem; sem ele, os rollups desses dias seriam zerados.
+    fim = truncar_hora(fim or datetime.now())
+    consulta_rollup = sessao.query(RollupLPR).filter(RollupLPR.hora < fim)
+    consulta_registros = sessao.query(
+        EntradaLPR.placa,
+        EntradaLPR.timestamp,
+        EntradaLPR.cor_veiculo,
+        EntradaLPR.cor_placa,
+        EntradaLPR.dispositivo_id,
+    ).filter(EntradaLPR.timestamp < fim)
+
+    if inicio is not None:
+        inicio = truncar_hora(inicio)
+        consulta_rollup = consulta_rollup.filter(RollupLPR.hora >= inicio)
+        consulta_registros = consulta_registros.filter(EntradaLPR.timestamp >= inicio)
+
+    removidos = consulta_rollup.delete(synchronize_session=False)
+
+    contagens = Counter()
+    lidos = 0
+    # Um dia pode estar no arquivo e ainda no banco (arquivamento interrompido
+    # antes da remoção); nesses dias, a leitura só conta uma vez.
+    dias_arquivados = arquivo.dias_arquivados() if arquivo is not None else set()
+    no_banco = set()
+    for registro in consulta_registros.execution_options(yield_per=TAMANHO_LOTE_RECONSTRUCAO):
+        contagens.update(_valores_registro(registro))
+        lidos += 1
+        if registro.timestamp.date().isoformat() in dias_arquivados:
+            no_banco.add((registro.placa, registro.timestamp))
+
+    if arquivo is not None:
+        for registro in arquivo.percorrer(inicio, fim):
+            if (registro.placa, registro.timestamp) in no_banco:
+                continue
+            contagens.update(_valores_registro(registro))
+            lidos += 1
+
+    chaves = list(contagens)
+    for indice in range(0, len(chaves), TAMANHO_LOTE_RECONSTRUCAO):
+        lote = chaves[indice : indice + TAMANHO_LOTE_RECONSTRUCAO]
+        _upsert(sessao, {chave: contagens[chave] for chave in lote})
+
+    sessao.commit()
+    return lidos, removidos, len(chaves)
+
+
+def _ler_data(valor, padrao):
+    if valor and valor.strip():
+        try:
+            return datetime.strptime(valor.strip(), "%Y-%m-%d")
+        except ValueError as exc:
+            raise ValueError(f"Data inválida: {valor} (use AAAA-MM-DD)") from exc
+    return padrao
+
+
+def consultar(sessao, data_inicio=None, data_fim=None, granularidade="hora", dimensao=None):
+    if granularidade not in GRANULARIDADES:
+        raise ValueError(f"Granularidade inválida: {granularidade} (use hora ou dia)")
+    if dimensao and dimensao not in DIMENSOES:
+        raise ValueError(f"Dimensão inválida: {dimensao} (use {', '.join(DIMENSOES)})")
+
+    hoje = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    inicio = _ler_data(data_inicio, hoje - timedelta(days=6))
+    fim = _ler_data(data_fim, hoje) + timedelta(days=1)
+    if fim <= inicio:
+        raise ValueError("data_fim deve ser maior ou igual a data_inicio")
+    if (fim - inicio).days > MAXIMO_DIAS_CONSULTA:
+        raise ValueError(f"Intervalo máximo de {MAXIMO_DIAS_CONSULTA} dias")
+
+    linhas = (
+        sessao.query(RollupLPR.hora, RollupLPR.dimensao, RollupLPR.valor, RollupLPR.total)
+        .filter(RollupLPR.hora >= inicio, RollupLPR.hora < fim)
+        .all()
+    )
+
+    def periodo(hora):
+        if granularidade == "dia":
+            return hora.strftime("%Y-%m-%d")
+        return hora.strftime("%Y-%m-%dT%H:00:00")
+
+    serie = Counter()
+    por_dimensao = {nome: Counter() for nome in DIMENSOES}
+    serie_dimensao = defaultdict(Counter)
+
+    for hora, nome_dimensao, valor, total in linhas:
+        if nome_dimensao == "total":
+            serie[periodo(hora)] += total
+        elif nome_dimensao in por_dimensao:
+            por_dimensao[nome_dimensao][valor or "N/A"] += total
+            if nome_dimensao == dimensao:
+                serie_dimensao[valor or "N/A"][periodo(hora)] += total
+
+    payload = {
+        "data_inicio": inicio.strftime("%Y-%m-%d"),
+        "data_fim": (fim - timedelta(days=1)).strftime("%Y-%m-%d"),
+        "granularidade": granularidade,
+        "total": sum(serie.values()),
+        "serie": [{"periodo": chave, "total": serie[chave]} for chave in sorted(serie)],
+    }
+    for nome, contagem in por_dimensao.items():
+        payload[f"por_{nome}"] = dict(contagem.most_common())
+    if dimensao:
+        payload["serie_por_valor"] = {
+            valor: [{"periodo": chave, "total": contagem[chave]} for chave in sorted(contagem)]
+            for valor, contagem in serie_dimensao.items()
+        }
+    return payload
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rollups de tráfego LPR (lpr_rollup)")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+
+    reconstrucao = subparsers.add_parser(
+        "reconstruir",
+        help="recalcula os rollups a partir de lpr_webhook (horas já encerradas)",
+    )
+    reconstrucao.add_argument("--data-inicio", help="AAAA-MM-DD (padrão: todo o histórico)")
+    reconstrucao.add_argument("--data-fim", help="AAAA-MM-DD inclusive (padrão: até a hora atual)")
+    reconstrucao.add_argument(
+        "--incluir-hora-atual",
+        action="store_true",
+        help="inclui a hora em andamento (use com a ingestão parada)",
+    )
+
+    argumentos = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(name)s | %(message)s")
+
+    try:
+        from dotenv import load_dotenv
+
+        load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
+    except ImportError:
+        pass
+
+    database.inicializar_banco()
+    database.criar_tabelas()
+    arquivo_frio = ArquivoFrio()
+    sessao = database.nova_sessao()
+    try:
+        data_inicio = _ler_data(argumentos.data_inicio, None)
+        limite = datetime.now()
+        limite = limite + timedelta(hours=1) if argumentos.incluir_hora_atual else limite
+        data_fim = _ler_data(argumentos.data_fim, None)
+        data_fim = min(data_fim + timedelta(days=1), limite) if data_fim is not None else limite
+        # Trava o arquivamento para nenhuma leitura mudar de lugar no meio.
+        with arquivo_frio.travar():
+            lidos, removidos, linhas = reconstruir(sessao, data_inicio, data_fim, arquivo_frio)
+        print(
+            f"Banco: {database.modo_banco_ativo()} | registros lidos: {lidos} | "
+            f"linhas de rollup removidas: {removidos} | gravadas: {linhas}"
+        )
+    finally:
+        sessao.close()
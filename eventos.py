@@ -0,0 +1,93 @@
+﻿from datetime import datetime
+
+from deduplicacao import ler_confianca
+
+
+class EventoInvalido(ValueError):
+    pass
+
+
+class LeituraEvento:
+    # Campos de um TollgateInfo já normalizados, como são gravados em
+    # lpr_webhook. `confianca` é o valor numérico usado na deduplicação;
+    # `confianca_original` é o que vai para a coluna.
+    __slots__ = (
+        "placa",
+        "cor_placa",
+        "cor_veiculo",
+        "confianca",
+        "confianca_original",
+        "timestamp",
+        "dispositivo_id",
+        "direcao",
+        "conteudo_imagem",
+    )
+
+    def __init__(
+        self, placa, cor_placa, cor_veiculo, confianca_original, timestamp, dispositivo_id, direcao, conteudo_imagem
+    ):
+        self.placa = placa
+        self.cor_placa = cor_placa
+        self.cor_veiculo = cor_veiculo
+        self.confianca = ler_confianca(confianca_original)
+        self.confianca_original = confianca_original
+        self.timestamp = timestamp
+        self.dispositivo_id = dispositivo_id
+        self.direcao = direcao
+        self.conteudo_imagem = conteudo_imagem
+
+
+def extrair_dispositivo(data):
+    if not isinstance(data, dict):
+        return None
+    picture = data.get("Picture", {})
+    snap_info = picture.get("SnapInfo", {}) if isinstance(picture, dict) else {}
+    device_id = snap_info.get("DeviceID") if isinstance(snap_info, dict) else None
+    if device_id is None:
+        return None
+    device_id = str(device_id).strip()
+    return device_id or None
+
+
+def extrair_conteudo_imagem(picture):
+    pic_data = picture.get("NormalPic", {}) or picture.get("VehiclePic", {})
+    image_content = pic_data.get("Content") if isinstance(pic_data, dict) else None
+    if not image_content or not isinstance(image_content, str):
+        return None
+    return image_content
+
+
+def ler_evento(data):
+    if not data or not isinstance(data, dict):
+        raise EventoInvalido("Dados inválidos recebidos")
+
+    picture = data.get("Picture", {})
+    plate_info = picture.get("Plate", {})
+    vehicle_info = picture.get("Vehicle", {})
+    snap_info = picture.get("SnapInfo", {})
+
+    plate = plate_info.get("PlateNumber")
+    if not plate or not isinstance(plate, str) or len(plate.strip()) < 3:
+        raise EventoInvalido(f"Placa inválida ou ausente: {plate}")
+
+    camera_time = snap_info.get("AccurateTime")
+    timestamp = datetime.now()
+    if camera_time and isinstance(camera_time, str):
+        try:
+            timestamp = datetime.strptime(camera_time.split(".")[0], "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            pass
+
+    direction = snap_info.get("Direction")
+    direction = str(direction).strip() if direction is not None else ""
+
+    return LeituraEvento(
+        placa=plate.strip().upper(),
+        cor_placa=plate_info.get("PlateColor", "N/A"),
+        cor_veiculo=vehicle_info.get("VehicleColor", "N/A"),
+        confianca_original=plate_info.get("Confidence"),
+        timestamp=timestamp,
+        dispositivo_id=extrair_dispositivo(data),
+        direcao=direction or None,
+        conteudo_imagem=extrair_conteudo_imagem(picture),
+    )
@@ -0,0 +1,179 @@
+﻿import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import string
+from datetime import datetime
+
+BOUNDARY = "myboundary"
+REALM = "DH_FAKECAMERA"
+
+_RE_PARAMETRO = re.compile(r'(\w+)\s*=\s*(?:"([^"]*)"|([^\s,]+))')
+
+
+def _md5(texto):
+    return hashlib.md5(texto.encode("utf-8")).hexdigest()
+
+
+def _placa_aleatoria():
+    letras = "".join(random.choices(string.ascii_uppercase, k=3))
+    return f"{letras}{random.randint(0, 9)}{random.choice(string.ascii_uppercase)}{random.randint(10, 99)}"
+
+
+def _jpeg_fake(tamanho=4096):
+    return b"\xff\xd8\xff\xe0" + os.urandom(tamanho) + b"\xff\xd9"
+
+
+def _autorizado(cabecalho, usuario, senha, nonces):
+    if not cabecalho.lower().startswith("digest "):
+        return False
+
+    parametros = {}
+    for chave, com_aspas, sem_aspas in _RE_PARAMETRO.findall(cabecalho[7:]):
+        parametros[chave.lower()] = com_aspas if com_aspas else sem_aspas
+
+    if parametros.get("username") != usuario or parametros.get("nonce") not in nonces:
+        return False
+
+    ha1 = _md5(f"{usuario}:{REALM}:{senha}")
+    ha2 = _md5(f"GET:{parametros.get('uri', '')}")
+    esperado = _md5(
+        f"{ha1}:{parametros.get('nonce')}:{parametros.get('nc')}:{parametros.get('cnonce')}:"
+        f"{parametros.get('qop')}:{ha2}"
+    )
+    return parametros.get("response") == esperado
+
+
+def _parte(tipo, conteudo):
+    cabecalho = f"--{BOUNDARY}\r\nContent-Type: {tipo}\r\nContent-Length: {len(conteudo)}\r\n\r\n"
+    return cabecalho.encode("latin-1") + conteudo + b"\r\n"
+
+
+def _evento_json(device_id):
+    payload = {
+        "Picture": {
+            "Plate": {"PlateNumber": _placa_aleatoria(), "PlateColor": "White", "Confidence": random.randint(70, 99)},
+            "Vehicle": {"VehicleColor": random.choice(["Black", "White", "Silver", "Red", "Blue"])},
+            "SnapInfo": {
+                "AccurateTime": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "DeviceID": device_id,
+                "Direction": random.choice(["Obverse", "Reverse"]),
+            },
+            "NormalPic": {"Content": base64.b64encode(_jpeg_fake()).decode("ascii")},
+        }
+    }
+    return _parte("application/json", json.dumps(payload).encode("utf-8"))
+
+
+def _evento_texto(device_id):
+    linhas = [
+        "Events[0].EventBaseInfo.Code=TrafficJunction",
+        f"Events[0].TrafficCar.PlateNumber={_placa_aleatoria()}",
+        "Events[0].TrafficCar.PlateColor=White",
+        f"Events[0].TrafficCar.VehicleColor={random.choice(['Black', 'White', 'Silver'])}",
+        f"Events[0].TrafficCar.Confidence={random.randint(70, 99)}",
+        f"Events[0].TrafficCar.DeviceID={device_id}",
+        f"Events[0].TrafficCar.Time={datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+    ]
+    texto = "\r\n".join(linhas).encode("utf-8")
+    return _parte("text/plain", texto) + _parte("image/jpeg", _jpeg_fake())
+
+
+async def _atender(reader, writer, args, indice, nonces, contadores):
+    try:
+        requisicao = await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        writer.close()
+        return
+
+    cabecalhos = {}
+    for linha in requisicao.decode("latin-1").split("\r\n")[1:]:
+        chave, _, valor = linha.partition(":")
+        cabecalhos[chave.strip().lower()] = valor.strip()
+
+    if not _autorizado(cabecalhos.get("authorization", ""), args.usuario, args.senha, nonces):
+        nonce = os.urandom(16).hex()
+        nonces.add(nonce)
+        writer.write(
+            (
+                "HTTP/1.1 401 Unauthorized\r\n"
+                f'WWW-Authenticate: Digest realm="{REALM}", nonce="{nonce}", stale=FALSE, qop="auth"\r\n'
+                "Content-Length: 0\r\n\r\n"
+            ).encode("latin-1")
+        )
+        await writer.drain()
+        writer.close()
+        return
+
+    device_id = f"fake-camera-{indice:03d}"
+    writer.write(
+        (
+            "HTTP/1.1 200 OK\r\n"
+            f"Content-Type: multipart/x-mixed-replace; boundary={BOUNDARY}\r\n"
+            "Connection: keep-alive\r\n\r\n"
+        ).encode("latin-1")
+    )
+    gerar_evento = _evento_json if args.formato == "json" else _evento_texto
+
+    try:
+        enviados = 0
+        while args.eventos <= 0 or enviados < args.eventos:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * args.intervalo)
+            if random.random() < 0.2:
+                writer.write(_parte("text/plain", b"Heartbeat"))
+            else:
+                writer.write(gerar_evento(device_id))
+                enviados += 1
+                contadores["eventos"] += 1
+            await writer.drain()
+        writer.write(f"--{BOUNDARY}--\r\n".encode("latin-1"))
+        await writer.drain()
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _executar(args):
+    nonces = set()
+    contadores = {"eventos": 0}
+    servidores = []
+    for indice in range(args.cameras):
+        porta = args.porta + indice
+
+        async def handler(reader, writer, indice=indice):
+            await _atender(reader, writer, args, indice, nonces, contadores)
+
+        servidores.append(await asyncio.start_server(handler, args.host, porta))
+
+    print(f"{args.cameras} câmera(s) simulada(s) em {args.host}:{args.porta}-{args.porta + args.cameras - 1}")
+    print(f"SUBSCRIBE_CAMERAS exemplo: http://{args.usuario}:{args.senha}@{args.host}:{args.porta}")
+
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(f"Eventos enviados: {contadores['eventos']}")
+    finally:
+        for servidor in servidores:
+            servidor.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulador de câmeras LPR em modo Subscribe")
+    parser.add_argument("--cameras", type=int, default=1)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--porta", type=int, default=18080)
+    parser.add_argument("--intervalo", type=float, default=2.0, help="segundos médios entre eventos")
+    parser.add_argument("--eventos", type=int, default=0, help="eventos por conexão (0 = infinito)")
+    parser.add_argument("--formato", choices=["json", "texto"], default="json")
+    parser.add_argument("--usuario", default="admin")
+    parser.add_argument("--senha", default="admin")
+
+    try:
+        asyncio.run(_executar(parser.parse_args()))
+    except KeyboardInterrupt:
+        print("Simulador encerrado.")
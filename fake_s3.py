@@ -0,0 +1,220 @@
+﻿import argparse
+import hashlib
+import sys
+import threading
+import uuid
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import escape
+
+# Servidor S3 mínimo (path-style, sem autenticação) para testar
+# ARMAZENAMENTO=s3 localmente: PUT/GET/HEAD/DELETE de objetos e upload
+# multipart. Os objetos ficam em memória.
+
+
+class _Estado:
+    def __init__(self):
+        self.objetos = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self.requisicoes = 0
+        self.multipart_concluidos = 0
+
+
+def _xml(corpo):
+    return ('<?xml version="1.0" encoding="UTF-8"?>' + corpo).encode("utf-8")
+
+
+class _Tratador(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    estado = None
+    verboso = False
+
+    def log_message(self, formato, *args):
+        if self.verboso:
+            super().log_message(formato, *args)
+
+    def _alvo(self):
+        partes = urlsplit(self.path)
+        caminho = unquote(partes.path).lstrip("/")
+        bucket, _, chave = caminho.partition("/")
+        return bucket, chave, parse_qs(partes.query, keep_blank_values=True)
+
+    def _ler_corpo(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            dados = self._ler_chunked()
+        else:
+            dados = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if "aws-chunked" in self.headers.get("Content-Encoding", ""):
+            dados = self._decodificar_aws_chunked(dados)
+        return dados
+
+    def _ler_chunked(self):
+        dados = bytearray()
+        while True:
+            linha = self.rfile.readline().strip()
+            tamanho = int(linha.split(b";")[0], 16)
+            if tamanho == 0:
+                while self.rfile.readline().strip():
+                    pass
+                return bytes(dados)
+            dados += self.rfile.read(tamanho)
+            self.rfile.readline()
+
+    @staticmethod
+    def _decodificar_aws_chunked(dados):
+        saida = bytearray()
+        posicao = 0
+        while True:
+            fim_linha = dados.index(b"\r\n", posicao)
+            tamanho = int(dados[posicao:fim_linha].split(b";")[0], 16)
+            if tamanho == 0:
+                return bytes(saida)
+            inicio = fim_linha + 2
+            saida += dados[inicio : inicio + tamanho]
+            posicao = inicio + tamanho + 2
+
+    def _responder(self, status, corpo=b"", cabecalhos=None, tipo="application/xml"):
+        self.send_response(status)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(corpo)))
+        for chave, valor in (cabecalhos or {}).items():
+            self.send_header(chave, valor)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(corpo)
+
+    def _nao_encontrado(self, chave):
+        self._responder(
+            404,
+            _xml(f"<Error><Code>NoSuchKey</Code><Message>Not Found</Message><Key>{escape(chave)}</Key></Error>"),
+        )
+
+    def do_PUT(self):
+        bucket, chave, consulta = self._alvo()
+        corpo = self._ler_corpo()
+        with self.estado.lock:
+            self.estado.requisicoes += 1
+            if not chave:
+                self._responder(200)
+                return
+            etag = f'"{hashlib.md5(corpo).hexdigest()}"'
+            if "uploadId" in consulta:
+                upload = self.estado.uploads.get(consulta["uploadId"][0])
+                if upload is None:
+                    self._responder(404, _xml("<Error><Code>NoSuchUpload</Code></Error>"))
+                    return
+                upload["partes"][int(consulta["partNumber"][0])] = corpo
+            else:
+                self.estado.objetos[(bucket, chave)] = {
+                    "dados": corpo,
+                    "etag": etag,
+                    "tipo": self.headers.get("Content-Type", "application/octet-stream"),
+                    "cache": self.headers.get("Cache-Control"),
+                }
+        self._responder(200, cabecalhos={"ETag": etag})
+
+    def do_POST(self):
+        bucket, chave, consulta = self._alvo()
+        self._ler_corpo()
+        with self.estado.lock:
+            self.estado.requisicoes += 1
+            if "uploads" in consulta:
+                upload_id = uuid.uuid4().hex
+                self.estado.uploads[upload_id] = {
+                    "partes": {},
+                    "tipo": self.headers.get("Content-Type", "application/octet-stream"),
+                    "cache": self.headers.get("Cache-Control"),
+                }
+                corpo = (
+                    f"<InitiateMultipartUploadResult><Bucket>{escape(bucket)}</Bucket>"
+                    f"<Key>{escape(chave)}</Key><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>"
+                )
+                self._responder(200, _xml(corpo))
+                return
+
+            upload = self.estado.uploads.pop(consulta.get("uploadId", [""])[0], None)
+            if upload is None:
+                self._responder(404, _xml("<Error><Code>NoSuchUpload</Code></Error>"))
+                return
+            dados = b"".join(upload["partes"][numero] for numero in sorted(upload["partes"]))
+            etag = f'"{hashlib.md5(dados).hexdigest()}-{len(upload["partes"])}"'
+            self.estado.objetos[(bucket, chave)] = {
+                "dados": dados,
+                "etag": etag,
+                "tipo": upload["tipo"],
+                "cache": upload["cache"],
+            }
+            self.estado.multipart_concluidos += 1
+        corpo = (
+            f"<CompleteMultipartUploadResult><Bucket>{escape(bucket)}</Bucket><Key>{escape(chave)}</Key>"
+            f"<ETag>{escape(etag)}</ETag></CompleteMultipartUploadResult>"
+        )
+        self._responder(200, _xml(corpo))
+
+    def do_GET(self):
+        bucket, chave, _ = self._alvo()
+        with self.estado.lock:
+            self.estado.requisicoes += 1
+            objeto = self.estado.objetos.get((bucket, chave))
+        if objeto is None:
+            self._nao_encontrado(chave)
+            return
+        cabecalhos = {"ETag": objeto["etag"], "Last-Modified": formatdate(usegmt=True), "Accept-Ranges": "bytes"}
+        if objeto["cache"]:
+            cabecalhos["Cache-Control"] = objeto["cache"]
+        dados = objeto["dados"]
+        intervalo = self.headers.get("Range", "")
+        if intervalo.startswith("bytes="):
+            inicio, _, fim = intervalo[6:].partition("-")
+            inicio = int(inicio)
+            fim = min(int(fim) if fim else len(dados) - 1, len(dados) - 1)
+            cabecalhos["Content-Range"] = f"bytes {inicio}-{fim}/{len(dados)}"
+            self._responder(206, dados[inicio : fim + 1], cabecalhos, objeto["tipo"])
+            return
+        self._responder(200, dados, cabecalhos, objeto["tipo"])
+
+    do_HEAD = do_GET
+
+    def do_DELETE(self):
+        bucket, chave, consulta = self._alvo()
+        with self.estado.lock:
+            self.estado.requisicoes += 1
+            if "uploadId" in consulta:
+                self.estado.uploads.pop(consulta["uploadId"][0], None)
+            else:
+                self.estado.objetos.pop((bucket, chave), None)
+        self._responder(204)
+
+
+class _Servidor(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Cliente que fecha a conexão no meio do corpo (Range, HEAD) não é erro.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def criar_servidor(host="127.0.0.1", porta=9000, verboso=False):
+    estado = _Estado()
+    tratador = type("TratadorS3", (_Tratador,), {"estado": estado, "verboso": verboso})
+    servidor = _Servidor((host, porta), tratador)
+    servidor.estado = estado
+    return servidor
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor S3 fake para testes de ARMAZENAMENTO=s3")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--porta", type=int, default=9000)
+    parser.add_argument("--verboso", action="store_true")
+    argumentos = parser.parse_args()
+
+    servidor = criar_servidor(argumentos.host, argumentos.porta, argumentos.verboso)
+    print(f"S3 fake em http://{argumentos.host}:{argumentos.porta} (S3_ENDPOINT_URL)")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,495 @@
+﻿import argparse
+import gzip
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+from bisect import bisect_left
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+import capturas
+import database
+import estatisticas
+import visitas
+from armazenamento import criar_armazenamento
+from deduplicacao import DetectorDuplicatas
+from eventos import ler_evento
+from models import EntradaLPR
+
+logger = logging.getLogger("IMPORTADOR")
+
+EXTENSOES_NDJSON = (".ndjson", ".jsonl", ".ndjson.gz", ".jsonl.gz")
+EXTENSOES_JSON = (".json", ".json.gz")
+TAMANHO_TAREFA = 256
+# Limite de parâmetros por consulta no SQLite antigo (999).
+TAMANHO_LOTE_CONSULTA = 400
+
+
+class _Leitura:
+    # Leitura aceita, aguardando o fim da janela de deduplicação da câmera.
+    __slots__ = (
+        "posicao",
+        "placa",
+        "cor_placa",
+        "cor_veiculo",
+        "confianca",
+        "confianca_original",
+        "timestamp",
+        "dispositivo_id",
+        "direcao",
+        "imagem",
+        "agrupamento",
+        "contada",
+    )
+
+    def __init__(self, posicao, leitura, imagem, contada=False):
+        self.posicao = posicao
+        self.contada = contada
+        self.placa = leitura.placa
+        self.cor_placa = leitura.cor_placa
+        self.cor_veiculo = leitura.cor_veiculo
+        self.confianca = leitura.confianca
+        self.confianca_original = leitura.confianca_original
+        self.timestamp = leitura.timestamp
+        self.dispositivo_id = leitura.dispositivo_id
+        self.direcao = leitura.direcao
+        self.imagem = imagem
+        self.agrupamento = None
+
+
+def _abrir(caminho):
+    if caminho.endswith(".gz"):
+        return gzip.open(caminho, "rt", encoding="utf-8")
+    return open(caminho, encoding="utf-8")
+
+
+def listar_fontes(caminhos):
+    # Ordem estável: a posição salva no estado vale entre execuções.
+    fontes = []
+    for caminho in caminhos:
+        if os.path.isdir(caminho):
+            for raiz, _, arquivos in os.walk(caminho):
+                for nome in arquivos:
+                    if nome.endswith(EXTENSOES_NDJSON + EXTENSOES_JSON):
+                        fontes.append(os.path.join(raiz, nome))
+        else:
+            fontes.append(caminho)
+    return sorted(os.path.abspath(fonte) for fonte in fontes)
+
+
+def ler_eventos(fontes, inicio=None):
+    # Gera ((índice da fonte, linha), texto ou objeto). NDJSON é lido linha
+    # a linha; arquivos .json têm um evento ou uma lista de eventos.
+    fonte_inicial, linha_inicial = inicio or (0, 0)
+    for indice, fonte in enumerate(fontes):
+        if indice < fonte_inicial:
+            continue
+        pular = linha_inicial if indice == fonte_inicial else 0
+        with _abrir(fonte) as arquivo:
+            if fonte.endswith(EXTENSOES_NDJSON):
+                for linha, texto in enumerate(arquivo):
+                    if linha >= pular and texto.strip():
+                        yield (indice, linha), texto
+            else:
+                try:
+                    conteudo = json.load(arquivo)
+                except ValueError as exc:
+                    logger.warning(f"{fonte}: JSON inválido ({exc})")
+                    continue
+                eventos = conteudo if isinstance(conteudo, list) else [conteudo]
+                for linha, evento in enumerate(eventos):
+                    if linha >= pular:
+                        yield (indice, linha), evento
+
+
+def _preparar_tarefa(itens, diretorio_temporario):
+    # Executado no pool de processos: parse, normalização e decodificação
+    # da imagem (sha256 + arquivo temporário).
+    resultados = []
+    for posicao, item in itens:
+        try:
+            evento = json.loads(item) if isinstance(item, str) else item
+            leitura = ler_evento(evento)
+        except (ValueError, AttributeError):
+            resultados.append((posicao, None, None))
+            continue
+
+        imagem = None
+        if leitura.conteudo_imagem is not None:
+            try:
+                imagem = capturas.decodificar_para_arquivo(leitura.conteudo_imagem, diretorio_temporario)
+            except capturas.ImagemInvalida:
+                pass
+            leitura.conteudo_imagem = None
+        resultados.append((posicao, leitura, imagem))
+    return resultados
+
+
+def _remover_temporario(imagem):
+    if imagem is not None and os.path.exists(imagem[1]):
+        os.remove(imagem[1])
+
+
+class Importador:
+    # Mesmas regras de salvar_registro_lpr, aplicadas no horário do evento:
+    # leituras parecidas da mesma câmera dentro de DEDUP_JANELA_SEGUNDOS
+    # viram uma só (fica a de maior confiança) e a mesma placa dentro da
+    # janela, em qualquer câmera ou já no banco, é descartada.
+    def __init__(self, armazenamento, arquivo_estado, tamanho_lote=1000, processos=None):
+        self.armazenamento = armazenamento
+        self.arquivo_estado = arquivo_estado
+        self.tamanho_lote = max(1, tamanho_lote)
+        self.processos = processos or os.cpu_count() or 1
+        self.detector = DetectorDuplicatas()
+        self.janela = timedelta(seconds=self.detector.janela_segundos)
+
+        self._abertas = {}
+        self._prontas = []
+        self._ultima_por_placa = {}
+        self.lidos = 0
+        self.importadas = 0
+        self.duplicadas = 0
+        self.invalidas = 0
+        self.com_imagem = 0
+        self.retomados = 0
+        self.concluida = False
+        # Retomada: as leituras entre a posição salva e `_lido_ate` já entraram
+        # nos contadores; as `_pendentes` ainda não tinham sido gravadas nem
+        # descartadas. Elas são relidas para refazer a deduplicação, sem contar
+        # de novo.
+        self._lido_ate = None
+        self._pendentes = set()
+
+    def _carregar_estado(self, fontes):
+        if not os.path.exists(self.arquivo_estado):
+            return None
+        with open(self.arquivo_estado, encoding="utf-8") as arquivo:
+            estado = json.load(arquivo)
+        if estado.get("fontes") != fontes:
+            raise ValueError(f"{self.arquivo_estado} é de outra importação (use --recomecar)")
+        for campo in ("lidos", "importadas", "duplicadas", "invalidas", "com_imagem"):
+            setattr(self, campo, estado.get(campo, 0))
+        self.retomados = self.lidos
+        self.concluida = estado.get("concluida", False)
+        if estado.get("lido_ate"):
+            self._lido_ate = tuple(estado["lido_ate"])
+            self._pendentes = {tuple(posicao) for posicao in estado.get("pendentes", [])}
+        return tuple(estado["posicao"]) if estado.get("posicao") else None
+
+    def _relida(self, posicao):
+        return self._lido_ate is not None and posicao < self._lido_ate
+
+    def _salvar_estado(self, fontes, posicao, proxima, concluida=False):
+        # Pendentes: abertas agora e as da execução anterior ainda não relidas.
+        pendentes = {leitura.posicao for abertas in self._abertas.values() for leitura in abertas}
+        pendentes.update(pendente for pendente in self._pendentes if pendente >= proxima)
+        lido_ate = max(proxima, self._lido_ate) if self._lido_ate is not None else proxima
+        estado = {
+            "fontes": fontes,
+            "posicao": list(posicao) if posicao else None,
+            "lido_ate": list(lido_ate),
+            "pendentes": sorted(list(pendente) for pendente in pendentes),
+            "concluida": concluida,
+            "lidos": self.lidos,
+            "importadas": self.importadas,
+            "duplicadas": self.duplicadas,
+            "invalidas": self.invalidas,
+            "com_imagem": self.com_imagem,
+        }
+        temporario = f"{self.arquivo_estado}.tmp"
+        with open(temporario, "w", encoding="utf-8") as arquivo:
+            json.dump(estado, arquivo, ensure_ascii=False, indent=1)
+        os.replace(temporario, self.arquivo_estado)
+
+    def _aceitar(self, posicao, leitura, imagem, contada=False):
+        camera = leitura.dispositivo_id or ""
+        agora = leitura.timestamp.timestamp()
+        abertas = self._abertas.setdefault(camera, deque())
+
+        # Fecha as leituras cujo agrupamento saiu da janela.
+        limite = agora - self.detector.janela_segundos
+        while abertas and abertas[0].agrupamento.visto_em < limite:
+            self._prontas.append(abertas.popleft())
+
+        agrupamento = self.detector.buscar(camera, leitura.placa, agora=agora)
+        if agrupamento is not None:
+            self.duplicadas += not contada
+            # Agrupamento ativo: a leitura dele ainda não foi gravada e a de
+            # maior confiança a corrige.
+            existente = agrupamento.registro_id
+            if leitura.confianca > agrupamento.confianca:
+                existente.placa = leitura.placa
+                existente.confianca = leitura.confianca
+                existente.confianca_original = leitura.confianca_original
+                if imagem is not None:
+                    _remover_temporario(existente.imagem)
+                    existente.imagem, imagem = imagem, None
+                agrupamento.placa = leitura.placa
+                agrupamento.confianca = leitura.confianca
+            self.detector.registrar(camera, leitura.placa, leitura.confianca, agrupamento=agrupamento, agora=agora)
+            _remover_temporario(imagem)
+            return
+
+        ultima = self._ultima_por_placa.get(leitura.placa)
+        if ultima is not None and abs(leitura.timestamp - ultima) <= self.janela:
+            self.duplicadas += not contada
+            _remover_temporario(imagem)
+            return
+        self._ultima_por_placa[leitura.placa] = leitura.timestamp
+
+        nova = _Leitura(posicao, leitura, imagem, contada)
+        nova.agrupamento = self.detector.registrar(
+            camera, leitura.placa, leitura.confianca, registro_id=nova, agora=agora
+        )
+        abertas.append(nova)
+
+    def _existentes(self, sessao, leituras):
+        # Placa já no banco dentro da janela (importação anterior, ingestão ao vivo).
+        inicio = min(leitura.timestamp for leitura in leituras) - self.janela
+        fim = max(leitura.timestamp for leitura in leituras) + self.janela
+        placas = sorted({leitura.placa for leitura in leituras})
+        por_placa = {}
+        for posicao in range(0, len(placas), TAMANHO_LOTE_CONSULTA):
+            linhas = (
+                sessao.query(EntradaLPR.placa, EntradaLPR.timestamp)
+                .filter(
+                    EntradaLPR.placa.in_(placas[posicao : posicao + TAMANHO_LOTE_CONSULTA]),
+                    EntradaLPR.timestamp >= inicio,
+                    EntradaLPR.timestamp <= fim,
+                )
+                .all()
+            )
+            for placa, timestamp in linhas:
+                por_placa.setdefault(placa, []).append(timestamp)
+        for horarios in por_placa.values():
+            horarios.sort()
+        return por_placa
+
+    def _gravar(self, sessao, leituras):
+        existentes = self._existentes(sessao, leituras)
+        aceitas = []
+        for leitura in leituras:
+            horarios = existentes.get(leitura.placa, ())
+            indice = bisect_left(horarios, leitura.timestamp - self.janela)
+            if indice < len(horarios) and horarios[indice] <= leitura.timestamp + self.janela:
+                self.duplicadas += not leitura.contada
+                _remover_temporario(leitura.imagem)
+                continue
+            aceitas.append(leitura)
+        if not aceitas:
+            return
+
+        # Uma gravação por imagem distinta, com todas as referências do lote.
+        por_hash = {}
+        for leitura in aceitas:
+            if leitura.imagem is not None:
+                por_hash.setdefault(leitura.imagem[0], []).append(leitura)
+        itens = []
+        for hash_imagem, grupo in por_hash.items():
+            _, caminho_temporario, tamanho = grupo[0].imagem
+            for outra in grupo[1:]:
+                _remover_temporario(outra.imagem)
+            itens.append((hash_imagem, caminho_temporario, tamanho, len(grupo)))
+        caminhos = capturas.armazenar_lote(sessao, itens, self.armazenamento)
+
+        linhas = [
+            {
+                "placa": leitura.placa,
+                "cor_placa": leitura.cor_placa,
+                "cor_veiculo": leitura.cor_veiculo,
+                "confianca": leitura.confianca_original,
+                "timestamp": leitura.timestamp,
+                "dispositivo_id": leitura.dispositivo_id,
+                "direcao": leitura.direcao,
+                "caminho_imagem": caminhos[leitura.imagem[0]] if leitura.imagem else None,
+                "hash_imagem": leitura.imagem[0] if leitura.imagem else None,
+            }
+            for leitura in aceitas
+        ]
+        modulo = postgresql if sessao.get_bind().dialect.name == "postgresql" else sqlite
+        comando = (
+            modulo.insert(EntradaLPR)
+            .on_conflict_do_nothing(index_elements=[EntradaLPR.placa, EntradaLPR.timestamp])
+            .returning(EntradaLPR.placa, EntradaLPR.timestamp)
+        )
+        inseridas = {tuple(linha) for linha in sessao.execute(comando, linhas)}
+
+        gravadas = [leitura for leitura in aceitas if (leitura.placa, leitura.timestamp) in inseridas]
+        sobras = Counter(
+            leitura.imagem[0] for leitura in aceitas if leitura.imagem and (leitura.placa, leitura.timestamp) not in inseridas
+        )
+        for hash_imagem, quantidade in sobras.items():
+            capturas.liberar(sessao, hash_imagem, quantidade)
+        estatisticas.incrementar_lote(sessao, gravadas)
+
+        novas = [leitura for leitura in aceitas if not leitura.contada]
+        gravadas_novas = [leitura for leitura in gravadas if not leitura.contada]
+        self.importadas += len(gravadas_novas)
+        self.duplicadas += len(novas) - len(gravadas_novas)
+        self.com_imagem += sum(1 for leitura in gravadas_novas if leitura.imagem is not None)
+
+    def _descarregar(self, sessao, fontes, proxima, final=False):
+        if final:
+            for abertas in self._abertas.values():
+                self._prontas.extend(abertas)
+                abertas.clear()
+        if not self._prontas or (not final and len(self._prontas) < self.tamanho_lote):
+            return
+
+        prontas, self._prontas = self._prontas, []
+        try:
+            for inicio in range(0, len(prontas), self.tamanho_lote):
+                self._gravar(sessao, prontas[inicio : inicio + self.tamanho_lote])
+            sessao.commit()
+        except Exception:
+            sessao.rollback()
+            for leitura in prontas:
+                _remover_temporario(leitura.imagem)
+            raise
+
+        # Retomada: a partir da leitura mais antiga ainda não gravada.
+        pendentes = [abertas[0].posicao for abertas in self._abertas.values() if abertas]
+        self._salvar_estado(fontes, min(pendentes, default=proxima), proxima, concluida=final)
+
+    def importar(self, caminhos, recomecar=False, ao_progredir=None):
+        fontes = listar_fontes(caminhos)
+        if recomecar and os.path.exists(self.arquivo_estado):
+            os.remove(self.arquivo_estado)
+        inicio = self._carregar_estado(fontes)
+        if self.concluida:
+            logger.info(f"Importação já concluída segundo {self.arquivo_estado} (use --recomecar)")
+            return self.estado()
+        if inicio is not None:
+            logger.info(f"Retomando em {fontes[inicio[0]]}:{inicio[1] + 1}")
+
+        # Diretório próprio: uma importação interrompida deixa temporários
+        # que são descartados na próxima, sem tocar nos do servidor.
+        diretorio_temporario = os.path.join(self.armazenamento.diretorio_temporario, ".importacao")
+        shutil.rmtree(diretorio_temporario, ignore_errors=True)
+        sessao = database.nova_sessao()
+        proxima = inicio or (0, 0)
+        try:
+            with ProcessPoolExecutor(max_workers=self.processos) as pool:
+                em_andamento = deque()
+                tarefa = []
+                eventos = ler_eventos(fontes, inicio)
+
+                def consumir():
+                    nonlocal proxima
+                    for posicao, leitura, imagem in em_andamento.popleft().result():
+                        relida = self._relida(posicao)
+                        self.lidos += not relida
+                        proxima = (posicao[0], posicao[1] + 1)
+                        if leitura is None:
+                            self.invalidas += not relida
+                            continue
+                        # Pendente: lida antes, mas o destino ainda não foi contado.
+                        self._aceitar(posicao, leitura, imagem, relida and posicao not in self._pendentes)
+                    self._descarregar(sessao, fontes, proxima)
+                    if ao_progredir is not None:
+                        ao_progredir(self)
+
+                for item in eventos:
+                    tarefa.append(item)
+                    if len(tarefa) >= TAMANHO_TAREFA:
+                        em_andamento.append(pool.submit(_preparar_tarefa, tarefa, diretorio_temporario))
+                        tarefa = []
+                    # Algumas tarefas à frente por processo, em ordem.
+                    if len(em_andamento) >= self.processos * 2:
+                        consumir()
+                if tarefa:
+                    em_andamento.append(pool.submit(_preparar_tarefa, tarefa, diretorio_temporario))
+                while em_andamento:
+                    consumir()
+            self._descarregar(sessao, fontes, proxima, final=True)
+        finally:
+            sessao.close()
+            shutil.rmtree(diretorio_temporario, ignore_errors=True)
+        return self.estado()
+
+    def estado(self):
+        return {
+            "lidos": self.lidos,
+            "importadas": self.importadas,
+            "duplicadas": self.duplicadas,
+            "invalidas": self.invalidas,
+            "com_imagem": self.com_imagem,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Importação em lote de eventos TollgateInfo (NDJSON ou diretórios)")
+    parser.add_argument("caminhos", nargs="+", help="arquivos .ndjson/.jsonl/.json (também .gz) ou diretórios")
+    parser.add_argument("--processos", type=int, help="processos para decodificar imagens (padrão: núcleos da CPU)")
+    parser.add_argument("--lote", type=int, default=1000, help="leituras por INSERT")
+    parser.add_argument("--estado", help="arquivo de progresso (padrão: storage/importacao.json)")
+    parser.add_argument("--recomecar", action="store_true", help="ignora o progresso salvo")
+    parser.add_argument(
+        "--sem-visitas",
+        action="store_true",
+        help="não recalcula o histórico por placa no fim (rode visitas.py reconstruir depois)",
+    )
+
+    argumentos = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(name)s | %(message)s")
+
+    diretorio_base = os.path.dirname(os.path.abspath(__file__))
+    try:
+        from dotenv import load_dotenv
+
+        load_dotenv(os.path.join(diretorio_base, ".env"))
+    except ImportError:
+        pass
+
+    database.inicializar_banco()
+    database.criar_tabelas()
+    os.makedirs(os.path.join(diretorio_base, "storage"), exist_ok=True)
+    importador = Importador(
+        criar_armazenamento(os.path.join(diretorio_base, "static")),
+        argumentos.estado or os.path.join(diretorio_base, "storage", "importacao.json"),
+        tamanho_lote=argumentos.lote,
+        processos=argumentos.processos,
+    )
+    inicio = time.monotonic()
+    ultimo_relatorio = [inicio]
+
+    def progresso(atual):
+        agora = time.monotonic()
+        if agora - ultimo_relatorio[0] >= 5:
+            ultimo_relatorio[0] = agora
+            print(
+                f"{atual.lidos} lido(s) | {atual.importadas} importada(s) | {atual.duplicadas} duplicada(s) | "
+                f"{(atual.lidos - atual.retomados) / max(0.001, agora - inicio):.0f} evento(s)/s"
+            )
+
+    try:
+        resultado = importador.importar(argumentos.caminhos, recomecar=argumentos.recomecar, ao_progredir=progresso)
+    except ValueError as exc:
+        print(exc)
+        sys.exit(1)
+    decorrido = max(0.001, time.monotonic() - inicio)
+    print(
+        f"Banco: {database.modo_banco_ativo()} | lidos: {resultado['lidos']} | importadas: {resultado['importadas']} | "
+        f"duplicadas: {resultado['duplicadas']} | inválidas: {resultado['invalidas']} | "
+        f"com imagem: {resultado['com_imagem']} | {decorrido:.1f}s "
+        f"({(resultado['lidos'] - importador.retomados) / decorrido:.0f} evento(s)/s)"
+    )
+
+    # As leituras importadas não passam por visitas.registrar (chegam fora de
+    # ordem em relação ao histórico): o histórico por placa é refeito inteiro.
+    if resultado["importadas"]:
+        if argumentos.sem_visitas:
+            print("Histórico por placa desatualizado: rode python visitas.py reconstruir")
+        else:
+            sessao = database.nova_sessao()
+            try:
+                lidos, _, placas = visitas.reconstruir(sessao)
+            finally:
+                sessao.close()
+            print(f"Histórico por placa recalculado: {lidos} registro(s), {placas} placa(s)")
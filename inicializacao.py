@@ -0,0 +1,93 @@
+﻿import logging
+import threading
+import time
+
+logger = logging.getLogger("INICIALIZACAO")
+
+PENDENTE = "pendente"
+EXECUTANDO = "executando"
+CONCLUIDA = "concluida"
+FALHOU = "falhou"
+
+
+class _Etapa:
+    __slots__ = ("nome", "obrigatoria", "situacao", "inicio", "fim", "detalhe")
+
+    def __init__(self, nome, obrigatoria):
+        self.nome = nome
+        self.obrigatoria = obrigatoria
+        self.situacao = PENDENTE
+        self.inicio = None
+        self.fim = None
+        self.detalhe = None
+
+
+class EtapasInicializacao:
+    # Etapas lentas da inicialização rodam em threads depois que o servidor
+    # já aceita conexões. O processo fica "pronto" quando todas as etapas
+    # obrigatórias terminaram; as opcionais só aparecem no estado.
+    def __init__(self):
+        self.iniciado_em = time.time()
+        self._etapas = {}
+        self._lock = threading.Lock()
+
+    def _registrar(self, nome, obrigatoria):
+        with self._lock:
+            etapa = self._etapas.get(nome)
+            if etapa is None:
+                etapa = self._etapas[nome] = _Etapa(nome, obrigatoria)
+            return etapa
+
+    def executar(self, nome, funcao, obrigatoria=True):
+        etapa = self._registrar(nome, obrigatoria)
+
+        def worker():
+            etapa.situacao = EXECUTANDO
+            etapa.inicio = time.monotonic()
+            try:
+                detalhe = funcao()
+            except Exception as exc:
+                etapa.detalhe = str(exc)
+                etapa.situacao = FALHOU
+                logger.error(f"Etapa de inicialização '{nome}' falhou: {exc}")
+            else:
+                etapa.detalhe = detalhe
+                etapa.situacao = CONCLUIDA
+            finally:
+                etapa.fim = time.monotonic()
+
+        thread = threading.Thread(target=worker, daemon=True, name=f"inicializacao-{nome}")
+        thread.start()
+        return thread
+
+    def concluir(self, nome, detalhe=None, obrigatoria=True):
+        # Etapa executada em primeiro plano, antes do servidor subir.
+        etapa = self._registrar(nome, obrigatoria)
+        etapa.inicio = etapa.fim = time.monotonic()
+        etapa.detalhe = detalhe
+        etapa.situacao = CONCLUIDA
+
+    def pronto(self):
+        with self._lock:
+            etapas = list(self._etapas.values())
+        return all(etapa.situacao == CONCLUIDA for etapa in etapas if etapa.obrigatoria)
+
+    def estado(self):
+        with self._lock:
+            etapas = list(self._etapas.values())
+        agora = time.monotonic()
+        return {
+            "pronto": all(etapa.situacao == CONCLUIDA for etapa in etapas if etapa.obrigatoria),
+            "segundos_desde_inicio": round(time.time() - self.iniciado_em, 1),
+            "etapas": {
+                etapa.nome: {
+                    "situacao": etapa.situacao,
+                    "obrigatoria": etapa.obrigatoria,
+                    "duracao_ms": (
+                        round(((etapa.fim or agora) - etapa.inicio) * 1000, 1) if etapa.inicio is not None else None
+                    ),
+                    "detalhe": etapa.detalhe,
+                }
+                for etapa in etapas
+            },
+        }
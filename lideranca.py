@@ -0,0 +1,174 @@
+﻿import logging
+import os
+import threading
+import time
+
+from sqlalchemy import text
+
+import database
+
+logger = logging.getLogger("LIDERANCA")
+
+# Chave do advisory lock de liderança no PostgreSQL ("HRLP").
+CHAVE_LIDER = 0x48524C50
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+
+class LockArquivo:
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self._arquivo = None
+
+    @property
+    def adquirido(self):
+        return self._arquivo is not None
+
+    def tentar_adquirir(self):
+        if self._arquivo is not None:
+            return True
+
+        os.makedirs(os.path.dirname(self.caminho), exist_ok=True)
+        arquivo = open(self.caminho, "a+b")
+        try:
+            if fcntl is not None:
+                fcntl.flock(arquivo.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            elif msvcrt is not None:
+                arquivo.seek(0)
+                msvcrt.locking(arquivo.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            arquivo.close()
+            return False
+
+        self._arquivo = arquivo
+        return True
+
+    def liberar(self):
+        if self._arquivo is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._arquivo.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                self._arquivo.seek(0)
+                msvcrt.locking(self._arquivo.fileno(), msvcrt.LK_UNLCK, 1)
+        except OSError:
+            pass
+        finally:
+            self._arquivo.close()
+            self._arquivo = None
+
+
+class EleicaoLider:
+    def __init__(self, intervalo=None, ao_assumir=None, ao_perder=None):
+        if intervalo is None:
+            try:
+                intervalo = int(os.getenv("LIDERANCA_INTERVALO_SEGUNDOS", "10").strip() or 10)
+            except ValueError:
+                intervalo = 10
+        self.intervalo = max(2, intervalo)
+        self.ao_assumir = ao_assumir
+        self.ao_perder = ao_perder
+        self.identificador = f"{os.uname().nodename if hasattr(os, 'uname') else 'local'}:{os.getpid()}"
+
+        self._lider = False
+        self._origem = None
+        self._conexao_pg = None
+        self._lock_local = LockArquivo(os.path.join(os.path.dirname(database.caminho_sqlite_local()), "lider.lock"))
+        self._thread = None
+
+    def eh_lider(self):
+        return self._lider
+
+    def origem(self):
+        return self._origem
+
+    def _fechar_conexao_pg(self):
+        if self._conexao_pg is None:
+            return
+        try:
+            self._conexao_pg.close()
+        except Exception:
+            pass
+        self._conexao_pg = None
+
+    def _tentar_postgres(self):
+        engine_pg = database.engine_postgres
+        if engine_pg is None or database.modo_banco_ativo() != "postgres":
+            self._fechar_conexao_pg()
+            return None
+
+        try:
+            if self._conexao_pg is not None:
+                self._conexao_pg.execute(text("SELECT 1")).scalar()
+                self._conexao_pg.commit()
+                return True
+
+            conexao = engine_pg.connect()
+            obtido = conexao.execute(text("SELECT pg_try_advisory_lock(:chave)"), {"chave": CHAVE_LIDER}).scalar()
+            conexao.commit()
+            if obtido:
+                self._conexao_pg = conexao
+                return True
+            conexao.close()
+            return False
+        except Exception as exc:
+            # Sem o advisory lock, outra instância pode assumir: cair para o
+            # lock de arquivo (por host) daria um líder por máquina.
+            logger.warning(f"Falha na eleição de líder via PostgreSQL: {database._formatar_erro(exc)}")
+            self._fechar_conexao_pg()
+            return False
+
+    def verificar(self):
+        # O lock de arquivo só vale no modo SQLite; com o PostgreSQL ativo,
+        # uma falha na conexão deixa a instância sem liderança.
+        resultado_pg = self._tentar_postgres()
+        if resultado_pg is not None:
+            self._lock_local.liberar()
+            lider, origem = resultado_pg, "postgres"
+        else:
+            lider, origem = self._lock_local.tentar_adquirir(), "arquivo"
+
+        if lider and not self._lider:
+            self._lider, self._origem = True, origem
+            logger.warning(f"Instância {self.identificador} assumiu a liderança ({origem})")
+            self._notificar(self.ao_assumir)
+        elif not lider and self._lider:
+            self._lider, self._origem = False, None
+            logger.warning(f"Instância {self.identificador} perdeu a liderança")
+            self._notificar(self.ao_perder)
+        elif lider:
+            self._origem = origem
+
+        return self._lider
+
+    def _notificar(self, callback):
+        if callback is None:
+            return
+        try:
+            callback()
+        except Exception as exc:
+            logger.error(f"Erro no callback de liderança: {exc}")
+
+    def iniciar(self):
+        self.verificar()
+
+        def worker():
+            while True:
+                time.sleep(self.intervalo)
+                try:
+                    self.verificar()
+                except Exception as exc:
+                    logger.error(f"Erro na eleição de líder: {exc}")
+
+        self._thread = threading.Thread(target=worker, daemon=True, name="eleicao-lider")
+        self._thread.start()
+        return self._thread
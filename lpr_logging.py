@@ -0,0 +1,218 @@
+﻿import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+from datetime import datetime
+
+DIRETORIO_LOGS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
+ARQUIVO_ERROS = os.path.join(DIRETORIO_LOGS, "erros.log")
+
+FORMATO_TEXTO = "%(asctime)s | %(levelname)s | %(name)s | %(message)s"
+FORMATO_DATA = "%Y-%m-%d %H:%M:%S"
+
+_lock = threading.Lock()
+_fila = None
+_listener = None
+_handlers_fila = []
+_pausado = False
+
+
+def _ler_inteiro_env(chave, padrao, minimo=0):
+    try:
+        return max(minimo, int(os.getenv(chave, str(padrao)).strip()))
+    except ValueError:
+        return padrao
+
+
+def normalizar_texto(texto):
+    if not isinstance(texto, str):
+        return texto
+    if any(ch in texto for ch in ("Ã", "Â", "�")):
+        try:
+            texto = texto.encode("latin-1", errors="ignore").decode("utf-8", errors="ignore")
+        except Exception:
+            pass
+    return texto
+
+
+class FormatadorTexto(logging.Formatter):
+    def __init__(self):
+        super().__init__(FORMATO_TEXTO, datefmt=FORMATO_DATA)
+
+    def format(self, record):
+        # O mesmo registro passa pelo console e pelo arquivo: o prefixo vai
+        # numa cópia para não se acumular.
+        copia = copy.copy(record)
+        mensagem = normalizar_texto(record.getMessage())
+        componente = getattr(record, "componente", None)
+        copia.msg = f"[{componente}] {mensagem}" if componente else mensagem
+        copia.args = None
+        return super().format(copia)
+
+
+class FormatadorJSON(logging.Formatter):
+    def format(self, record):
+        registro = {
+            "timestamp": datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "mensagem": normalizar_texto(record.getMessage()),
+            "pid": record.process,
+            "thread": record.threadName,
+        }
+        componente = getattr(record, "componente", None)
+        if componente:
+            registro["componente"] = componente
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            registro["excecao"] = record.exc_text
+        return json.dumps(registro, ensure_ascii=False)
+
+
+class _HandlerFila(logging.handlers.QueueHandler):
+    # A fila é local ao processo: o registro segue sem formatação e com
+    # exc_info intacto, e toda a formatação acontece na thread do listener.
+    descartados = 0
+
+    def prepare(self, record):
+        if record.args:
+            # Outros handlers do mesmo logger ainda usam o registro original.
+            record = copy.copy(record)
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _HandlerFila.descartados += 1
+
+
+def _criar_formatador():
+    if os.getenv("LOG_FORMATO", "texto").strip().lower() == "json":
+        return FormatadorJSON()
+    return FormatadorTexto()
+
+
+def _criar_handler_arquivo(caminho):
+    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+    backups = _ler_inteiro_env("LOG_BACKUPS", 5)
+    rotacao = os.getenv("LOG_ROTACAO", "tamanho").strip().lower()
+
+    if rotacao in {"diaria", "diario", "dia"}:
+        return logging.handlers.TimedRotatingFileHandler(
+            caminho,
+            when="midnight",
+            backupCount=backups,
+            encoding="utf-8",
+        )
+    if rotacao == "nenhuma":
+        return logging.FileHandler(caminho, encoding="utf-8")
+
+    tamanho_mb = _ler_inteiro_env("LOG_MAX_MB", 10, minimo=1)
+    return logging.handlers.RotatingFileHandler(
+        caminho,
+        maxBytes=tamanho_mb * 1024 * 1024,
+        backupCount=backups,
+        encoding="utf-8",
+    )
+
+
+def _criar_handlers_destino():
+    formatador = _criar_formatador()
+
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(formatador)
+
+    arquivo = _criar_handler_arquivo(ARQUIVO_ERROS)
+    arquivo.setLevel(logging.ERROR)
+    arquivo.setFormatter(formatador)
+
+    return [console, arquivo]
+
+
+def _iniciar_listener():
+    global _fila, _listener
+
+    _fila = queue.Queue(maxsize=_ler_inteiro_env("LOG_FILA_MAXIMA", 10000, minimo=100))
+    _listener = logging.handlers.QueueListener(_fila, *_criar_handlers_destino(), respect_handler_level=True)
+    _listener.start()
+    for handler in _handlers_fila:
+        handler.queue = _fila
+
+
+def parar_logging():
+    global _listener
+    with _lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def _pausar_antes_fork():
+    # O fork acontece com o listener parado: nenhum handler fica com lock
+    # preso no filho. Fila cheia: segue sem pausar.
+    global _pausado
+    if _listener is None or _pausado:
+        return
+    try:
+        _listener.stop()
+        _pausado = True
+    except queue.Full:
+        pass
+
+
+def _retomar_apos_fork():
+    global _pausado
+    if _listener is not None and _pausado:
+        _listener.start()
+    _pausado = False
+
+
+def _reiniciar_apos_fork():
+    # A thread do listener não sobrevive ao fork; o filho cria fila e
+    # handlers próprios em vez de herdar locks possivelmente ocupados.
+    global _lock, _listener, _pausado
+    _lock = threading.Lock()
+    _pausado = False
+    if _listener is None:
+        return
+    _listener = None
+    _iniciar_listener()
+
+
+def configurar_logger(nome):
+    logger = logging.getLogger(nome)
+    logger.setLevel(logging.INFO)
+
+    with _lock:
+        if _listener is None:
+            _iniciar_listener()
+        if not any(isinstance(h, _HandlerFila) for h in logger.handlers):
+            handler = _HandlerFila(_fila)
+            _handlers_fila.append(handler)
+            logger.addHandler(handler)
+
+    logger.propagate = False
+    return logger
+
+
+def total_descartados():
+    return _HandlerFila.descartados
+
+
+atexit.register(parar_logging)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(
+        before=_pausar_antes_fork, after_in_parent=_retomar_apos_fork, after_in_child=_reiniciar_apos_fork
+    )
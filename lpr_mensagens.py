@@ -1,4 +1,10 @@
 ﻿MENSAGEM_ENTRADA_PADRAO = "Nova entrada: Veículo *{PLACA}* - cor *{COR}*"
+MENSAGEM_WATCHLIST_PADRAO = (
+    "ALERTA DE WATCHLIST: Veículo *{PLACA}* ({CATEGORIA}) - lido como *{LIDA}* "
+    "({TIPO}) - cor *{COR}* - câmera {CAMERA}"
+)
+MENSAGEM_RESUMO_PADRAO = "Resumo de entradas: *{QUANTIDADE}* veículo(s) entre {INICIO} e {FIM}\n{ITENS}"
+MENSAGEM_RESUMO_ITEM_PADRAO = "{HORA} - *{PLACA}* - {COR}"
 
 
 def formatar_template_mensagem(template, placa, cor_veiculo):
@@ -10,3 +16,38 @@ def formatar_template_mensagem(template, placa, cor_veiculo):
     mensagem = mensagem.replace("{COR}", cor_veiculo or "")
     mensagem = mensagem.replace("{MANUTENCOES}", "")
     return mensagem.strip()
+
+
+def formatar_alerta_watchlist(template, correspondencia, cor_veiculo, camera=None):
+    if not template:
+        return ""
+
+    entrada = correspondencia.entrada
+    mensagem = template
+    mensagem = mensagem.replace("{PLACA}", entrada.placa or "")
+    mensagem = mensagem.replace("{CATEGORIA}", entrada.categoria or "sem categoria")
+    mensagem = mensagem.replace("{DESCRICAO}", entrada.descricao or "")
+    mensagem = mensagem.replace("{LIDA}", correspondencia.placa_lida or "")
+    mensagem = mensagem.replace("{TIPO}", correspondencia.tipo)
+    mensagem = mensagem.replace("{COR}", cor_veiculo or "")
+    mensagem = mensagem.replace("{CAMERA}", camera or "não informada")
+    return mensagem.strip()
+
+
+def formatar_resumo_entradas(template, template_item, entradas):
+    if not template or not entradas:
+        return ""
+
+    itens = []
+    for entrada in entradas:
+        item = template_item.replace("{HORA}", entrada.horario.strftime("%H:%M:%S"))
+        item = item.replace("{PLACA}", entrada.placa or "")
+        item = item.replace("{COR}", entrada.cor or "")
+        itens.append(item.strip())
+
+    mensagem = template
+    mensagem = mensagem.replace("{QUANTIDADE}", str(len(entradas)))
+    mensagem = mensagem.replace("{INICIO}", entradas[0].horario.strftime("%H:%M"))
+    mensagem = mensagem.replace("{FIM}", entradas[-1].horario.strftime("%H:%M"))
+    mensagem = mensagem.replace("{ITENS}", "\n".join(itens))
+    return mensagem.strip()
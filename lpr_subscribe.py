@@ -0,0 +1,476 @@
+﻿import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlsplit
+
+logger = logging.getLogger("SUBSCRIBE")
+
+CAMINHO_PADRAO = "/cgi-bin/snapManager.cgi?action=attachFileProc&Flags[0]=Event&Events=[TrafficJunction]&heartbeat=30"
+
+_RE_PARAMETRO_DIGEST = re.compile(r'(\w+)\s*=\s*(?:"([^"]*)"|([^\s,]+))')
+
+
+def _ler_inteiro_env(chave, padrao, minimo=0):
+    valor = os.getenv(chave, "").strip()
+    if not valor:
+        return padrao
+    try:
+        return max(minimo, int(valor))
+    except ValueError:
+        logger.warning(f"Valor inválido em {chave}='{valor}', usando {padrao}")
+        return padrao
+
+
+class CameraSubscribe:
+    def __init__(self, url, caminho=None):
+        partes = urlsplit(url if "://" in url else f"http://{url}")
+        if partes.scheme not in {"http", "https"} or not partes.hostname:
+            raise ValueError(f"URL de câmera inválida: {url}")
+
+        self.https = partes.scheme == "https"
+        self.host = partes.hostname
+        self.porta = partes.port or (443 if self.https else 80)
+        self.usuario = unquote(partes.username or "")
+        self.senha = unquote(partes.password or "")
+
+        caminho_url = partes.path or ""
+        if partes.query:
+            caminho_url = f"{caminho_url}?{partes.query}"
+        self.caminho = caminho_url if caminho_url not in {"", "/"} else (caminho or CAMINHO_PADRAO)
+        self.identificador = f"{self.host}:{self.porta}"
+
+    def __repr__(self):
+        return f"<CameraSubscribe({self.identificador})>"
+
+
+def carregar_cameras_env():
+    raw = os.getenv("SUBSCRIBE_CAMERAS", "").strip()
+    if not raw:
+        return []
+
+    caminho = os.getenv("SUBSCRIBE_PATH", "").strip() or None
+    cameras = []
+    for item in (parte.strip() for parte in raw.split(",")):
+        if not item:
+            continue
+        try:
+            cameras.append(CameraSubscribe(item, caminho))
+        except ValueError as exc:
+            logger.warning(f"SUBSCRIBE_CAMERAS: {exc}")
+    return cameras
+
+
+class _DesafioDigest:
+    def __init__(self, cabecalho):
+        parametros = {}
+        for chave, com_aspas, sem_aspas in _RE_PARAMETRO_DIGEST.findall(cabecalho):
+            parametros[chave.lower()] = com_aspas if com_aspas else sem_aspas
+        self.realm = parametros.get("realm", "")
+        self.nonce = parametros.get("nonce", "")
+        self.opaque = parametros.get("opaque")
+        self.algoritmo = parametros.get("algorithm", "MD5")
+        qops = [item.strip() for item in parametros.get("qop", "").split(",") if item.strip()]
+        self.qop = "auth" if "auth" in qops else (qops[0] if qops else None)
+        self.contador = 0
+
+    def _hash(self, texto):
+        nome = self.algoritmo.upper().replace("-SESS", "")
+        funcao = hashlib.sha256 if nome == "SHA-256" else hashlib.md5
+        return funcao(texto.encode("utf-8")).hexdigest()
+
+    def cabecalho(self, usuario, senha, metodo, uri):
+        self.contador += 1
+        nc = f"{self.contador:08x}"
+        cnonce = os.urandom(8).hex()
+
+        ha1 = self._hash(f"{usuario}:{self.realm}:{senha}")
+        if self.algoritmo.upper().endswith("-SESS"):
+            ha1 = self._hash(f"{ha1}:{self.nonce}:{cnonce}")
+        ha2 = self._hash(f"{metodo}:{uri}")
+
+        if self.qop:
+            resposta = self._hash(f"{ha1}:{self.nonce}:{nc}:{cnonce}:{self.qop}:{ha2}")
+        else:
+            resposta = self._hash(f"{ha1}:{self.nonce}:{ha2}")
+
+        campos = [
+            f'username="{usuario}"',
+            f'realm="{self.realm}"',
+            f'nonce="{self.nonce}"',
+            f'uri="{uri}"',
+            f'response="{resposta}"',
+            f"algorithm={self.algoritmo}",
+        ]
+        if self.qop:
+            campos.extend([f"qop={self.qop}", f"nc={nc}", f'cnonce="{cnonce}"'])
+        if self.opaque:
+            campos.append(f'opaque="{self.opaque}"')
+        return "Digest " + ", ".join(campos)
+
+
+class _FimDoStream(Exception):
+    pass
+
+
+class _LeitorCorpo:
+    def __init__(self, reader, chunked, timeout):
+        self._reader = reader
+        self._chunked = chunked
+        self._timeout = timeout
+        self._buffer = bytearray()
+        self._fim = False
+
+    async def _ler(self, coroutine):
+        return await asyncio.wait_for(coroutine, timeout=self._timeout)
+
+    async def _proximo_bloco(self):
+        if self._fim:
+            raise _FimDoStream()
+
+        if not self._chunked:
+            bloco = await self._ler(self._reader.read(65536))
+            if not bloco:
+                self._fim = True
+                raise _FimDoStream()
+            return bloco
+
+        linha = await self._ler(self._reader.readline())
+        if not linha:
+            self._fim = True
+            raise _FimDoStream()
+        tamanho = int(linha.split(b";", 1)[0].strip() or b"0", 16)
+        if tamanho == 0:
+            self._fim = True
+            raise _FimDoStream()
+        bloco = await self._ler(self._reader.readexactly(tamanho))
+        await self._ler(self._reader.readexactly(2))
+        return bloco
+
+    async def readline(self):
+        while True:
+            posicao = self._buffer.find(b"\n")
+            if posicao >= 0:
+                linha = bytes(self._buffer[: posicao + 1])
+                del self._buffer[: posicao + 1]
+                return linha
+            self._buffer.extend(await self._proximo_bloco())
+
+    async def readexactly(self, tamanho):
+        while len(self._buffer) < tamanho:
+            self._buffer.extend(await self._proximo_bloco())
+        dados = bytes(self._buffer[:tamanho])
+        del self._buffer[:tamanho]
+        return dados
+
+    def devolver(self, dados):
+        self._buffer[:0] = dados
+
+    async def readuntil(self, separador):
+        inicio = 0
+        while True:
+            posicao = self._buffer.find(separador, inicio)
+            if posicao >= 0:
+                dados = bytes(self._buffer[:posicao])
+                del self._buffer[: posicao + len(separador)]
+                return dados
+            inicio = max(0, len(self._buffer) - len(separador) + 1)
+            self._buffer.extend(await self._proximo_bloco())
+
+
+def _converter_texto_evento(texto):
+    campos = {}
+    for linha in texto.splitlines():
+        if "=" not in linha:
+            continue
+        chave, valor = linha.split("=", 1)
+        campos[chave.strip()] = valor.strip()
+
+    if not campos:
+        return {"Active": True} if "heartbeat" in texto.lower() else None
+
+    def campo(*sufixos):
+        for chave, valor in campos.items():
+            for sufixo in sufixos:
+                if chave.endswith(sufixo):
+                    return valor
+        return None
+
+    placa = campo(".TrafficCar.PlateNumber", ".Object.Text", "PlateNumber")
+    if not placa:
+        if any("Heartbeat" in chave or "Heartbeat" in valor for chave, valor in campos.items()):
+            return {"Active": True}
+        return None
+
+    confianca = campo(".TrafficCar.Confidence", ".Object.Confidence", "Confidence")
+    try:
+        confianca = int(confianca) if confianca is not None else None
+    except ValueError:
+        confianca = None
+
+    return {
+        "Picture": {
+            "Plate": {
+                "PlateNumber": placa,
+                "PlateColor": campo(".TrafficCar.PlateColor", "PlateColor") or "N/A",
+                "Confidence": confianca,
+            },
+            "Vehicle": {"VehicleColor": campo(".TrafficCar.VehicleColor", "VehicleColor") or "N/A"},
+            "SnapInfo": {
+                "AccurateTime": campo(".TrafficCar.Time", "AccurateTime"),
+                "DeviceID": campo(".TrafficCar.DeviceID", "DeviceID"),
+                "Direction": campo(".TrafficCar.Direction", "Direction"),
+            },
+        }
+    }
+
+
+class ClienteSubscribe:
+    def __init__(self, cameras, ao_receber_evento, workers=None):
+        self.cameras = list(cameras)
+        self.ao_receber_evento = ao_receber_evento
+        self.timeout_leitura = _ler_inteiro_env("SUBSCRIBE_TIMEOUT_SEGUNDOS", 90, minimo=5)
+        self.timeout_conexao = _ler_inteiro_env("SUBSCRIBE_CONNECT_TIMEOUT_SEGUNDOS", 10, minimo=1)
+        self.backoff_maximo = _ler_inteiro_env("SUBSCRIBE_BACKOFF_MAX_SEGUNDOS", 60, minimo=1)
+        self.conexoes_simultaneas = _ler_inteiro_env("SUBSCRIBE_CONEXOES_SIMULTANEAS", 50, minimo=1)
+        workers = workers or _ler_inteiro_env("SUBSCRIBE_WORKERS", 8, minimo=1)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="subscribe")
+        self._loop = None
+        self._thread = None
+        self._parar = None
+        self._estado = {
+            camera.identificador: {"conectada": False, "eventos": 0, "reconexoes": 0, "ultimo_erro": None}
+            for camera in self.cameras
+        }
+
+    def estado(self):
+        return {chave: dict(valor) for chave, valor in self._estado.items()}
+
+    async def _abrir_conexao(self, camera):
+        contexto_ssl = ssl.create_default_context() if camera.https else None
+        if contexto_ssl is not None and os.getenv("SUBSCRIBE_VERIFICAR_TLS", "1").strip() == "0":
+            contexto_ssl.check_hostname = False
+            contexto_ssl.verify_mode = ssl.CERT_NONE
+        return await asyncio.wait_for(
+            asyncio.open_connection(camera.host, camera.porta, ssl=contexto_ssl),
+            timeout=self.timeout_conexao,
+        )
+
+    async def _enviar_requisicao(self, camera, desafio):
+        reader, writer = await self._abrir_conexao(camera)
+        linhas = [
+            f"GET {camera.caminho} HTTP/1.1",
+            f"Host: {camera.host}:{camera.porta}",
+            "Accept: multipart/x-mixed-replace, */*",
+            "Connection: keep-alive",
+        ]
+        if desafio is not None and camera.usuario:
+            linhas.append("Authorization: " + desafio.cabecalho(camera.usuario, camera.senha, "GET", camera.caminho))
+        writer.write(("\r\n".join(linhas) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+        linha_status = await asyncio.wait_for(reader.readline(), timeout=self.timeout_leitura)
+        partes = linha_status.decode("latin-1").split(" ", 2)
+        if len(partes) < 2 or not partes[1].isdigit():
+            writer.close()
+            raise ConnectionError(f"resposta HTTP inválida: {linha_status[:80]!r}")
+        status = int(partes[1])
+
+        cabecalhos = {}
+        while True:
+            linha = await asyncio.wait_for(reader.readline(), timeout=self.timeout_leitura)
+            if linha in {b"\r\n", b"\n", b""}:
+                break
+            chave, _, valor = linha.decode("latin-1").partition(":")
+            cabecalhos[chave.strip().lower()] = valor.strip()
+
+        return status, cabecalhos, reader, writer
+
+    async def _conectar(self, camera, desafio):
+        status, cabecalhos, reader, writer = await self._enviar_requisicao(camera, desafio)
+
+        if status == 401 and camera.usuario:
+            writer.close()
+            cabecalho_desafio = cabecalhos.get("www-authenticate", "")
+            if not cabecalho_desafio.lower().startswith("digest"):
+                raise PermissionError("câmera não ofereceu autenticação Digest")
+            desafio = _DesafioDigest(cabecalho_desafio)
+            status, cabecalhos, reader, writer = await self._enviar_requisicao(camera, desafio)
+
+        if status != 200:
+            writer.close()
+            if status == 401:
+                raise PermissionError("credenciais recusadas pela câmera")
+            raise ConnectionError(f"câmera respondeu HTTP {status}")
+
+        return desafio, cabecalhos, reader, writer
+
+    async def _despachar(self, camera, dados, tamanho):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self.ao_receber_evento, camera, dados, tamanho)
+        self._estado[camera.identificador]["eventos"] += 1
+
+    async def _consumir_stream(self, camera, cabecalhos, reader):
+        chunked = "chunked" in cabecalhos.get("transfer-encoding", "").lower()
+        corpo = _LeitorCorpo(reader, chunked, self.timeout_leitura)
+
+        tipo = cabecalhos.get("content-type", "")
+        boundary_match = re.search(r'boundary="?([^";]+)"?', tipo)
+        if not boundary_match:
+            while True:
+                linha = (await corpo.readline()).strip()
+                if linha:
+                    await self._processar_parte(camera, "application/json", linha)
+
+        delimitador = b"--" + boundary_match.group(1).encode("latin-1").lstrip(b"-")
+        pendente = []
+        try:
+            await self._consumir_partes(camera, corpo, delimitador, pendente)
+        finally:
+            if pendente:
+                await self._despachar(camera, *pendente.pop())
+
+    async def _consumir_partes(self, camera, corpo, delimitador, pendente):
+        while True:
+            linha = (await corpo.readline()).strip()
+            if not linha.startswith(delimitador):
+                continue
+            if linha == delimitador + b"--":
+                return
+
+            cabecalhos_parte = {}
+            while True:
+                linha = await corpo.readline()
+                if linha in {b"\r\n", b"\n"}:
+                    break
+                chave, _, valor = linha.decode("latin-1").partition(":")
+                cabecalhos_parte[chave.strip().lower()] = valor.strip()
+
+            tamanho = cabecalhos_parte.get("content-length", "")
+            if tamanho.isdigit():
+                conteudo = await corpo.readexactly(int(tamanho))
+            else:
+                conteudo = await corpo.readuntil(b"\r\n" + delimitador)
+                corpo.devolver(delimitador)
+
+            tipo = cabecalhos_parte.get("content-type", "").lower()
+            if tipo.startswith("image/"):
+                if pendente:
+                    dados, tamanho_evento = pendente.pop()
+                    dados["Picture"]["NormalPic"] = {"Content": base64.b64encode(conteudo).decode("ascii")}
+                    await self._despachar(camera, dados, tamanho_evento + len(conteudo))
+                continue
+
+            if pendente:
+                await self._despachar(camera, *pendente.pop())
+
+            aguardando_imagem = await self._processar_parte(camera, tipo, conteudo)
+            if aguardando_imagem is not None:
+                pendente.append(aguardando_imagem)
+
+    async def _processar_parte(self, camera, tipo, conteudo):
+        texto = conteudo.decode("utf-8", errors="replace").strip()
+        if not texto:
+            return None
+
+        if "json" in tipo or texto.startswith("{"):
+            try:
+                dados = json.loads(texto)
+            except ValueError:
+                logger.warning(f"[{camera.identificador}] Parte JSON inválida ignorada")
+                return None
+            if isinstance(dados, dict):
+                await self._despachar(camera, dados, len(conteudo))
+            return None
+
+        # Formato texto (chave=valor): a imagem chega na parte seguinte do multipart.
+        dados = _converter_texto_evento(texto)
+        if dados is None:
+            return None
+        if "Picture" in dados:
+            return dados, len(conteudo)
+        await self._despachar(camera, dados, len(conteudo))
+        return None
+
+    async def _manter_camera(self, camera, semaforo):
+        estado = self._estado[camera.identificador]
+        desafio = None
+        tentativa = 0
+
+        while not self._parar.is_set():
+            writer = None
+            conectado_em = None
+            try:
+                async with semaforo:
+                    desafio, cabecalhos, reader, writer = await self._conectar(camera, desafio)
+                conectado_em = time.monotonic()
+                estado["conectada"] = True
+                estado["ultimo_erro"] = None
+                logger.info(f"[{camera.identificador}] Subscribe conectado")
+                await self._consumir_stream(camera, cabecalhos, reader)
+                logger.warning(f"[{camera.identificador}] Stream encerrado pela câmera")
+            except asyncio.CancelledError:
+                raise
+            except (_FimDoStream, asyncio.IncompleteReadError):
+                logger.warning(f"[{camera.identificador}] Stream encerrado pela câmera")
+            except asyncio.TimeoutError:
+                estado["ultimo_erro"] = "timeout"
+                logger.warning(f"[{camera.identificador}] Sem dados da câmera, reconectando")
+            except Exception as exc:
+                estado["ultimo_erro"] = str(exc)
+                logger.warning(f"[{camera.identificador}] Falha no subscribe: {exc}")
+            finally:
+                estado["conectada"] = False
+                if writer is not None:
+                    writer.close()
+
+            if conectado_em is not None and time.monotonic() - conectado_em > 30:
+                tentativa = 0
+            tentativa += 1
+            estado["reconexoes"] += 1
+
+            espera = random.uniform(0, min(self.backoff_maximo, 2 ** min(tentativa, 10)))
+            try:
+                await asyncio.wait_for(self._parar.wait(), timeout=espera)
+            except asyncio.TimeoutError:
+                pass
+
+    async def executar(self):
+        self._parar = asyncio.Event()
+        semaforo = asyncio.Semaphore(self.conexoes_simultaneas)
+        tarefas = [asyncio.create_task(self._manter_camera(camera, semaforo)) for camera in self.cameras]
+        try:
+            await self._parar.wait()
+        finally:
+            for tarefa in tarefas:
+                tarefa.cancel()
+            await asyncio.gather(*tarefas, return_exceptions=True)
+
+    def iniciar_em_thread(self):
+        if not self.cameras:
+            return None
+
+        def worker():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._loop.run_until_complete(self.executar())
+            finally:
+                self._loop.close()
+
+        self._thread = threading.Thread(target=worker, daemon=True, name="subscribe-loop")
+        self._thread.start()
+        return self._thread
+
+    def parar(self):
+        if self._loop is not None and self._parar is not None:
+            self._loop.call_soon_threadsafe(self._parar.set)
+        self._executor.shutdown(wait=False)
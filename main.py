@@ -1,86 +1,73 @@
 ﻿from __future__ import annotations
 
-import base64
-import ipaddress
-import logging
 import os
+import signal
 import socket
 import subprocess
 import sys
 import threading
 import time
-import uuid
 from datetime import datetime, timedelta
 
 import requests
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, jsonify, redirect, request, send_file
 from flask_cors import CORS
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from waitress import serve
 
+import capturas
 import database
-from database import criar_tabelas, inicializar_banco, obter_registros_filtrados
-from lpr_mensagens import MENSAGEM_ENTRADA_PADRAO, formatar_template_mensagem
+from cache_registros import CacheRegistros
+import estatisticas
+import visitas
+from agendador_notificacoes import (
+    PRIORIDADE_ALERTA,
+    PRIORIDADE_ENTRADA,
+    PRIORIDADE_RESUMO,
+    AgendadorNotificacoes,
+    BaldesCompartilhados,
+)
+from arquivamento import ArquivoFrio
+from armazenamento import CACHE_CONTROL_CAPTURAS, chave_valida, criar_armazenamento, etag_captura, tipo_conteudo
+from cameras import RegistroCameras
+from controle_acesso import ControleAcesso
+from database import criar_tabelas, inicializar_banco
+from deduplicacao import DetectorDuplicatas, ler_confianca
+from eventos import EventoInvalido, extrair_conteudo_imagem, extrair_dispositivo, ler_evento
+from inicializacao import EtapasInicializacao
+from lideranca import EleicaoLider, LockArquivo
+from lpr_logging import DIRETORIO_LOGS, configurar_logger, parar_logging
+from lpr_mensagens import (
+    MENSAGEM_ENTRADA_PADRAO,
+    MENSAGEM_WATCHLIST_PADRAO,
+    formatar_alerta_watchlist,
+    formatar_template_mensagem,
+)
+from lpr_subscribe import ClienteSubscribe, carregar_cameras_env
 from models import EntradaLPR
+from placas import normalizar_placa
+from recompressao import Recompressor
+from resumo_entradas import AgrupadorEntradas
+from serializacao import para_json
+from sugestoes_placas import IndicePlacas
+from travas import LockExclusivo
+from watchlist import GerenciadorWatchlist
 from whatsapp_notifier import NotificadorWhatsApp
 
 
 class LoggerLPR:
     def __init__(self):
-        self.logger = logging.getLogger("HR_INTELBRAS_LPR_WEBHOOK")
-        self.logger.setLevel(logging.INFO)
-
-        formatter = logging.Formatter(
-            "%(asctime)s | %(levelname)s | %(name)s | %(message)s",
-            datefmt="%Y-%m-%d %H:%M:%S",
-        )
-
-        if not any(isinstance(h, logging.StreamHandler) for h in self.logger.handlers):
-            console = logging.StreamHandler(sys.stdout)
-            console.setFormatter(formatter)
-            self.logger.addHandler(console)
-
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        logs_dir = os.path.join(base_dir, "logs")
-        os.makedirs(logs_dir, exist_ok=True)
-        error_log = os.path.join(logs_dir, "erros.log")
-        if not any(
-            isinstance(h, logging.FileHandler)
-            and getattr(h, "baseFilename", "") == os.path.abspath(error_log)
-            for h in self.logger.handlers
-        ):
-            file_handler = logging.FileHandler(error_log, encoding="utf-8")
-            file_handler.setLevel(logging.ERROR)
-            file_handler.setFormatter(formatter)
-            self.logger.addHandler(file_handler)
-
-        self.logger.propagate = False
+        self.logger = configurar_logger("HR_INTELBRAS_LPR_WEBHOOK")
 
     def info(self, message, component=None):
-        if component:
-            message = f"[{component}] {message}"
-        self.logger.info(self._normalize(message))
+        self.logger.info(message, extra={"componente": component})
 
     def warning(self, message, component=None):
-        if component:
-            message = f"[{component}] {message}"
-        self.logger.warning(self._normalize(message))
+        self.logger.warning(message, extra={"componente": component})
 
     def error(self, message, component=None, details=False):
-        if component:
-            message = f"[{component}] {message}"
-        self.logger.error(self._normalize(message), exc_info=details)
-
-    def _normalize(self, message):
-        if not isinstance(message, str):
-            return message
-        text = message
-        if any(ch in text for ch in ("Ã", "Â", "�")):
-            try:
-                text = text.encode("latin-1", errors="ignore").decode("utf-8", errors="ignore")
-            except Exception:
-                pass
-        return text
+        self.logger.error(message, exc_info=details, extra={"componente": component})
 
 
 log = LoggerLPR()
@@ -99,17 +86,60 @@ ASSETS_PERMITIDOS = {
 os.makedirs(DIRETORIO_CAPTURAS, exist_ok=True)
 
 DESTINO_ENTRADAS = ""
+DESTINO_ALERTAS = ""
 MENSAGEM_ENTRADA = ""
 notificador_entradas = None
-
-FRONTEND_ALLOWED_IPS = []
-
-RESPOSTA_CAMERA = {"Response": {"Status": 0, "Message": "Success"}}
+agrupador_entradas = None
+agendador_notificacoes = None
+despachar_notificacao = None
+
+controle_acesso = ControleAcesso(os.path.join(DIRETORIO_BASE, ".env"))
+
+# Respostas fixas às câmeras, codificadas uma vez só.
+RESPOSTA_CAMERA = para_json({"Response": {"Status": 0, "Message": "Success"}})
+RESPOSTA_DEVICE_INFO = para_json({"Result": True, "Message": "Success"})
+
+registro_cameras = RegistroCameras()
+# Criado antes do fork: os contadores de invalidação são compartilhados.
+cache_registros = CacheRegistros()
+# Também antes do fork: o limite de envios por destinatário vale para a
+# soma dos workers.
+baldes_notificacoes = BaldesCompartilhados()
+indice_placas = IndicePlacas(database.nova_sessao)
+arquivo_frio = ArquivoFrio()
+gerenciador_watchlist = GerenciadorWatchlist(database.nova_sessao)
+detector_duplicatas = DetectorDuplicatas()
+armazenamento = criar_armazenamento(DIRETORIO_STATIC)
+recompressor = Recompressor(database.nova_sessao, armazenamento, ao_alterar=cache_registros.invalidar_tudo)
+DISPOSITIVOS_SUBSCRIBE = {}
+
+eleicao_lider = None
+cliente_subscribe = None
+processo_whatsapp = None
+etapas_inicializacao = EtapasInicializacao()
+# Saída de um worker que não conseguiu preparar o banco: o supervisor para
+# em vez de reiniciá-lo em laço.
+CODIGO_SAIDA_FALHA_BANCO = 3
+lock_migracao = LockArquivo(os.path.join(os.path.dirname(database.caminho_sqlite_local()), "migracao.lock"))
 
 app = Flask(__name__, static_folder=DIRETORIO_STATIC)
+app.config["USE_X_SENDFILE"] = os.getenv("CAPTURAS_X_SENDFILE", "0").strip() == "1"
 CORS(app, resources={r"/api/*": {"origins": "*"}, r"/*": {"origins": "*"}})
 
 
+@app.before_request
+def aplicar_controle_acesso():
+    permitido, grupo = verificar_acesso(request.path, obter_ip_cliente(request))
+    if not permitido:
+        corpo, status = resposta_acesso_negado(grupo)
+        return (jsonify(corpo) if isinstance(corpo, dict) else corpo), status
+    indisponivel = resposta_banco_em_preparo(request.path)
+    if indisponivel is not None:
+        corpo, status = indisponivel
+        return jsonify(corpo), status
+    return None
+
+
 @app.after_request
 def adicionar_headers_cors(response):
     response.headers.add("Access-Control-Allow-Headers", "Content-Type,Authorization")
@@ -130,14 +160,26 @@ def limpar_imagens_antigas(directory, days=15):
         limit = now - (days * 86400)
         removed = 0
 
-        for filename in os.listdir(directory):
-            full_path = os.path.join(directory, filename)
-            if os.path.isfile(full_path) and os.path.getmtime(full_path) < limit:
-                os.remove(full_path)
-                removed += 1
+        # Arquivos soltos do formato antigo (captures/<uuid>.jpg).
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.stat().st_mtime < limit:
+                    os.remove(entry.path)
+                    removed += 1
+
+        # Capturas por hash: leituras antigas liberam a referência e o blob
+        # só é apagado quando nenhuma leitura o usa mais.
+        session = obter_sessao_banco()
+        try:
+            released = capturas.liberar_expiradas(session, datetime.now() - timedelta(days=days))
+            if released:
+                cache_registros.invalidar_tudo()
+            removed += capturas.remover_orfas(session, armazenamento)
+        finally:
+            session.close()
 
-        if removed > 0:
-            log.info(f"Limpeza automática: {removed} imagem(ns) removida(s)")
+        if removed > 0 or released > 0:
+            log.info(f"Limpeza automática: {removed} imagem(ns) removida(s), {released} leitura(s) expirada(s)")
 
     except Exception as exc:
         log.error(f"Erro na limpeza de imagens: {exc}", details=True)
@@ -155,8 +197,9 @@ def obter_ip_local():
 
 
 def carregar_configuracoes_whatsapp():
-    global DESTINO_ENTRADAS, MENSAGEM_ENTRADA
+    global DESTINO_ENTRADAS, DESTINO_ALERTAS, MENSAGEM_ENTRADA
     DESTINO_ENTRADAS = os.getenv("DESTINO_ENTRADAS", "").strip()
+    DESTINO_ALERTAS = os.getenv("DESTINO_ALERTAS", "").strip() or DESTINO_ENTRADAS
     MENSAGEM_ENTRADA = MENSAGEM_ENTRADA_PADRAO
 
 
@@ -181,241 +224,659 @@ def ler_porta_env(key, mandatory=False):
 
 
 def carregar_configuracoes_frontend():
-    global FRONTEND_ALLOWED_IPS
+    controle_acesso.recarregar(forcar=True)
 
-    raw = os.getenv("FRONTEND_ALLOWED_IPS", "").strip()
-    if not raw:
-        FRONTEND_ALLOWED_IPS = []
-        return
 
-    candidates = [item.strip() for item in raw.split(",") if item.strip()]
-    valid = []
-    for item in candidates:
-        try:
-            if "/" in item:
-                ipaddress.ip_network(item, strict=False)
-            else:
-                ipaddress.ip_address(item)
-            valid.append(item)
-        except ValueError:
-            log.warning(f"FRONTEND_ALLOWED_IPS inválido ignorado: {item}")
+def obter_ip_cliente(req):
+    return controle_acesso.ip_cliente(
+        req.remote_addr,
+        req.headers.get("X-Forwarded-For", ""),
+        req.headers.get("X-Real-Ip", ""),
+    )
 
-    FRONTEND_ALLOWED_IPS = valid
 
+def verificar_acesso(caminho, ip_cliente):
+    permitido, grupo = controle_acesso.permitido_rota(caminho, ip_cliente)
+    if not permitido:
+        log.warning(f"Acesso negado ({grupo}) para IP {ip_cliente or 'desconhecido'} em {caminho}")
+    return permitido, grupo
 
-def obter_ip_cliente(req):
-    forwarded = req.headers.get("X-Forwarded-For", "")
-    ip = forwarded.split(",")[0].strip() if forwarded else (req.remote_addr or "")
-    if ip.startswith("::ffff:"):
-        ip = ip.replace("::ffff:", "")
-    return ip
 
+def resposta_banco_em_preparo(caminho):
+    # Enquanto o esquema do banco é preparado, o que depende dele responde
+    # 503: a câmera reenvia o evento e o painel tenta de novo. KeepAlive,
+    # DeviceInfo, health e o frontend não usam o banco.
+    if database.estrutura_pronta():
+        return None
+    if caminho == "/NotificationInfo/TollgateInfo" or caminho.startswith("/api/"):
+        return {"erro": "Banco em preparação", "mensagem": "Tente novamente em instantes"}, 503
+    return None
 
-def ip_frontend_permitido(ip_cliente):
-    if not FRONTEND_ALLOWED_IPS and os.getenv("FRONTEND_ALLOWED_IPS"):
-        carregar_configuracoes_frontend()
 
-    if not FRONTEND_ALLOWED_IPS:
-        return True
+def resposta_acesso_negado(grupo):
+    if grupo == "frontend":
+        return "Acesso negado.", 403
+    return {"erro": "Acesso negado"}, 403
 
-    if not ip_cliente:
-        return False
 
+def caminho_captura_atual(image_key):
+    session = database.nova_sessao()
     try:
-        ip_obj = ipaddress.ip_address(ip_cliente)
-    except ValueError:
-        return False
+        return capturas.caminho_atual(session, image_key)
+    finally:
+        session.close()
 
-    for item in FRONTEND_ALLOWED_IPS:
-        try:
-            if "/" in item:
-                if ip_obj in ipaddress.ip_network(item, strict=False):
-                    return True
-            else:
-                if ip_obj == ipaddress.ip_address(item):
-                    return True
-        except ValueError:
-            continue
 
-    return False
+def enviar_whatsapp(message, image_key, recipients, priority):
+    # Com o agendador, o envio não bloqueia quem chamou: a mensagem entra na
+    # fila de cada destinatário conforme a prioridade.
+    if agendador_notificacoes is not None:
+        agendador_notificacoes.enfileirar(message, recipients, image_key, priority)
+    elif despachar_notificacao is not None:
+        despachar_notificacao(notificador_entradas, message, image_key, recipients)
+    else:
+        notificador_entradas.enviar_mensagem(message, destinatarios=recipients, caminho_imagem=image_key)
+
+
+def enviar_para_destinatario(message, recipient, image_key=None):
+    # Chamado pelo agendador. No modo ASGI o envio vai pelo cliente httpx do
+    # event loop, e a thread do agendador só aguarda o resultado.
+    if despachar_notificacao is not None:
+        despachar_notificacao(notificador_entradas, message, image_key, recipient, aguardar=True)
+        return
+    notificador_entradas.enviar_mensagem(message, destinatarios=recipient, caminho_imagem=image_key)
+
 
+def enviar_notificacao_entrada(message, image_key=None, resumo=False):
+    if not notificador_entradas or not DESTINO_ENTRADAS:
+        return
 
-def salvar_registro_lpr(session: Session, data: dict):
     try:
-        if not data or not isinstance(data, dict):
-            log.error("Dados inválidos recebidos")
-            return
+        enviar_whatsapp(message, image_key, DESTINO_ENTRADAS, PRIORIDADE_RESUMO if resumo else PRIORIDADE_ENTRADA)
+    except Exception as exc:
+        log.error(f"Erro ao enviar mensagem WhatsApp (entradas): {exc}")
 
-        picture = data.get("Picture", {})
-        plate_info = picture.get("Plate", {})
-        vehicle_info = picture.get("Vehicle", {})
-        snap_info = picture.get("SnapInfo", {})
 
-        plate = plate_info.get("PlateNumber")
-        plate_color = plate_info.get("PlateColor", "N/A")
-        vehicle_color = vehicle_info.get("VehicleColor", "N/A")
+def notificar_entrada(plate, vehicle_color, image_key=None):
+    if not notificador_entradas or not DESTINO_ENTRADAS:
+        return
 
-        if not plate or not isinstance(plate, str) or len(plate.strip()) < 3:
-            log.warning(f"Placa inválida ou ausente: {plate}")
-            return
+    try:
+        translated_color = NotificadorWhatsApp._traduzir_cor_veiculo(vehicle_color)
+        color_label = (translated_color or vehicle_color or "não informada").lower()
+        message = formatar_template_mensagem(MENSAGEM_ENTRADA, plate, color_label)
+        # Em rajadas (troca de turno) as entradas viram um resumo único.
+        if agrupador_entradas is not None:
+            agrupador_entradas.adicionar(plate, color_label, image_key, message)
+        else:
+            enviar_notificacao_entrada(message, image_key)
+    except Exception as exc:
+        log.error(f"Erro ao enviar mensagem WhatsApp (entradas): {exc}")
 
-        plate = plate.strip().upper()
 
-        camera_time = snap_info.get("AccurateTime")
-        timestamp = datetime.now()
-        if camera_time and isinstance(camera_time, str):
-            try:
-                timestamp = datetime.strptime(camera_time.split(".")[0], "%Y-%m-%d %H:%M:%S")
-            except ValueError:
-                pass
+def notificar_watchlist(correspondencia, vehicle_color, device_id=None, image_key=None):
+    entry = correspondencia.entrada
+    log.warning(
+        f"Watchlist: placa lida {correspondencia.placa_lida} corresponde a {entry.placa} "
+        f"({correspondencia.tipo}, categoria={entry.categoria or '-'}, câmera={device_id or '-'})"
+    )
+    if not notificador_entradas or not DESTINO_ALERTAS:
+        return
 
-        duplicate_limit = timestamp - timedelta(seconds=30)
-        existing = (
-            session.query(EntradaLPR)
-            .filter(EntradaLPR.placa == plate, EntradaLPR.timestamp >= duplicate_limit)
-            .first()
-        )
-        if existing:
-            return
+    try:
+        translated_color = NotificadorWhatsApp._traduzir_cor_veiculo(vehicle_color)
+        color_label = (translated_color or vehicle_color or "não informada").lower()
+        message = formatar_alerta_watchlist(MENSAGEM_WATCHLIST_PADRAO, correspondencia, color_label, device_id)
+        enviar_whatsapp(message, image_key, DESTINO_ALERTAS, PRIORIDADE_ALERTA)
+    except Exception as exc:
+        log.error(f"Erro ao enviar alerta WhatsApp (watchlist): {exc}")
 
-        record = EntradaLPR(
-            placa=plate,
-            cor_placa=plate_color,
-            cor_veiculo=vehicle_color,
-            confianca=plate_info.get("Confidence"),
-            timestamp=timestamp,
-        )
-        session.add(record)
+
+def salvar_imagem_evento(session, picture):
+    image_content = extrair_conteudo_imagem(picture)
+    if image_content is None:
+        return None
+
+    try:
+        return capturas.armazenar(session, image_content, armazenamento)
+    except capturas.ImagemInvalida as exc:
+        log.warning(f"{exc}, ignorando")
+    except Exception as exc:
+        log.error(f"Erro ao processar imagem: {exc}")
+        session.rollback()
+    return None
+
+
+def atualizar_melhor_leitura(session, cluster, plate, confidence, picture):
+    # Leitura do mesmo veículo com confiança maior: corrige a placa gravada
+    # em vez de criar outro registro.
+    record = session.get(EntradaLPR, cluster.registro_id) if cluster.registro_id else None
+    if record is None:
+        return None
+
+    # A imagem vem antes da correção: uma falha no armazenamento faz
+    # rollback da sessão, e não pode levar junto a placa já corrigida.
+    stored = salvar_imagem_evento(session, picture)
+    old_plate = record.placa
+    corrected = normalizar_placa(old_plate) != normalizar_placa(plate)
+    if corrected:
+        # Os resumos das duas placas mudam: mesmo lock de inserir_registro.
+        visitas.bloquear_placas(session, old_plate, plate)
+        visitas.desfazer(session, record, old_plate)
+    record.placa = plate
+    if corrected:
+        visitas.registrar(session, record)
+    record.confianca = confidence if confidence >= 0 else record.confianca
+    if stored and stored.hash != record.hash_imagem:
+        capturas.liberar(session, record.hash_imagem)
+        record.caminho_imagem = stored.caminho
+        record.hash_imagem = stored.hash
+    elif stored:
+        capturas.liberar(session, stored.hash)
+
+    try:
         session.commit()
-        session.refresh(record)
+    except IntegrityError:
+        session.rollback()
+        return None
+    cache_registros.invalidar(record.timestamp)
+    indice_placas.corrigir(old_plate, plate, record.timestamp, record.id)
+
+    cluster.placa = plate
+    cluster.confianca = confidence
+    log.info(f"LPR corrigido por leitura de maior confiança: {old_plate} -> {plate} (id={record.id})")
+    return record.caminho_imagem
+
+
+def inserir_registro(session, cluster, reading):
+    # Chamado com o lock do agrupamento reservado para a leitura. Devolve o
+    # registro gravado, ou None se a placa já estava no banco (o agrupamento
+    # passa a apontar para o registro existente).
+    plate = reading.placa
+    # Serializa a verificação de duplicidade e o resumo da placa entre
+    # processos/instâncias.
+    visitas.bloquear_placas(session, plate)
+
+    duplicate_limit = reading.timestamp - timedelta(seconds=detector_duplicatas.janela_segundos)
+    existing = (
+        session.query(EntradaLPR)
+        .filter(EntradaLPR.placa == plate, EntradaLPR.timestamp >= duplicate_limit)
+        .first()
+    )
+    if existing:
+        cluster.registro_id = existing.id
+        cluster.placa = existing.placa
+        cluster.confianca = ler_confianca(existing.confianca)
+        session.rollback()
+        return None
+
+    record = EntradaLPR(
+        placa=plate,
+        cor_placa=reading.cor_placa,
+        cor_veiculo=reading.cor_veiculo,
+        confianca=reading.confianca_original,
+        timestamp=reading.timestamp,
+        dispositivo_id=reading.dispositivo_id,
+        direcao=reading.direcao,
+    )
+    session.add(record)
+    try:
+        session.flush()
+        estatisticas.incrementar(session, record)
+        visitas.registrar(session, record)
+        session.commit()
+    except IntegrityError:
+        # Mesmo evento já gravado por outro processo: o agrupamento fica
+        # sem registro e não recebe correções.
+        session.rollback()
+        return None
+    cache_registros.invalidar(reading.timestamp)
+    indice_placas.registrar(plate, reading.timestamp, record.id)
+    session.refresh(record)
+    cluster.registro_id = record.id
+    return record
 
-        image_absolute = None
-        pic_data = picture.get("NormalPic", {}) or picture.get("VehiclePic", {})
-        image_content = pic_data.get("Content") if isinstance(pic_data, dict) else None
 
-        if image_content and isinstance(image_content, str):
-            try:
-                if not image_content.startswith("data:image/"):
-                    image_bytes = base64.b64decode(image_content)
-                else:
-                    encoded = image_content.split(",")[1] if "," in image_content else image_content
-                    image_bytes = base64.b64decode(encoded)
-
-                if len(image_bytes) >= 1000:
-                    timestamp_str = timestamp.strftime("%Y%m%d_%H%M%S")
-                    filename = f"{record.id}-{plate}-{timestamp_str}-{uuid.uuid4().hex[:8]}.jpg"
-                    image_relative = os.path.join("captures", filename)
-                    image_absolute = os.path.join(DIRETORIO_STATIC, image_relative)
-
-                    with open(image_absolute, "wb") as file:
-                        file.write(image_bytes)
-
-                    record.caminho_imagem = image_relative
-                    session.commit()
-                else:
-                    log.warning(f"Imagem muito pequena ({len(image_bytes)} bytes), ignorando")
+def salvar_registro_lpr(session: Session, data: dict, tamanho_payload=0, ip_origem=None):
+    started = time.perf_counter()
+    device_id = extrair_dispositivo(data)
+    duplicate = False
+    try:
+        if not data or not isinstance(data, dict):
+            log.error("Dados inválidos recebidos")
+            return
 
-            except Exception as exc:
-                log.error(f"Erro ao processar imagem: {exc}")
+        try:
+            reading = ler_evento(data)
+        except EventoInvalido as exc:
+            log.warning(str(exc))
+            return
+
+        picture = data.get("Picture", {})
+        plate = reading.placa
+        vehicle_color = reading.cor_veiculo
+        confidence = reading.confianca
+        timestamp = reading.timestamp
+        watchlist_match = gerenciador_watchlist.verificar(plate)
+
+        # O lock da câmera cobre só a busca e o registro do agrupamento; o
+        # banco e a imagem ficam com o lock do agrupamento, e leituras de
+        # outros veículos da mesma câmera não esperam por eles.
+        with detector_duplicatas.bloquear(device_id):
+            # Leituras parecidas da mesma câmera na janela (OCR instável com o
+            # veículo parado) pertencem ao mesmo agrupamento.
+            cluster = detector_duplicatas.buscar(device_id, plate)
+            if cluster is not None:
+                duplicate = True
+                detector_duplicatas.registrar(device_id, plate, confidence, agrupamento=cluster)
+                alert = watchlist_match is not None and not cluster.alertado
+                cluster.alertado = cluster.alertado or alert
+            else:
+                # Reserva o agrupamento antes de gravar: a próxima leitura
+                # parecida espera a gravação no lock dele.
+                cluster = detector_duplicatas.registrar(device_id, plate, confidence)
+                cluster.alertado = watchlist_match is not None
+                cluster.lock.acquire()
+
+        if duplicate:
+            image_key = None
+            with cluster.lock:
+                if confidence > cluster.confianca:
+                    image_key = atualizar_melhor_leitura(session, cluster, plate, confidence, picture)
+            if alert:
+                notificar_watchlist(watchlist_match, vehicle_color, device_id, image_key)
+            return
+
+        try:
+            record = inserir_registro(session, cluster, reading)
+        except Exception:
+            detector_duplicatas.descartar(device_id, cluster)
+            raise
+        finally:
+            cluster.lock.release()
+        if record is None:
+            # Nenhum alerta saiu para esta leitura: a próxima do agrupamento
+            # pode alertar.
+            cluster.alertado = False
+            duplicate = True
+            return
+
+        image_key = None
+        stored = salvar_imagem_evento(session, picture)
+        if stored:
+            record.caminho_imagem = stored.caminho
+            record.hash_imagem = stored.hash
+            session.commit()
+            cache_registros.invalidar(timestamp)
+            image_key = stored.caminho
 
         log.info(f"LPR salvo: placa={plate}, cor={vehicle_color}")
 
-        if notificador_entradas:
-            try:
-                translated_color = NotificadorWhatsApp._traduzir_cor_veiculo(vehicle_color)
-                color_label = (translated_color or vehicle_color or "não informada").lower()
-                message = formatar_template_mensagem(MENSAGEM_ENTRADA, plate, color_label)
-                notificador_entradas.enviar_mensagem(message, caminho_imagem=image_absolute)
-            except Exception as exc:
-                log.error(f"Erro ao enviar mensagem WhatsApp (entradas): {exc}")
+        if watchlist_match is not None:
+            notificar_watchlist(watchlist_match, vehicle_color, device_id, image_key)
+        notificar_entrada(plate, vehicle_color, image_key)
 
     except Exception as exc:
         log.error(f"Erro ao salvar registro LPR: {exc}", details=True)
         session.rollback()
 
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        registro_cameras.registrar_evento(
+            device_id,
+            tamanho_payload=tamanho_payload,
+            duracao_ms=elapsed_ms,
+            duplicado=duplicate,
+            ip=ip_origem,
+        )
 
-def _processar_webhook_lpr(data, source="TollgateInfo"):
-    if not data:
-        log.warning(f"Webhook {source} recebido sem payload JSON válido")
-        return jsonify(RESPOSTA_CAMERA), 200
 
+def processar_evento_lpr(data, tamanho_payload=0, ip_origem=None):
     session = obter_sessao_banco()
     try:
-        salvar_registro_lpr(session, data)
+        salvar_registro_lpr(session, data, tamanho_payload=tamanho_payload, ip_origem=ip_origem)
     finally:
         session.close()
 
-    return jsonify(RESPOSTA_CAMERA), 200
-
 
-@app.route("/NotificationInfo/TollgateInfo", methods=["POST"])
-def tollgate_info():
+def tratar_tollgate_info(data, tamanho_payload=0, ip_origem=None):
     try:
-        data = request.get_json(silent=True)
-        return _processar_webhook_lpr(data, source="TollgateInfo")
+        if not data:
+            log.warning("Webhook TollgateInfo recebido sem payload JSON válido")
+            return RESPOSTA_CAMERA, 200
+
+        processar_evento_lpr(data, tamanho_payload=tamanho_payload, ip_origem=ip_origem)
     except Exception as exc:
         log.error(f"Erro no TollgateInfo: {exc}", details=True)
-        return jsonify(RESPOSTA_CAMERA), 200
 
+    return RESPOSTA_CAMERA, 200
 
-@app.route("/NotificationInfo/KeepAlive", methods=["POST"])
-def keep_alive():
-    return jsonify(RESPOSTA_CAMERA), 200
 
+def tratar_keep_alive(data, ip_origem=None):
+    try:
+        data = data or {}
+        device_id = str(data.get("DeviceID") or "").strip()
+        registro_cameras.registrar_contato(device_id, ip=ip_origem)
+    except Exception as exc:
+        log.error(f"Erro no KeepAlive: {exc}", details=True)
+
+    return RESPOSTA_CAMERA, 200
 
-@app.route("/NotificationInfo/DeviceInfo", methods=["POST"])
-def device_info():
+
+def tratar_device_info(data, ip_origem=None):
     try:
-        data = request.get_json(silent=True) or {}
+        data = data or {}
         device_name = data.get("DeviceName", "N/A")
         device_id = data.get("DeviceID", "N/A")
         log.info(f"DeviceInfo: {device_name} (ID: {device_id})")
+        registro_cameras.registrar_contato(
+            str(data.get("DeviceID") or "").strip(),
+            ip=ip_origem,
+            nome=data.get("DeviceName"),
+            modelo=data.get("DeviceModel"),
+        )
     except Exception as exc:
         log.error(f"Erro no DeviceInfo: {exc}", details=True)
 
-    return jsonify({"Result": True, "Message": "Success"}), 200
+    return RESPOSTA_DEVICE_INFO, 200
 
 
-@app.route("/api/records", methods=["GET"])
-def obter_registros():
+def consultar_registros(args):
+    try:
+        plate = args.get("placa") or args.get("plate")
+        start_date = args.get("data_inicio") or args.get("start_date")
+        end_date = args.get("data_fim") or args.get("end_date")
+        device = args.get("dispositivo") or args.get("camera")
+
+        def listar(session):
+            rows = database.obter_linhas_registros(session, plate, start_date, end_date, device, arquivo=arquivo_frio)
+            return [
+                {
+                    "id": record_id,
+                    "placa": placa,
+                    "cor_placa": cor_placa,
+                    "cor_veiculo": cor_veiculo,
+                    "confianca": confianca,
+                    "imagem_url": f"/static/{caminho_imagem}" if caminho_imagem else None,
+                    "timestamp": timestamp,
+                    "dispositivo_id": dispositivo_id,
+                }
+                for record_id, placa, cor_placa, cor_veiculo, confianca, caminho_imagem, timestamp, dispositivo_id in rows
+            ]
+
+        def serializar():
+            # Leitura pesada do painel: réplica quando configurada. O
+            # timestamp é convertido pelo próprio codificador.
+            return para_json(database.executar_leitura(listar))
+
+        # Vários painéis repetem a mesma consulta a cada poucos segundos.
+        key = cache_registros.chave(plate, start_date, end_date, device)
+        return cache_registros.obter(key, serializar), 200
+
+    except Exception as exc:
+        log.error(f"Erro ao buscar registros: {exc}", details=True)
+        return para_json({"erro": "Erro ao buscar registros", "mensagem": str(exc)}), 500
+
+
+def consultar_sugestoes(args):
+    try:
+        limit = int(args.get("limite") or args.get("limit") or 10)
+    except ValueError:
+        return {"erro": "limite inválido"}, 400
+    term = args.get("q") or args.get("placa") or ""
+    return {"sugestoes": indice_placas.sugerir(term, limit), "pronto": indice_placas.pronto}, 200
+
+
+def consultar_historico_placa(plate, args):
+    try:
+        limit = int(args.get("limite") or args.get("limit") or 10)
+        payload = database.executar_leitura(lambda session: visitas.consultar(session, plate, limit))
+    except ValueError:
+        return {"erro": "limite inválido"}, 400
+    except Exception as exc:
+        log.error(f"Erro ao consultar histórico da placa: {exc}", details=True)
+        return {"erro": "Erro ao consultar histórico", "mensagem": str(exc)}, 500
+
+    if payload is None:
+        return {"erro": "Placa sem passagens registradas", "placa": plate}, 404
+    return payload, 200
+
+
+def consultar_estatisticas(args):
     try:
-        plate = request.args.get("placa") or request.args.get("plate")
-        start_date = request.args.get("data_inicio") or request.args.get("start_date")
-        end_date = request.args.get("data_fim") or request.args.get("end_date")
+        payload = database.executar_leitura(
+            lambda session: estatisticas.consultar(
+                session,
+                data_inicio=args.get("data_inicio") or args.get("start_date"),
+                data_fim=args.get("data_fim") or args.get("end_date"),
+                granularidade=(args.get("granularidade") or "hora").strip().lower(),
+                dimensao=(args.get("dimensao") or "").strip().lower() or None,
+            )
+        )
+        return payload, 200
+
+    except ValueError as exc:
+        return {"erro": str(exc)}, 400
+    except Exception as exc:
+        log.error(f"Erro ao consultar estatísticas: {exc}", details=True)
+        return {"erro": "Erro ao consultar estatísticas", "mensagem": str(exc)}, 500
+
 
+def consultar_watchlist():
+    try:
         session = obter_sessao_banco()
         try:
-            records = obter_registros_filtrados(session, plate, start_date, end_date)
-            payload = []
-            for record in records:
-                payload.append(
-                    {
-                        "id": record.id,
-                        "placa": record.placa,
-                        "cor_placa": record.cor_placa,
-                        "cor_veiculo": record.cor_veiculo,
-                        "confianca": record.confianca,
-                        "imagem_url": f"/static/{record.caminho_imagem}" if record.caminho_imagem else None,
-                        "timestamp": record.timestamp.isoformat(),
-                    }
-                )
-            return jsonify(payload)
+            return {"itens": gerenciador_watchlist.listar(session), **gerenciador_watchlist.estado()}, 200
         finally:
             session.close()
+    except Exception as exc:
+        log.error(f"Erro ao listar watchlist: {exc}", details=True)
+        return {"erro": "Erro ao listar watchlist", "mensagem": str(exc)}, 500
+
+
+def salvar_watchlist(data):
+    items = data if isinstance(data, list) else (data.get("itens") if isinstance(data, dict) else None)
+    if items is None and isinstance(data, dict) and data.get("placa"):
+        items = [data]
+    if not items:
+        return {"erro": "Informe 'placa' ou uma lista em 'itens'"}, 400
 
+    try:
+        session = obter_sessao_banco()
+        try:
+            total = gerenciador_watchlist.salvar(session, items)
+        finally:
+            session.close()
+        gerenciador_watchlist.recarregar()
+        return {"salvos": total, **gerenciador_watchlist.estado()}, 200
+    except ValueError as exc:
+        return {"erro": str(exc)}, 400
     except Exception as exc:
-        log.error(f"Erro ao buscar registros: {exc}", details=True)
-        return jsonify({"erro": "Erro ao buscar registros", "mensagem": str(exc)}), 500
+        log.error(f"Erro ao salvar watchlist: {exc}", details=True)
+        return {"erro": "Erro ao salvar watchlist", "mensagem": str(exc)}, 500
+
+
+def remover_watchlist(plate):
+    try:
+        session = obter_sessao_banco()
+        try:
+            removed = gerenciador_watchlist.remover(session, plate)
+        finally:
+            session.close()
+        if not removed:
+            return {"erro": "Placa não encontrada na watchlist"}, 404
+        gerenciador_watchlist.recarregar()
+        return {"removida": plate, **gerenciador_watchlist.estado()}, 200
+    except Exception as exc:
+        log.error(f"Erro ao remover placa da watchlist: {exc}", details=True)
+        return {"erro": "Erro ao remover placa da watchlist", "mensagem": str(exc)}, 500
+
+
+def consultar_capturas():
+    try:
+        session = obter_sessao_banco()
+        try:
+            return {
+                **capturas.resumo(session),
+                "armazenamento": armazenamento.estado(),
+                "recompressao": recompressor.estado(),
+            }, 200
+        finally:
+            session.close()
+    except Exception as exc:
+        log.error(f"Erro ao consultar capturas: {exc}", details=True)
+        return {"erro": "Erro ao consultar capturas", "mensagem": str(exc)}, 500
+
+
+def consultar_cameras():
+    try:
+        return registro_cameras.listar(), 200
+    except Exception as exc:
+        log.error(f"Erro ao listar câmeras: {exc}", details=True)
+        return {"erro": "Erro ao listar câmeras", "mensagem": str(exc)}, 500
+
+
+def processar_evento_subscribe(camera, data, tamanho_payload):
+    try:
+        picture = data.get("Picture")
+        if isinstance(picture, dict):
+            snap_info = picture.get("SnapInfo")
+            if not isinstance(snap_info, dict):
+                snap_info = picture["SnapInfo"] = {}
+            if not snap_info.get("DeviceID"):
+                snap_info["DeviceID"] = camera.identificador
+            DISPOSITIVOS_SUBSCRIBE[camera.identificador] = str(snap_info["DeviceID"]).strip()
+            processar_evento_lpr(data, tamanho_payload=tamanho_payload, ip_origem=camera.host)
+            return
+
+        device_id = data.get("DeviceID") or DISPOSITIVOS_SUBSCRIBE.get(camera.identificador, camera.identificador)
+        registro_cameras.registrar_contato(
+            str(device_id).strip(),
+            ip=camera.host,
+            nome=data.get("DeviceName"),
+            modelo=data.get("DeviceModel"),
+        )
+    except Exception as exc:
+        log.error(f"Erro ao processar evento Subscribe de {camera.identificador}: {exc}", details=True)
+
+
+@app.route("/NotificationInfo/TollgateInfo", methods=["POST"])
+def tollgate_info():
+    corpo, status = tratar_tollgate_info(
+        request.get_json(silent=True),
+        tamanho_payload=request.content_length or 0,
+        ip_origem=obter_ip_cliente(request),
+    )
+    return app.response_class(corpo, status=status, mimetype="application/json")
+
+
+@app.route("/NotificationInfo/KeepAlive", methods=["POST"])
+def keep_alive():
+    corpo, status = tratar_keep_alive(request.get_json(silent=True), ip_origem=obter_ip_cliente(request))
+    return app.response_class(corpo, status=status, mimetype="application/json")
+
+
+@app.route("/NotificationInfo/DeviceInfo", methods=["POST"])
+def device_info():
+    corpo, status = tratar_device_info(request.get_json(silent=True), ip_origem=obter_ip_cliente(request))
+    return app.response_class(corpo, status=status, mimetype="application/json")
+
+
+@app.route("/api/records", methods=["GET"])
+def obter_registros():
+    corpo, status = consultar_registros(request.args)
+    return app.response_class(corpo, status=status, mimetype="application/json")
+
+
+@app.route("/api/plates/suggest", methods=["GET"])
+def sugerir_placas():
+    payload, status = consultar_sugestoes(request.args)
+    return jsonify(payload), status
+
+
+@app.route("/api/plates/<placa>/history", methods=["GET"])
+def historico_placa(placa):
+    payload, status = consultar_historico_placa(placa, request.args)
+    return jsonify(payload), status
+
+
+@app.route("/api/stats", methods=["GET"])
+def obter_estatisticas():
+    payload, status = consultar_estatisticas(request.args)
+    return jsonify(payload), status
+
+
+@app.route("/api/watchlist", methods=["GET"])
+def obter_watchlist():
+    payload, status = consultar_watchlist()
+    return jsonify(payload), status
+
+
+@app.route("/api/watchlist", methods=["POST"])
+def adicionar_watchlist():
+    payload, status = salvar_watchlist(request.get_json(silent=True))
+    return jsonify(payload), status
+
+
+@app.route("/api/watchlist/<placa>", methods=["DELETE"])
+def excluir_watchlist(placa):
+    payload, status = remover_watchlist(placa)
+    return jsonify(payload), status
+
+
+@app.route("/api/watchlist/verificar", methods=["GET"])
+def verificar_watchlist():
+    match = gerenciador_watchlist.verificar(request.args.get("placa", ""))
+    return jsonify({"correspondencia": match.para_dict() if match else None}), 200
+
+
+@app.route("/api/capturas", methods=["GET"])
+def obter_capturas():
+    payload, status = consultar_capturas()
+    return jsonify(payload), status
+
+
+@app.route("/api/cache", methods=["GET"])
+def obter_cache():
+    return jsonify({"registros": cache_registros.estado()}), 200
+
+
+@app.route("/api/arquivo", methods=["GET"])
+def obter_arquivo():
+    return jsonify(arquivo_frio.estado()), 200
+
+
+@app.route("/api/notificacoes", methods=["GET"])
+def obter_notificacoes():
+    return jsonify(
+        {
+            "agendador": agendador_notificacoes.estado() if agendador_notificacoes is not None else None,
+            "resumo": agrupador_entradas.estado() if agrupador_entradas is not None else None,
+        }
+    ), 200
+
+
+@app.route("/api/cameras", methods=["GET"])
+def obter_cameras():
+    payload, status = consultar_cameras()
+    return jsonify(payload), status
+
+
+@app.route("/health/live", methods=["GET"])
+def health_live():
+    return jsonify({"status": "ok", "pid": os.getpid()}), 200
+
+
+@app.route("/health/ready", methods=["GET"])
+def health_ready():
+    estado = etapas_inicializacao.estado()
+    estado["replicas"] = database.estado_replicas()
+    return jsonify(estado), 200 if estado["pronto"] else 503
 
 
 @app.route("/", methods=["GET"])
 def index():
     try:
-        client_ip = obter_ip_cliente(request)
-        if not ip_frontend_permitido(client_ip):
-            log.warning(f"Acesso negado ao frontend para IP {client_ip or 'desconhecido'}")
-            return "Acesso negado.", 403
-
         frontend_path = os.path.join(DIRETORIO_BASE, "frontend.html")
         with open(frontend_path, "r", encoding="utf-8") as file:
             html = file.read()
@@ -430,11 +891,6 @@ def index():
 
 @app.route("/assets/<path:nome>", methods=["GET"])
 def assets(nome):
-    client_ip = obter_ip_cliente(request)
-    if not ip_frontend_permitido(client_ip):
-        log.warning(f"Acesso negado a assets para IP {client_ip or 'desconhecido'}")
-        return "Acesso negado.", 403
-
     filename = os.path.basename(nome)
     if filename not in ASSETS_PERMITIDOS:
         return "Asset não encontrado", 404
@@ -446,13 +902,54 @@ def assets(nome):
     return send_file(asset_path)
 
 
+@app.route("/static/captures/<path:nome>", methods=["GET"])
+def captura(nome):
+    relative = f"captures/{nome}"
+    if not chave_valida(relative):
+        return "Arquivo não encontrado", 404
+
+    # Capturas são endereçadas pelo conteúdo (sha256 no nome): nunca mudam,
+    # então o ETag é o próprio nome e o cache pode ser imutável.
+    etag = etag_captura(relative)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = CACHE_CONTROL_CAPTURAS
+        return response
+
+    local_path = armazenamento.caminho_local(relative)
+    if local_path is not None:
+        if not os.path.isfile(local_path):
+            return "Arquivo não encontrado", 404
+        # send_file usa wsgi.file_wrapper e trata Range/HEAD; com
+        # CAPTURAS_X_SENDFILE=1 o envio fica com o proxy (X-Sendfile).
+        response = send_file(local_path, mimetype=tipo_conteudo(relative), etag=etag, conditional=True)
+        response.headers["Cache-Control"] = CACHE_CONTROL_CAPTURAS
+        return response
+
+    url = armazenamento.url_redirecionamento(relative)
+    if url:
+        return redirect(url, code=302)
+
+    body = armazenamento.abrir(relative)
+    if body is None:
+        return "Arquivo não encontrado", 404
+    response = app.response_class(
+        body.iter_chunks(64 * 1024),
+        mimetype=tipo_conteudo(relative),
+        direct_passthrough=True,
+    )
+    response.call_on_close(body.close)
+    size = getattr(body, "tamanho", None)
+    if size is not None:
+        response.content_length = size
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = CACHE_CONTROL_CAPTURAS
+    return response.make_conditional(request, accept_ranges=True, complete_length=size)
+
+
 @app.route("/favicon.ico", methods=["GET"])
 def favicon():
-    client_ip = obter_ip_cliente(request)
-    if not ip_frontend_permitido(client_ip):
-        log.warning(f"Acesso negado ao favicon para IP {client_ip or 'desconhecido'}")
-        return "Acesso negado.", 403
-
     icon_path = os.path.join(DIRETORIO_ASSETS, "logo_hr_azul.svg")
     if not os.path.exists(icon_path):
         return "", 204
@@ -479,7 +976,12 @@ def iniciar_thread_sincronizacao_banco():
         while True:
             time.sleep(interval)
             try:
-                promoted, migrated = database.tentar_promover_para_postgres_e_migrar()
+                # Com vários workers no mesmo host, só quem tem o lock migra o SQLite local.
+                migrate = lock_migracao.tentar_adquirir()
+                promoted, migrated = database.tentar_promover_para_postgres_e_migrar(migrar=migrate)
+                if promoted or migrated:
+                    cache_registros.invalidar_tudo()
+                    indice_placas.reconstruir()
                 if promoted:
                     log.info("Sincronização: banco ativo alterado para PostgreSQL")
                 if migrated > 0:
@@ -492,6 +994,425 @@ def iniciar_thread_sincronizacao_banco():
     return interval
 
 
+def eh_lider():
+    return eleicao_lider is None or eleicao_lider.eh_lider()
+
+
+def iniciar_thread_retencao():
+    raw_days = os.getenv("RETENCAO_IMAGENS_DIAS", "15").strip()
+    try:
+        days = int(raw_days)
+    except ValueError:
+        days = 15
+
+    if days <= 0:
+        return None
+
+    def worker():
+        while True:
+            if eh_lider():
+                limpar_imagens_antigas(DIRETORIO_CAPTURAS, days=days)
+            time.sleep(3600)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    return days
+
+
+def iniciar_thread_arquivamento():
+    if not arquivo_frio.ativo():
+        return None
+
+    def worker():
+        while True:
+            if eh_lider():
+                try:
+                    days, rows = arquivo_frio.arquivar(obter_sessao_banco)
+                    if rows:
+                        cache_registros.invalidar_tudo()
+                        indice_placas.sinalizar_reconstrucao()
+                        log.info(f"Arquivamento: {rows} leitura(s) de {days} dia(s) movida(s) para {arquivo_frio.diretorio}")
+                except Exception as exc:
+                    log.error(f"Erro no arquivamento de leituras: {exc}", details=True)
+            time.sleep(3600)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    return arquivo_frio.dias
+
+
+def iniciar_thread_persistencia_cameras():
+    raw_interval = os.getenv("CAMERA_PERSISTENCIA_SEGUNDOS", "60").strip()
+    try:
+        interval = int(raw_interval)
+    except ValueError:
+        interval = 60
+    interval = max(10, interval)
+
+    def worker():
+        while True:
+            time.sleep(interval)
+            session = None
+            try:
+                session = obter_sessao_banco()
+                registro_cameras.persistir(session)
+            except Exception as exc:
+                log.error(f"Erro ao persistir registro de câmeras: {exc}")
+            finally:
+                if session is not None:
+                    session.close()
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    return interval
+
+
+def iniciar_servidor(port, sock=None):
+    server_mode = os.getenv("SERVIDOR_MODO", "waitress").strip().lower()
+
+    if server_mode == "asgi":
+        try:
+            import uvicorn
+
+            import asgi_app
+
+            asgi = asgi_app.criar_app(sys.modules[__name__])
+        except (ImportError, RuntimeError) as exc:
+            log.warning(f"Modo ASGI indisponível ({exc}); usando waitress")
+        else:
+            log.info("Servidor em modo ASGI (uvicorn, event loop)")
+            config = uvicorn.Config(
+                asgi,
+                host="0.0.0.0",
+                port=port,
+                log_level="warning",
+                limit_concurrency=int(os.getenv("ASGI_LIMITE_CONEXOES", "10000") or 10000),
+                timeout_keep_alive=120,
+            )
+            uvicorn.Server(config).run(sockets=[sock] if sock is not None else None)
+            return
+
+    cpu_count = os.cpu_count() or 4
+    waitress_threads = max(8, cpu_count * 4)
+    log.info(f"Servidor em modo waitress ({waitress_threads} threads)")
+
+    listen_options = {"sockets": [sock]} if sock is not None else {"host": "0.0.0.0", "port": port}
+    serve(
+        app,
+        threads=waitress_threads,
+        connection_limit=1000,
+        cleanup_interval=10,
+        channel_timeout=120,
+        **listen_options,
+    )
+
+
+def iniciar_subscribe():
+    global cliente_subscribe
+    if cliente_subscribe is not None:
+        return
+
+    cameras_subscribe = carregar_cameras_env()
+    if not cameras_subscribe:
+        return
+
+    cliente_subscribe = ClienteSubscribe(cameras_subscribe, processar_evento_subscribe)
+    cliente_subscribe.iniciar_em_thread()
+    log.info(f"Modo Subscribe ativo para {len(cameras_subscribe)} câmera(s)")
+
+
+def parar_subscribe():
+    global cliente_subscribe
+    if cliente_subscribe is None:
+        return
+
+    cliente_subscribe.parar()
+    cliente_subscribe = None
+    log.info("Modo Subscribe parado nesta instância (liderança perdida)")
+
+
+def ler_total_workers():
+    raw_workers = os.getenv("WEBHOOK_WORKERS", "1").strip()
+    try:
+        workers = max(1, int(raw_workers))
+    except ValueError:
+        log.warning(f"WEBHOOK_WORKERS inválido: {raw_workers}, usando 1")
+        workers = 1
+
+    if workers > 1 and not hasattr(os, "fork"):
+        log.warning("WEBHOOK_WORKERS > 1 requer fork (Linux/macOS); usando 1 worker")
+        workers = 1
+    return workers
+
+
+def promover_banco_inicial():
+    # Com vários workers no mesmo host, só quem tem o lock migra o SQLite local.
+    promoted, migrated = database.tentar_promover_para_postgres_e_migrar(migrar=lock_migracao.tentar_adquirir())
+    if promoted or migrated:
+        cache_registros.invalidar_tudo()
+        indice_placas.reconstruir()
+    if promoted:
+        log.info("Banco promovido para PostgreSQL na inicialização")
+    if migrated > 0:
+        log.info(f"Migração inicial: {migrated} registro(s) local(is) migrado(s)")
+    return f"{database.modo_banco_ativo()}, {migrated} registro(s) migrado(s)"
+
+
+def carregar_registro_cameras():
+    session = obter_sessao_banco()
+    try:
+        cameras_carregadas = registro_cameras.carregar(session)
+    finally:
+        session.close()
+    if cameras_carregadas:
+        log.info(f"Registro de câmeras: {cameras_carregadas} câmera(s) conhecida(s)")
+    return f"{cameras_carregadas} câmera(s)"
+
+
+def carregar_indice_placas():
+    total = indice_placas.reconstruir()
+    indice_placas.iniciar_thread_atualizacao()
+    log.info(f"Índice de placas para sugestões: {total} placa(s)")
+    return f"{total} placa(s)"
+
+
+def carregar_watchlist():
+    # Sem a watchlist carregada um alerta passaria despercebido: tenta até
+    # conseguir, e o processo só fica pronto depois disso.
+    while True:
+        try:
+            gerenciador_watchlist.recarregar(forcar=True)
+            break
+        except Exception as exc:
+            log.warning(f"Não foi possível carregar a watchlist: {exc}; nova tentativa em 5s")
+            time.sleep(5)
+    log.info(f"Watchlist ativa: {len(gerenciador_watchlist.indice)} placa(s)")
+    return f"{len(gerenciador_watchlist.indice)} placa(s)"
+
+
+def aguardar_api_whatsapp(whatsapp_url):
+    timeout = int(os.getenv("WHATSAPP_INICIALIZACAO_SEGUNDOS", "60").strip() or 60)
+    limit = time.monotonic() + timeout
+    while time.monotonic() < limit:
+        try:
+            requests.get(whatsapp_url, timeout=2)
+            log.info(f"WhatsApp API rodando em {whatsapp_url}")
+            return whatsapp_url
+        except requests.exceptions.RequestException:
+            time.sleep(0.5)
+    raise RuntimeError(f"WhatsApp API não respondeu em {timeout}s")
+
+
+def iniciar_api_whatsapp():
+    global processo_whatsapp
+    whatsapp_dir = os.path.join(DIRETORIO_BASE, "whatsapp_api")
+    try:
+        result = subprocess.run(["node", "--version"], capture_output=True, check=True, text=True)
+        log.info(f"Node.js detectado: {result.stdout.strip()}")
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        log.warning("Node.js não encontrado - WhatsApp desabilitado")
+        return
+
+    package_json = os.path.join(whatsapp_dir, "package.json")
+    if not os.path.exists(package_json):
+        log.warning("whatsapp_api/package.json não encontrado")
+        log.warning("Execute: cd whatsapp_api && npm install")
+        return
+
+    os.makedirs(DIRETORIO_LOGS, exist_ok=True)
+    whatsapp_log = os.path.join(DIRETORIO_LOGS, "whatsapp_api.log")
+    log_file = open(whatsapp_log, "a", encoding="utf-8")
+
+    processo_whatsapp = subprocess.Popen(
+        ["node", "index.js"],
+        stdout=subprocess.DEVNULL,
+        stderr=log_file,
+        cwd=whatsapp_dir,
+        shell=False,
+        start_new_session=True if os.name != "nt" else False,
+    )
+    # Sem espera fixa: os workers acompanham a API até ela responder.
+    try:
+        processo_whatsapp.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        return
+    log.error("WhatsApp API falhou ao iniciar")
+    log.error(f"Verifique o log: {whatsapp_log}")
+
+
+def criar_socket_servidor(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", port))
+    sock.listen(1024)
+    return sock
+
+
+def encerrar_por_falha(codigo):
+    # Chamado de uma thread em segundo plano: o servidor não tem como ser
+    # interrompido de outra forma.
+    if processo_whatsapp:
+        processo_whatsapp.terminate()
+    parar_logging()
+    os._exit(codigo)
+
+
+def preparar_banco(whatsapp_url):
+    # DDL (colunas novas, índices) pode levar minutos numa tabela grande: roda
+    # com a porta já aberta. Os workers do host fazem um de cada vez; entre
+    # hosts vale o advisory lock do DDL.
+    diretorio = os.path.dirname(database.caminho_sqlite_local())
+    os.makedirs(diretorio, exist_ok=True)
+    try:
+        with LockExclusivo(os.path.join(diretorio, "esquema.lock")):
+            inicializar_banco(criar_estrutura=False)
+            criar_tabelas()
+    except Exception as exc:
+        log.error(f"Falha ao inicializar banco: {exc}", details=True)
+        encerrar_por_falha(CODIGO_SAIDA_FALHA_BANCO)
+
+    modo = database.modo_banco_ativo()
+    if modo == "postgres":
+        log.info("Banco ativo: PostgreSQL")
+    else:
+        log.info(f"Banco ativo: SQLite local ({database.caminho_sqlite_local()})")
+    iniciar_tarefas(whatsapp_url)
+    return modo
+
+
+def iniciar_tarefas(whatsapp_url):
+    global eleicao_lider, notificador_entradas, agrupador_entradas, agendador_notificacoes
+
+    # Retenção, arquivamento, recompressão, alertas do WhatsApp e Subscribe
+    # rodam só no líder. A sincronização do banco roda em todo worker: cada
+    # processo troca o próprio engine para o PostgreSQL, e a migração do
+    # SQLite local fica com quem tem lock_migracao no host.
+    eleicao_lider = EleicaoLider(ao_assumir=iniciar_subscribe, ao_perder=parar_subscribe)
+    eleicao_lider.iniciar()
+    log.info(f"Liderança: {'líder' if eleicao_lider.eh_lider() else 'seguidor'} ({eleicao_lider.identificador})")
+
+    if whatsapp_url and (DESTINO_ENTRADAS or DESTINO_ALERTAS):
+        endpoint = f"{whatsapp_url}/api/send"
+        notificador_entradas = NotificadorWhatsApp(
+            endpoint,
+            DESTINO_ENTRADAS,
+            eh_lider=eh_lider,
+            armazenamento=armazenamento,
+            resolver_imagem=caminho_captura_atual,
+        )
+        if os.getenv("WHATSAPP_AGENDADOR", "1").strip() != "0":
+            agendador_notificacoes = AgendadorNotificacoes(enviar_para_destinatario, baldes_notificacoes)
+            log.info(
+                f"Agendador de notificações: {agendador_notificacoes.por_minuto} envio(s)/min por destinatário, "
+                f"{agendador_notificacoes.paralelos} em paralelo"
+            )
+        agrupador_entradas = AgrupadorEntradas(
+            enviar_notificacao_entrada, armazenamento, resolver_imagem=caminho_captura_atual
+        )
+        if agrupador_entradas.ativo():
+            log.info(
+                f"Resumo de entradas ativo: acima de {agrupador_entradas.limiar} entrada(s) "
+                f"em {agrupador_entradas.janela}s (imagem: {agrupador_entradas.modo_imagem})"
+            )
+
+    # Migração, watchlist e registro de câmeras carregam em paralelo e
+    # /health/ready mostra o que já terminou.
+    etapas_inicializacao.executar("watchlist", carregar_watchlist)
+    etapas_inicializacao.executar("migracao_banco", promover_banco_inicial, obrigatoria=False)
+    etapas_inicializacao.executar("registro_cameras", carregar_registro_cameras, obrigatoria=False)
+    etapas_inicializacao.executar("indice_placas", carregar_indice_placas, obrigatoria=False)
+    if notificador_entradas is not None:
+        etapas_inicializacao.executar(
+            "whatsapp", lambda: aguardar_api_whatsapp(whatsapp_url), obrigatoria=False
+        )
+    gerenciador_watchlist.iniciar_thread_recarga()
+
+    interval = iniciar_thread_sincronizacao_banco()
+    log.info(f"Monitor de sincronização ativo (intervalo: {interval}s)")
+    interval = iniciar_thread_persistencia_cameras()
+    log.info(f"Persistência do registro de câmeras ativa (intervalo: {interval}s)")
+    if recompressor.iniciar(eh_lider=eh_lider):
+        log.info(f"Recompressão de imagens ativa ({recompressor.estado()['formato']}, executada pelo líder)")
+    retention_days = iniciar_thread_retencao()
+    if retention_days:
+        log.info(f"Retenção de imagens ativa ({retention_days} dia(s), executada pelo líder)")
+    archive_days = iniciar_thread_arquivamento()
+    if archive_days:
+        log.info(f"Arquivamento ativo (leituras com mais de {archive_days} dia(s), executado pelo líder)")
+
+
+def executar_worker(webhook_port, whatsapp_url=None, sock=None):
+    # O servidor sobe já; o banco e, depois dele, as demais etapas e tarefas
+    # sobem em segundo plano.
+    etapas_inicializacao.executar("banco", lambda: preparar_banco(whatsapp_url))
+    iniciar_servidor(webhook_port, sock)
+
+
+def iniciar_thread_api_whatsapp(whatsapp_url):
+    if whatsapp_url is None:
+        return None
+    thread = threading.Thread(target=iniciar_api_whatsapp, daemon=True, name="inicializacao-whatsapp")
+    thread.start()
+    return thread
+
+
+def supervisionar_workers(total, webhook_port, whatsapp_url=None):
+    sock = criar_socket_servidor(webhook_port)
+    children = set()
+
+    def iniciar_filho():
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.default_int_handler)
+                database.reiniciar_pools_apos_fork()
+                executar_worker(webhook_port, whatsapp_url, sock)
+            except KeyboardInterrupt:
+                pass
+            except Exception as exc:
+                log.error(f"Erro fatal no worker {os.getpid()}: {exc}", details=True)
+                exit_code = 1
+            os._exit(exit_code)
+        children.add(pid)
+
+    def encerrar(_signum, _frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, encerrar)
+
+    for _ in range(total):
+        iniciar_filho()
+    log.info(f"{total} worker(s) ativos: {', '.join(str(pid) for pid in sorted(children))}")
+    # Só depois do fork: os workers não herdam a thread nem o Popen em curso.
+    thread_whatsapp = iniciar_thread_api_whatsapp(whatsapp_url)
+
+    try:
+        while children:
+            pid, status = os.wait()
+            children.discard(pid)
+            if os.waitstatus_to_exitcode(status) == CODIGO_SAIDA_FALHA_BANCO:
+                # Reiniciar não resolve (leituras duplicadas, DDL com erro).
+                raise RuntimeError(f"Worker {pid} não conseguiu preparar o banco; veja o erro acima")
+            log.warning(f"Worker {pid} encerrado (status {status}); reiniciando")
+            time.sleep(1)
+            if thread_whatsapp is not None:
+                thread_whatsapp.join()
+            iniciar_filho()
+    except (KeyboardInterrupt, RuntimeError):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(children):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        raise
+
+
 if __name__ == "__main__":
     log.info("=" * 60)
     log.info(" " * 11 + "HR INTELBRAS LPR WEBHOOK")
@@ -521,144 +1442,64 @@ if __name__ == "__main__":
     if not DESTINO_ENTRADAS:
         log.warning("Notificações de entradas via WhatsApp desabilitadas: DESTINO_ENTRADAS não definido no .env")
 
-    if FRONTEND_ALLOWED_IPS:
-        log.info(f"Frontend restrito a {len(FRONTEND_ALLOWED_IPS)} IP(s)/rede(s)")
-    else:
+    log.info(f"Controle de acesso: {controle_acesso.resumo()}")
+    if not controle_acesso.restrito("frontend"):
         log.warning("Frontend liberado para todos os IPs (FRONTEND_ALLOWED_IPS não definido)")
 
-    log.info("[2/5] Inicializando banco (PostgreSQL com fallback SQLite)...")
-    try:
-        inicializar_banco()
-        criar_tabelas()
-    except Exception as exc:
-        log.error(f"Falha ao inicializar banco: {exc}", details=True)
-        sys.exit(1)
-
-    modo_inicial = database.modo_banco_ativo()
-    if modo_inicial == "postgres":
-        log.info("Banco ativo: PostgreSQL")
-    else:
-        log.info(f"Banco ativo: SQLite local ({database.caminho_sqlite_local()})")
-
-    try:
-        promoted, migrated = database.tentar_promover_para_postgres_e_migrar()
-        if promoted:
-            log.info("Banco promovido para PostgreSQL na inicialização")
-        if migrated > 0:
-            log.info(f"Migração inicial: {migrated} registro(s) local(is) migrado(s)")
-    except Exception as exc:
-        log.warning(f"Não foi possível promover/migrar banco na inicialização: {exc}")
-
-    log.info("[3/5] Iniciando API do WhatsApp...")
+    log.info("[2/5] Banco (PostgreSQL com fallback SQLite) preparado em segundo plano, com a porta já aberta")
 
-    whatsapp_dir = os.path.join(DIRETORIO_BASE, "whatsapp_api")
-    whatsapp_process = None
-    notificador_entradas = None
+    log.info("[3/5] Iniciando API do WhatsApp em segundo plano...")
+    local_ip = obter_ip_local()
+    whatsapp_url = None
 
     if whatsapp_port is None:
         log.warning("API_WHATSAPP_PORT não definido. WhatsApp desabilitado.")
     else:
-        try:
-            result = subprocess.run(["node", "--version"], capture_output=True, check=True, text=True)
-            log.info(f"Node.js detectado: {result.stdout.strip()}")
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            log.warning("Node.js não encontrado - WhatsApp desabilitado")
-        else:
-            try:
-                package_json = os.path.join(whatsapp_dir, "package.json")
-                if not os.path.exists(package_json):
-                    log.warning("whatsapp_api/package.json não encontrado")
-                    log.warning("Execute: cd whatsapp_api && npm install")
-                else:
-                    logs_dir = os.path.join(DIRETORIO_BASE, "logs")
-                    os.makedirs(logs_dir, exist_ok=True)
-                    whatsapp_log = os.path.join(logs_dir, "erros.log")
-                    log_file = open(whatsapp_log, "a", encoding="utf-8")
-
-                    whatsapp_process = subprocess.Popen(
-                        ["node", "index.js"],
-                        stdout=subprocess.DEVNULL,
-                        stderr=log_file,
-                        cwd=whatsapp_dir,
-                        shell=False,
-                        start_new_session=True if os.name != "nt" else False,
-                    )
-
-                    log.info("Aguardando inicialização do WhatsApp...")
-                    time.sleep(3)
-
-                    if whatsapp_process.poll() is not None:
-                        log.error("WhatsApp API falhou ao iniciar")
-                        log.error(f"Verifique o log: {whatsapp_log}")
-                    else:
-                        local_ip = obter_ip_local()
-                        whatsapp_url = (
-                            f"http://{local_ip}:{whatsapp_port}"
-                            if local_ip
-                            else f"http://127.0.0.1:{whatsapp_port}"
-                        )
-
-                        try:
-                            requests.get(whatsapp_url, timeout=2)
-                            log.info(f"WhatsApp API rodando em {whatsapp_url}")
-                        except requests.exceptions.RequestException:
-                            log.warning("WhatsApp API ainda não responde; continuando inicialização")
-
-                        if DESTINO_ENTRADAS:
-                            endpoint = f"{whatsapp_url}/api/send"
-                            notificador_entradas = NotificadorWhatsApp(endpoint, DESTINO_ENTRADAS)
+        whatsapp_url = f"http://{local_ip or '127.0.0.1'}:{whatsapp_port}"
 
-            except Exception as exc:
-                log.error(f"Erro ao iniciar WhatsApp API: {exc}", details=True)
-
-    log.info("[4/5] Ativando monitor de sincronização de banco...")
-    interval = iniciar_thread_sincronizacao_banco()
-    log.info(f"Monitor de sincronização ativo (intervalo: {interval}s)")
+    log.info("[4/5] Preparando workers e tarefas em segundo plano...")
+    total_workers = ler_total_workers()
+    if total_workers > 1:
+        log.info(f"Modo multi-worker: {total_workers} processos compartilhando a porta {webhook_port}")
 
     log.info("[5/5] Iniciando servidor Flask...")
     log.info("=" * 60)
     log.info(" " * 9 + "SERVIDOR INICIADO COM SUCESSO")
     log.info("=" * 60)
 
-    local_ip = obter_ip_local()
     if local_ip:
         log.info(f"Frontend: http://{local_ip}:{webhook_port}/")
         log.info(f"API: http://{local_ip}:{webhook_port}/api/records")
         log.info(f"Webhook: http://{local_ip}:{webhook_port}/NotificationInfo/TollgateInfo")
-        if notificador_entradas and whatsapp_port:
+        if whatsapp_url and DESTINO_ENTRADAS:
             log.info(f"WhatsApp: http://{local_ip}:{whatsapp_port}")
     else:
         log.info(f"Frontend: http://localhost:{webhook_port}/")
         log.info(f"API: http://localhost:{webhook_port}/api/records")
         log.info(f"Webhook: http://localhost:{webhook_port}/NotificationInfo/TollgateInfo")
-        if notificador_entradas and whatsapp_port:
+        if whatsapp_url and DESTINO_ENTRADAS:
             log.info(f"WhatsApp: http://localhost:{whatsapp_port}")
 
-    cpu_count = os.cpu_count() or 4
-    waitress_threads = max(8, cpu_count * 4)
-
     try:
-        serve(
-            app,
-            host="0.0.0.0",
-            port=webhook_port,
-            threads=waitress_threads,
-            connection_limit=1000,
-            cleanup_interval=10,
-            channel_timeout=120,
-        )
+        if total_workers > 1:
+            supervisionar_workers(total_workers, webhook_port, whatsapp_url)
+        else:
+            iniciar_thread_api_whatsapp(whatsapp_url)
+            executar_worker(webhook_port, whatsapp_url)
     except KeyboardInterrupt:
-        log.info("Encerrando servidor...")
-        if whatsapp_process:
-            log.info("Encerrando WhatsApp API...")
-            whatsapp_process.terminate()
-            try:
-                whatsapp_process.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                whatsapp_process.kill()
-        sys.exit(0)
+        pass
     except Exception as exc:
         log.error(f"Erro fatal no servidor: {exc}", details=True)
-        if whatsapp_process:
-            whatsapp_process.terminate()
+        if processo_whatsapp:
+            processo_whatsapp.terminate()
         sys.exit(1)
+
+    log.info("Encerrando servidor...")
+    if processo_whatsapp:
+        log.info("Encerrando WhatsApp API...")
+        processo_whatsapp.terminate()
+        try:
+            processo_whatsapp.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            processo_whatsapp.kill()
+    sys.exit(0)
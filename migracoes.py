@@ -0,0 +1,51 @@
+﻿import argparse
+import logging
+import os
+
+from sqlalchemy.orm import Session
+
+import database
+import estatisticas
+import visitas
+from arquivamento import ArquivoFrio
+
+
+def remover_duplicadas():
+    # Remove as leituras repetidas (mesma placa e horário) que impedem o
+    # índice único e recalcula o que dependia delas. Rode com o serviço parado.
+    arquivo_frio = ArquivoFrio()
+    resultado = []
+    for modo, alvo, removidas in database.remover_leituras_duplicadas():
+        rollups = placas = 0
+        if removidas:
+            with Session(alvo) as sessao, arquivo_frio.travar():
+                _, _, rollups = estatisticas.reconstruir(sessao, arquivo=arquivo_frio)
+                _, _, placas = visitas.reconstruir(sessao)
+        resultado.append((modo, removidas, rollups, placas))
+    return resultado
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrações explícitas do banco")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+    subparsers.add_parser(
+        "remover-duplicadas",
+        help="remove leituras com placa e horário repetidos, cria o índice único e recalcula rollups e visitas",
+    )
+
+    argumentos = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(name)s | %(message)s")
+
+    try:
+        from dotenv import load_dotenv
+
+        load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
+    except ImportError:
+        pass
+
+    database.inicializar_banco(criar_estrutura=False)
+    for modo, removidas, rollups, placas in remover_duplicadas():
+        print(
+            f"Banco: {modo} | leituras removidas: {removidas} | "
+            f"linhas de rollup gravadas: {rollups} | placas com histórico: {placas}"
+        )
@@ -1,6 +1,6 @@
 ﻿from datetime import datetime
 
-from sqlalchemy import Column, DateTime, Integer, String
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, Index, Integer, String
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
@@ -8,6 +8,7 @@ Base = declarative_base()
 
 class EntradaLPR(Base):
     __tablename__ = "lpr_webhook"
+    __table_args__ = (Index("uq_lpr_webhook_placa_timestamp", "placa", "timestamp", unique=True),)
 
     id = Column(Integer, primary_key=True, index=True)
     placa = Column(String, index=True, nullable=False)
@@ -16,6 +17,103 @@ class EntradaLPR(Base):
     caminho_imagem = Column(String, nullable=True)
     confianca = Column(Integer, nullable=True)
     timestamp = Column(DateTime, default=datetime.utcnow, nullable=False)
+    dispositivo_id = Column(String, index=True, nullable=True)
+    hash_imagem = Column(String, index=True, nullable=True)
+    direcao = Column(String, nullable=True)
 
     def __repr__(self):
         return f"<EntradaLPR(id={self.id}, placa={self.placa})>"
+
+
+class CameraLPR(Base):
+    __tablename__ = "lpr_cameras"
+
+    dispositivo_id = Column(String, primary_key=True)
+    nome = Column(String, nullable=True)
+    modelo = Column(String, nullable=True)
+    ultimo_ip = Column(String, nullable=True)
+    ultimo_contato = Column(DateTime, nullable=True)
+    total_eventos = Column(Integer, default=0, nullable=False)
+    total_duplicados = Column(Integer, default=0, nullable=False)
+    bytes_recebidos = Column(BigInteger, default=0, nullable=False)
+
+    def __repr__(self):
+        return f"<CameraLPR(dispositivo_id={self.dispositivo_id}, nome={self.nome})>"
+
+
+class CapturaLPR(Base):
+    __tablename__ = "lpr_capturas"
+
+    hash = Column(String, primary_key=True)
+    caminho = Column(String, nullable=False)
+    tamanho = Column(Integer, default=0, nullable=False)
+    tamanho_original = Column(Integer, nullable=True)
+    nivel = Column(Integer, default=0, nullable=False)
+    referencias = Column(Integer, default=0, nullable=False, index=True)
+    criado_em = Column(DateTime, default=datetime.utcnow, nullable=False)
+    ultimo_uso = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"<CapturaLPR(hash={self.hash}, referencias={self.referencias})>"
+
+
+class RollupLPR(Base):
+    __tablename__ = "lpr_rollup"
+
+    hora = Column(DateTime, primary_key=True)
+    dimensao = Column(String, primary_key=True)
+    valor = Column(String, primary_key=True, default="")
+    total = Column(Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        return f"<RollupLPR(hora={self.hora}, dimensao={self.dimensao}, valor={self.valor}, total={self.total})>"
+
+
+class WatchlistPlaca(Base):
+    __tablename__ = "lpr_watchlist"
+
+    id = Column(Integer, primary_key=True, index=True)
+    placa = Column(String, unique=True, nullable=False)
+    categoria = Column(String, nullable=True)
+    descricao = Column(String, nullable=True)
+    prioridade = Column(Integer, default=1, nullable=False)
+    ativo = Column(Boolean, default=True, nullable=False)
+    atualizado_em = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"<WatchlistPlaca(placa={self.placa}, categoria={self.categoria})>"
+
+
+class ResumoPlaca(Base):
+    # Uma linha por placa (normalizada), mantida na mesma transação de cada
+    # leitura gravada.
+    __tablename__ = "lpr_placas"
+
+    placa = Column(String, primary_key=True)
+    primeira_vez = Column(DateTime, nullable=False)
+    ultima_vez = Column(DateTime, nullable=False)
+    passagens = Column(Integer, default=0, nullable=False)
+    visitas = Column(Integer, default=0, nullable=False)
+    visitas_fechadas = Column(Integer, default=0, nullable=False)
+    permanencia_total_segundos = Column(BigInteger, default=0, nullable=False)
+    visita_aberta_id = Column(Integer, nullable=True)
+
+    def __repr__(self):
+        return f"<ResumoPlaca(placa={self.placa}, visitas={self.visitas})>"
+
+
+class VisitaLPR(Base):
+    __tablename__ = "lpr_visitas"
+    __table_args__ = (Index("ix_lpr_visitas_placa_id", "placa", "id"),)
+
+    id = Column(Integer, primary_key=True)
+    placa = Column(String, nullable=False)
+    entrada = Column(DateTime, nullable=True)
+    saida = Column(DateTime, nullable=True)
+    dispositivo_entrada = Column(String, nullable=True)
+    dispositivo_saida = Column(String, nullable=True)
+    registro_entrada_id = Column(Integer, index=True, nullable=True)
+    registro_saida_id = Column(Integer, index=True, nullable=True)
+
+    def __repr__(self):
+        return f"<VisitaLPR(placa={self.placa}, entrada={self.entrada}, saida={self.saida})>"
@@ -0,0 +1,43 @@
+﻿import re
+
+# Caracteres que o OCR das câmeras costuma trocar entre si; cada grupo é
+# reduzido a um único representante antes da comparação.
+GRUPOS_CONFUSAO = ("0ODQ", "1IL", "8B", "5S", "2Z", "6G")
+
+_TABELA_CONFUSAO = str.maketrans(
+    {caractere: grupo[0] for grupo in GRUPOS_CONFUSAO for caractere in grupo[1:]}
+)
+_RE_NAO_ALFANUMERICO = re.compile(r"[^0-9A-Z]")
+
+
+def normalizar_placa(placa):
+    if not placa:
+        return ""
+    return _RE_NAO_ALFANUMERICO.sub("", str(placa).upper())
+
+
+def canonizar_placa(placa):
+    return normalizar_placa(placa).translate(_TABELA_CONFUSAO)
+
+
+def delecoes(chave):
+    return {chave[:indice] + chave[indice + 1 :] for indice in range(len(chave))}
+
+
+def distancia_ate_um(a, b):
+    # Levenshtein limitado: True se a e b diferem em no máximo uma
+    # substituição, inserção ou remoção.
+    if a == b:
+        return True
+    tamanho_a, tamanho_b = len(a), len(b)
+    if abs(tamanho_a - tamanho_b) > 1:
+        return False
+    if tamanho_a > tamanho_b:
+        a, b, tamanho_a, tamanho_b = b, a, tamanho_b, tamanho_a
+
+    indice = 0
+    while indice < tamanho_a and a[indice] == b[indice]:
+        indice += 1
+    if tamanho_a == tamanho_b:
+        return a[indice + 1 :] == b[indice + 1 :]
+    return a[indice:] == b[indice + 1 :]
@@ -0,0 +1,286 @@
+﻿import logging
+import os
+import posixpath
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import capturas
+from models import CapturaLPR
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+    features = None
+
+logger = logging.getLogger("RECOMPRESSAO")
+
+NIVEL_ORIGINAL = 0
+NIVEL_PADRAO = 1
+NIVEL_ARQUIVO = 2
+
+_EXTENSOES = {"webp": "webp", "jpeg": "jpg", "avif": "avif"}
+_FORMATOS_PIL = {"webp": "WEBP", "jpeg": "JPEG", "avif": "AVIF"}
+
+
+def _ler_env_inteiro(chave, padrao, minimo=0):
+    try:
+        return max(minimo, int(os.getenv(chave, str(padrao)).strip()))
+    except ValueError:
+        return padrao
+
+
+class PerfilCompressao:
+    __slots__ = ("nivel", "formato", "qualidade", "dimensao_maxima")
+
+    def __init__(self, nivel, formato, qualidade, dimensao_maxima):
+        self.nivel = nivel
+        self.formato = formato
+        self.qualidade = qualidade
+        self.dimensao_maxima = dimensao_maxima
+
+
+def _ler_formato():
+    formato = os.getenv("IMAGEM_FORMATO", "webp").strip().lower() or "webp"
+    if formato == "jpg":
+        formato = "jpeg"
+    if formato not in _FORMATOS_PIL:
+        logger.warning(f"IMAGEM_FORMATO inválido: {formato}; usando webp")
+        return "webp"
+    if formato == "avif" and features is not None and not features.check("avif"):
+        logger.warning("Pillow sem suporte a AVIF; usando webp")
+        return "webp"
+    return formato
+
+
+def codificar(caminho_origem, caminho_destino, perfil):
+    with Image.open(caminho_origem) as imagem:
+        if imagem.format == "JPEG":
+            # Decodifica já reduzido quando possível (DCT scaling do libjpeg).
+            imagem.draft("RGB", (perfil.dimensao_maxima, perfil.dimensao_maxima))
+        imagem = imagem.convert("RGB")
+        if max(imagem.size) > perfil.dimensao_maxima:
+            imagem.thumbnail((perfil.dimensao_maxima, perfil.dimensao_maxima), Image.LANCZOS)
+
+        opcoes = {"quality": perfil.qualidade}
+        if perfil.formato == "webp":
+            opcoes["method"] = 4
+        elif perfil.formato == "jpeg":
+            opcoes["optimize"] = True
+            opcoes["progressive"] = True
+        imagem.save(caminho_destino, _FORMATOS_PIL[perfil.formato], **opcoes)
+    return os.path.getsize(caminho_destino)
+
+
+class Recompressor:
+    def __init__(self, obter_sessao, armazenamento, ao_alterar=None):
+        self.obter_sessao = obter_sessao
+        self.armazenamento = armazenamento
+        # Chamado quando caminho_imagem das leituras muda (cache de /api/records).
+        self.ao_alterar = ao_alterar
+        self.ativo = os.getenv("RECOMPRESSAO_IMAGENS", "0").strip() == "1"
+        self.intervalo = _ler_env_inteiro("RECOMPRESSAO_INTERVALO_SEGUNDOS", 30, minimo=5)
+        self.atraso = _ler_env_inteiro("RECOMPRESSAO_ATRASO_SEGUNDOS", 60)
+        self.workers = _ler_env_inteiro("RECOMPRESSAO_WORKERS", 2, minimo=1)
+        self.lote = _ler_env_inteiro("RECOMPRESSAO_LOTE", 200, minimo=1)
+        self.dias_camada = _ler_env_inteiro("IMAGEM_CAMADA_DIAS", 7)
+
+        formato = _ler_formato() if Image is not None else "webp"
+        self.perfis = {
+            NIVEL_PADRAO: PerfilCompressao(
+                NIVEL_PADRAO,
+                formato,
+                _ler_env_inteiro("IMAGEM_QUALIDADE", 80, minimo=1),
+                _ler_env_inteiro("IMAGEM_DIMENSAO_MAXIMA", 1920, minimo=64),
+            ),
+            NIVEL_ARQUIVO: PerfilCompressao(
+                NIVEL_ARQUIVO,
+                formato,
+                _ler_env_inteiro("IMAGEM_CAMADA_QUALIDADE", 50, minimo=1),
+                _ler_env_inteiro("IMAGEM_CAMADA_DIMENSAO_MAXIMA", 1280, minimo=64),
+            ),
+        }
+
+        self.processadas = 0
+        self.bytes_economizados = 0
+        self.falhas = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def disponivel(self):
+        return self.ativo and Image is not None
+
+    def _candidatas(self, sessao):
+        agora = datetime.utcnow()
+        # Só processa blobs sem uso recente: o WhatsApp pode ainda estar lendo
+        # o arquivo original logo após a ingestão.
+        recentes = sessao.query(CapturaLPR.hash, CapturaLPR.caminho, CapturaLPR.nivel).filter(
+            CapturaLPR.nivel == NIVEL_ORIGINAL,
+            CapturaLPR.referencias > 0,
+            CapturaLPR.ultimo_uso < agora - timedelta(seconds=self.atraso),
+        )
+        tarefas = [(hash_imagem, caminho, NIVEL_PADRAO) for hash_imagem, caminho, _ in recentes.limit(self.lote)]
+
+        if self.dias_camada > 0 and len(tarefas) < self.lote:
+            antigas = sessao.query(CapturaLPR.hash, CapturaLPR.caminho, CapturaLPR.nivel).filter(
+                CapturaLPR.nivel < NIVEL_ARQUIVO,
+                CapturaLPR.referencias > 0,
+                CapturaLPR.ultimo_uso < agora - timedelta(days=self.dias_camada),
+            )
+            vistas = {hash_imagem for hash_imagem, _, _ in tarefas}
+            for hash_imagem, caminho, _ in antigas.limit(self.lote - len(tarefas)):
+                if hash_imagem not in vistas:
+                    tarefas.append((hash_imagem, caminho, NIVEL_ARQUIVO))
+        return tarefas
+
+    def processar(self, hash_imagem, caminho_atual, nivel):
+        perfil = self.perfis[nivel]
+        novo_relativo = posixpath.join(
+            posixpath.dirname(caminho_atual.replace("\\", "/")),
+            f"{hash_imagem}-n{nivel}.{_EXTENSOES[perfil.formato]}",
+        )
+
+        # No backend local é o próprio arquivo; no S3, uma cópia temporária.
+        origem, origem_temporaria = self.armazenamento.obter_arquivo_local(caminho_atual)
+        if origem is None:
+            return False
+        temporario = os.path.join(self.armazenamento.diretorio_temporario, f".{uuid.uuid4().hex}.tmp")
+
+        try:
+            tamanho_atual = os.path.getsize(origem)
+            try:
+                novo_tamanho = codificar(origem, temporario, perfil)
+            except Exception as exc:
+                if os.path.exists(temporario):
+                    os.remove(temporario)
+                with self._lock:
+                    self.falhas += 1
+                logger.warning(f"Falha ao recomprimir {caminho_atual}: {exc}")
+                self._marcar_nivel(hash_imagem, caminho_atual, nivel)
+                return False
+        finally:
+            if origem_temporaria:
+                os.remove(origem)
+
+        if novo_tamanho >= tamanho_atual:
+            # Não compensa: mantém o arquivo atual e não tenta de novo.
+            os.remove(temporario)
+            self._marcar_nivel(hash_imagem, caminho_atual, nivel)
+            return False
+
+        self.armazenamento.gravar(novo_relativo, temporario)
+        sessao = self.obter_sessao()
+        try:
+            atualizadas = (
+                sessao.query(CapturaLPR)
+                .filter(CapturaLPR.hash == hash_imagem, CapturaLPR.caminho == caminho_atual)
+                .update(
+                    {
+                        CapturaLPR.caminho: novo_relativo,
+                        CapturaLPR.tamanho: novo_tamanho,
+                        CapturaLPR.nivel: nivel,
+                    },
+                    synchronize_session=False,
+                )
+            )
+            if not atualizadas:
+                sessao.rollback()
+                self.armazenamento.remover(novo_relativo)
+                return False
+            capturas.atualizar_caminho_leituras(sessao, hash_imagem, novo_relativo)
+            sessao.commit()
+            if self.ao_alterar is not None:
+                self.ao_alterar()
+        except Exception:
+            sessao.rollback()
+            self.armazenamento.remover(novo_relativo)
+            raise
+        finally:
+            sessao.close()
+
+        try:
+            self.armazenamento.remover(caminho_atual)
+        except Exception as exc:
+            logger.warning(f"Não foi possível remover {caminho_atual}: {exc}")
+
+        with self._lock:
+            self.processadas += 1
+            self.bytes_economizados += tamanho_atual - novo_tamanho
+        return True
+
+    def _marcar_nivel(self, hash_imagem, caminho_atual, nivel):
+        sessao = self.obter_sessao()
+        try:
+            sessao.query(CapturaLPR).filter(
+                CapturaLPR.hash == hash_imagem,
+                CapturaLPR.caminho == caminho_atual,
+            ).update({CapturaLPR.nivel: nivel}, synchronize_session=False)
+            sessao.commit()
+        except Exception:
+            sessao.rollback()
+        finally:
+            sessao.close()
+
+    def executar_ciclo(self):
+        sessao = self.obter_sessao()
+        try:
+            tarefas = self._candidatas(sessao)
+        finally:
+            sessao.close()
+        if not tarefas:
+            return 0
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="recompressao")
+
+        futuros = [self._executor.submit(self.processar, *tarefa) for tarefa in tarefas]
+        concluidas = 0
+        for futuro in futuros:
+            try:
+                concluidas += 1 if futuro.result() else 0
+            except Exception as exc:
+                logger.warning(f"Erro na recompressão: {exc}")
+        return concluidas
+
+    def iniciar(self, eh_lider=None):
+        if not self.ativo:
+            return None
+        if Image is None:
+            logger.warning("RECOMPRESSAO_IMAGENS=1 requer Pillow (pip install pillow); recompressão desativada")
+            return None
+
+        def worker():
+            while True:
+                time.sleep(self.intervalo)
+                if eh_lider is not None and not eh_lider():
+                    continue
+                try:
+                    concluidas = self.executar_ciclo()
+                    if concluidas:
+                        logger.info(
+                            f"Recompressão: {concluidas} imagem(ns) neste ciclo, "
+                            f"{self.bytes_economizados / (1024 * 1024):.1f} MB economizados desde o início"
+                        )
+                except Exception as exc:
+                    logger.warning(f"Falha no ciclo de recompressão: {exc}")
+
+        thread = threading.Thread(target=worker, daemon=True, name="recompressao")
+        thread.start()
+        return thread
+
+    def estado(self):
+        perfil = self.perfis[NIVEL_PADRAO]
+        return {
+            "ativo": self.disponivel(),
+            "formato": perfil.formato,
+            "qualidade": perfil.qualidade,
+            "dimensao_maxima": perfil.dimensao_maxima,
+            "camada_dias": self.dias_camada,
+            "camada_qualidade": self.perfis[NIVEL_ARQUIVO].qualidade,
+            "processadas": self.processadas,
+            "bytes_economizados_processo": self.bytes_economizados,
+            "falhas": self.falhas,
+        }
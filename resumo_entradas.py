@@ -0,0 +1,183 @@
+﻿import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+
+from lpr_mensagens import MENSAGEM_RESUMO_ITEM_PADRAO, MENSAGEM_RESUMO_PADRAO, formatar_resumo_entradas
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger("RESUMO_ENTRADAS")
+
+MODOS_IMAGEM = ("nenhuma", "primeira", "colagem")
+TAMANHO_MINIATURA = (320, 240)
+COLUNAS_COLAGEM = 3
+# Colagens antigas são apagadas no próximo resumo; o envio assíncrono pode
+# ainda estar lendo a mais recente.
+IDADE_MAXIMA_COLAGEM_SEGUNDOS = 3600
+
+
+def _ler_env_inteiro(chave, padrao, minimo=0):
+    try:
+        return max(minimo, int(os.getenv(chave, str(padrao)).strip()))
+    except ValueError:
+        return padrao
+
+
+class EntradaResumo:
+    __slots__ = ("placa", "cor", "horario", "imagem")
+
+    def __init__(self, placa, cor, horario, imagem=None):
+        self.placa = placa
+        self.cor = cor
+        self.horario = horario
+        self.imagem = imagem
+
+
+class AgrupadorEntradas:
+    # Com tráfego leve cada entrada é enviada na hora. Quando mais de
+    # `limiar` entradas chegam dentro de `janela` segundos, as seguintes são
+    # acumuladas e enviadas como um único resumo ao fim da janela.
+    def __init__(self, enviar, armazenamento=None, diretorio_temporario=None, resolver_imagem=None):
+        self.enviar = enviar
+        self.armazenamento = armazenamento
+        # A janela segura as entradas por até RESUMO_JANELA_SEGUNDOS: a
+        # recompressão pode ter trocado o arquivo de uma captura nesse meio tempo.
+        self.resolver_imagem = resolver_imagem
+        self.limiar = _ler_env_inteiro("RESUMO_LIMIAR_ENTRADAS", 10)
+        self.janela = _ler_env_inteiro("RESUMO_JANELA_SEGUNDOS", 120, minimo=5)
+        self.maximo = _ler_env_inteiro("RESUMO_MAXIMO_ENTRADAS", 40, minimo=2)
+        self.modo_imagem = os.getenv("RESUMO_IMAGEM", "primeira").strip().lower() or "primeira"
+        if self.modo_imagem not in MODOS_IMAGEM:
+            logger.warning(f"RESUMO_IMAGEM inválido: {self.modo_imagem}; usando primeira")
+            self.modo_imagem = "primeira"
+        if self.modo_imagem == "colagem" and Image is None:
+            logger.warning("RESUMO_IMAGEM=colagem requer Pillow (pip install pillow); usando primeira")
+            self.modo_imagem = "primeira"
+        self.diretorio_temporario = diretorio_temporario or os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "storage", "resumos"
+        )
+
+        self.template = MENSAGEM_RESUMO_PADRAO
+        self.template_item = MENSAGEM_RESUMO_ITEM_PADRAO
+        self._recentes = deque()
+        self._pendentes = []
+        self._temporizador = None
+        self._lock = threading.Lock()
+        self.resumos_enviados = 0
+        self.entradas_agrupadas = 0
+
+    def ativo(self):
+        return self.limiar > 0
+
+    def adicionar(self, placa, cor, imagem=None, mensagem_individual=None):
+        agora = time.monotonic()
+        entrada = EntradaResumo(placa, cor, datetime.now(), imagem)
+        with self._lock:
+            self._recentes.append(agora)
+            while self._recentes and self._recentes[0] < agora - self.janela:
+                self._recentes.popleft()
+
+            agrupar = self.ativo() and (self._pendentes or len(self._recentes) > self.limiar)
+            if agrupar:
+                self._pendentes.append(entrada)
+                if self._temporizador is None:
+                    self._temporizador = threading.Timer(self.janela, self.descarregar)
+                    self._temporizador.daemon = True
+                    self._temporizador.start()
+                cheio = len(self._pendentes) >= self.maximo
+        if not agrupar:
+            self.enviar(mensagem_individual, imagem)
+        elif cheio:
+            self.descarregar()
+
+    def descarregar(self):
+        with self._lock:
+            pendentes, self._pendentes = self._pendentes, []
+            if self._temporizador is not None:
+                self._temporizador.cancel()
+                self._temporizador = None
+        if not pendentes:
+            return
+
+        try:
+            mensagem = formatar_resumo_entradas(self.template, self.template_item, pendentes)
+            self.enviar(mensagem, self._imagem_resumo(pendentes), resumo=True)
+            self.resumos_enviados += 1
+            self.entradas_agrupadas += len(pendentes)
+            logger.info(f"Resumo de {len(pendentes)} entrada(s) enviado")
+        except Exception as exc:
+            logger.error(f"Erro ao enviar resumo de entradas: {exc}")
+
+    def _imagem_resumo(self, pendentes):
+        imagens = [entrada.imagem for entrada in pendentes if entrada.imagem]
+        if not imagens or self.modo_imagem == "nenhuma":
+            return None
+        if self.modo_imagem == "primeira" or self.armazenamento is None:
+            return imagens[0]
+        try:
+            return self._montar_colagem(imagens[: COLUNAS_COLAGEM * COLUNAS_COLAGEM])
+        except Exception as exc:
+            logger.warning(f"Falha ao montar colagem do resumo: {exc}")
+            return imagens[0]
+
+    def _montar_colagem(self, imagens):
+        os.makedirs(self.diretorio_temporario, exist_ok=True)
+        self._limpar_colagens()
+
+        largura, altura = TAMANHO_MINIATURA
+        colunas = min(COLUNAS_COLAGEM, len(imagens))
+        linhas = (len(imagens) + colunas - 1) // colunas
+        colagem = Image.new("RGB", (colunas * largura, linhas * altura), "black")
+        for indice, relativo in enumerate(imagens):
+            caminho, temporario = self.armazenamento.obter_arquivo_local(relativo)
+            if caminho is None and self.resolver_imagem is not None:
+                atual = self.resolver_imagem(relativo)
+                if atual and atual != relativo:
+                    caminho, temporario = self.armazenamento.obter_arquivo_local(atual)
+            if caminho is None:
+                continue
+            try:
+                with Image.open(caminho) as imagem:
+                    imagem.draft("RGB", TAMANHO_MINIATURA)
+                    imagem = imagem.convert("RGB")
+                    imagem.thumbnail(TAMANHO_MINIATURA)
+                    x = (indice % colunas) * largura + (largura - imagem.width) // 2
+                    y = (indice // colunas) * altura + (altura - imagem.height) // 2
+                    colagem.paste(imagem, (x, y))
+            finally:
+                if temporario:
+                    os.remove(caminho)
+
+        destino = os.path.join(self.diretorio_temporario, f"resumo-{uuid.uuid4().hex}.jpg")
+        colagem.save(destino, "JPEG", quality=80)
+        return destino
+
+    def _limpar_colagens(self):
+        limite = time.time() - IDADE_MAXIMA_COLAGEM_SEGUNDOS
+        with os.scandir(self.diretorio_temporario) as entradas:
+            for entrada in entradas:
+                if entrada.name.startswith("resumo-") and entrada.stat().st_mtime < limite:
+                    try:
+                        os.remove(entrada.path)
+                    except OSError:
+                        pass
+
+    def estado(self):
+        with self._lock:
+            pendentes = len(self._pendentes)
+        return {
+            "ativo": self.ativo(),
+            "limiar_entradas": self.limiar,
+            "janela_segundos": self.janela,
+            "imagem": self.modo_imagem,
+            "pendentes": pendentes,
+            "resumos_enviados": self.resumos_enviados,
+            "entradas_agrupadas": self.entradas_agrupadas,
+        }
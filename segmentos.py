@@ -0,0 +1,308 @@
+﻿import mmap
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+from travas import LockExclusivo
+
+TAMANHO_BLOCO_LEITURA = 64 * 1024
+_RE_SEGMENTO = re.compile(r"^seg-(\d{8})\.idx$")
+# Remoção no índice: a entrada vira lápide e o segmento é apagado inteiro
+# quando não sobra nenhuma captura viva nele.
+_LAPIDE = -1
+# Num miss, a releitura completa do diretório roda no máximo uma vez por
+# intervalo; capturas novas de outros processos caem sempre no último segmento.
+_INTERVALO_ATUALIZACAO_COMPLETA = 5.0
+
+
+class _LeitorFatia:
+    # Leitura de uma captura como fatia do mmap do segmento.
+    def __init__(self, fatia):
+        self._fatia = fatia
+        self._posicao = 0
+        self.tamanho = len(fatia)
+
+    def read(self, tamanho=-1):
+        if tamanho is None or tamanho < 0:
+            tamanho = self.tamanho - self._posicao
+        bloco = self._fatia[self._posicao : self._posicao + tamanho]
+        self._posicao += len(bloco)
+        return bytes(bloco)
+
+    def seekable(self):
+        return True
+
+    def seek(self, posicao, origem=0):
+        base = {0: 0, 1: self._posicao, 2: self.tamanho}[origem]
+        self._posicao = min(max(0, base + posicao), self.tamanho)
+        return self._posicao
+
+    def tell(self):
+        return self._posicao
+
+    def iter_chunks(self, tamanho=TAMANHO_BLOCO_LEITURA):
+        while True:
+            bloco = self.read(tamanho)
+            if not bloco:
+                return
+            yield bloco
+
+    def close(self):
+        if isinstance(self._fatia, memoryview):
+            self._fatia.release()
+        self._fatia = b""
+
+
+class _Segmento:
+    __slots__ = ("numero", "posicao_indice", "vivas", "mapa", "tamanho_mapa")
+
+    def __init__(self, numero):
+        self.numero = numero
+        self.posicao_indice = 0
+        self.vivas = 0
+        self.mapa = None
+        self.tamanho_mapa = 0
+
+
+class ArmazenamentoSegmentos:
+    nome = "segmentos"
+
+    def __init__(self, diretorio, tamanho_maximo_mb=256, fsync=False):
+        self.diretorio = os.path.realpath(diretorio)
+        self.diretorio_temporario = os.path.join(self.diretorio, "tmp")
+        os.makedirs(self.diretorio_temporario, exist_ok=True)
+        self.tamanho_maximo = tamanho_maximo_mb * 1024 * 1024
+        self.fsync = fsync
+
+        self._lock_arquivo = os.path.join(self.diretorio, "segmentos.lock")
+        self._lock = threading.RLock()
+        self._segmentos = {}
+        # chave -> (segmento, offset, tamanho)
+        self._indice = {}
+        self._atualizado_em = 0.0
+        with self._lock:
+            self._atualizar()
+
+    def _arquivo_dados(self, numero):
+        return os.path.join(self.diretorio, f"seg-{numero:08d}.dat")
+
+    def _arquivo_indice(self, numero):
+        return os.path.join(self.diretorio, f"seg-{numero:08d}.idx")
+
+    def _aplicar(self, chave, numero, offset, tamanho):
+        anterior = self._indice.get(chave)
+        if anterior is not None:
+            segmento_anterior = self._segmentos.get(anterior[0])
+            if segmento_anterior is not None:
+                segmento_anterior.vivas -= 1
+        if offset == _LAPIDE:
+            self._indice.pop(chave, None)
+            return
+        self._indice[chave] = (numero, offset, tamanho)
+        self._segmentos[numero].vivas += 1
+
+    def _ler_indice(self, segmento):
+        # Lê só o que foi acrescentado desde a última leitura (inclusive por
+        # outros processos); uma linha incompleta fica para a próxima vez.
+        try:
+            with open(self._arquivo_indice(segmento.numero), "rb") as arquivo:
+                arquivo.seek(segmento.posicao_indice)
+                novos = arquivo.read()
+        except FileNotFoundError:
+            return False
+        fim = novos.rfind(b"\n")
+        if fim < 0:
+            return True
+        for linha in novos[:fim].split(b"\n"):
+            chave, offset, tamanho = linha.decode("utf-8").split("\t")
+            self._aplicar(chave, segmento.numero, int(offset), int(tamanho))
+        segmento.posicao_indice += fim + 1
+        return True
+
+    def _descartar(self, numero):
+        # O mmap não é fechado aqui: fatias ainda em uso por outras threads o
+        # mantêm vivo até serem liberadas.
+        if self._segmentos.pop(numero, None) is None:
+            return
+        for chave in [chave for chave, local in self._indice.items() if local[0] == numero]:
+            del self._indice[chave]
+
+    def _atualizar(self):
+        existentes = {}
+        with os.scandir(self.diretorio) as entradas:
+            for entrada in entradas:
+                encontrado = _RE_SEGMENTO.match(entrada.name)
+                if encontrado:
+                    try:
+                        existentes[int(encontrado.group(1))] = entrada.stat().st_size
+                    except FileNotFoundError:
+                        pass
+        for numero in set(self._segmentos) - set(existentes):
+            self._descartar(numero)
+        for numero in sorted(existentes):
+            segmento = self._segmentos.get(numero)
+            if segmento is None:
+                segmento = self._segmentos[numero] = _Segmento(numero)
+            elif existentes[numero] <= segmento.posicao_indice:
+                # .idx só cresce: sem bytes novos não há o que reler.
+                continue
+            if not self._ler_indice(segmento):
+                self._descartar(numero)
+        self._atualizado_em = time.monotonic()
+
+    def _atualizar_recentes(self):
+        # Só o último segmento conhecido e o seguinte a ele recebem capturas
+        # novas; basta um stat em cada para saber se há o que ler.
+        ultimo = max(self._segmentos, default=0)
+        for numero in (ultimo, ultimo + 1):
+            if not numero:
+                continue
+            try:
+                tamanho = os.stat(self._arquivo_indice(numero)).st_size
+            except FileNotFoundError:
+                continue
+            segmento = self._segmentos.get(numero)
+            if segmento is None:
+                segmento = self._segmentos[numero] = _Segmento(numero)
+            if tamanho > segmento.posicao_indice and not self._ler_indice(segmento):
+                self._descartar(numero)
+
+    def _localizar(self, relativo):
+        with self._lock:
+            local = self._indice.get(relativo)
+            if local is None:
+                # Pode ter sido gravada por outro processo.
+                self._atualizar_recentes()
+                local = self._indice.get(relativo)
+            if local is None and time.monotonic() - self._atualizado_em >= _INTERVALO_ATUALIZACAO_COMPLETA:
+                self._atualizar()
+                local = self._indice.get(relativo)
+            return local
+
+    def _fatia(self, relativo):
+        local = self._localizar(relativo)
+        if local is None:
+            return None
+        numero, offset, tamanho = local
+        with self._lock:
+            segmento = self._segmentos.get(numero)
+            if segmento is None:
+                return None
+            if segmento.mapa is None or segmento.tamanho_mapa < offset + tamanho:
+                try:
+                    with open(self._arquivo_dados(numero), "rb") as arquivo:
+                        tamanho_arquivo = os.fstat(arquivo.fileno()).st_size
+                        if tamanho_arquivo < offset + tamanho:
+                            return None
+                        mapa = mmap.mmap(arquivo.fileno(), 0, access=mmap.ACCESS_READ)
+                except FileNotFoundError:
+                    self._descartar(numero)
+                    return None
+                segmento.mapa = mapa
+                segmento.tamanho_mapa = tamanho_arquivo
+            return memoryview(segmento.mapa)[offset : offset + tamanho]
+
+    def _registrar(self, numero, chave, offset, tamanho):
+        with open(self._arquivo_indice(numero), "ab") as indice:
+            indice.write(f"{chave}\t{offset}\t{tamanho}\n".encode("utf-8"))
+            indice.flush()
+            if self.fsync:
+                os.fsync(indice.fileno())
+
+    def caminho_local(self, relativo):
+        return None
+
+    def existe(self, relativo):
+        return self._localizar(relativo) is not None
+
+    def gravar(self, relativo, caminho_origem):
+        try:
+            with self._lock, LockExclusivo(self._lock_arquivo):
+                self._atualizar()
+                numero = max(self._segmentos, default=0)
+                if not numero or os.path.getsize(self._arquivo_dados(numero)) >= self.tamanho_maximo:
+                    numero += 1
+                    open(self._arquivo_dados(numero), "ab").close()
+                    open(self._arquivo_indice(numero), "ab").close()
+                    self._segmentos[numero] = _Segmento(numero)
+
+                with open(self._arquivo_dados(numero), "ab") as dados, open(caminho_origem, "rb") as origem:
+                    offset = dados.tell()
+                    shutil.copyfileobj(origem, dados, TAMANHO_BLOCO_LEITURA)
+                    dados.flush()
+                    if self.fsync:
+                        os.fsync(dados.fileno())
+                    tamanho = dados.tell() - offset
+                self._registrar(numero, relativo, offset, tamanho)
+                self._ler_indice(self._segmentos[numero])
+        finally:
+            try:
+                os.remove(caminho_origem)
+            except FileNotFoundError:
+                pass
+
+    def abrir(self, relativo):
+        fatia = self._fatia(relativo)
+        return _LeitorFatia(fatia) if fatia is not None else None
+
+    def ler(self, relativo):
+        fatia = self._fatia(relativo)
+        if fatia is None:
+            return None
+        try:
+            return bytes(fatia)
+        finally:
+            fatia.release()
+
+    def remover(self, relativo):
+        with self._lock, LockExclusivo(self._lock_arquivo):
+            self._atualizar()
+            local = self._indice.get(relativo)
+            if local is None:
+                return
+            numero = local[0]
+            self._registrar(numero, relativo, _LAPIDE, 0)
+            self._ler_indice(self._segmentos[numero])
+
+            # Segmento sem capturas vivas (e que não é o atual) sai inteiro.
+            segmento = self._segmentos[numero]
+            if segmento.vivas <= 0 and numero != max(self._segmentos):
+                self._descartar(numero)
+                for caminho in (self._arquivo_dados(numero), self._arquivo_indice(numero)):
+                    try:
+                        os.remove(caminho)
+                    except FileNotFoundError:
+                        pass
+
+    def obter_arquivo_local(self, relativo):
+        fatia = self._fatia(relativo)
+        if fatia is None:
+            return None, False
+        destino = os.path.join(self.diretorio_temporario, f".{uuid.uuid4().hex}{os.path.splitext(relativo)[1]}")
+        try:
+            with open(destino, "wb") as arquivo:
+                arquivo.write(fatia)
+        finally:
+            fatia.release()
+        return destino, True
+
+    def url_redirecionamento(self, relativo, expira_segundos=3600):
+        return None
+
+    def estado(self):
+        with self._lock:
+            self._atualizar()
+            return {
+                "tipo": self.nome,
+                "segmentos": len(self._segmentos),
+                "capturas": len(self._indice),
+                "bytes_segmentos": sum(
+                    os.path.getsize(self._arquivo_dados(numero))
+                    for numero in self._segmentos
+                    if os.path.exists(self._arquivo_dados(numero))
+                ),
+                "tamanho_maximo_mb": self.tamanho_maximo // (1024 * 1024),
+            }
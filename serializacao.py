@@ -0,0 +1,25 @@
+﻿import json
+from datetime import date, datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _padrao(valor):
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    raise TypeError(f"Tipo não serializável: {type(valor).__name__}")
+
+
+def para_json(payload):
+    # Bytes UTF-8 prontos para a resposta. Datas viram ISO 8601 nos dois
+    # caminhos (orjson gera o mesmo texto de isoformat para datas sem fuso).
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, ensure_ascii=False, default=_padrao).encode("utf-8")
+
+
+def codificador():
+    return "orjson" if orjson is not None else "json"
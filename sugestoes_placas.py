@@ -0,0 +1,335 @@
+﻿import bisect
+import heapq
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from sqlalchemy import func
+
+from models import EntradaLPR
+from placas import normalizar_placa
+
+logger = logging.getLogger("SUGESTOES_PLACAS")
+
+TAMANHO_NGRAMA = 3
+LIMITE_MAXIMO = 20
+# Prefixos curtos casam com muitas placas: o topo deles é mantido pronto.
+TAMANHO_PREFIXO_TOPO = TAMANHO_NGRAMA - 1
+LIMITE_VARREDURA = 10000
+_FORMATO_GERACAO = "<Q"
+
+
+def _ler_env_inteiro(chave, padrao, minimo=0):
+    try:
+        return max(minimo, int(os.getenv(chave, str(padrao)).strip()))
+    except ValueError:
+        return padrao
+
+
+def _ngramas(placa):
+    return {placa[indice : indice + TAMANHO_NGRAMA] for indice in range(len(placa) - TAMANHO_NGRAMA + 1)}
+
+
+class _Placa:
+    __slots__ = ("placa", "ultima_vez", "visitas")
+
+    def __init__(self, placa, ultima_vez, visitas):
+        self.placa = placa
+        self.ultima_vez = ultima_vez
+        self.visitas = visitas
+
+    def ordem(self):
+        # Mais visitas primeiro; empate pela mais recente.
+        return -self.visitas, -self.ultima_vez.timestamp(), self.placa
+
+    def para_dict(self):
+        return {"placa": self.placa, "ultima_vez": self.ultima_vez.isoformat(), "visitas": self.visitas}
+
+
+class IndicePlacas:
+    # Placas distintas (normalizadas) com última passagem e número de
+    # visitas: lista ordenada para prefixos e postings de trigramas para
+    # trechos do meio da placa.
+    def __init__(self, obter_sessao):
+        self.obter_sessao = obter_sessao
+        self.intervalo = _ler_env_inteiro("SUGESTOES_ATUALIZACAO_SEGUNDOS", 10, minimo=1)
+        # No PostgreSQL, ids de workers diferentes chegam ao commit fora de
+        # ordem: as últimas SUGESTOES_JANELA_IDS leituras são revistas a cada
+        # varredura, o que também traz as correções feitas por outros workers.
+        self.janela_ids = _ler_env_inteiro("SUGESTOES_JANELA_IDS", 1000, minimo=1)
+        # Remoções (arquivamento) e o que sair da janela só entram na
+        # reconstrução completa.
+        self.intervalo_reconstrucao = _ler_env_inteiro("SUGESTOES_RECONSTRUCAO_SEGUNDOS", 3600)
+        self.pronto = False
+
+        self._placas = {}
+        self._ordenadas = []
+        self._postings = {}
+        self._topo_prefixos = {}
+        # Leituras com id até a marca já foram vistas. As da janela
+        # (id > marca - janela_ids) ficam em _aplicadas com a placa contada.
+        self._marca_id = 0
+        self._aplicadas = {}
+        self._reconstrucoes = 0
+        self._reconstruido_em = None
+        # Criado antes do fork: sinalizar_reconstrucao avisa todos os workers.
+        self._geracao = mmap.mmap(-1, struct.calcsize(_FORMATO_GERACAO))
+        self._geracao_vista = 0
+        self._lock = threading.RLock()
+        # Reconstruções (inicialização, promoção do banco) uma de cada vez:
+        # a última a começar é a que fica.
+        self._lock_reconstrucao = threading.Lock()
+        self._thread = None
+
+    def _ler_geracao(self):
+        return struct.unpack_from(_FORMATO_GERACAO, self._geracao, 0)[0]
+
+    def sinalizar_reconstrucao(self):
+        # Leituras removidas do banco (arquivamento): cada worker reconstrói
+        # o índice na próxima varredura.
+        struct.pack_into(_FORMATO_GERACAO, self._geracao, 0, self._ler_geracao() + 1)
+
+    def _atualizar_topo(self, item):
+        for tamanho in range(1, TAMANHO_PREFIXO_TOPO + 1):
+            if len(item.placa) < tamanho:
+                break
+            topo = self._topo_prefixos.setdefault(item.placa[:tamanho], [])
+            topo[:] = [outro for outro in topo if outro is not item]
+            bisect.insort(topo, item, key=_Placa.ordem)
+            del topo[LIMITE_MAXIMO:]
+
+    def _recalcular_topo(self, placa):
+        # Visitas só diminuem em correções: o topo do prefixo é refeito.
+        for tamanho in range(1, TAMANHO_PREFIXO_TOPO + 1):
+            prefixo = placa[:tamanho]
+            inicio = bisect.bisect_left(self._ordenadas, prefixo)
+            fim = bisect.bisect_left(self._ordenadas, prefixo + "\uffff")
+            self._topo_prefixos[prefixo] = heapq.nsmallest(
+                LIMITE_MAXIMO, (self._placas[outra] for outra in self._ordenadas[inicio:fim]), key=_Placa.ordem
+            )
+
+    def _somar(self, placa, ultima_vez, visitas=1, incremental=True):
+        placa = normalizar_placa(placa)
+        if not placa:
+            return
+        item = self._placas.get(placa)
+        if item is None:
+            item = self._placas[placa] = _Placa(placa, ultima_vez, 0)
+            if incremental:
+                bisect.insort(self._ordenadas, placa)
+            else:
+                self._ordenadas.append(placa)
+            for ngrama in _ngramas(placa):
+                self._postings.setdefault(ngrama, set()).add(placa)
+        item.visitas += visitas
+        if ultima_vez > item.ultima_vez:
+            item.ultima_vez = ultima_vez
+        if incremental:
+            self._atualizar_topo(item)
+
+    def _subtrair(self, placa):
+        placa = normalizar_placa(placa)
+        item = self._placas.get(placa)
+        if item is None:
+            return
+        item.visitas -= 1
+        if item.visitas <= 0:
+            del self._placas[placa]
+            self._ordenadas.pop(bisect.bisect_left(self._ordenadas, placa))
+            for ngrama in _ngramas(placa):
+                postings = self._postings.get(ngrama)
+                if postings is not None:
+                    postings.discard(placa)
+                    if not postings:
+                        del self._postings[ngrama]
+        self._recalcular_topo(placa)
+
+    def reconstruir(self):
+        with self._lock_reconstrucao:
+            return self._reconstruir()
+
+    def _reconstruir(self):
+        geracao = self._ler_geracao()
+        sessao = self.obter_sessao()
+        try:
+            maior_id = sessao.query(func.max(EntradaLPR.id)).scalar() or 0
+            corte = maior_id - self.janela_ids
+            agregadas = (
+                sessao.query(EntradaLPR.placa, func.max(EntradaLPR.timestamp), func.count(EntradaLPR.id))
+                .filter(EntradaLPR.id <= corte)
+                .group_by(EntradaLPR.placa)
+                .all()
+            )
+            # A janela vem linha a linha, para as varreduras saberem o que já
+            # foi contado.
+            recentes = (
+                sessao.query(EntradaLPR.id, EntradaLPR.placa, EntradaLPR.timestamp)
+                .filter(EntradaLPR.id > corte)
+                .order_by(EntradaLPR.id)
+                .all()
+            )
+        finally:
+            sessao.close()
+
+        with self._lock:
+            self._placas = {}
+            self._ordenadas = []
+            self._postings = {}
+            self._topo_prefixos = {}
+            self._aplicadas = {}
+            self._marca_id = maior_id
+            for placa, ultima_vez, visitas in agregadas:
+                if ultima_vez is not None:
+                    self._somar(placa, ultima_vez, visitas, incremental=False)
+            for registro_id, placa, ultima_vez in recentes:
+                if ultima_vez is not None:
+                    self._somar(placa, ultima_vez, incremental=False)
+                    self._aplicadas[registro_id] = placa
+                self._marca_id = max(self._marca_id, registro_id)
+            self._ordenadas.sort()
+            grupos = {}
+            for placa in self._ordenadas:
+                for tamanho in range(1, min(TAMANHO_PREFIXO_TOPO, len(placa)) + 1):
+                    grupos.setdefault(placa[:tamanho], []).append(self._placas[placa])
+            self._topo_prefixos = {
+                prefixo: heapq.nsmallest(LIMITE_MAXIMO, itens, key=_Placa.ordem) for prefixo, itens in grupos.items()
+            }
+            self._reconstrucoes += 1
+            self._reconstruido_em = time.monotonic()
+            self._geracao_vista = geracao
+            self.pronto = True
+        return len(self._placas)
+
+    def registrar(self, placa, ultima_vez, registro_id):
+        # Chamado após o commit de uma leitura nova neste processo.
+        with self._lock:
+            if not self.pronto or registro_id <= self._marca_id - self.janela_ids or registro_id in self._aplicadas:
+                return
+            self._aplicadas[registro_id] = placa
+            self._somar(placa, ultima_vez)
+
+    def corrigir(self, placa_anterior, placa_nova, ultima_vez, registro_id=None):
+        if normalizar_placa(placa_anterior) == normalizar_placa(placa_nova):
+            return
+        with self._lock:
+            if not self.pronto:
+                return
+            if registro_id in self._aplicadas:
+                # A varredura compara com esta placa: a correção não é
+                # aplicada duas vezes (nem se a varredura chegou antes).
+                if self._aplicadas[registro_id] == placa_nova:
+                    return
+                self._aplicadas[registro_id] = placa_nova
+            self._subtrair(placa_anterior)
+            self._somar(placa_nova, ultima_vez)
+
+    def atualizar(self):
+        # Leituras gravadas ou corrigidas por outros workers/instâncias desde
+        # a última vez, revendo a janela dos ids mais recentes.
+        with self._lock:
+            if not self.pronto:
+                return 0
+            reconstrucoes = self._reconstrucoes
+            corte = self._marca_id - self.janela_ids
+        sessao = self.obter_sessao()
+        try:
+            linhas = (
+                sessao.query(EntradaLPR.id, EntradaLPR.placa, EntradaLPR.timestamp)
+                .filter(EntradaLPR.id > corte)
+                .order_by(EntradaLPR.id)
+                .limit(LIMITE_VARREDURA)
+                .all()
+            )
+        finally:
+            sessao.close()
+
+        alteradas = 0
+        with self._lock:
+            if reconstrucoes != self._reconstrucoes:
+                return 0
+            for registro_id, placa, ultima_vez in linhas:
+                anterior = self._aplicadas.get(registro_id)
+                if ultima_vez is None:
+                    continue
+                if anterior is None:
+                    self._somar(placa, ultima_vez)
+                    alteradas += 1
+                elif normalizar_placa(anterior) != normalizar_placa(placa):
+                    # Corrigida em outro worker.
+                    self._subtrair(anterior)
+                    self._somar(placa, ultima_vez)
+                    alteradas += 1
+                self._aplicadas[registro_id] = placa
+                self._marca_id = max(self._marca_id, registro_id)
+            corte = self._marca_id - self.janela_ids
+            self._aplicadas = {
+                registro_id: placa for registro_id, placa in self._aplicadas.items() if registro_id > corte
+            }
+        return alteradas
+
+    def precisa_reconstruir(self):
+        if self._ler_geracao() != self._geracao_vista:
+            return True
+        return bool(
+            self.intervalo_reconstrucao
+            and self._reconstruido_em is not None
+            and time.monotonic() - self._reconstruido_em >= self.intervalo_reconstrucao
+        )
+
+    def sugerir(self, termo, limite=10):
+        termo = normalizar_placa(termo)
+        limite = max(1, min(LIMITE_MAXIMO, limite))
+        if not termo:
+            return []
+
+        with self._lock:
+            if len(termo) <= TAMANHO_PREFIXO_TOPO:
+                return [item.para_dict() for item in self._topo_prefixos.get(termo, [])[:limite]]
+
+            # Candidatas: interseção das postings, começando pela menor.
+            postings = [self._postings.get(ngrama) for ngrama in _ngramas(termo)]
+            if any(lista is None for lista in postings):
+                return []
+            postings.sort(key=len)
+            candidatas = postings[0]
+            for lista in postings[1:]:
+                candidatas = candidatas & lista
+                if not candidatas:
+                    return []
+            encontradas = [self._placas[placa] for placa in candidatas if termo in placa]
+            # Quem começa com o termo vem antes de quem só o contém.
+            melhores = heapq.nsmallest(
+                limite, encontradas, key=lambda item: (not item.placa.startswith(termo), *item.ordem())
+            )
+            return [item.para_dict() for item in melhores]
+
+    def iniciar_thread_atualizacao(self):
+        if self._thread is not None:
+            return self._thread
+
+        def worker():
+            while True:
+                time.sleep(self.intervalo)
+                try:
+                    if self.precisa_reconstruir():
+                        self.reconstruir()
+                    else:
+                        self.atualizar()
+                except Exception as exc:
+                    logger.warning(f"Falha ao atualizar índice de placas: {exc}")
+
+        self._thread = threading.Thread(target=worker, daemon=True, name="sugestoes-placas")
+        self._thread.start()
+        return self._thread
+
+    def estado(self):
+        with self._lock:
+            return {
+                "pronto": self.pronto,
+                "placas": len(self._placas),
+                "ngramas": len(self._postings),
+                "ultimo_id": self._marca_id,
+            }
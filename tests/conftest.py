@@ -0,0 +1,23 @@
+﻿import os
+import sys
+
+import pytest
+
+# Os módulos do projeto ficam na raiz do repositório.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def banco(monkeypatch, tmp_path):
+    # SQLite próprio do teste, fora de storage/.
+    import database
+
+    monkeypatch.setenv("DATABASE_URL", "")
+    monkeypatch.setenv("POSTGRES_HOST", "")
+    monkeypatch.setenv("DEDUP_JANELA_SEGUNDOS", "30")
+    monkeypatch.setattr(database, "_STORAGE_DIR", str(tmp_path / "storage"))
+    monkeypatch.setattr(database, "_SQLITE_FILE", str(tmp_path / "storage" / "lpr_local.db"))
+    database.inicializar_banco()
+    database.criar_tabelas()
+    yield
+    database.engine.dispose()
@@ -0,0 +1,100 @@
+﻿import heapq
+import multiprocessing
+import types
+
+import pytest
+
+import agendador_notificacoes
+from agendador_notificacoes import (
+    PRIORIDADE_ALERTA,
+    PRIORIDADE_ENTRADA,
+    AgendadorNotificacoes,
+    BaldesCompartilhados,
+)
+
+
+@pytest.fixture
+def relogio(monkeypatch):
+    # Relógio só do módulo: as threads e locks do processo seguem o real.
+    falso = types.SimpleNamespace(agora=1000.0)
+    falso.monotonic = lambda: falso.agora
+    monkeypatch.setattr(agendador_notificacoes, "time", falso)
+    return falso
+
+
+def test_balde_comeca_cheio_e_repoe_pela_taxa(relogio):
+    baldes = BaldesCompartilhados(total=8)
+    for _ in range(3):
+        assert baldes.consumir("grupo", 1, capacidade=3, taxa=1.0) is None
+    assert baldes.consumir("grupo", 1, capacidade=3, taxa=1.0) == pytest.approx(1.0)
+
+    relogio.agora += 0.5
+    assert baldes.consumir("grupo", 1, capacidade=3, taxa=1.0) == pytest.approx(0.5)
+    relogio.agora += 0.5
+    assert baldes.consumir("grupo", 1, capacidade=3, taxa=1.0) is None
+
+    relogio.agora += 100
+    assert baldes.fichas("grupo", capacidade=3, taxa=1.0) == pytest.approx(3.0)
+
+
+def test_reserva_fica_para_os_alertas(relogio):
+    baldes = BaldesCompartilhados(total=8)
+    # Entradas precisam de 1 + reserva fichas; alertas, de uma.
+    assert baldes.consumir("grupo", 2, capacidade=3, taxa=1.0) is None
+    assert baldes.consumir("grupo", 2, capacidade=3, taxa=1.0) is None
+    assert baldes.consumir("grupo", 2, capacidade=3, taxa=1.0) == pytest.approx(1.0)
+    assert baldes.consumir("grupo", 1, capacidade=3, taxa=1.0) is None
+    assert baldes.consumir("grupo", 1, capacidade=3, taxa=1.0) == pytest.approx(1.0)
+
+
+def _consumir_no_filho(baldes):
+    baldes.consumir("grupo", 1, capacidade=3, taxa=1e-9)
+    baldes.consumir("grupo", 1, capacidade=3, taxa=1e-9)
+
+
+def test_baldes_sao_divididos_entre_processos():
+    contexto = multiprocessing.get_context("fork")
+    baldes = BaldesCompartilhados(total=8)
+    filho = contexto.Process(target=_consumir_no_filho, args=(baldes,))
+    filho.start()
+    filho.join(10)
+    assert filho.exitcode == 0
+    assert baldes.fichas("grupo", capacidade=3, taxa=1e-9) == pytest.approx(1.0)
+    assert baldes.fichas("outro", capacidade=3, taxa=1e-9) == pytest.approx(3.0)
+
+
+def _enfileirar(agendador, nome, prioridade, mensagem):
+    # Direto na fila, sem subir a thread do agendador.
+    destinatario = agendador._destinatario(nome)
+    heapq.heappush(destinatario.fila, (prioridade, next(agendador._sequencia), mensagem, None, 0.0))
+    return destinatario
+
+
+def test_agendador_segura_entradas_e_libera_alerta(monkeypatch, relogio):
+    monkeypatch.setenv("WHATSAPP_ENVIOS_POR_MINUTO", "60")
+    monkeypatch.setenv("WHATSAPP_RAJADA", "3")
+    monkeypatch.setenv("WHATSAPP_RESERVA_ALERTAS", "1")
+    agendador = AgendadorNotificacoes(lambda *args: None, BaldesCompartilhados(total=8))
+
+    for indice in range(3):
+        destinatario = _enfileirar(agendador, "grupo", PRIORIDADE_ENTRADA, f"entrada {indice}")
+    enviadas = []
+    for _ in range(2):
+        liberados, _ = agendador._selecionar()
+        enviadas += [item[2] for _, item in liberados]
+        destinatario.ocupado = False
+    assert enviadas == ["entrada 0", "entrada 1"]
+
+    # Resta uma ficha, que é a reserva: a entrada espera a reposição.
+    liberados, espera = agendador._selecionar()
+    assert liberados == []
+    assert espera == pytest.approx(1.0)
+
+    _enfileirar(agendador, "grupo", PRIORIDADE_ALERTA, "alerta")
+    liberados, _ = agendador._selecionar()
+    assert [item[2] for _, item in liberados] == ["alerta"]
+    destinatario.ocupado = False
+
+    relogio.agora += 2
+    liberados, _ = agendador._selecionar()
+    assert [item[2] for _, item in liberados] == ["entrada 2"]
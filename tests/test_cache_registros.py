@@ -0,0 +1,114 @@
+﻿import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from cache_registros import CacheRegistros
+
+
+class _Consulta:
+    def __init__(self):
+        self.chamadas = 0
+
+    def __call__(self):
+        self.chamadas += 1
+        return f"corpo {self.chamadas}".encode()
+
+
+def test_gravacao_dentro_do_periodo_invalida_e_fora_nao():
+    cache = CacheRegistros()
+    chave = cache.chave(data_inicio="2024-03-01", data_fim="2024-03-03")
+    consulta = _Consulta()
+
+    assert cache.obter(chave, consulta) == b"corpo 1"
+    cache.invalidar(datetime(2024, 3, 10, 8, 0))
+    assert cache.obter(chave, consulta) == b"corpo 1"
+
+    cache.invalidar(datetime(2024, 3, 2, 23, 59))
+    assert cache.obter(chave, consulta) == b"corpo 2"
+    assert cache.obter(chave, consulta) == b"corpo 2"
+    assert consulta.chamadas == 2
+    estado = cache.estado()
+    assert (estado["acertos"], estado["falhas"], estado["invalidadas"]) == (2, 2, 1)
+
+
+def test_consulta_sem_periodo_depende_de_qualquer_gravacao():
+    cache = CacheRegistros()
+    sem_periodo = cache.chave(placa="abc-1234")
+    periodo = cache.chave(data_inicio="2024-03-01", data_fim="2024-03-01")
+    consulta = _Consulta()
+
+    cache.obter(sem_periodo, consulta)
+    cache.obter(periodo, consulta)
+    cache.invalidar(datetime(2030, 1, 1))
+    cache.obter(sem_periodo, consulta)
+    cache.obter(periodo, consulta)
+    assert consulta.chamadas == 3
+
+    cache.invalidar_tudo()
+    cache.obter(periodo, consulta)
+    assert consulta.chamadas == 4
+
+
+def test_requisicoes_iguais_simultaneas_fazem_uma_consulta():
+    cache = CacheRegistros()
+    chave = cache.chave(placa="ABC1234")
+    liberar = threading.Event()
+    chamadas = []
+
+    def consulta_lenta():
+        chamadas.append(1)
+        liberar.wait(5)
+        return b"lento"
+
+    resultados = []
+    threads = [threading.Thread(target=lambda: resultados.append(cache.obter(chave, consulta_lenta))) for _ in range(4)]
+    threads[0].start()
+    while chave not in cache._em_andamento:
+        time.sleep(0.001)
+    for thread in threads[1:]:
+        thread.start()
+    while cache.estado()["coalescidas"] < 3:
+        time.sleep(0.001)
+    liberar.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert resultados == [b"lento"] * 4
+    assert len(chamadas) == 1
+
+
+def test_erro_da_consulta_chega_a_quem_esperava_e_nao_fica_no_cache():
+    cache = CacheRegistros()
+    chave = cache.chave(placa="ABC1234")
+    liberar = threading.Event()
+
+    def consulta_com_erro():
+        liberar.wait(5)
+        raise RuntimeError("banco fora")
+
+    erros = []
+
+    def chamar():
+        try:
+            cache.obter(chave, consulta_com_erro)
+        except RuntimeError as exc:
+            erros.append(str(exc))
+
+    responsavel = threading.Thread(target=chamar)
+    responsavel.start()
+    while chave not in cache._em_andamento:
+        time.sleep(0.001)
+    espera = threading.Thread(target=chamar)
+    espera.start()
+    while cache.estado()["coalescidas"] < 1:
+        time.sleep(0.001)
+    liberar.set()
+    responsavel.join(5)
+    espera.join(5)
+
+    assert erros == ["banco fora", "banco fora"]
+    with pytest.raises(RuntimeError):
+        cache.obter(chave, consulta_com_erro)
+    assert cache.estado()["entradas"] == 0
@@ -0,0 +1,56 @@
+﻿import ipaddress
+
+from controle_acesso import ControleAcesso, ListaIPs
+
+
+def _controle(monkeypatch, **variaveis):
+    for chave in (
+        "FRONTEND_ALLOWED_IPS",
+        "FRONTEND_DENIED_IPS",
+        "API_ALLOWED_IPS",
+        "API_DENIED_IPS",
+        "CAMERA_ALLOWED_IPS",
+        "CAMERA_DENIED_IPS",
+        "PROXIES_CONFIAVEIS",
+    ):
+        monkeypatch.setenv(chave, variaveis.get(chave, ""))
+    controle = ControleAcesso(intervalo_recarga=3600)
+    controle.recarregar(forcar=True)
+    return controle
+
+
+def test_cabecalhos_de_proxy_ignorados_sem_proxy_confiavel(monkeypatch):
+    controle = _controle(monkeypatch)
+    assert controle.ip_cliente("203.0.113.7", "127.0.0.1", "10.0.0.1") == "203.0.113.7"
+    assert controle.ip_cliente("::ffff:203.0.113.7", "127.0.0.1") == "203.0.113.7"
+
+
+def test_cabecalhos_de_proxy_aceitos_do_proxy_confiavel(monkeypatch):
+    controle = _controle(monkeypatch, PROXIES_CONFIAVEIS="10.0.0.0/24")
+    assert controle.ip_cliente("10.0.0.5", "198.51.100.9") == "198.51.100.9"
+    assert controle.ip_cliente("10.0.0.5", "", "198.51.100.9") == "198.51.100.9"
+    # O cliente forjou o primeiro salto: vale o último que não é proxy.
+    assert controle.ip_cliente("10.0.0.5", "127.0.0.1, 198.51.100.9, 10.0.0.4") == "198.51.100.9"
+    # De fora da lista, os cabeçalhos não contam.
+    assert controle.ip_cliente("10.0.1.5", "127.0.0.1") == "10.0.1.5"
+
+
+def test_redes_sobrepostas_e_adjacentes_sao_fundidas():
+    lista = ListaIPs(["10.0.0.0/25", "10.0.0.128/25", "10.0.0.64/26", "192.168.1.10", "2001:db8::/64", "lixo"])
+    assert len(lista) == 5
+    assert lista._inicios[4] == [int(ipaddress.ip_address("10.0.0.0")), int(ipaddress.ip_address("192.168.1.10"))]
+    assert lista._fins[4] == [int(ipaddress.ip_address("10.0.0.255")), int(ipaddress.ip_address("192.168.1.10"))]
+    for ip in ("10.0.0.0", "10.0.0.127", "10.0.0.128", "10.0.0.255", "192.168.1.10", "::ffff:10.0.0.9", "2001:db8::1"):
+        assert lista.contem(ip), ip
+    for ip in ("9.255.255.255", "10.0.1.0", "192.168.1.9", "192.168.1.11", "2001:db8:0:1::1", "", "nao-e-ip"):
+        assert not lista.contem(ip), ip
+
+
+def test_negados_tem_prioridade_e_lista_vazia_libera(monkeypatch):
+    controle = _controle(monkeypatch, API_ALLOWED_IPS="10.0.0.0/8", API_DENIED_IPS="10.1.0.0/16")
+    assert controle.permitido_rota("/api/records", "10.2.3.4") == (True, "api")
+    assert controle.permitido_rota("/api/records", "10.1.3.4") == (False, "api")
+    assert controle.permitido_rota("/api/records", "172.16.0.1") == (False, "api")
+    assert controle.permitido_rota("/NotificationInfo/TollgateInfo", "172.16.0.1") == (True, "camera")
+    assert controle.permitido_rota("/health/live", "172.16.0.1") == (True, None)
+    assert controle.restrito("api") and not controle.restrito("camera")
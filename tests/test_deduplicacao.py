@@ -0,0 +1,49 @@
+﻿from deduplicacao import DetectorDuplicatas
+
+
+def test_leituras_a_distancia_um_caem_no_mesmo_agrupamento_da_camera():
+    detector = DetectorDuplicatas(janela_segundos=30, aproximada=True)
+    grupo = detector.registrar("cam-1", "ABC1234", 90, registro_id=1, agora=0)
+
+    assert detector.buscar("cam-1", "abc-1234", agora=1) is grupo
+    assert detector.buscar("cam-1", "A8C1234", agora=1) is grupo
+    assert detector.buscar("cam-1", "ABC1294", agora=2) is grupo
+    assert detector.buscar("cam-1", "ABC123", agora=2) is grupo
+    assert detector.buscar("cam-2", "ABC1234", agora=2) is None
+    assert detector.buscar("cam-1", "ABC1299", agora=2) is None
+
+
+def test_agrupamento_cresce_com_as_variantes_registradas():
+    detector = DetectorDuplicatas(janela_segundos=30, aproximada=True)
+    grupo = detector.registrar("cam-1", "ABC1234", 90, registro_id=1, agora=0)
+    detector.registrar("cam-1", "ABC1294", 70, agrupamento=grupo, agora=5)
+
+    # A duas edições da primeira leitura, mas a uma da variante.
+    assert detector.buscar("cam-1", "ABC1299", agora=6) is grupo
+    assert grupo.leituras == 2
+    assert grupo.chaves == {"A8C1234", "A8C1294"}
+
+
+def test_janela_expira_e_vence_o_agrupamento_mais_recente():
+    detector = DetectorDuplicatas(janela_segundos=30, aproximada=True)
+    antigo = detector.registrar("cam-1", "ABC1234", 90, registro_id=1, agora=0)
+    recente = detector.registrar("cam-1", "ABC1236", 90, registro_id=2, agora=10)
+
+    assert detector.buscar("cam-1", "ABC1235", agora=20) is recente
+    assert detector.buscar("cam-1", "ABC1234", agora=20) is antigo
+    # O antigo expirou; a leitura ainda está a uma edição do recente.
+    assert detector.buscar("cam-1", "ABC1234", agora=31) is recente
+    assert detector.estado()["agrupamentos_ativos"] == 1
+    assert detector.buscar("cam-1", "ABC1236", agora=41) is None
+    assert detector.estado()["agrupamentos_ativos"] == 0
+
+
+def test_sem_aproximacao_e_apos_descartar():
+    detector = DetectorDuplicatas(janela_segundos=30, aproximada=False)
+    grupo = detector.registrar("cam-1", "ABC1234", 90, registro_id=1, agora=0)
+    assert detector.buscar("cam-1", "A8C1234", agora=1) is grupo
+    assert detector.buscar("cam-1", "ABC1294", agora=1) is None
+
+    detector.descartar("cam-1", grupo)
+    assert detector.buscar("cam-1", "ABC1234", agora=1) is None
+    assert detector.estado()["agrupamentos_ativos"] == 0
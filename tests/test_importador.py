@@ -0,0 +1,149 @@
+﻿import json
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+import importador
+from armazenamento import ArmazenamentoLocal
+from models import EntradaLPR
+
+INICIO = datetime(2024, 3, 1, 8, 0, 0)
+
+
+def _evento(placa, segundos, camera="cam-1", confianca=90):
+    return {
+        "Picture": {
+            "Plate": {"PlateNumber": placa, "PlateColor": "White", "Confidence": confianca},
+            "Vehicle": {"VehicleColor": "Black"},
+            "SnapInfo": {
+                "AccurateTime": (INICIO + timedelta(seconds=segundos)).strftime("%Y-%m-%d %H:%M:%S"),
+                "DeviceID": camera,
+            },
+        }
+    }
+
+
+def _gravar_ndjson(caminho, eventos):
+    with open(caminho, "w", encoding="utf-8") as arquivo:
+        for evento in eventos:
+            arquivo.write((evento if isinstance(evento, str) else json.dumps(evento)) + "\n")
+    return str(caminho)
+
+
+def _eventos_variados():
+    # Placas distintas a cada 10 minutos, com releituras da mesma placa na
+    # janela (mesma câmera e outra câmera) e algumas linhas inválidas.
+    eventos = []
+    for indice in range(60):
+        placa = f"T{indice:02d}X{indice % 10}Y{indice % 7}"
+        segundos = indice * 600
+        eventos.append(_evento(placa, segundos, camera=f"cam-{indice % 3}", confianca=80))
+        if indice % 4 == 0:
+            eventos.append(_evento(placa, segundos + 5, camera=f"cam-{indice % 3}", confianca=95))
+        if indice % 5 == 0:
+            eventos.append(_evento(placa, segundos + 10, camera="cam-9"))
+        if indice % 9 == 0:
+            eventos.append("{nao e json")
+    return eventos
+
+
+def _importador(tmp_path, nome_estado="estado.json"):
+    return importador.Importador(
+        ArmazenamentoLocal(str(tmp_path / "static")),
+        str(tmp_path / nome_estado),
+        tamanho_lote=5,
+        processos=1,
+    )
+
+
+def _contar_registros():
+    sessao = database.nova_sessao()
+    try:
+        return sessao.query(EntradaLPR).count()
+    finally:
+        sessao.close()
+
+
+class _Interromper(Exception):
+    pass
+
+
+def test_duplicadas_na_janela_e_ja_gravadas_sao_descartadas(banco, tmp_path):
+    fonte = _gravar_ndjson(
+        tmp_path / "eventos.ndjson",
+        [
+            _evento("ABC1D23", 0, confianca=80),
+            _evento("ABC1D23", 3, confianca=95),
+            _evento("ABC1D23", 8, camera="cam-2"),
+            _evento("XYZ9K88", 60),
+            "{nao e json",
+        ],
+    )
+
+    resultado = _importador(tmp_path).importar([fonte])
+    assert resultado == {"lidos": 5, "importadas": 2, "duplicadas": 2, "invalidas": 1, "com_imagem": 0}
+
+    sessao = database.nova_sessao()
+    try:
+        confianca = sessao.query(EntradaLPR.confianca).filter(EntradaLPR.placa == "ABC1D23").scalar()
+    finally:
+        sessao.close()
+    # Fica a leitura de maior confiança do agrupamento.
+    assert confianca == 95
+
+    # Segunda importação do mesmo arquivo: tudo já está no banco.
+    novamente = _importador(tmp_path, "outro_estado.json").importar([fonte])
+    assert novamente["importadas"] == 0
+    assert novamente["duplicadas"] == 4
+    assert _contar_registros() == 2
+
+
+def test_insercao_em_conflito_conta_como_duplicada(banco, tmp_path, monkeypatch):
+    fonte = _gravar_ndjson(tmp_path / "eventos.ndjson", [_evento("ABC1D23", 0), _evento("XYZ9K88", 60)])
+    # Simula a ingestão ao vivo gravando a mesma leitura entre a consulta de
+    # existentes e o INSERT: só o ON CONFLICT DO NOTHING a barra.
+    monkeypatch.setattr(importador.Importador, "_existentes", lambda self, sessao, leituras: {})
+    sessao = database.nova_sessao()
+    sessao.add(EntradaLPR(placa="ABC1D23", timestamp=INICIO, dispositivo_id="cam-1"))
+    sessao.commit()
+    sessao.close()
+
+    resultado = _importador(tmp_path).importar([fonte])
+    assert resultado["importadas"] == 1
+    assert resultado["duplicadas"] == 1
+    assert _contar_registros() == 2
+
+
+def test_retomada_nao_conta_leituras_relidas(banco, tmp_path, monkeypatch):
+    monkeypatch.setattr(importador, "TAMANHO_TAREFA", 8)
+    eventos = _eventos_variados()
+    fonte = _gravar_ndjson(tmp_path / "eventos.ndjson", eventos)
+
+    chamadas = []
+
+    def interromper(_):
+        chamadas.append(1)
+        if len(chamadas) == 6:
+            raise _Interromper()
+
+    with pytest.raises(_Interromper):
+        _importador(tmp_path).importar([fonte], ao_progredir=interromper)
+    with open(tmp_path / "estado.json", encoding="utf-8") as arquivo:
+        estado = json.load(arquivo)
+    # A interrupção caiu no meio: há leituras relidas na retomada.
+    assert estado["posicao"] < estado["lido_ate"]
+
+    retomado = _importador(tmp_path).importar([fonte])
+    gravadas = _contar_registros()
+
+    # Mesmo arquivo importado sem interrupção em outro banco.
+    monkeypatch.setattr(database, "_SQLITE_FILE", str(tmp_path / "storage" / "limpo.db"))
+    database.inicializar_banco()
+    database.criar_tabelas()
+    limpo = _importador(tmp_path, "estado_limpo.json").importar([fonte])
+
+    assert retomado == limpo
+    assert retomado["lidos"] == len(eventos)
+    assert retomado["importadas"] == gravadas == _contar_registros()
+    assert retomado["lidos"] == retomado["importadas"] + retomado["duplicadas"] + retomado["invalidas"]
@@ -0,0 +1,66 @@
+﻿from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import text
+
+import database
+import estatisticas
+import migracoes
+import visitas
+from models import CapturaLPR, EntradaLPR, ResumoPlaca, RollupLPR
+
+INICIO = datetime(2024, 3, 1, 8, 0, 0)
+
+
+@pytest.fixture
+def banco_sem_indice(banco, monkeypatch, tmp_path):
+    # Banco anterior ao índice único, com o mesmo evento gravado três vezes.
+    monkeypatch.setenv("ARQUIVO_DIRETORIO", str(tmp_path / "arquivo"))
+    with database.engine.begin() as connection:
+        connection.execute(text("DROP INDEX uq_lpr_webhook_placa_timestamp"))
+    sessao = database.nova_sessao()
+    try:
+        sessao.add(CapturaLPR(hash="h" * 64, caminho="captures/hh/h.jpg", tamanho=10, referencias=3))
+        for minutos in (0, 0, 0, 10):
+            registro = EntradaLPR(
+                placa="ABC1D23",
+                timestamp=INICIO + timedelta(minutes=minutos),
+                dispositivo_id="cam-1",
+                hash_imagem="h" * 64 if minutos == 0 else None,
+            )
+            sessao.add(registro)
+            sessao.flush()
+            estatisticas.incrementar(sessao, registro)
+            visitas.registrar(sessao, registro)
+        sessao.commit()
+    finally:
+        sessao.close()
+
+
+def test_inicializacao_para_sem_apagar_leituras(banco_sem_indice):
+    with pytest.raises(database.LeiturasDuplicadas, match="migracoes.py remover-duplicadas"):
+        database.criar_tabelas()
+
+    sessao = database.nova_sessao()
+    try:
+        assert sessao.query(EntradaLPR).count() == 4
+    finally:
+        sessao.close()
+
+
+def test_migracao_remove_copias_e_recalcula_totais(banco_sem_indice):
+    resultado = migracoes.remover_duplicadas()
+    assert [(modo, removidas) for modo, removidas, _, _ in resultado] == [("sqlite", 2)]
+
+    sessao = database.nova_sessao()
+    try:
+        assert sessao.query(EntradaLPR).count() == 2
+        assert sessao.get(CapturaLPR, "h" * 64).referencias == 1
+        total = sessao.query(RollupLPR.total).filter(RollupLPR.dimensao == "total").all()
+        assert sorted(total) == [(2,)]
+        assert sessao.get(ResumoPlaca, "ABC1D23").passagens == 2
+    finally:
+        sessao.close()
+
+    # Com o índice criado, a inicialização volta a funcionar.
+    database.criar_tabelas()
@@ -0,0 +1,66 @@
+﻿import base64
+import io
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+import capturas
+import database
+from armazenamento import ArmazenamentoLocal
+from models import CapturaLPR
+from recompressao import NIVEL_PADRAO, Recompressor
+from whatsapp_notifier import NotificadorWhatsApp
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def _jpeg_base64():
+    # Ruído comprime mal em JPEG de qualidade alta: o WebP sai menor.
+    imagem = Image.frombytes("RGB", (256, 256), os.urandom(256 * 256 * 3))
+    saida = io.BytesIO()
+    imagem.save(saida, "JPEG", quality=95)
+    return base64.b64encode(saida.getvalue()).decode()
+
+
+def _caminho_atual(caminho):
+    sessao = database.nova_sessao()
+    try:
+        return capturas.caminho_atual(sessao, caminho)
+    finally:
+        sessao.close()
+
+
+def test_hash_do_caminho_ignora_nivel_e_extensao():
+    assert capturas.hash_do_caminho("captures/ab/abcdef.jpg") == "abcdef"
+    assert capturas.hash_do_caminho("captures/ab/abcdef-n2.webp") == "abcdef"
+
+
+def test_mensagem_na_fila_encontra_a_captura_recomprimida(banco, monkeypatch, tmp_path):
+    monkeypatch.setenv("RECOMPRESSAO_IMAGENS", "1")
+    monkeypatch.setenv("IMAGEM_FORMATO", "webp")
+    monkeypatch.setenv("API_WHATSAPP_PORT", "9")
+    armazenamento = ArmazenamentoLocal(str(tmp_path / "static"))
+
+    sessao = database.nova_sessao()
+    try:
+        armazenada = capturas.armazenar(sessao, _jpeg_base64(), armazenamento)
+        sessao.query(CapturaLPR).update({CapturaLPR.ultimo_uso: datetime.utcnow() - timedelta(minutes=5)})
+        sessao.commit()
+    finally:
+        sessao.close()
+    # Caminho guardado pela mensagem no momento da leitura.
+    na_fila = armazenada.caminho
+
+    recompressor = Recompressor(database.nova_sessao, armazenamento)
+    assert recompressor.processar(armazenada.hash, na_fila, NIVEL_PADRAO)
+    assert not armazenamento.existe(na_fila)
+
+    sem_resolver = NotificadorWhatsApp(armazenamento=armazenamento)
+    assert sem_resolver._carregar_imagem(na_fila) is None
+
+    notificador = NotificadorWhatsApp(armazenamento=armazenamento, resolver_imagem=_caminho_atual)
+    nome, conteudo, tipo = notificador._carregar_imagem(na_fila)
+    assert nome == f"{armazenada.hash}-n{NIVEL_PADRAO}.webp"
+    assert tipo == "image/webp"
+    assert conteudo
@@ -0,0 +1,81 @@
+﻿from datetime import datetime, timedelta
+
+import pytest
+
+import database
+from models import EntradaLPR
+from sugestoes_placas import IndicePlacas
+
+INICIO = datetime(2024, 3, 1, 8, 0, 0)
+
+
+@pytest.fixture
+def indice(banco):
+    sessao = database.nova_sessao()
+    try:
+        for minutos, placa in enumerate(["ABC1234", "ABC-1234", "abc1234", "ABD5678", "ABD5678", "XBC9999"]):
+            sessao.add(EntradaLPR(placa=placa, timestamp=INICIO + timedelta(minutes=minutos), dispositivo_id="cam-1"))
+        sessao.commit()
+    finally:
+        sessao.close()
+    indice = IndicePlacas(database.nova_sessao)
+    assert indice.reconstruir() == 3
+    return indice
+
+
+def _placas(sugestoes):
+    return [(item["placa"], item["visitas"]) for item in sugestoes]
+
+
+def _corrigir_no_banco(registro_id, placa):
+    sessao = database.nova_sessao()
+    try:
+        registro = sessao.get(EntradaLPR, registro_id)
+        anterior = registro.placa
+        registro.placa = placa
+        sessao.commit()
+        return anterior, registro.timestamp
+    finally:
+        sessao.close()
+
+
+def test_prefixo_e_trigrama(indice):
+    assert _placas(indice.sugerir("ab")) == [("ABC1234", 3), ("ABD5678", 2)]
+    assert _placas(indice.sugerir("A")) == [("ABC1234", 3), ("ABD5678", 2)]
+    # Começa com o termo antes de só conter.
+    assert _placas(indice.sugerir("BC9")) == [("XBC9999", 1)]
+    assert _placas(indice.sugerir("ABC")) == [("ABC1234", 3)]
+    assert _placas(indice.sugerir("C12")) == [("ABC1234", 3)]
+    assert indice.sugerir("ZZZ") == []
+
+
+def test_correcao_move_visitas_entre_prefixos(indice):
+    for registro_id in (1, 2):
+        anterior, timestamp = _corrigir_no_banco(registro_id, "XBC1234")
+        indice.corrigir(anterior, "XBC1234", timestamp, registro_id)
+
+    assert _placas(indice.sugerir("AB")) == [("ABD5678", 2), ("ABC1234", 1)]
+    assert _placas(indice.sugerir("XB")) == [("XBC1234", 2), ("XBC9999", 1)]
+    assert _placas(indice.sugerir("BC1")) == [("XBC1234", 2), ("ABC1234", 1)]
+
+    # A varredura enxerga as mesmas correções no banco e não conta de novo.
+    assert indice.atualizar() == 0
+    indice.corrigir("ABC1234", "XBC1234", INICIO, 2)
+    assert _placas(indice.sugerir("XB")) == [("XBC1234", 2), ("XBC9999", 1)]
+
+
+def test_correcao_da_ultima_leitura_tira_a_placa_do_indice(indice):
+    for registro_id in (1, 2, 3):
+        anterior, timestamp = _corrigir_no_banco(registro_id, "ABD5678")
+        indice.corrigir(anterior, "ABD5678", timestamp, registro_id)
+
+    assert _placas(indice.sugerir("AB")) == [("ABD5678", 5)]
+    assert indice.sugerir("C12") == []
+    assert indice.estado()["placas"] == 2
+
+
+def test_correcao_feita_por_outro_worker_chega_pela_varredura(indice):
+    _corrigir_no_banco(6, "ABC1234")
+    assert indice.atualizar() == 1
+    assert _placas(indice.sugerir("AB")) == [("ABC1234", 4), ("ABD5678", 2)]
+    assert indice.sugerir("XB") == []
@@ -0,0 +1,63 @@
+﻿from datetime import datetime, timedelta
+
+import database
+import visitas
+from models import EntradaLPR, ResumoPlaca
+
+INICIO = datetime(2024, 3, 1, 8, 0, 0)
+
+
+def _gravar(sessao, placa, minutos):
+    registro = EntradaLPR(placa=placa, timestamp=INICIO + timedelta(minutes=minutos), dispositivo_id="cam-1")
+    sessao.add(registro)
+    sessao.flush()
+    visitas.registrar(sessao, registro)
+    return registro
+
+
+def _corrigir(sessao, registro, nova):
+    antiga = registro.placa
+    visitas.desfazer(sessao, registro, antiga)
+    registro.placa = nova
+    visitas.registrar(sessao, registro)
+    sessao.commit()
+
+
+def test_correcao_recalcula_limites_pela_placa_normalizada(banco):
+    sessao = database.nova_sessao()
+    try:
+        primeira = _gravar(sessao, "ABC1234", 0)
+        _gravar(sessao, "ABC-1234", 10)
+        _gravar(sessao, "abc 1234", 20)
+        ultima = _gravar(sessao, "ABC1234", 30)
+        sessao.commit()
+
+        resumo = sessao.get(ResumoPlaca, "ABC1234")
+        assert resumo.passagens == 4
+
+        # A última passagem era de outra placa: vale a grafia "abc 1234".
+        _corrigir(sessao, ultima, "XYZ9K88")
+        assert resumo.ultima_vez == INICIO + timedelta(minutes=20)
+        assert resumo.primeira_vez == INICIO
+
+        # A primeira também: vale a grafia "ABC-1234".
+        _corrigir(sessao, primeira, "XYZ9K88")
+        assert resumo.primeira_vez == INICIO + timedelta(minutes=10)
+        assert resumo.passagens == 2
+
+        outra = sessao.get(ResumoPlaca, "XYZ9K88")
+        assert (outra.primeira_vez, outra.ultima_vez, outra.passagens) == (INICIO, INICIO + timedelta(minutes=30), 2)
+    finally:
+        sessao.close()
+
+
+def test_correcao_da_unica_passagem_remove_o_resumo(banco):
+    sessao = database.nova_sessao()
+    try:
+        registro = _gravar(sessao, "QWE7R12", 0)
+        sessao.commit()
+        _corrigir(sessao, registro, "QWE7R13")
+        assert sessao.get(ResumoPlaca, "QWE7R12") is None
+        assert sessao.get(ResumoPlaca, "QWE7R13").passagens == 1
+    finally:
+        sessao.close()
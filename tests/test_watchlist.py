@@ -0,0 +1,52 @@
+﻿from watchlist import TIPO_APROXIMADA, TIPO_CONFUSAO, TIPO_EXATA, EntradaWatchlist, IndiceWatchlist
+
+
+def _indice():
+    return IndiceWatchlist(
+        [
+            EntradaWatchlist("ABC-1234", "furto", prioridade=1),
+            EntradaWatchlist("XYZ9K88", "suspeito", prioridade=2),
+            EntradaWatchlist("AB", "curta demais"),
+        ]
+    )
+
+
+def _verificar(indice, placa, aproximada=True):
+    correspondencia = indice.verificar(placa, aproximada)
+    if correspondencia is None:
+        return None
+    return correspondencia.entrada.placa, correspondencia.tipo
+
+
+def test_exata_e_confusao_de_ocr():
+    indice = _indice()
+    assert len(indice) == 2
+    assert _verificar(indice, "abc 1234") == ("ABC-1234", TIPO_EXATA)
+    # B/8 e 1/I pertencem ao mesmo grupo de confusão.
+    assert _verificar(indice, "A8CI234") == ("ABC-1234", TIPO_CONFUSAO)
+
+
+def test_distancia_um_por_troca_remocao_e_insercao():
+    indice = _indice()
+    assert _verificar(indice, "ABC1294") == ("ABC-1234", TIPO_APROXIMADA)
+    assert _verificar(indice, "ABC123") == ("ABC-1234", TIPO_APROXIMADA)
+    assert _verificar(indice, "BC1234") == ("ABC-1234", TIPO_APROXIMADA)
+    assert _verificar(indice, "ABC12345") == ("ABC-1234", TIPO_APROXIMADA)
+    assert _verificar(indice, "XYZ9K8") == ("XYZ9K88", TIPO_APROXIMADA)
+
+
+def test_distancia_dois_nao_casa():
+    indice = _indice()
+    assert _verificar(indice, "ABC1299") is None
+    assert _verificar(indice, "ABC1243") is None
+    assert _verificar(indice, "ABC12") is None
+    assert _verificar(indice, "AB") is None
+    assert _verificar(indice, "ABC1294", aproximada=False) is None
+
+
+def test_varias_candidatas_vence_a_maior_prioridade():
+    indice = IndiceWatchlist(
+        [EntradaWatchlist("ABC1234", prioridade=1), EntradaWatchlist("ABC1235", prioridade=5)]
+    )
+    assert _verificar(indice, "ABC1236") == ("ABC1235", TIPO_APROXIMADA)
+    assert _verificar(indice, "ABC1234") == ("ABC1234", TIPO_EXATA)
@@ -0,0 +1,37 @@
+﻿try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+
+class LockExclusivo:
+    # Lock bloqueante entre processos (append nos segmentos, escrita do
+    # arquivo frio).
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self._arquivo = None
+
+    def __enter__(self):
+        self._arquivo = open(self.caminho, "a+b")
+        if fcntl is not None:
+            fcntl.flock(self._arquivo.fileno(), fcntl.LOCK_EX)
+        elif msvcrt is not None:
+            self._arquivo.seek(0)
+            msvcrt.locking(self._arquivo.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *_):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._arquivo.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                self._arquivo.seek(0)
+                msvcrt.locking(self._arquivo.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._arquivo.close()
+            self._arquivo = None
@@ -0,0 +1,294 @@
+﻿import argparse
+import logging
+import os
+from functools import lru_cache
+
+from sqlalchemy import func
+
+import database
+from models import EntradaLPR, ResumoPlaca, VisitaLPR
+from placas import normalizar_placa
+
+logger = logging.getLogger("VISITAS")
+
+ENTRADA = "entrada"
+SAIDA = "saida"
+# Valores de SnapInfo.Direction reconhecidos (sem diferenciar maiúsculas).
+DIRECOES_ENTRADA_PADRAO = "obverse,approach,in,entry,entrada"
+DIRECOES_SAIDA_PADRAO = "reverse,leave,away,out,exit,saida,saída"
+LIMITE_VISITAS_MAXIMO = 100
+TAMANHO_LOTE_RECONSTRUCAO = 5000
+
+
+def _ler_lista(chave, padrao="", minusculas=False):
+    valores = (valor.strip() for valor in os.getenv(chave, padrao).split(","))
+    return {valor.lower() if minusculas else valor for valor in valores if valor}
+
+
+@lru_cache(maxsize=1)
+def _regras():
+    # Lido na primeira leitura, depois do .env carregado.
+    return (
+        _ler_lista("VISITAS_CAMERAS_ENTRADA"),
+        _ler_lista("VISITAS_CAMERAS_SAIDA"),
+        _ler_lista("VISITAS_DIRECOES_ENTRADA", DIRECOES_ENTRADA_PADRAO, minusculas=True),
+        _ler_lista("VISITAS_DIRECOES_SAIDA", DIRECOES_SAIDA_PADRAO, minusculas=True),
+    )
+
+
+def classificar(dispositivo_id, direcao):
+    # Câmera dedicada (portão de entrada/saída) vale mais que a direção.
+    cameras_entrada, cameras_saida, direcoes_entrada, direcoes_saida = _regras()
+    if dispositivo_id in cameras_saida:
+        return SAIDA
+    if dispositivo_id in cameras_entrada:
+        return ENTRADA
+    direcao = (direcao or "").strip().lower()
+    if direcao in direcoes_saida:
+        return SAIDA
+    if direcao in direcoes_entrada:
+        return ENTRADA
+    return None
+
+
+def _aplicar(resumo, aberta, registro, sentido):
+    # Devolve (visita nova ou None, visita aberta depois da leitura).
+    momento = registro.timestamp
+    resumo.passagens += 1
+    resumo.primeira_vez = min(resumo.primeira_vez, momento)
+    resumo.ultima_vez = max(resumo.ultima_vez, momento)
+
+    if sentido == SAIDA and aberta is not None and aberta.entrada <= momento:
+        aberta.saida = momento
+        aberta.dispositivo_saida = registro.dispositivo_id
+        aberta.registro_saida_id = registro.id
+        resumo.visitas_fechadas += 1
+        resumo.permanencia_total_segundos += int((momento - aberta.entrada).total_seconds())
+        return None, None
+
+    resumo.visitas += 1
+    visita = VisitaLPR(placa=resumo.placa)
+    if sentido == SAIDA:
+        # Saída sem entrada registrada: a visita conta, sem permanência.
+        visita.saida = momento
+        visita.dispositivo_saida = registro.dispositivo_id
+        visita.registro_saida_id = registro.id
+        return visita, aberta
+
+    visita.entrada = momento
+    visita.dispositivo_entrada = registro.dispositivo_id
+    visita.registro_entrada_id = registro.id
+    # Sem direção conhecida a passagem é uma visita sem par de saída.
+    return visita, visita if sentido == ENTRADA else aberta
+
+
+def _novo_resumo(placa, momento):
+    return ResumoPlaca(
+        placa=placa,
+        primeira_vez=momento,
+        ultima_vez=momento,
+        passagens=0,
+        visitas=0,
+        visitas_fechadas=0,
+        permanencia_total_segundos=0,
+    )
+
+
+def bloquear_placas(sessao, *placas):
+    # Resumo e visitas são lidos e regravados por placa normalizada: o lock
+    # usa a mesma chave ("ABC-1234" e "ABC1234" esperam uma pela outra).
+    # Sempre em ordem, para duas correções cruzadas não se travarem.
+    for placa in sorted({normalizar_placa(placa) for placa in placas} - {""}):
+        database.bloquear_chave_transacao(sessao, f"placa:{placa}")
+
+
+def registrar(sessao, registro):
+    # Executado na mesma transação do INSERT em lpr_webhook, depois de
+    # bloquear_placas.
+    placa = normalizar_placa(registro.placa)
+    if not placa:
+        return
+    resumo = sessao.get(ResumoPlaca, placa)
+    if resumo is None:
+        resumo = _novo_resumo(placa, registro.timestamp)
+        sessao.add(resumo)
+    aberta = sessao.get(VisitaLPR, resumo.visita_aberta_id) if resumo.visita_aberta_id else None
+
+    visita, aberta = _aplicar(resumo, aberta, registro, classificar(registro.dispositivo_id, registro.direcao))
+    if visita is not None:
+        sessao.add(visita)
+        sessao.flush()
+    resumo.visita_aberta_id = aberta.id if aberta is not None else None
+
+
+def desfazer(sessao, registro, placa):
+    # Leitura corrigida para outra placa: retira dela o que `registrar`
+    # aplicou em `placa`.
+    placa = normalizar_placa(placa)
+    resumo = sessao.get(ResumoPlaca, placa)
+    if resumo is None:
+        return
+
+    for visita in sessao.query(VisitaLPR).filter(VisitaLPR.registro_saida_id == registro.id).all():
+        if visita.entrada is None:
+            sessao.delete(visita)
+            resumo.visitas -= 1
+            continue
+        resumo.visitas_fechadas -= 1
+        resumo.permanencia_total_segundos -= int((visita.saida - visita.entrada).total_seconds())
+        visita.saida = visita.dispositivo_saida = visita.registro_saida_id = None
+        resumo.visita_aberta_id = visita.id
+
+    for visita in sessao.query(VisitaLPR).filter(VisitaLPR.registro_entrada_id == registro.id).all():
+        if visita.saida is None:
+            sessao.delete(visita)
+            resumo.visitas -= 1
+            if resumo.visita_aberta_id == visita.id:
+                resumo.visita_aberta_id = None
+            continue
+        resumo.visitas_fechadas -= 1
+        resumo.permanencia_total_segundos -= int((visita.saida - visita.entrada).total_seconds())
+        visita.entrada = visita.dispositivo_entrada = visita.registro_entrada_id = None
+
+    resumo.passagens -= 1
+    if resumo.passagens <= 0:
+        sessao.delete(resumo)
+        return
+    # Só recalcula o limite que a leitura corrigida definia; os demais podem
+    # vir de leituras já arquivadas.
+    if registro.timestamp <= resumo.primeira_vez or registro.timestamp >= resumo.ultima_vez:
+        primeira, ultima = _limites(sessao, placa, registro.id)
+        if primeira is not None:
+            if registro.timestamp <= resumo.primeira_vez:
+                resumo.primeira_vez = primeira
+            if registro.timestamp >= resumo.ultima_vez:
+                resumo.ultima_vez = ultima
+
+
+def _limites(sessao, placa, ignorar_id):
+    # Primeira e última leitura da placa normalizada, qualquer que seja a
+    # grafia gravada ("ABC-1234", "ABC 1234", "abc1234").
+    linhas = (
+        sessao.query(EntradaLPR.placa, func.min(EntradaLPR.timestamp), func.max(EntradaLPR.timestamp))
+        .filter(func.upper(EntradaLPR.placa).like("%".join(placa)), EntradaLPR.id != ignorar_id)
+        .group_by(EntradaLPR.placa)
+        .all()
+    )
+    limites = [(primeira, ultima) for bruta, primeira, ultima in linhas if normalizar_placa(bruta) == placa]
+    if not limites:
+        return None, None
+    return min(primeira for primeira, _ in limites), max(ultima for _, ultima in limites)
+
+
+def _visita_dict(visita):
+    duracao = None
+    if visita.entrada is not None and visita.saida is not None:
+        duracao = int((visita.saida - visita.entrada).total_seconds())
+    return {
+        "entrada": visita.entrada.isoformat() if visita.entrada else None,
+        "saida": visita.saida.isoformat() if visita.saida else None,
+        "dispositivo_entrada": visita.dispositivo_entrada,
+        "dispositivo_saida": visita.dispositivo_saida,
+        "permanencia_segundos": duracao,
+    }
+
+
+def consultar(sessao, placa, limite=10):
+    placa = normalizar_placa(placa)
+    resumo = sessao.get(ResumoPlaca, placa) if placa else None
+    if resumo is None:
+        return None
+
+    aberta = sessao.get(VisitaLPR, resumo.visita_aberta_id) if resumo.visita_aberta_id else None
+    limite = max(0, min(LIMITE_VISITAS_MAXIMO, limite))
+    ultimas = []
+    if limite:
+        ultimas = (
+            sessao.query(VisitaLPR).filter(VisitaLPR.placa == placa).order_by(VisitaLPR.id.desc()).limit(limite).all()
+        )
+    return {
+        "placa": resumo.placa,
+        "primeira_vez": resumo.primeira_vez.isoformat(),
+        "ultima_vez": resumo.ultima_vez.isoformat(),
+        "passagens": resumo.passagens,
+        "visitas": resumo.visitas,
+        "visitas_com_saida": resumo.visitas_fechadas,
+        "permanencia_total_segundos": resumo.permanencia_total_segundos,
+        "permanencia_media_segundos": (
+            round(resumo.permanencia_total_segundos / resumo.visitas_fechadas) if resumo.visitas_fechadas else None
+        ),
+        "entrada_aberta": _visita_dict(aberta) if aberta is not None else None,
+        "ultimas_visitas": [_visita_dict(visita) for visita in ultimas],
+    }
+
+
+def reconstruir(sessao):
+    # Refaz resumos e visitas a partir de lpr_webhook, em ordem de horário
+    # (dados anteriores à coluna direcao, importações em lote).
+    removidas = sessao.query(VisitaLPR).delete(synchronize_session=False)
+    sessao.query(ResumoPlaca).delete(synchronize_session=False)
+
+    estados = {}
+    pendentes = []
+    lidos = 0
+    consulta = sessao.query(
+        EntradaLPR.id, EntradaLPR.placa, EntradaLPR.timestamp, EntradaLPR.dispositivo_id, EntradaLPR.direcao
+    ).order_by(EntradaLPR.timestamp, EntradaLPR.id)
+    for registro in consulta.execution_options(yield_per=TAMANHO_LOTE_RECONSTRUCAO):
+        lidos += 1
+        placa = normalizar_placa(registro.placa)
+        if not placa:
+            continue
+        resumo, aberta = estados.get(placa) or (_novo_resumo(placa, registro.timestamp), None)
+        visita, aberta = _aplicar(resumo, aberta, registro, classificar(registro.dispositivo_id, registro.direcao))
+        estados[placa] = (resumo, aberta)
+        if visita is not None:
+            pendentes.append(visita)
+        if len(pendentes) >= TAMANHO_LOTE_RECONSTRUCAO:
+            _gravar_visitas(sessao, pendentes, estados)
+            pendentes = []
+
+    _gravar_visitas(sessao, pendentes, estados)
+    for resumo, aberta in estados.values():
+        resumo.visita_aberta_id = aberta.id if aberta is not None else None
+    sessao.add_all(resumo for resumo, _ in estados.values())
+    sessao.commit()
+    return lidos, removidas, len(estados)
+
+
+def _gravar_visitas(sessao, visitas, estados):
+    sessao.add_all(visitas)
+    sessao.flush()
+    # Só as visitas ainda abertas podem mudar; as demais saem da sessão.
+    abertas = {id(aberta) for _, aberta in estados.values() if aberta is not None}
+    for visita in visitas:
+        if id(visita) not in abertas:
+            sessao.expunge(visita)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Histórico de visitas por placa (lpr_placas, lpr_visitas)")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+    subparsers.add_parser("reconstruir", help="recalcula resumos e visitas a partir de lpr_webhook")
+
+    argumentos = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(name)s | %(message)s")
+
+    try:
+        from dotenv import load_dotenv
+
+        load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
+    except ImportError:
+        pass
+
+    database.inicializar_banco()
+    database.criar_tabelas()
+    sessao = database.nova_sessao()
+    try:
+        lidos, removidas, placas = reconstruir(sessao)
+        print(
+            f"Banco: {database.modo_banco_ativo()} | registros lidos: {lidos} | "
+            f"visitas removidas: {removidas} | placas: {placas}"
+        )
+    finally:
+        sessao.close()
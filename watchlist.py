@@ -0,0 +1,260 @@
+﻿import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import func
+
+from models import WatchlistPlaca
+from placas import canonizar_placa, delecoes, distancia_ate_um, normalizar_placa
+
+logger = logging.getLogger("WATCHLIST")
+
+TIPO_EXATA = "exata"
+TIPO_CONFUSAO = "confusao"
+TIPO_APROXIMADA = "aproximada"
+
+TAMANHO_MINIMO_PLACA = 3
+LIMITE_IMPORTACAO = 100000
+
+
+class EntradaWatchlist:
+    __slots__ = ("placa", "categoria", "descricao", "prioridade")
+
+    def __init__(self, placa, categoria=None, descricao=None, prioridade=1):
+        self.placa = placa
+        self.categoria = categoria
+        self.descricao = descricao
+        self.prioridade = prioridade
+
+    def para_dict(self):
+        return {
+            "placa": self.placa,
+            "categoria": self.categoria,
+            "descricao": self.descricao,
+            "prioridade": self.prioridade,
+        }
+
+
+class Correspondencia:
+    __slots__ = ("entrada", "tipo", "placa_lida")
+
+    def __init__(self, entrada, tipo, placa_lida):
+        self.entrada = entrada
+        self.tipo = tipo
+        self.placa_lida = placa_lida
+
+    def para_dict(self):
+        return {"placa_lida": self.placa_lida, "tipo": self.tipo, **self.entrada.para_dict()}
+
+
+class IndiceWatchlist:
+    # Índice imutável: chave canônica (confusões de OCR reduzidas) -> entradas,
+    # mais as vizinhanças de deleção de cada chave para distância de edição 1.
+    def __init__(self, entradas=()):
+        self._exatas = {}
+        self._canonicas = {}
+        self._delecoes = {}
+        total = 0
+
+        for entrada in entradas:
+            placa = normalizar_placa(entrada.placa)
+            if len(placa) < TAMANHO_MINIMO_PLACA:
+                continue
+            total += 1
+            self._exatas[placa] = entrada
+            chave = canonizar_placa(placa)
+            self._canonicas.setdefault(chave, []).append(entrada)
+            for variante in delecoes(chave):
+                self._delecoes.setdefault(variante, set()).add(chave)
+
+        self.total = total
+
+    def __len__(self):
+        return self.total
+
+    def _melhor(self, candidatas):
+        return max(candidatas, key=lambda entrada: entrada.prioridade or 0)
+
+    def verificar(self, placa, aproximada=True):
+        placa = normalizar_placa(placa)
+        if not self.total or len(placa) < TAMANHO_MINIMO_PLACA:
+            return None
+
+        entrada = self._exatas.get(placa)
+        if entrada is not None:
+            return Correspondencia(entrada, TIPO_EXATA, placa)
+
+        chave = canonizar_placa(placa)
+        candidatas = self._canonicas.get(chave)
+        if candidatas:
+            return Correspondencia(self._melhor(candidatas), TIPO_CONFUSAO, placa)
+
+        if not aproximada:
+            return None
+
+        chaves = set(self._delecoes.get(chave, ()))
+        for variante in delecoes(chave):
+            if variante in self._canonicas:
+                chaves.add(variante)
+            chaves.update(self._delecoes.get(variante, ()))
+
+        encontradas = [
+            entrada
+            for candidata in chaves
+            if distancia_ate_um(chave, candidata)
+            for entrada in self._canonicas[candidata]
+        ]
+        if encontradas:
+            return Correspondencia(self._melhor(encontradas), TIPO_APROXIMADA, placa)
+        return None
+
+
+def _ler_env_inteiro(chave, padrao, minimo=0):
+    try:
+        return max(minimo, int(os.getenv(chave, str(padrao)).strip()))
+    except ValueError:
+        return padrao
+
+
+class GerenciadorWatchlist:
+    def __init__(self, obter_sessao, intervalo_recarga=None):
+        self.obter_sessao = obter_sessao
+        self.intervalo_recarga = (
+            intervalo_recarga
+            if intervalo_recarga is not None
+            else _ler_env_inteiro("WATCHLIST_RECARGA_SEGUNDOS", 30, minimo=1)
+        )
+        self.aproximada = os.getenv("WATCHLIST_DISTANCIA_EDICAO", "1").strip() != "0"
+        self.indice = IndiceWatchlist()
+        self.carregado_em = None
+        self._assinatura = None
+        self._lock = threading.Lock()
+
+    def verificar(self, placa):
+        return self.indice.verificar(placa, aproximada=self.aproximada)
+
+    def _assinatura_banco(self, sessao):
+        total, ultima = sessao.query(func.count(WatchlistPlaca.id), func.max(WatchlistPlaca.atualizado_em)).one()
+        return total, ultima
+
+    def recarregar(self, forcar=False):
+        with self._lock:
+            sessao = self.obter_sessao()
+            try:
+                assinatura = self._assinatura_banco(sessao)
+                if not forcar and assinatura == self._assinatura:
+                    return False
+
+                linhas = (
+                    sessao.query(
+                        WatchlistPlaca.placa,
+                        WatchlistPlaca.categoria,
+                        WatchlistPlaca.descricao,
+                        WatchlistPlaca.prioridade,
+                    )
+                    .filter(WatchlistPlaca.ativo.is_(True))
+                    .all()
+                )
+            finally:
+                sessao.close()
+
+            inicio = time.perf_counter()
+            indice = IndiceWatchlist(
+                EntradaWatchlist(placa, categoria, descricao, prioridade)
+                for placa, categoria, descricao, prioridade in linhas
+            )
+            self.indice = indice
+            self._assinatura = assinatura
+            self.carregado_em = datetime.now()
+
+        logger.info(
+            f"Watchlist carregada: {len(indice)} placa(s) em {(time.perf_counter() - inicio) * 1000:.0f} ms"
+        )
+        return True
+
+    def iniciar_thread_recarga(self):
+        def worker():
+            while True:
+                time.sleep(self.intervalo_recarga)
+                try:
+                    self.recarregar()
+                except Exception as exc:
+                    logger.warning(f"Falha ao recarregar watchlist: {exc}")
+
+        thread = threading.Thread(target=worker, daemon=True, name="watchlist-recarga")
+        thread.start()
+        return thread
+
+    def listar(self, sessao):
+        linhas = sessao.query(WatchlistPlaca).order_by(WatchlistPlaca.placa.asc()).all()
+        return [
+            {
+                "placa": linha.placa,
+                "categoria": linha.categoria,
+                "descricao": linha.descricao,
+                "prioridade": linha.prioridade,
+                "ativo": bool(linha.ativo),
+                "atualizado_em": linha.atualizado_em.isoformat() if linha.atualizado_em else None,
+            }
+            for linha in linhas
+        ]
+
+    def salvar(self, sessao, itens):
+        if len(itens) > LIMITE_IMPORTACAO:
+            raise ValueError(f"Máximo de {LIMITE_IMPORTACAO} placas por requisição")
+
+        normalizados = {}
+        for item in itens:
+            if not isinstance(item, dict):
+                raise ValueError("Cada item deve ser um objeto com o campo 'placa'")
+            placa = normalizar_placa(item.get("placa"))
+            if len(placa) < TAMANHO_MINIMO_PLACA:
+                raise ValueError(f"Placa inválida: {item.get('placa')}")
+            try:
+                prioridade = int(item.get("prioridade", 1))
+            except (TypeError, ValueError) as exc:
+                raise ValueError(f"Prioridade inválida para {placa}") from exc
+            normalizados[placa] = {
+                "categoria": (item.get("categoria") or "").strip() or None,
+                "descricao": (item.get("descricao") or "").strip() or None,
+                "prioridade": prioridade,
+            }
+
+        existentes = {}
+        placas = list(normalizados)
+        for indice in range(0, len(placas), 500):
+            lote = placas[indice : indice + 500]
+            for linha in sessao.query(WatchlistPlaca).filter(WatchlistPlaca.placa.in_(lote)):
+                existentes[linha.placa] = linha
+
+        agora = datetime.utcnow()
+        for placa, campos in normalizados.items():
+            linha = existentes.get(placa)
+            if linha is None:
+                sessao.add(WatchlistPlaca(placa=placa, ativo=True, atualizado_em=agora, **campos))
+            else:
+                linha.categoria = campos["categoria"]
+                linha.descricao = campos["descricao"]
+                linha.prioridade = campos["prioridade"]
+                linha.ativo = True
+                linha.atualizado_em = agora
+        sessao.commit()
+        return len(normalizados)
+
+    def remover(self, sessao, placa):
+        linha = sessao.query(WatchlistPlaca).filter(WatchlistPlaca.placa == normalizar_placa(placa)).first()
+        if linha is None or not linha.ativo:
+            return False
+        linha.ativo = False
+        linha.atualizado_em = datetime.utcnow()
+        sessao.commit()
+        return True
+
+    def estado(self):
+        return {
+            "total_indexado": len(self.indice),
+            "carregado_em": self.carregado_em.isoformat() if self.carregado_em else None,
+            "distancia_edicao": self.aproximada,
+        }
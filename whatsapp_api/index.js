@@ -304,7 +304,58 @@ app.get('/api/status', async (req, res) => {
     }
 });
 
-const sendMessageWithTimeout = async (chatId, message, file, timeout = 20000) => {
+// Mídias enviadas uma vez por /api/media e referenciadas por mediaId em
+// /api/send, para todos os destinatários e novas tentativas.
+const mediaTtlMs = (parseInt(process.env.WHATSAPP_MEDIA_TTL_MINUTOS, 10) || 30) * 60 * 1000;
+const mediaMaximo = 500;
+const mediaCache = new Map();
+
+const mediaDoArquivo = (file) => new MessageMedia(
+    file.mimetype || 'image/jpeg',
+    file.data.toString('base64'),
+    file.name
+);
+
+const obterMedia = (mediaId) => {
+    const entrada = mediaCache.get(mediaId);
+    if (!entrada) return null;
+    if (Date.now() - entrada.criadoEm > mediaTtlMs) {
+        mediaCache.delete(mediaId);
+        return null;
+    }
+    return entrada.media;
+};
+
+setInterval(() => {
+    const limite = Date.now() - mediaTtlMs;
+    for (const [mediaId, entrada] of mediaCache) {
+        if (entrada.criadoEm < limite) mediaCache.delete(mediaId);
+    }
+}, 60 * 1000).unref();
+
+app.post('/api/media', (req, res) => {
+    const file = req.files ? req.files.file : null;
+    const mediaId = (req.body.mediaId || '').trim();
+    if (!file || !mediaId) {
+        return res.status(400).json({ status: 'error', message: 'Informe file e mediaId.' });
+    }
+
+    mediaCache.delete(mediaId);
+    mediaCache.set(mediaId, { media: mediaDoArquivo(file), criadoEm: Date.now() });
+    while (mediaCache.size > mediaMaximo) {
+        mediaCache.delete(mediaCache.keys().next().value);
+    }
+    res.status(200).json({ status: 'success', mediaId });
+});
+
+app.get('/api/media/:mediaId', (req, res) => {
+    if (obterMedia(req.params.mediaId)) {
+        return res.status(200).json({ status: 'success', mediaId: req.params.mediaId });
+    }
+    res.status(404).json({ status: 'error', code: 'media_not_found', message: 'Mídia não encontrada.' });
+});
+
+const sendMessageWithTimeout = async (chatId, message, media, timeout = 20000) => {
     return new Promise(async (resolve, reject) => {
         const timeoutId = setTimeout(() => {
             reject(new Error('Timeout ao enviar mensagem.'));
@@ -334,15 +385,9 @@ const sendMessageWithTimeout = async (chatId, message, file, timeout = 20000) =>
                     console.log(`PDF com a mensagem enviado para ${chatId}`);
                 } else {
                     // Caso não haja imagem ou PDF, apenas envia a mensagem de texto
-                    if (file) {
-                        const filePath = path.join('/tmp', file.name);
-                        await file.mv(filePath);
-                        const media = MessageMedia.fromFilePath(filePath);
+                    if (media) {
                         await client.sendMessage(chatId, media, { caption: message });
                         console.log(`Mensagem com anexo enviada para ${chatId}`);
-                        fs.unlink(filePath, (err) => {
-                            if (err) console.error(`Erro ao remover o arquivo: ${filePath}`, err);
-                        });
                     } else {
                         await client.sendMessage(chatId, message);
                         console.log(`Mensagem enviada para ${chatId}`);
@@ -361,6 +406,9 @@ const sendMessageWithTimeout = async (chatId, message, file, timeout = 20000) =>
 };
 
 const delay = ms => new Promise(resolve => setTimeout(resolve, ms));
+// Intervalo entre destinatários de uma mesma requisição. O webhook já envia
+// um destinatário por requisição, com limite de taxa próprio.
+const intervaloEnvioMs = Math.max(0, parseInt(process.env.WHATSAPP_INTERVALO_ENVIO_MS, 10) || 5000);
 
 app.post('/api/send', async (req, res) => {
     try {
@@ -377,18 +425,33 @@ app.post('/api/send', async (req, res) => {
             return res.status(500).json({ status: 'error', message: 'Cliente não está conectado ao WhatsApp. Por favor, aguarde.' });
         }
 
-        const { recipients, message } = req.body;
+        const { recipients, message, mediaId } = req.body;
         const recipientList = recipients.split(',');
         const file = req.files ? req.files.file : null;
 
+        let media = null;
+        if (mediaId) {
+            media = obterMedia(mediaId);
+            if (!media) {
+                return res.status(404).json({ status: 'error', code: 'media_not_found', message: 'Mídia não encontrada.' });
+            }
+        } else if (file) {
+            // Lida uma vez da memória e reaproveitada para todos os destinatários.
+            media = mediaDoArquivo(file);
+        }
+
         console.log('Destinatários:', recipientList);
         console.log('Mensagem:', message);
 
         const chats = await client.getChats();
         const erros_envio = [];
 
-        for (const recipient of recipientList) {
+        for (const [indice, recipient] of recipientList.entries()) {
             const recipientTrimmed = recipient.trim();
+            if (indice > 0) {
+                // Intervalo entre os envios para evitar bloqueio
+                await delay(intervaloEnvioMs);
+            }
 
             // Verifica se o destinatário é um número de celular
             if (/^\+?\d+$/.test(recipientTrimmed)) {
@@ -400,22 +463,19 @@ app.post('/api/send', async (req, res) => {
                 }
 
                 const chatId = number + "@c.us";
-                await sendMessageWithTimeout(chatId, message, file);
+                await sendMessageWithTimeout(chatId, message, media);
 
             } else {
                 // Envia para grupos usando o nome exato do grupo
                 const group = chats.find(chat => chat.isGroup && chat.name === recipientTrimmed);
                 if (group) {
-                    await sendMessageWithTimeout(group.id._serialized, message, file);
+                    await sendMessageWithTimeout(group.id._serialized, message, media);
                 } else {
                     const mensagemErro = `Grupo "${recipientTrimmed}" não encontrado.`;
                     console.error(`ERRO DESTINO: ${mensagemErro}`);
                     erros_envio.push(mensagemErro);
                 }
             }
-
-            // Delay de 5 segundos entre os envios para evitar bloqueio
-            await delay(5000); // Delay de 5 segundos (pode ajustar conforme necessário)
         }
 
         if (erros_envio.length > 0) {
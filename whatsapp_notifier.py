@@ -1,13 +1,30 @@
-﻿import logging
+﻿import asyncio
+import mimetypes
 import os
 import threading
 import time
+from collections import OrderedDict
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from lpr_logging import configurar_logger
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+def _ler_env_inteiro(chave, padrao, minimo=0):
+    try:
+        return max(minimo, int(os.getenv(chave, str(padrao)).strip()))
+    except ValueError:
+        return padrao
 
 
 class NotificadorWhatsApp:
-    def __init__(self, url_api=None, destinatarios=None):
+    def __init__(self, url_api=None, destinatarios=None, eh_lider=None, armazenamento=None, resolver_imagem=None):
         if url_api is None:
             porta_env = os.getenv("API_WHATSAPP_PORT", "").strip()
             if not porta_env:
@@ -23,36 +40,34 @@ class NotificadorWhatsApp:
         self.url_api = url_api
         self.destinatarios = destinatarios or ""
         self.url_base = url_api.replace("/api/send", "")
+        self.url_media = f"{self.url_base}/api/media"
         self.intervalo_alerta = 30
         self.ultimo_alerta = 0
-
-        self.logger = logging.getLogger("WHATSAPP")
-        self.logger.setLevel(logging.INFO)
-        formatador = logging.Formatter(
-            "%(asctime)s | %(levelname)s | %(name)s | %(message)s",
-            datefmt="%Y-%m-%d %H:%M:%S",
-        )
-
-        if not any(isinstance(h, logging.StreamHandler) for h in self.logger.handlers):
-            handler_console = logging.StreamHandler()
-            handler_console.setFormatter(formatador)
-            self.logger.addHandler(handler_console)
-
-        diretorio_base = os.path.dirname(os.path.abspath(__file__))
-        diretorio_logs = os.path.join(diretorio_base, "logs")
-        os.makedirs(diretorio_logs, exist_ok=True)
-        arquivo_erros = os.path.join(diretorio_logs, "erros.log")
-        if not any(
-            isinstance(h, logging.FileHandler)
-            and getattr(h, "baseFilename", "") == os.path.abspath(arquivo_erros)
-            for h in self.logger.handlers
-        ):
-            handler_erro = logging.FileHandler(arquivo_erros, encoding="utf-8")
-            handler_erro.setLevel(logging.ERROR)
-            handler_erro.setFormatter(formatador)
-            self.logger.addHandler(handler_erro)
-
-        self.logger.propagate = False
+        self._cliente_async = None
+        self.eh_lider = eh_lider
+        self.armazenamento = armazenamento
+        # Devolve o caminho vigente de uma captura que mudou de arquivo
+        # (recompressão) enquanto a mensagem esperava na fila.
+        self.resolver_imagem = resolver_imagem
+
+        # Uma sessão com keep-alive para toda a vida do notificador; o pool
+        # bloqueia acima de WHATSAPP_CONEXOES_MAXIMAS conexões simultâneas.
+        self.conexoes_maximas = _ler_env_inteiro("WHATSAPP_CONEXOES_MAXIMAS", 4, minimo=1)
+        self.timeout_conexao = _ler_env_inteiro("WHATSAPP_TIMEOUT_CONEXAO", 3, minimo=1)
+        self.timeout_leitura = _ler_env_inteiro("WHATSAPP_TIMEOUT_LEITURA", 45, minimo=1)
+        self._sessao = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=self.conexoes_maximas, pool_block=True)
+        self._sessao.mount("http://", adaptador)
+        self._sessao.mount("https://", adaptador)
+
+        # Mídias já enviadas à API (id -> instante do envio). A API guarda a
+        # mídia por WHATSAPP_MEDIA_TTL_MINUTOS; aqui expira um pouco antes.
+        self.media_ttl = max(60, _ler_env_inteiro("WHATSAPP_MEDIA_TTL_MINUTOS", 30, minimo=1) * 60 - 60)
+        self._medias = OrderedDict()
+        self._lock_medias = threading.Lock()
+        self._suporta_media = True
+
+        self.logger = configurar_logger("WHATSAPP")
         self._iniciar_thread_alerta()
 
     def _iniciar_thread_alerta(self):
@@ -60,6 +75,8 @@ class NotificadorWhatsApp:
             time.sleep(30)
             while True:
                 time.sleep(self.intervalo_alerta)
+                if self.eh_lider is not None and not self.eh_lider():
+                    continue
                 if not self._verificar_status():
                     now = time.time()
                     if now - self.ultimo_alerta >= self.intervalo_alerta:
@@ -89,7 +106,7 @@ class NotificadorWhatsApp:
     def _verificar_status(self):
         try:
             url_status = f"{self.url_base}/api/status"
-            resposta = requests.get(url_status, timeout=5)
+            resposta = self._sessao.get(url_status, timeout=(self.timeout_conexao, 5))
             if resposta.status_code == 200:
                 resultado = resposta.json()
                 return resultado.get("status") == "connected"
@@ -99,8 +116,111 @@ class NotificadorWhatsApp:
             self.logger.error(f"Falha ao consultar status WhatsApp: {erro}")
             return False
 
+    def _carregar_imagem(self, caminho_imagem):
+        # caminho_imagem é a chave da captura no backend de armazenamento
+        # (local ou S3); caminhos absolutos continuam sendo lidos do disco.
+        if not caminho_imagem:
+            return None
+        imagem = self._ler_imagem(caminho_imagem)
+        if imagem is None and self.resolver_imagem is not None and not os.path.isabs(caminho_imagem):
+            try:
+                atual = self.resolver_imagem(caminho_imagem)
+            except Exception as erro:
+                self.logger.warning(f"Falha ao localizar imagem {caminho_imagem}: {erro}")
+                atual = None
+            if atual and atual != caminho_imagem:
+                imagem = self._ler_imagem(atual)
+        if imagem is None:
+            self.logger.warning(f"Imagem não encontrada: {caminho_imagem}")
+        return imagem
+
+    def _ler_imagem(self, caminho_imagem):
+        try:
+            if self.armazenamento is not None and not os.path.isabs(caminho_imagem):
+                conteudo = self.armazenamento.ler(caminho_imagem)
+            elif os.path.exists(caminho_imagem):
+                with open(caminho_imagem, "rb") as arquivo:
+                    conteudo = arquivo.read()
+            else:
+                conteudo = None
+        except Exception as erro:
+            self.logger.warning(f"Falha ao ler imagem {caminho_imagem}: {erro}")
+            return None
+        if conteudo is None:
+            return None
+        tipo = mimetypes.guess_type(caminho_imagem)[0] or "image/jpeg"
+        return os.path.basename(caminho_imagem), conteudo, tipo
+
+    @staticmethod
+    def _id_media(caminho_imagem):
+        # Capturas têm o sha256 no nome e colagens um uuid: o nome do arquivo
+        # já identifica o conteúdo.
+        return os.path.splitext(os.path.basename(caminho_imagem))[0]
+
+    def _media_conhecida(self, media_id):
+        with self._lock_medias:
+            enviada_em = self._medias.get(media_id)
+            if enviada_em is None:
+                return False
+            if time.monotonic() - enviada_em > self.media_ttl:
+                del self._medias[media_id]
+                return False
+            self._medias.move_to_end(media_id)
+            return True
+
+    def _registrar_media(self, media_id):
+        with self._lock_medias:
+            self._medias[media_id] = time.monotonic()
+            self._medias.move_to_end(media_id)
+            while len(self._medias) > 1000:
+                self._medias.popitem(last=False)
+
+    def _esquecer_media(self, media_id):
+        with self._lock_medias:
+            self._medias.pop(media_id, None)
+
+    def _interpretar_envio_media(self, resposta, media_id, imagem):
+        if resposta.status_code == 200:
+            self._registrar_media(media_id)
+            return media_id, None
+        if resposta.status_code == 404:
+            # API antiga, sem /api/media: volta ao upload a cada mensagem.
+            self._suporta_media = False
+            self.logger.warning("API WhatsApp sem /api/media; enviando a imagem em cada mensagem")
+        else:
+            self.logger.warning(f"Falha ao enviar mídia: HTTP {resposta.status_code}")
+        return None, imagem
+
+    def _preparar_media(self, caminho_imagem):
+        # Devolve (media_id, None) quando a mídia já está na API, ou
+        # (None, imagem) para enviar o arquivo junto com a mensagem.
+        if not caminho_imagem:
+            return None, None
+        media_id = self._id_media(caminho_imagem)
+        if self._suporta_media and self._media_conhecida(media_id):
+            return media_id, None
+
+        imagem = self._carregar_imagem(caminho_imagem)
+        if imagem is None or not self._suporta_media:
+            return None, imagem
+        resposta = self._sessao.post(
+            self.url_media,
+            data={"mediaId": media_id},
+            files={"file": imagem},
+            timeout=(self.timeout_conexao, self.timeout_leitura),
+        )
+        return self._interpretar_envio_media(resposta, media_id, imagem)
+
+    @staticmethod
+    def _media_expirada(resposta):
+        if resposta.status_code != 404:
+            return False
+        try:
+            return resposta.json().get("code") == "media_not_found"
+        except ValueError:
+            return False
+
     def _enviar_requisicao(self, mensagem, caminho_imagem=None, destinatarios=None):
-        arquivo_obj = None
         try:
             if not mensagem or not isinstance(mensagem, str) or not mensagem.strip():
                 self.logger.error("Mensagem vazia ou inválida - envio abortado")
@@ -112,57 +232,148 @@ class NotificadorWhatsApp:
                 return False
 
             destinatarios_utilizados = destinatarios if destinatarios is not None else self.destinatarios
-            dados = {"recipients": destinatarios_utilizados, "message": mensagem}
-            arquivos = None
-
-            if caminho_imagem and os.path.exists(caminho_imagem):
-                arquivo_obj = open(caminho_imagem, "rb")
-                arquivos = {"file": (os.path.basename(caminho_imagem), arquivo_obj, "image/jpeg")}
+            for tentativa in range(2):
+                dados = {"recipients": destinatarios_utilizados, "message": mensagem}
+                media_id, imagem = self._preparar_media(caminho_imagem)
+                if media_id:
+                    dados["mediaId"] = media_id
+                arquivos = {"file": imagem} if imagem else None
+
+                resposta = self._sessao.post(
+                    self.url_api,
+                    data=dados,
+                    files=arquivos,
+                    timeout=(self.timeout_conexao, self.timeout_leitura),
+                )
+                if media_id and tentativa == 0 and self._media_expirada(resposta):
+                    # A API reiniciou ou descartou a mídia: envia de novo.
+                    self._esquecer_media(media_id)
+                    continue
+                return self._interpretar_resposta_envio(resposta)
+            return False
 
-            resposta = requests.post(self.url_api, data=dados, files=arquivos, timeout=45)
+        except requests.exceptions.Timeout:
+            self.logger.warning("Timeout ao enviar mensagem WhatsApp")
+            if caminho_imagem:
+                self.logger.warning("Tentando novamente sem imagem...")
+                return self._enviar_requisicao(mensagem, None, destinatarios)
+            return False
 
-            if resposta.status_code == 200:
-                try:
-                    resultado = resposta.json()
-                except ValueError:
-                    resultado = {}
-                return resultado.get("status") == "success"
+        except requests.exceptions.RequestException as erro:
+            self.logger.error(f"Erro de requisição WhatsApp: {erro}")
+            return False
 
+    def _interpretar_resposta_envio(self, resposta):
+        if resposta.status_code == 200:
             try:
-                dados_erro = resposta.json()
+                resultado = resposta.json()
             except ValueError:
-                dados_erro = None
+                resultado = {}
+            return resultado.get("status") == "success"
 
-            preview_resposta = resposta.text.strip()[:500] if hasattr(resposta, "text") else "Sem corpo"
-            self.logger.error(
-                f"Falha na API WhatsApp: HTTP {resposta.status_code} | Corpo={preview_resposta}"
-            )
+        try:
+            dados_erro = resposta.json()
+        except ValueError:
+            dados_erro = None
+
+        preview_resposta = resposta.text.strip()[:500] if hasattr(resposta, "text") else "Sem corpo"
+        self.logger.error(
+            f"Falha na API WhatsApp: HTTP {resposta.status_code} | Corpo={preview_resposta}"
+        )
 
-            if isinstance(dados_erro, dict):
-                mensagem_erro = dados_erro.get("message") or dados_erro.get("erro")
-                if mensagem_erro:
-                    self.logger.error(f"Detalhes da falha: {mensagem_erro}")
-                erros_lista = dados_erro.get("erros")
-                if isinstance(erros_lista, list):
-                    for erro_item in erros_lista:
-                        self.logger.error(f"Destino não encontrado: {erro_item}")
+        if isinstance(dados_erro, dict):
+            mensagem_erro = dados_erro.get("message") or dados_erro.get("erro")
+            if mensagem_erro:
+                self.logger.error(f"Detalhes da falha: {mensagem_erro}")
+            erros_lista = dados_erro.get("erros")
+            if isinstance(erros_lista, list):
+                for erro_item in erros_lista:
+                    self.logger.error(f"Destino não encontrado: {erro_item}")
 
+        return False
+
+    async def _verificar_status_async(self, cliente):
+        try:
+            resposta = await cliente.get(f"{self.url_base}/api/status", timeout=httpx.Timeout(5, connect=self.timeout_conexao))
+            if resposta.status_code == 200:
+                return resposta.json().get("status") == "connected"
+            self.logger.warning(f"Status endpoint retornou HTTP {resposta.status_code}")
+            return False
+        except Exception as erro:
+            self.logger.error(f"Falha ao consultar status WhatsApp: {erro}")
             return False
 
-        except requests.exceptions.Timeout:
+    async def _preparar_media_async(self, cliente, caminho_imagem):
+        if not caminho_imagem:
+            return None, None
+        media_id = self._id_media(caminho_imagem)
+        if self._suporta_media and self._media_conhecida(media_id):
+            return media_id, None
+
+        imagem = await asyncio.to_thread(self._carregar_imagem, caminho_imagem)
+        if imagem is None or not self._suporta_media:
+            return None, imagem
+        resposta = await cliente.post(self.url_media, data={"mediaId": media_id}, files={"file": imagem})
+        return self._interpretar_envio_media(resposta, media_id, imagem)
+
+    async def _enviar_requisicao_async(self, cliente, mensagem, caminho_imagem=None, destinatarios=None):
+        destinatarios_utilizados = destinatarios if destinatarios is not None else self.destinatarios
+
+        try:
+            for tentativa in range(2):
+                dados = {"recipients": destinatarios_utilizados, "message": mensagem}
+                media_id, imagem = await self._preparar_media_async(cliente, caminho_imagem)
+                if media_id:
+                    dados["mediaId"] = media_id
+                arquivos = {"file": imagem} if imagem else None
+
+                resposta = await cliente.post(self.url_api, data=dados, files=arquivos)
+                if media_id and tentativa == 0 and self._media_expirada(resposta):
+                    self._esquecer_media(media_id)
+                    continue
+                return self._interpretar_resposta_envio(resposta)
+            return False
+        except httpx.TimeoutException:
             self.logger.warning("Timeout ao enviar mensagem WhatsApp")
             if caminho_imagem:
                 self.logger.warning("Tentando novamente sem imagem...")
-                return self._enviar_requisicao(mensagem, None, destinatarios)
+                return await self._enviar_requisicao_async(cliente, mensagem, None, destinatarios)
             return False
-
-        except requests.exceptions.RequestException as erro:
+        except httpx.HTTPError as erro:
             self.logger.error(f"Erro de requisição WhatsApp: {erro}")
             return False
 
-        finally:
-            if arquivo_obj:
-                arquivo_obj.close()
+    async def enviar_mensagem_async(self, mensagem, destinatarios=None, caminho_imagem=None):
+        if httpx is None:
+            return await asyncio.to_thread(self.enviar_mensagem, mensagem, destinatarios, caminho_imagem)
+
+        if not mensagem or not isinstance(mensagem, str) or not mensagem.strip():
+            self.logger.error("Mensagem vazia ou inválida - envio abortado")
+            return "Mensagem não enviada - mensagem vazia ou inválida."
+
+        if not self.tem_destinatarios(destinatarios):
+            self.logger.error("Envio abortado - destinatários não configurados")
+            return "Mensagem não enviada - destinatários não configurados."
+
+        if self._cliente_async is None:
+            self._cliente_async = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.conexoes_maximas,
+                    max_keepalive_connections=self.conexoes_maximas,
+                ),
+                timeout=httpx.Timeout(self.timeout_leitura, connect=self.timeout_conexao),
+            )
+
+        if not await self._verificar_status_async(self._cliente_async):
+            self.logger.warning("Envio abortado - WhatsApp não conectado")
+            return f"Mensagem não enviada - WhatsApp não conectado. Para conectar acesse {self.url_base}"
+
+        sucesso = await self._enviar_requisicao_async(self._cliente_async, mensagem, caminho_imagem, destinatarios)
+        if sucesso:
+            return "Mensagem enviada com sucesso."
+
+        self.logger.error("Falha ao enviar mensagem")
+        return "Mensagem não enviada - erro ao enviar."
 
     @staticmethod
     def _traduzir_cor_veiculo(cor):